@@ -54,7 +54,7 @@ import wx
 
 class TimelapsePlugin(Plugin):
     name = "Timelapse"
-    __version__ = "2.1"
+    __version__ = "2.2"
     __author__ = u"Éric Piel"
     __license__ = "Public domain"
 
@@ -105,9 +105,10 @@ class TimelapsePlugin(Plugin):
         self._dlg = None
         self.addMenu("Acquisition/Timelapse...\tCtrl+T", self.start)
 
-        self._to_store = queue.Queue()  # queue of tuples (str, [DataArray]) for saving data
+        self._to_store = queue.Queue()  # queue of tuples (callable, args) for saving data
         self._sthreads = []  # the saving threads
         self._exporter = None  # dataio exporter to use
+        self._writer = None  # stack writer, if all the acquisitions are stored in one file
 
     def _get_new_filename(self):
         conf = get_acqui_conf()
@@ -280,12 +281,12 @@ class TimelapsePlugin(Plugin):
     def _saving_thread(self, i):
         try:
             while True:
-                fn, das = self._to_store.get()
-                if fn is None:
+                save, args = self._to_store.get()
+                if save is None:
                     self._to_store.task_done()
                     return
-                logging.info("Saving data %s in thread %d", fn, i)
-                self._exporter.export(fn, das)
+                logging.info("Saving data in thread %d", i)
+                save(*args)
                 self._to_store.task_done()
         except Exception:
             logging.exception("Failure in the saving thread")
@@ -324,7 +325,18 @@ class TimelapsePlugin(Plugin):
         """
         Queue the requested DataArrays to be stored in the given file
         """
-        self._to_store.put((fn, das))
+        self._to_store.put((self._exporter.export, (fn, das)))
+
+    def _save_frame(self, fn, das):
+        """
+        Queue the DataArrays of one acquisition of the timelapse to be stored.
+        If all the acquisitions are stored in one file, they are appended to it,
+        otherwise they are stored in the given file.
+        """
+        if self._writer:
+            self._to_store.put((self._writer.append, (das,)))
+        else:
+            self._save_data(fn, das)
 
     def acquire(self, dlg):
         main_data = self.main_app.main_data
@@ -332,7 +344,16 @@ class TimelapsePlugin(Plugin):
         stream_paused = str_ctrl.pauseStreams()
         dlg.pauseSettings()
 
-        self._start_saving_threads(4)
+        fn = self.filename.value
+        self._exporter = dataio.find_fittest_converter(fn)
+        if hasattr(self._exporter, "open_stack"):
+            # All the acquisitions are stored as a T stack in a single file.
+            # As they must be appended in order, only one thread can save them.
+            self._writer = self._exporter.open_stack(fn, "T")
+            self._start_saving_threads(1)
+        else:
+            self._writer = None
+            self._start_saving_threads(4)
 
         ss, last_ss = self._get_acq_streams()
         sacqt = acqmng.estimateTime(ss)
@@ -353,6 +374,9 @@ class TimelapsePlugin(Plugin):
         finally:
             # Make sure the threads are stopped even in case of error
             self._stop_saving_threads()
+            if self._writer:
+                self._writer.close()
+                self._writer = None
 
         # self.showAcquisition(self.filename.value)
 
@@ -373,7 +397,6 @@ class TimelapsePlugin(Plugin):
         nb = self.numberOfAcquisitions.value
 
         fn = self.filename.value
-        self._exporter = dataio.find_fittest_converter(fn)
         bs, ext = splitext(fn)
         fn_pat = bs + "-%.5d" + ext
 
@@ -441,7 +464,7 @@ class TimelapsePlugin(Plugin):
                 logging.debug("Skipping extra data")
                 return
 
-            self._save_data(fn_pat % (i,), [st.raw[0]])
+            self._save_frame(fn_pat % (i,), [st.raw[0]])
 
             # Update progress bar
             left = nb - i
@@ -462,7 +485,6 @@ class TimelapsePlugin(Plugin):
         nb = self.numberOfAcquisitions.value
 
         fn = self.filename.value
-        self._exporter = dataio.find_fittest_converter(fn)
         bs, ext = splitext(fn)
         fn_pat = bs + "-%.5d" + ext
 
@@ -495,7 +517,11 @@ class TimelapsePlugin(Plugin):
                 dlg.resumeSettings()
                 return
 
-            self._save_data(fn_pat % (i,), das)
+            if left == 1 and last_ss and self._writer:
+                # Different streams than the other acquisitions => separate file
+                self._save_data(fn_pat % (i,), das)
+            else:
+                self._save_frame(fn_pat % (i,), das)
 
             # Wait the period requested, excepted the last time
             if left > 1:
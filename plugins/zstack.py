@@ -45,7 +45,7 @@ import wx
 
 class ZStackPlugin(Plugin):
     name = "Z Stack"
-    __version__ = "1.3"
+    __version__ = "1.4"
     __author__ = u"Anders Muskens"
     __license__ = "GPLv2"
 
@@ -281,16 +281,13 @@ class ZStackPlugin(Plugin):
         if dlg:  # If dlg hasn't been destroyed yet
             dlg.Destroy()
 
-    def constructCube(self, images):
-        # images is a list of 3 dim data arrays.
-        ret = []
-        for image in images:
-            stack = numpy.dstack(image)
-            stack = numpy.swapaxes(stack, 1, 2)
-            ret.append(stack[0])
-
-        # Add back metadata
-        metadata3d = copy.copy(images[0].metadata)
+    def _getCubeMetadata(self, md):
+        """
+        Computes the metadata of a Z stack, based on the metadata of its first image
+        md (dict): metadata of the first image
+        return (dict): metadata for the 3D data
+        """
+        metadata3d = copy.copy(md)
         # Extend pixel size to 3D
         ps_x, ps_y = metadata3d[model.MD_PIXEL_SIZE]
         ps_z = self.zstep.value
@@ -300,17 +297,24 @@ class ZStackPlugin(Plugin):
         c_z = self.zstart.value + (self.zstep.value * self.numberofAcquisitions.value) / 2
         metadata3d[model.MD_POS] = (c_x, c_y, c_z)
 
-        # For a negative pixel size, convert to a positive and flip the z axis
-        if ps_z < 0:
-            ret = numpy.flipud(ret)
-            ps_z = -ps_z
-
+        # For a negative pixel size, the z axis is flipped to be positive
         metadata3d[model.MD_PIXEL_SIZE] = (ps_x, ps_y, abs(ps_z))
         metadata3d[model.MD_DIMS] = "ZYX"
+        return metadata3d
 
-        ret = DataArray(ret, metadata3d)
+    def constructCube(self, images):
+        # images is a list of 2 dim data arrays.
+        # Copy each image directly at its place in the cube
+        ret = numpy.empty((len(images),) + images[0].shape, dtype=images[0].dtype)
+        for i, image in enumerate(images):
+            ret[i] = image
 
-        return ret
+        # For a negative pixel size, flip the z axis
+        if self.zstep.value < 0:
+            ret = ret[::-1]
+
+        # Add back metadata
+        return DataArray(ret, self._getCubeMetadata(images[0].metadata))
 
     """
     The acquire function API is generic.
@@ -378,6 +382,7 @@ class ZStackPlugin(Plugin):
         sacqt = acqmng.estimateTime(ss)
         
         completed = False
+        writer = None
 
         try:
             step_time = self.initAcquisition()
@@ -389,9 +394,17 @@ class ZStackPlugin(Plugin):
             f.set_running_or_notify_cancel()  # Indicate the work is starting now
             dlg.showProgress(f)
 
+            # If the format supports it, each acquisition is directly written
+            # into the file, instead of being kept in memory.
+            fn = self.filename.value
+            exporter = dataio.find_fittest_converter(fn)
+            if hasattr(exporter, "open_stack"):
+                writer = exporter.open_stack(fn, "Z")
             # list of list of DataArray: for each stream, for each acquisition, the data acquired
             images = None
-        
+            # list of dict: for each stream, the metadata of the first acquisition
+            mds = None
+
             for i in range(nb):
                 left = nb - i
                 dur = sacqt * left + step_time * (left - 1)
@@ -401,37 +414,58 @@ class ZStackPlugin(Plugin):
                 startt = time.time()
                 f.set_progress(end=startt + dur)
                 das, e = acqmng.acquire(ss, self.main_app.main_data.settings_obs).result()
-                if images is None:
+                if f.cancelled():
+                    raise CancelledError()
+
+                if mds is None:
                     # Copy metadata from the first acquisition
+                    mds = [da.metadata for da in das]
                     images = [[] for i in range(len(das))]
 
-                for im, da in zip(images, das):
-                    im.append(da)
-
-                if f.cancelled():
-                    raise CancelledError()
+                if writer:
+                    writer.append(das)
+                else:
+                    for im, da in zip(images, das):
+                        im.append(da)
 
                 # Execute an action to prepare the next acquisition for the ith acquisition
                 self.stepAcquisition(i, images)
 
             f.set_result(None)  # Indicate it's over
-            
-            # Construct a cube from each stream's image.
-            images = self.postProcessing(images)
 
-            # Export image
-            exporter = dataio.find_fittest_converter(self.filename.value)
-            exporter.export(self.filename.value, images)
+            if writer:
+                writer.close(md=[self._getCubeMetadata(md) for md in mds],
+                             reverse=(self.zstep.value < 0))
+            else:
+                # Construct a cube from each stream's image.
+                images = self.postProcessing(images)
+
+                # Export image
+                exporter.export(fn, images)
             completed = True
             dlg.Close()
-            
+
         except CancelledError:
             logging.debug("Acquisition cancelled.")
+            if writer:
+                # Don't leave a partial file
+                writer.close()
+                try:
+                    os.remove(fn)
+                except OSError:
+                    logging.warning("Failed to delete partial file %s", fn)
             dlg.resumeSettings()
 
-        except e:
-            logging.exception(e)
+        except Exception:
+            logging.exception("Acquisition failed.")
 
         finally:
+            if writer:
+                # If the acquisition failed, keep the planes already acquired.
+                # (Does nothing if already closed)
+                try:
+                    writer.close()
+                except Exception:
+                    logging.exception("Failed to close file %s", fn)
             # Do completion actions
             self.completeAcquisition(completed)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+
+# This script measures the throughput of the whole data path, from the drivers
+# to the DataFlows, the streams, the projections and the export, and saves the
+# results in a JSON report. It is typically run on a simulated microscope, and
+# the report compared to the one of a previous version, to detect regressions.
+
+# Example usage:
+# ./scripts/benchmark.py --config install/linux/usr/share/odemis/sim/sparc2-sim.odm.yaml --high-rate --output report.json
+# ./scripts/benchmark.py --output new.json --baseline report.json
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import logging
+from odemis import model, dataio
+from odemis.acq import stream
+from odemis.odemisd import modelgen
+from odemis.util import benchmark, test
+import os
+import platform
+import sys
+import tempfile
+import yaml
+
+
+# Roles of the detectors measured directly via their DataFlow
+DETECTOR_ROLES = ("ccd", "sp-ccd", "se-detector", "bs-detector", "cl-detector",
+                  "spectrometer", "streak-ccd")
+
+# Classes of the simulators which accept a "high_rate" initialisation argument
+HIGH_RATE_CLASSES = ("simcam.Camera", "simsem.SimSEM")
+
+
+def get_component(role):
+    """
+    return (Component or None): the component with the given role, or None if
+      not available.
+    """
+    try:
+        return model.getComponent(role=role)
+    except LookupError:
+        return None
+
+
+def make_high_rate_config(config):
+    """
+    Create a copy of a microscope file, with the simulators which support it
+    started in high-rate mode
+    config (str): path to the microscope file
+    return (str): path to the new microscope file. It's a temporary file, which
+      should be deleted by the caller.
+    """
+    with open(config) as f:
+        inst = yaml.load(f, modelgen.SafeLoader)
+
+    for name, attrs in inst.items():
+        cls = attrs.get("class", "")
+        if ".".join(cls.split(".")[-2:]) in HIGH_RATE_CLASSES:
+            init = attrs.setdefault("init", {})
+            init["high_rate"] = True
+            logging.info("Starting %s in high-rate mode", name)
+
+    fd, path = tempfile.mkstemp(prefix="benchmark-", suffix=".odm.yaml")
+    with os.fdopen(fd, "w") as f:
+        yaml.safe_dump(inst, f, allow_unicode=True)
+    return path
+
+
+def is_comedi_test(comp):
+    """
+    return (bool): True if the component is part of a semcomedi board simulated
+      by the comedi_test kernel driver
+    """
+    try:
+        return "comedi_test" in comp.parent.swVersion
+    except AttributeError:  # No parent
+        return False
+
+
+def set_high_rate(comps):
+    """
+    Configure the hardware to generate data as fast as possible. The simulators
+    which have a high-rate mode must also be started with it (see
+    make_high_rate_config()).
+    comps (dict role -> Component)
+    """
+    for role, comp in comps.items():
+        if model.hasVA(comp, "exposureTime"):
+            comp.exposureTime.value = comp.exposureTime.range[0]
+        if model.hasVA(comp, "dwellTime"):
+            # With semcomedi, the shortest dwell time depends on the number of
+            # detectors acquiring simultaneously. It's set for a single one,
+            # as they are measured one at a time. With comedi_test, the kernel
+            # driver generates the data at whatever rate is requested.
+            comp.dwellTime.value = comp.dwellTime.range[0]
+            if is_comedi_test(comp):
+                logging.info("%s is simulated by comedi_test", comp.name)
+        if model.hasVA(comp, "partialFrames"):
+            # The DataFlows are measured in frames, so send them whole
+            comp.partialFrames.value = False
+
+        # simstreakcam
+        if role == "streak-unit":
+            # In Focus mode, no time axis is computed for each frame
+            comp.streakMode.value = False
+        elif role == "streak-ccd":
+            comp.binning.value = max(comp.binning.choices)
+        logging.info("Configured %s for high rate", comp.name)
+
+
+def run_benchmarks(duration, repetition, nacq):
+    """
+    Run all the benchmarks possible with the hardware available
+    duration (float): time to measure each live data (s)
+    repetition (int, int): number of e-beam positions for the SEM+CCD acquisitions
+    nacq (int): number of acquisitions to run
+    return (dict str -> dict): the statistics of each benchmark
+    """
+    results = {}
+    ebeam = get_component("e-beam")
+    sed = get_component("se-detector")
+
+    # Raw DataFlows
+    for role in DETECTOR_ROLES:
+        det = get_component(role)
+        if det is None:
+            continue
+        logging.info("Measuring DataFlow of %s...", role)
+        results["df-" + role] = benchmark.measure_dataflow(det.data, duration)
+
+    # Live streams (DataFlow + projection)
+    ccd = get_component("ccd")
+    if ccd is not None:
+        logging.info("Measuring live camera stream...")
+        s = stream.CameraStream("ccd", ccd, ccd.data, None)
+        results["live-ccd"] = benchmark.measure_live_stream(s, duration)
+
+    if ebeam is not None and sed is not None:
+        logging.info("Measuring live SEM stream...")
+        s = stream.SEMStream("sem", sed, sed.data, ebeam)
+        results["live-sem"] = benchmark.measure_live_stream(s, duration)
+
+    # SEM + CCD acquisitions
+    data = []
+    if ebeam is not None and sed is not None:
+        for role, sst_cls, mds_cls in (("ccd", stream.ARSettingsStream, stream.SEMARMDStream),
+                                       ("spectrometer", stream.SpectrumSettingsStream, stream.SEMSpectrumMDStream)):
+            det = get_component(role)
+            if det is None:
+                continue
+            logging.info("Measuring SEM + %s acquisition...", role)
+            sems = stream.SEMStream("sem", sed, sed.data, ebeam)
+            ccds = sst_cls(role, det, det.data, ebeam)
+            ccds.repetition.value = repetition
+            mds = mds_cls("sem-" + role, [sems, ccds])
+            results["acq-sem-" + role], data = benchmark.measure_acquisition(mds, nacq)
+
+    # Export of the latest acquisition
+    if data:
+        for fmt in ("HDF5", "TIFF"):
+            try:
+                exporter = dataio.get_converter(fmt)
+            except ValueError:
+                logging.info("Skipping export to %s, as not available", fmt)
+                continue
+            logging.info("Measuring export to %s...", fmt)
+            results["export-" + fmt.lower()] = benchmark.measure_export(data, exporter, nacq)
+
+    return results
+
+
+def main(args):
+    """
+    Handles the command line arguments
+    args is the list of arguments passed
+    return (int): value to return to the OS as program exit code
+    """
+    parser = argparse.ArgumentParser(description="Measures the data throughput "
+                                     "of the (simulated) microscope")
+    parser.add_argument("--config", dest="config",
+                        help="Microscope configuration file to start the back-end with. "
+                             "If not given, the back-end already running is used.")
+    parser.add_argument("--high-rate", dest="highrate", action="store_true", default=False,
+                        help="Start the simulators in high-rate mode, and set the "
+                             "detectors to generate data as fast as possible")
+    parser.add_argument("--duration", dest="duration", type=float, default=5,
+                        help="Time to measure each live data (s)")
+    parser.add_argument("--repetition", dest="repetition", type=int, nargs=2, default=(8, 8),
+                        help="Number of e-beam positions for the SEM+CCD acquisitions")
+    parser.add_argument("--n", dest="nacq", type=int, default=3,
+                        help="Number of acquisitions and exports to run")
+    parser.add_argument("--output", "-o", dest="output",
+                        help="JSON file to save the report to")
+    parser.add_argument("--baseline", dest="baseline",
+                        help="JSON report to compare the results to")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.2,
+                        help="Relative change allowed compared to the baseline")
+    parser.add_argument("--log-level", dest="loglev", metavar="<level>", type=int,
+                        default=1, help="set verbosity level (0-2, default = 1)")
+    options = parser.parse_args(args[1:])
+
+    loglev_names = [logging.WARNING, logging.INFO, logging.DEBUG]
+    loglev = loglev_names[min(len(loglev_names) - 1, options.loglev)]
+    logging.getLogger().setLevel(loglev)
+
+    started = False
+    hr_config = None
+    try:
+        if options.config:
+            config = options.config
+            if options.highrate:
+                hr_config = make_high_rate_config(options.config)
+                config = hr_config
+            try:
+                test.start_backend(config)
+                started = True
+            except LookupError:
+                logging.warning("A back-end is already running, it will be used instead")
+
+        comps = {c.role: c for c in model.getComponents()}
+        if options.highrate:
+            set_high_rate(comps)
+
+        monitor = benchmark.ProcessMonitor()
+        monitor.start()
+        try:
+            results = run_benchmarks(options.duration, tuple(options.repetition), options.nacq)
+        finally:
+            monitor.stop()
+
+        report = benchmark.make_report(results, monitor.get_stats(),
+                                       config=options.config,
+                                       high_rate=options.highrate,
+                                       host=platform.node(),
+                                       python=platform.python_version())
+        if options.output:
+            benchmark.write_report(report, options.output)
+            logging.info("Report saved to %s", options.output)
+        else:
+            print(json.dumps(report, indent=2, sort_keys=True))
+
+        if options.baseline:
+            baseline = benchmark.read_report(options.baseline)
+            regressions = benchmark.compare_reports(report, baseline, options.tolerance)
+            for name, vref, vnew in regressions:
+                print("Regression on %s: %g -> %g" % (name, vref, vnew))
+            if regressions:
+                return 2
+    except KeyboardInterrupt:
+        logging.info("Interrupted before the end of the execution")
+        return 1
+    except Exception:
+        logging.exception("Unexpected error while performing action.")
+        return 127
+    finally:
+        if started:
+            test.stop_backend()
+        if hr_config:
+            os.remove(hr_config)
+
+    return 0
+
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    exit(ret)
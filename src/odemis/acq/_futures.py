@@ -105,18 +105,30 @@ class SimpleStreamFuture(futures.Future):
         f = self._stream.prepare()
         f.result()
 
-        # start stream
-        self._startt = time.time()
-        self._stream.image.subscribe(self._image_listener)
-        # TODO: if exception during activation, it will not be passed here
-        # as the VA will just log it. => change _onActive to be a setter, or
-        # check also the .status VA.
-        self._stream.is_active.value = True
-
-        # wait until one image acquired or cancelled
-        if not self._acq_over.wait(10 * estt + 5):
-            raise IOError("Acquisition of stream %s timed out after %f s" %
-                          (self._stream.name.value, 10 * estt + 5))
+        # The first image must be a whole frame, so make sure the stream doesn't
+        # update it by blocks of lines.
+        partial_frames = getattr(self._stream, "partial_frames", None)
+        if partial_frames is not None and partial_frames.value:
+            partial_frames.value = False
+        else:
+            partial_frames = None
+
+        try:
+            # start stream
+            self._startt = time.time()
+            self._stream.image.subscribe(self._image_listener)
+            # TODO: if exception during activation, it will not be passed here
+            # as the VA will just log it. => change _onActive to be a setter, or
+            # check also the .status VA.
+            self._stream.is_active.value = True
+
+            # wait until one image acquired or cancelled
+            if not self._acq_over.wait(10 * estt + 5):
+                raise IOError("Acquisition of stream %s timed out after %f s" %
+                              (self._stream.name.value, 10 * estt + 5))
+        finally:
+            if partial_frames is not None:
+                partial_frames.value = True
 
         with self._condition:
             if self._state in (CANCELLED, CANCELLED_AND_NOTIFIED):
@@ -23,10 +23,11 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import collections
-from concurrent.futures import TimeoutError, CancelledError
+from concurrent.futures import TimeoutError, CancelledError, ThreadPoolExecutor
 from concurrent.futures._base import CANCELLED, FINISHED, RUNNING
 import cv2
 import logging
+import math
 import numpy
 from odemis import model
 from odemis.acq.align import light
@@ -42,10 +43,16 @@ import time
 
 MTD_BINARY = 0
 MTD_EXHAUSTIVE = 1
+MTD_PIPELINED = 2
 
 MAX_STEPS_NUMBER = 100  # Max steps to perform autofocus
 MAX_BS_NUMBER = 1  # Maximum number of applying binary search with a smaller max_step
 
+# For the pipelined method
+PIPELINED_COARSE_STEPS = 11  # Minimum number of focus positions measured over the whole range
+PIPELINED_FINE_STEPS = 5  # Number of focus positions measured at each refinement
+PIPELINED_MAX_ITERATIONS = 6  # Maximum number of refinements
+
 
 def _convertRBGToGrayscale(image):
     """
@@ -235,6 +242,59 @@ def _discard_data(df, data):
     pass
 
 
+def _getDepthOfField(detector, emt):
+    """
+    Find the depth of field of the detector or emitter
+    detector: model.DigitalCamera or model.Detector
+    emt (None or model.Emitter): In case of a SED this is the scanner used
+    return (float): the depth of field (m)
+    """
+    avail_depths = (detector, emt)
+    if model.hasVA(emt, "dwellTime"):
+        # Hack in case of using the e-beam with a DigitalCamera detector.
+        # All the digital cameras have a depthOfField, which is updated based
+        # on the optical lens properties... but the depthOfField in this
+        # case depends on the e-beam lens.
+        # TODO: or better rely on which component the focuser affects? If it
+        # affects (also) the emitter, use this one first? (but in the
+        # current models the focusers affects nothing)
+        avail_depths = (emt, detector)
+    for c in avail_depths:
+        if model.hasVA(c, "depthOfField"):
+            dof = c.depthOfField.value
+            break
+    else:
+        logging.debug("No depth of field info found")
+        dof = 1e-6  # m, not too bad value
+    logging.debug("Depth of field is %f", dof)
+    return dof
+
+
+def _getFocusMeasure(detector):
+    """
+    Pick the function to measure the focus level of the images of the detector
+    detector: model.DigitalCamera or model.Detector
+    return (callable DataArray -> float): the measurement function
+    """
+    # Pick measurement method based on the heuristics that SEM detectors
+    # are typically just a point (ie, shape == data depth).
+    # TODO: is this working as expected? Alternatively, we could check
+    # MD_DET_TYPE.
+    if len(detector.shape) > 1:
+        if detector.role == 'diagnostic-ccd':
+            logging.debug("Using Spot method to estimate focus")
+            return MeasureSpotsFocus
+        elif detector.resolution.value[1] == 1:
+            logging.debug("Using 1d method to estimate focus")
+            return Measure1d
+        else:
+            logging.debug("Using Optical method to estimate focus")
+            return MeasureOpticalFocus
+    else:
+        logging.debug("Using SEM method to estimate focus")
+        return MeasureSEMFocus
+
+
 def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
     """
     Iteratively acquires an optical image, measures its focus level and adjusts
@@ -280,24 +340,7 @@ def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
         timeout = 3 + 2 * estimateAcquisitionTime(detector, emt)
 
         # use the .depthOfField on detector or emitter as maximum stepsize
-        avail_depths = (detector, emt)
-        if model.hasVA(emt, "dwellTime"):
-            # Hack in case of using the e-beam with a DigitalCamera detector.
-            # All the digital cameras have a depthOfField, which is updated based
-            # on the optical lens properties... but the depthOfField in this
-            # case depends on the e-beam lens.
-            # TODO: or better rely on which component the focuser affects? If it
-            # affects (also) the emitter, use this one first? (but in the
-            # current models the focusers affects nothing)
-            avail_depths = (emt, detector)
-        for c in avail_depths:
-            if model.hasVA(c, "depthOfField"):
-                dof = c.depthOfField.value
-                break
-        else:
-            logging.debug("No depth of field info found")
-            dof = 1e-6  # m, not too bad value
-        logging.debug("Depth of field is %f", dof)
+        dof = _getDepthOfField(detector, emt)
         min_step = dof / 2
 
         # adjust to rng_focus if provided
@@ -319,23 +362,7 @@ def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
         best_fm = 0
         last_pos = None
 
-        # Pick measurement method based on the heuristics that SEM detectors
-        # are typically just a point (ie, shape == data depth).
-        # TODO: is this working as expected? Alternatively, we could check
-        # MD_DET_TYPE.
-        if len(detector.shape) > 1:
-            if detector.role == 'diagnostic-ccd':
-                logging.debug("Using Spot method to estimate focus")
-                Measure = MeasureSpotsFocus
-            elif detector.resolution.value[1] == 1:
-                logging.debug("Using 1d method to estimate focus")
-                Measure = Measure1d
-            else:
-                logging.debug("Using Optical method to estimate focus")
-                Measure = MeasureOpticalFocus
-        else:
-            logging.debug("Using SEM method to estimate focus")
-            Measure = MeasureSEMFocus
+        Measure = _getFocusMeasure(detector)
 
         step_factor = 2 ** 7
         if good_focus is not None:
@@ -512,40 +539,9 @@ def _DoExhaustiveFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focu
         # Big timeout, most important being that it's shorter than eternity
         timeout = 3 + 2 * estimateAcquisitionTime(detector, emt)
 
-        # use the .depthOfField on detector or emitter as maximum stepsize
-        avail_depths = (detector, emt)
-        if model.hasVA(emt, "dwellTime"):
-            # Hack in case of using the e-beam with a DigitalCamera detector.
-            # All the digital cameras have a depthOfField, which is updated based
-            # on the optical lens properties... but the depthOfField in this
-            # case depends on the e-beam lens.
-            avail_depths = (emt, detector)
-        for c in avail_depths:
-            if model.hasVA(c, "depthOfField"):
-                dof = c.depthOfField.value
-                break
-        else:
-            logging.debug("No depth of field info found")
-            dof = 1e-6  # m, not too bad value
-        logging.debug("Depth of field is %f", dof)
-
-        # Pick measurement method based on the heuristics that SEM detectors
-        # are typically just a point (ie, shape == data depth).
-        # TODO: is this working as expected? Alternatively, we could check
-        # MD_DET_TYPE.
-        if len(detector.shape) > 1:
-            if detector.role == 'diagnostic-ccd':
-                logging.debug("Using Spot method to estimate focus")
-                Measure = MeasureSpotsFocus
-            elif detector.resolution.value[1] == 1:
-                logging.debug("Using 1d method to estimate focus")
-                Measure = Measure1d
-            else:
-                logging.debug("Using Optical method to estimate focus")
-                Measure = MeasureOpticalFocus
-        else:
-            logging.debug("Using SEM method to estimate focus")
-            Measure = MeasureSEMFocus
+        dof = _getDepthOfField(detector, emt)
+
+        Measure = _getFocusMeasure(detector)
 
         # adjust to rng_focus if provided
         rng = focus.axes["z"].range
@@ -622,6 +618,193 @@ def _DoExhaustiveFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focu
             future._autofocus_state = FINISHED
 
 
+def _fitFocusPeak(positions, levels):
+    """
+    Estimate the best focus position by fitting a Gaussian (ie, a parabola on
+    the logarithm of the focus levels) on the best measurement and its neighbours.
+    positions (list of floats): focus positions, in increasing order
+    levels (list of floats): focus level at each position
+    return (float or None): the estimated best focus position, or None if the
+      peak couldn't be located within the measured positions.
+    """
+    positions = numpy.asarray(positions, dtype=float)
+    levels = numpy.asarray(levels, dtype=float)
+    ib = int(numpy.argmax(levels))
+    if ib == 0 or ib == len(levels) - 1:
+        # The peak is probably outside of the measured positions
+        return None
+
+    x = positions[max(0, ib - 2):ib + 3]
+    y = levels[max(0, ib - 2):ib + 3]
+    if numpy.all(y > 0):
+        y = numpy.log(y)
+    else:
+        logging.debug("Focus levels not all positive, fitting a parabola")
+
+    # Normalise the positions, to avoid a badly conditioned fit
+    scale = numpy.max(numpy.abs(x - positions[ib]))
+    xn = (x - positions[ib]) / scale
+    a, b, c = numpy.polyfit(xn, y, 2)
+    if a >= 0:
+        # Not a peak
+        return None
+    peak = -b / (2 * a)
+    if not xn[0] <= peak <= xn[-1]:
+        return None
+
+    return positions[ib] + peak * scale
+
+
+def _measureFocusSweep(future, positions, detector, focus, dfbkg, timeout, Measure, executor):
+    """
+    Measures the focus level at each of the given positions. The move to the
+    next position is started as soon as the image is acquired, and the focus
+    level is computed in the executor, so that moves, acquisitions and
+    measurements overlap.
+    future (model.ProgressiveFuture): Progressive future provided by the wrapper
+    positions (list of floats): focus positions to measure, in order
+    Measure (callable): function to measure the focus level of an image
+    executor (ThreadPoolExecutor): where the focus levels are computed
+    returns (list of (float, float)): position and focus level for each position
+    raises:
+            CancelledError if cancelled
+    """
+    measures = []  # list of (position, future of the focus level)
+    f = focus.moveAbs({"z": positions[0]})
+    for i, pos in enumerate(positions):
+        f.result()
+        if future._autofocus_state == CANCELLED:
+            raise CancelledError()
+        image = AcquireNoBackground(detector, dfbkg, timeout)
+        if i + 1 < len(positions):
+            f = focus.moveAbs({"z": positions[i + 1]})
+        measures.append((pos, executor.submit(Measure, image)))
+
+    return [(pos, fm.result()) for pos, fm in measures]
+
+
+def _DoPipelinedFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
+    """
+    Measures the focus level on a few positions over the whole given range, and
+    then iteratively refines the search around the peak estimated by fitting
+    the measured focus levels. During each sweep, the focus move, the
+    acquisition and the measurement of the focus level are pipelined.
+    future (model.ProgressiveFuture): Progressive future provided by the wrapper
+    detector: model.DigitalCamera or model.Detector
+    emt (None or model.Emitter): In case of a SED this is the scanner used
+    focus (model.Actuator): The optical focus
+    dfbkg (model.DataFlow): dataflow of se- or bs- detector
+    good_focus (float): if provided, an already known good focus position to be
+      taken into consideration while autofocusing
+    rng_focus (tuple): if provided, the search of the best focus position is limited
+      within this range
+    returns:
+        (float): Focus position (m)
+        (float): Focus level
+    raises:
+            CancelledError if cancelled
+            IOError if procedure failed
+    """
+    logging.debug("Starting pipelined autofocus on detector %s...", detector.name)
+
+    # Only a couple of workers, as the measurement is fast compared to the
+    # acquisition, and the point is just to not block the next move.
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        # Big timeout, most important being that it's shorter than eternity
+        timeout = 3 + 2 * estimateAcquisitionTime(detector, emt)
+
+        dof = _getDepthOfField(detector, emt)
+        min_step = dof / 2
+
+        Measure = _getFocusMeasure(detector)
+
+        # adjust to rng_focus if provided
+        rng = focus.axes["z"].range
+        if rng_focus:
+            rng = (max(rng[0], rng_focus[0]), min(rng[1], rng_focus[1]))
+
+        if good_focus:
+            focus.moveAbsSync({"z": good_focus})
+
+        best_pos = orig_pos = focus.position.value['z']
+        best_fm = None
+        measured = {}  # position -> focus level
+
+        if future._autofocus_state == CANCELLED:
+            raise CancelledError()
+
+        # Start with a coarse sweep over the whole range, from the closest end.
+        # Same as for the exhaustive method, the step shouldn't be much bigger
+        # than 8 * dof, otherwise the peak could be missed.
+        n = int(numpy.clip(math.ceil((rng[1] - rng[0]) / (8 * dof)) + 1,
+                           PIPELINED_COARSE_STEPS, MAX_STEPS_NUMBER))
+        step = (rng[1] - rng[0]) / (n - 1)
+        positions = list(numpy.linspace(rng[0], rng[1], n))
+        if abs(orig_pos - rng[1]) < abs(orig_pos - rng[0]):
+            positions.reverse()
+
+        for i in range(PIPELINED_MAX_ITERATIONS + 1):
+            for pos, fm in _measureFocusSweep(future, positions, detector, focus,
+                                              dfbkg, timeout, Measure, executor):
+                logging.debug("Focus level at %f is %f", pos, fm)
+                measured[pos] = fm
+                if best_fm is None or fm > best_fm:
+                    best_pos, best_fm = pos, fm
+
+            all_pos = sorted(measured.keys())
+            levels = [measured[p] for p in all_pos]
+            if max(levels) == min(levels):
+                logging.debug("Focus level is the same everywhere, going back to %f", orig_pos)
+                peak = orig_pos
+                break
+
+            peak = _fitFocusPeak(all_pos, levels)
+            if peak is None:
+                peak = best_pos
+            logging.debug("Focus peak estimated at %f (step = %g)", peak, step)
+
+            if step <= 4 * min_step or i == PIPELINED_MAX_ITERATIONS:
+                break
+
+            # Refine around the peak, skipping the positions already measured
+            step /= 2
+            hw = PIPELINED_FINE_STEPS // 2
+            positions = []
+            for p in numpy.clip(peak + step * numpy.arange(-hw, hw + 1), rng[0], rng[1]):
+                if all(abs(p - mp) > min_step for mp in all_pos + positions):
+                    positions.append(p)
+            if not positions:
+                break
+            # Start from the end closest to the current position
+            if abs(positions[-1] - pos) < abs(positions[0] - pos):
+                positions.reverse()
+
+        if future._autofocus_state == CANCELLED:
+            raise CancelledError()
+
+        focus.moveAbsSync({"z": peak})
+        image = AcquireNoBackground(detector, dfbkg, timeout)
+        fm = Measure(image)
+        logging.debug("Focus level at %f is %f", peak, fm)
+        if fm < best_fm:
+            logging.debug("Estimated peak is worse than the best measured position %f", best_pos)
+            focus.moveAbsSync({"z": best_pos})
+            return best_pos, best_fm
+
+        return peak, fm
+
+    except CancelledError:
+        # Go to the best position known so far
+        focus.moveAbsSync({"z": best_pos})
+    finally:
+        executor.shutdown(wait=False)
+        with future._autofocus_lock:
+            if future._autofocus_state == CANCELLED:
+                raise CancelledError()
+            future._autofocus_state = FINISHED
+
+
 def _CancelAutoFocus(future):
     """
     Canceller of AutoFocus task.
@@ -660,13 +843,24 @@ def estimateAcquisitionTime(detector, scanner=None):
 
 
 # TODO: drop steps, which is unused, or use it
-def estimateAutoFocusTime(detector, scanner=None, steps=MAX_STEPS_NUMBER):
+def estimateAutoFocusTime(detector, scanner=None, steps=None, method=MTD_BINARY):
     """
     detector (model.DigitalCamera or model.Detector): Detector on which to
       improve the focus quality
     scanner (None or model.Emitter): In case of a SED this is the scanner used
-    Estimates overlay procedure duration
+    steps (None or 0<int): maximum number of acquisitions. If None, it's
+      estimated based on the method.
+    method (MTD_*): focusing method, as passed to AutoFocus()
+    Estimates autofocus procedure duration
     """
+    if steps is None:
+        if method == MTD_PIPELINED:
+            # Coarse sweep, each refinement, and the final check at the peak.
+            # The moves happen during the acquisitions, so they don't count.
+            steps = (PIPELINED_COARSE_STEPS +
+                     PIPELINED_MAX_ITERATIONS * PIPELINED_FINE_STEPS + 1)
+        else:
+            steps = MAX_STEPS_NUMBER
     return steps * estimateAcquisitionTime(detector, scanner)
 
 
@@ -1045,7 +1239,10 @@ def AutoFocus(detector, emt, focus, dfbkg=None, good_focus=None, rng_focus=None,
     rng_focus (tuple): if provided, the search of the best focus position is limited
       within this range
     method (MTD_*): focusing method, if BINARY we follow a dichotomic method while in
-      case of EXHAUSTIVE we iterate through the whole provided range
+      case of EXHAUSTIVE we iterate through the whole provided range. In case
+      of PIPELINED, a few positions over the range are measured, and the search
+      is refined around the peak estimated by fitting, while overlapping the
+      moves with the acquisitions.
     returns (model.ProgressiveFuture):  Progress of DoAutoFocus, whose result() will return:
             Focus position (m)
             Focus level
@@ -1053,7 +1250,7 @@ def AutoFocus(detector, emt, focus, dfbkg=None, good_focus=None, rng_focus=None,
     # Create ProgressiveFuture and update its state to RUNNING
     est_start = time.time() + 0.1
     f = model.ProgressiveFuture(start=est_start,
-                                end=est_start + estimateAutoFocusTime(detector, emt))
+                                end=est_start + estimateAutoFocusTime(detector, emt, method=method))
     f._autofocus_state = RUNNING
     f._autofocus_lock = threading.Lock()
     f.task_canceller = _CancelAutoFocus
@@ -1063,6 +1260,8 @@ def AutoFocus(detector, emt, focus, dfbkg=None, good_focus=None, rng_focus=None,
         autofocus_fn = _DoExhaustiveFocus
     elif method == MTD_BINARY:
         autofocus_fn = _DoBinaryFocus
+    elif method == MTD_PIPELINED:
+        autofocus_fn = _DoPipelinedFocus
     else:
         raise ValueError("Unknown autofocus method")
 
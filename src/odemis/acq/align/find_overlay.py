@@ -44,7 +44,8 @@ from . import coordinates, transform
 
 
 # Approximate size of a (big) CL spot. If the distance between spots is smaller
-# than this, one image per spot will be taken.
+# than this, the grid is acquired as several interleaved sub-grids, or as one
+# image per spot.
 SPOT_SIZE = 1.5e-6  # m
 
 MAX_TRIALS_NUMBER = 2  # Maximum number of scan grid repetitions
@@ -168,8 +169,21 @@ def _DoFindOverlay(future, repetitions, dwell_time, max_allowed_diff, escan,
 
                 # Check if ScanGrid gave one image or list of images
                 # If it is a list, follow the "one image per spot" procedure
+                # If it is a tuple, each image contains a sub-grid of spots
                 logging.debug("Isolating spots...")
-                if isinstance(optical_image, list):
+                if isinstance(optical_image, tuple):
+                    report["Acquisition method"] = "Interleaved grids (%d images)" % (len(optical_image),)
+                    opxs = optical_image[0][0].metadata[model.MD_PIXEL_SIZE]
+                    opt_img_shape = optical_image[0][0].shape
+                    subimage_coordinates = []
+                    for oimg, sub_rep, sub_scale in optical_image:
+                        if future._find_overlay_state == CANCELLED:
+                            raise CancelledError()
+                        optical_dist = escan.pixelSize.value[0] * sub_scale[0] / opxs[0]
+                        subspots, subspot_coordinates = coordinates.DivideInNeighborhoods(oimg, sub_rep, optical_dist)
+                        subimages.extend(subspots)
+                        subimage_coordinates.extend(subspot_coordinates)
+                elif isinstance(optical_image, list):
                     report["Acquisition method"] = "One image per spot"
                     opxs = optical_image[0].metadata[model.MD_PIXEL_SIZE]
                     opt_img_shape = optical_image[0].shape
@@ -205,7 +219,7 @@ def _DoFindOverlay(future, repetitions, dwell_time, max_allowed_diff, escan,
                 if future._find_overlay_state == CANCELLED:
                     raise CancelledError()
                 logging.debug("Finding spot centers with %d subimages...", len(subimages))
-                spot_coordinates = [spot.FindCenterCoordinates(i) for i in subimages]
+                spot_coordinates = [tuple(c) for c in spot.FindCentersCoordinates(subimages)]
 
                 # Reconstruct the optical coordinates
                 if future._find_overlay_state == CANCELLED:
@@ -291,6 +305,10 @@ def _DoFindOverlay(future, repetitions, dwell_time, max_allowed_diff, escan,
                 _MakeReport(str(exp), report, optical_image, subimages)
                 # Maybe it's just due to a bad SNR => retry with longer dwell time
                 future._gscanner.dwell_time = future._gscanner.dwell_time * 1.2 + 0.1
+                # If the spots of the interleaved grids couldn't be separated,
+                # fallback to the (slower, but safer) one image per spot.
+                if isinstance(optical_image, tuple):
+                    future._gscanner.interleave = False
         else:
             raise ValueError("Overlay failure after %d attempts" % (MAX_TRIALS_NUMBER,))
 
@@ -386,6 +404,8 @@ def _transformMetadata(optical_image, transformation_values, escan, ccd, skew=Fa
     transform_md[model.MD_POS_COR] = position_cor
     if isinstance(optical_image, list):
         opt_img_pxs = optical_image[0]
+    elif isinstance(optical_image, tuple):
+        opt_img_pxs = optical_image[0][0]
     else:
         opt_img_pxs = optical_image
     try:
@@ -412,9 +432,13 @@ def _MakeReport(msg, data, optical_image=None, subimages=None):
     Creates failure report in case we cannot match the coordinates.
     msg (str): error message
     data (dict str->value): description of the value -> value
-    optical_image (2d array or None): Image from CCD
+    optical_image (2d array, list of 2d array, tuple of (2d array, 2 ints, 2 floats),
+      or None): Image(s) from CCD
     subimages (list of 2d array or None): List of Image from CCD
     """
+    if isinstance(optical_image, tuple):  # interleaved grids
+        optical_image = [oimg for oimg, _, _ in optical_image]
+
     path = os.path.join(os.path.expanduser(u"~"), u"odemis-overlay-report",
                         time.strftime(u"%Y%m%d-%H%M%S"))
     os.makedirs(path)
@@ -458,6 +482,36 @@ def _set_blanker(escan, active):
         logging.exception("Failed to set the blanker to %s", active)
 
 
+def _computeInterleave(repetitions, spot_dist, dwell_time, max_et):
+    """
+    Computes how to split a grid in interleaved sub-grids, so that in each
+    sub-grid, the spots are far enough from each other to be separated on a
+    single CCD image, and the CCD exposure time is within range.
+    repetitions (tuple of 2 ints): number of spots in X and Y
+    spot_dist (tuple of 2 floats): distance between the spots in X and Y (m)
+    dwell_time (float): time to spend on each spot (s)
+    max_et (float): maximum exposure time of the CCD (s)
+    returns (tuple of 2 ints): number of sub-grids in X and Y. Sub-grid (ox, oy)
+      contains every spot (i, j) such as i % X == ox and j % Y == oy.
+    """
+    inter = [min(max(1, int(math.ceil(SPOT_SIZE / d))), r)
+             for d, r in zip(spot_dist, repetitions)]
+
+    def sub_rep(i):
+        return int(math.ceil(repetitions[i] / inter[i]))
+
+    # Use more sub-grids, until they can be acquired in a single exposure
+    while sub_rep(0) * sub_rep(1) * dwell_time > max_et:
+        i = 0 if sub_rep(0) >= sub_rep(1) else 1
+        if inter[i] >= repetitions[i]:
+            i = 1 - i
+            if inter[i] >= repetitions[i]:
+                break  # Only one spot per sub-grid
+        inter[i] += 1
+
+    return tuple(inter)
+
+
 class GridScanner(object):
     def __init__(self, repetitions, dwell_time, escan, ccd, detector, bgsub=False):
         self.repetitions = repetitions
@@ -466,6 +520,10 @@ class GridScanner(object):
         self.ccd = ccd
         self.detector = detector
         self.bgsub = bgsub
+        # If True, when the spots are too close to be separated, the grid is
+        # acquired as several interleaved sub-grids, with one image per sub-grid.
+        # Otherwise, one image per spot is acquired.
+        self.interleave = True
         self.bg_image = None
         self._min_acq_time = float("inf")
 
@@ -602,67 +660,176 @@ class GridScanner(object):
 
         return self._spot_images, electron_coordinates, scale
 
-    def _doWholeAcquisition(self, electron_coordinates, scale):
+    def _acquireGridImage(self, et):
         """
-        Perform acquisition with one optical image for all the spots.
-        It's faster, but it's harder to separate the spots.
+        Acquires one CCD image, while the e-beam scans with the current settings
+        et (float): exposure time of the CCD (s)
+        returns (DataArray): the optical image
+        raises:
+            CancelledError if cancelled
+            TimeoutError if the CCD image didn't arrive
         """
-        escan = self.escan
         ccd = self.ccd
         detector = self.detector
-        dwell_time = self.dwell_time
-
-        # order matters
-        escan.scale.value = scale
-        escan.resolution.value = self.repetitions
-        escan.translation.value = (0, 0)
-
-        # Scan at least 10 times, to avoids CCD/SEM synchronization problems
-        sem_dt = escan.dwellTime.clip(dwell_time / 10)
-        escan.dwellTime.value = sem_dt
-        # For safety, ensure the exposure time is at least twice the time for a whole scan
-        if dwell_time < 2 * sem_dt:
-            dwell_time = 2 * sem_dt
-            logging.info("Increasing dwell time to %g s to avoid synchronization problems",
-                         dwell_time)
 
-        # CCD setup
-        ccd.binning.value = (1, 1)
-        ccd.resolution.value = ccd.shape[0:2]
-        et = numpy.prod(self.repetitions) * dwell_time
         ccd.exposureTime.value = et  # s
         readout = numpy.prod(ccd.resolution.value) / ccd.readoutRate.value
         tot_time = et + readout + 0.05
 
+        self._ccd_done.clear()
         try:
             if self._acq_state == CANCELLED:
                 raise CancelledError()
 
-            if self.bgsub:
-                _set_blanker(self.escan, True)
-                self.bg_image = ccd.data.get(asap=False)
-                _set_blanker(self.escan, False)
-
             detector.data.subscribe(self._discard_data)
             self._min_acq_time = time.time()
             ccd.data.subscribe(self._onCCDImage)
-            logging.debug("Scanning spot grid...")
 
             # Wait for CCD to capture the image
             if not self._ccd_done.wait(2 * tot_time + 4):
                 raise TimeoutError("Acquisition of CCD timed out")
 
-            with self._acq_lock:
-                if self._acq_state == CANCELLED:
-                    raise CancelledError()
-                logging.debug("Scan done.")
-                self._acq_state = FINISHED
+            if self._acq_state == CANCELLED:
+                raise CancelledError()
         finally:
             detector.data.unsubscribe(self._discard_data)
             ccd.data.unsubscribe(self._onCCDImage)
 
+        return self._optical_image
+
+    def _setGridDwellTime(self, nspots):
+        """
+        Sets the e-beam dwell time to scan the grid multiple times during the
+          exposure of the CCD.
+        nspots (int): number of spots in the grid scanned
+        returns (float): exposure time of the CCD (s)
+        """
+        dwell_time = self.dwell_time
+        # Scan at least 10 times, to avoids CCD/SEM synchronization problems
+        sem_dt = self.escan.dwellTime.clip(dwell_time / 10)
+        self.escan.dwellTime.value = sem_dt
+        # For safety, ensure the exposure time is at least twice the time for a whole scan
+        if dwell_time < 2 * sem_dt:
+            dwell_time = 2 * sem_dt
+            logging.info("Increasing dwell time to %g s to avoid synchronization problems",
+                         dwell_time)
+
+        return nspots * dwell_time
+
+    def _doWholeAcquisition(self, electron_coordinates, scale):
+        """
+        Perform acquisition with one optical image for all the spots.
+        It's faster, but it's harder to separate the spots.
+        """
+        escan = self.escan
+        ccd = self.ccd
+
+        # order matters
+        escan.scale.value = scale
+        escan.resolution.value = self.repetitions
+        escan.translation.value = (0, 0)
+        et = self._setGridDwellTime(numpy.prod(self.repetitions))
+
+        # CCD setup
+        ccd.binning.value = (1, 1)
+        ccd.resolution.value = ccd.shape[0:2]
+
+        if self._acq_state == CANCELLED:
+            raise CancelledError()
+
+        if self.bgsub:
+            _set_blanker(self.escan, True)
+            self.bg_image = ccd.data.get(asap=False)
+            _set_blanker(self.escan, False)
+
+        logging.debug("Scanning spot grid...")
+        self._acquireGridImage(et)
+
+        with self._acq_lock:
+            if self._acq_state == CANCELLED:
+                raise CancelledError()
+            logging.debug("Scan done.")
+            self._acq_state = FINISHED
+
         return self._optical_image, electron_coordinates, scale
 
+    def _doInterleavedAcquisition(self, scale, interleave):
+        """
+        Perform acquisition with one optical image per sub-grid. Each sub-grid
+        contains every spot in N (in X and Y), so that the spots are far enough
+        to be separated. In each image, the e-beam scans all the spots of the
+        sub-grid, like in the whole acquisition.
+        It's much faster than one image per spot, as only a few images are needed.
+        scale (tuple of 2 floats): distance between spots in the whole grid (px)
+        interleave (tuple of 2 ints): number of sub-grids in X and Y
+        returns (tuple of (DataArray, tuple of 2 ints, tuple of 2 floats)):
+                  for each sub-grid, the optical image, the number of spots
+                  and the distance between spots (in SEM px)
+                (list of tuples): coordinates of all the spots in electron image
+                (tuple of floats): scaling of the (whole grid) electron image
+        """
+        escan = self.escan
+        ccd = self.ccd
+        rep = self.repetitions
+        sub_scale = (scale[0] * interleave[0], scale[1] * interleave[1])
+
+        # CCD setup
+        ccd.binning.value = (1, 1)
+        ccd.resolution.value = ccd.shape[0:2]
+
+        if self._acq_state == CANCELLED:
+            raise CancelledError()
+
+        if self.bgsub:
+            _set_blanker(self.escan, True)
+            self.bg_image = ccd.data.get(asap=False)
+            _set_blanker(self.escan, False)
+
+        logging.debug("Scanning spot grid as %s interleaved grids...", interleave)
+        bound = ((rep[0] - 1) * scale[0] / 2,
+                 (rep[1] - 1) * scale[1] / 2)
+        images = []
+        electron_coordinates = []
+        for ox in range(interleave[0]):
+            for oy in range(interleave[1]):
+                sub_rep = (len(range(ox, rep[0], interleave[0])),
+                           len(range(oy, rep[1], interleave[1])))
+                # Center of the sub-grid
+                trans = (-bound[0] + (ox + (sub_rep[0] - 1) * interleave[0] / 2) * scale[0],
+                         -bound[1] + (oy + (sub_rep[1] - 1) * interleave[1] / 2) * scale[1])
+
+                # order matters
+                escan.scale.value = sub_scale
+                escan.resolution.value = sub_rep
+                escan.translation.value = trans
+                et = self._setGridDwellTime(numpy.prod(sub_rep))
+
+                # The e-beam scanner might have adjusted the settings to fit
+                # the FoV, so compute the spot positions from the actual ones.
+                act_scale = escan.scale.value
+                act_rep = escan.resolution.value
+                act_trans = escan.translation.value
+                if act_rep != sub_rep or act_trans != trans:
+                    logging.info("Sub-grid scanned with res = %s, trans = %s, instead of %s, %s",
+                                 act_rep, act_trans, sub_rep, trans)
+
+                logging.debug("Scanning sub-grid %d,%d", ox, oy)
+                optical_image = self._acquireGridImage(et)
+                images.append((optical_image, act_rep, act_scale))
+                for i in range(act_rep[0]):
+                    for j in range(act_rep[1]):
+                        electron_coordinates.append(
+                            (act_trans[0] + (i - (act_rep[0] - 1) / 2) * act_scale[0],
+                             act_trans[1] + (j - (act_rep[1] - 1) / 2) * act_scale[1]))
+
+        with self._acq_lock:
+            if self._acq_state == CANCELLED:
+                raise CancelledError()
+            logging.debug("Scan done.")
+            self._acq_state = FINISHED
+
+        return tuple(images), electron_coordinates, scale
+
     def DoAcquisition(self):
         """
         Uses the e-beam to scan the rectangular grid consisted of the given number
@@ -672,9 +839,11 @@ class GridScanner(object):
         escan (model.Emitter): The e-beam scanner
         ccd (model.DigitalCamera): The CCD
         detector (model.Detector): The electron detector
-        returns (DataArray or list of DataArrays): 2D array containing the
-                     the spotted optical image, or a list of 2D images
-                     containing the optical image for each spot.
+        returns (DataArray or list of DataArrays or tuple of (DataArray, tuple, tuple)):
+                     2D array containing the the spotted optical image, or
+                     a list of 2D images containing the optical image for each
+                     spot, or the optical image of each interleaved sub-grid
+                     (see _doInterleavedAcquisition()).
                 (List of tuples):  Coordinates of spots in electron image
                 (Tuple of floats): Scaling of electron image
         """
@@ -732,9 +901,17 @@ class GridScanner(object):
 
         try:
             # If the distance between e-beam spots is below the size of a spot,
-            # use the “one image per spot” procedure
+            # split the grid in sub-grids with spots far enough, or, if it
+            # doesn't help, use the “one image per spot” procedure
             if (spot_dist[0] < SPOT_SIZE) or (spot_dist[1] < SPOT_SIZE) or (et > max_et):
-                return self._doSpotAcquisition(electron_coordinates, scale)
+                interleave = _computeInterleave(rep, spot_dist, dwell_time, max_et)
+                nsub = interleave[0] * interleave[1]
+                sub_et = (math.ceil(rep[0] / interleave[0]) * math.ceil(rep[1] / interleave[1]) *
+                          dwell_time)
+                if self.interleave and nsub < numpy.prod(rep) and sub_et <= max_et:
+                    return self._doInterleavedAcquisition(scale, interleave)
+                else:
+                    return self._doSpotAcquisition(electron_coordinates, scale)
             else:
                 return self._doWholeAcquisition(electron_coordinates, scale)
         finally:
@@ -29,6 +29,91 @@ import math
 from numpy import arange
 from numpy import fft
 
+
+class ShiftReference(object):
+    """
+    Image prepared to be passed multiple times to MeasureShift(): its Fourier
+    transform is computed only once. The buffers needed to compute the shift
+    are also kept, so a ShiftReference should not be used simultaneously by
+    multiple threads.
+    """
+
+    def __init__(self, img):
+        """
+        img (numpy.array): 2d array
+        """
+        self.shape = img.shape
+        if numpy.iscomplexobj(img):
+            self.rfft = None
+            self._fft = fft.fft2(img)
+        else:
+            # As the image is real, half of the Fourier transform is sufficient
+            self.rfft = fft.rfft2(img)
+            self._fft = None  # full Fourier transform, only computed if needed
+        self._upbufs = None  # buffers for the upsampled cross-correlation
+
+    @property
+    def fft(self):
+        """
+        (numpy.array of complex): the full Fourier transform of the image
+        """
+        if self._fft is None:
+            self._fft = _rfftToFFT(self.rfft, self.shape[1])
+        return self._fft
+
+    def _getUpsampleBuffers(self):
+        """
+        return (numpy.array of complex, numpy.array of complex): buffers of
+          shape (m, 2n) and (2m, 2n), where m, n is the shape of the image. Only
+          the parts written by _UpsampledCC() are ever non-zero.
+        """
+        if self._upbufs is None:
+            m, n = self.shape
+            self._upbufs = (numpy.zeros((m, n * 2), dtype=complex),
+                            numpy.zeros((m * 2, n * 2), dtype=complex))
+        return self._upbufs
+
+
+def _rfftToFFT(rf, n):
+    """
+    Reconstructs the full Fourier transform of a real input, from its half
+    Fourier transform, using the Hermitian symmetry.
+    rf (numpy.array of complex): 2d array, as returned by rfft2()
+    n (int): size of the last dimension of the real input
+    return (numpy.array of complex): 2d array, as returned by fft2()
+    """
+    m, nr = rf.shape
+    full = numpy.empty((m, n), dtype=rf.dtype)
+    full[:, :nr] = rf
+    # F[i, j] = conj(F[-i, -j])
+    rows = (-numpy.arange(m)) % m
+    cols = n - numpy.arange(nr, n)
+    full[:, nr:] = rf[rows][:, cols].conj()
+    return full
+
+
+def _UpsampledCC(cps, ref):
+    """
+    Computes the cross-correlation upsampled by a factor 2, by embedding the
+    cross-power spectrum in the center of a 2x larger array of zeros (in
+    "fftshift" order) and computing its inverse Fourier transform.
+    cps (numpy.array of complex): 2d array, the cross-power spectrum
+    ref (ShiftReference): the reference providing the buffers
+    return (numpy.array of complex): 2d array twice as large as cps
+    """
+    m, n = cps.shape
+    mp, np_ = m - m // 2, n - n // 2  # number of non-negative frequencies
+    rows, cc = ref._getUpsampleBuffers()
+    # Directly place the frequencies where they would end up after the
+    # (i)fftshift, and only transform along X the rows which are not all 0.
+    rows[:, :np_] = cps[:, :np_]
+    rows[:, 2 * n - n // 2:] = cps[:, np_:]
+    rows = fft.ifft(rows, axis=1)
+    cc[:mp] = rows[:mp]
+    cc[2 * m - m // 2:] = rows[mp:]
+    return fft.ifft(cc, axis=0)
+
+
 def MeasureShift(previous_img, current_img, precision=1):
     """
     Given two images, it calculates the shift in x and y axis. It first computes
@@ -39,9 +124,11 @@ def MeasureShift(previous_img, current_img, precision=1):
     http://www.mathworks.com/matlabcentral/fileexchange/
     18401-efficient-subpixel-image-registration-by-cross-correlation.
 
-    previous_img (numpy.array): 2d array with the previous frame
-    current_img (numpy.array): 2d array with the last frame, must be of same
-      shape as previous_img
+    previous_img (numpy.array or ShiftReference): 2d array with the previous frame
+    current_img (numpy.array or ShiftReference): 2d array with the last frame,
+      must be of same shape as previous_img. When the same image is compared
+      multiple times, passing it as a ShiftReference avoids recomputing its
+      Fourier transform.
     precision (1<=int): Calculate drift within 1/precision of a pixel
     returns (tuple of floats): Drift in pixels
     """
@@ -49,13 +136,19 @@ def MeasureShift(previous_img, current_img, precision=1):
         raise ValueError("Precision cannot be less than 1, got %s." % (precision,))
     assert previous_img.shape == current_img.shape, "Prev shape %s != new shape %s" % (previous_img.shape, current_img.shape)
 
-    previous_fft = fft.fft2(previous_img)
-    current_fft = fft.fft2(current_img)
-    m, n = previous_fft.shape
+    if not isinstance(previous_img, ShiftReference):
+        previous_img = ShiftReference(previous_img)
+    if not isinstance(current_img, ShiftReference):
+        current_img = ShiftReference(current_img)
+    m, n = previous_img.shape
 
     if precision == 1:
         # Cross-correlation computation
-        CC = fft.ifft2(previous_fft * current_fft.conj())
+        if previous_img.rfft is not None and current_img.rfft is not None:
+            # Real images => the cross-correlation is real too
+            CC = fft.irfft2(previous_img.rfft * current_img.rfft.conj(), s=(m, n))
+        else:
+            CC = fft.ifft2(previous_img.fft * current_img.fft.conj())
 
         # Locate the peak
         ACC = abs(CC)
@@ -80,18 +173,13 @@ def MeasureShift(previous_img, current_img, precision=1):
             col_shift = cloc
 
     else:
-        mlarge, nlarge = m * 2, n * 2
+        # Cross-power spectrum
+        cps = previous_img.fft * current_img.fft.conj()
 
-        # Upsample by factor of 2 to obtain initial estimation and
-        # embed Fourier data in a 2x larger array
-        CC = numpy.zeros((mlarge, nlarge), dtype=numpy.complex)
-        CC[m - m // 2:m + 1 + (m - 1) // 2,
-           n - n // 2:n + 1 + (n - 1) // 2] = (fft.fftshift(previous_fft) *
-                                               fft.fftshift(current_fft).conj()
-                                              )
-
-        # Cross-correlation computation
-        CC = fft.ifft2(fft.ifftshift(CC))
+        # Upsample by factor of 2 to obtain initial estimation:
+        # cross-correlation computation, with the Fourier data embedded in a
+        # 2x larger array
+        CC = _UpsampledCC(cps, current_img)
 
         # Locate the peak
         ACC = abs(CC)
@@ -127,7 +215,8 @@ def MeasureShift(previous_img, current_img, precision=1):
         dft_shift = math.ceil(precision * 1.5) // 2  # Center of output at dft_shift+1
 
         # Matrix multiply DFT around the current shift estimation
-        CC = (_UpsampledDFT(current_fft * previous_fft.conj(),
+        # (current_fft * previous_fft.conj() == cps.conj())
+        CC = (_UpsampledDFT(cps.conj(),
                             math.ceil(precision * 1.5),
                             math.ceil(precision * 1.5),
                             precision,
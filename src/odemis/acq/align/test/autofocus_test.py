@@ -30,7 +30,7 @@ from odemis import model, acq
 import odemis
 from odemis.acq import align, stream
 from odemis.acq.align import autofocus
-from odemis.acq.align.autofocus import Sparc2AutoFocus, MTD_BINARY
+from odemis.acq.align.autofocus import Sparc2AutoFocus, MTD_BINARY, MTD_PIPELINED
 from odemis.dataio import hdf5
 from odemis.util import test, timeout, img
 import os
@@ -128,6 +128,46 @@ class TestAutofocus(unittest.TestCase):
         self.assertAlmostEqual(foc_pos, self._opt_good_focus, 3)
         self.assertGreater(foc_lev, 0)
 
+    @timeout(1000)
+    def test_autofocus_opt_pipelined(self):
+        """
+        Test AutoFocus on CCD, with the pipelined method
+        """
+        focus = self.focus
+        ebeam = self.ebeam
+        ccd = self.ccd
+        focus.moveAbs({"z": self._opt_good_focus - 400e-6}).result()
+        ccd.exposureTime.value = ccd.exposureTime.range[0]
+        start = time.time()
+        future_focus = align.AutoFocus(ccd, ebeam, focus, method=MTD_PIPELINED)
+        foc_pos, foc_lev = future_focus.result(timeout=900)
+        logging.info("Pipelined autofocus took %g s", time.time() - start)
+        self.assertAlmostEqual(foc_pos, self._opt_good_focus, 3)
+        self.assertGreater(foc_lev, 0)
+
+    def test_estimate_time_pipelined(self):
+        """
+        The pipelined method needs fewer acquisitions than the binary one
+        """
+        et = autofocus.estimateAcquisitionTime(self.ccd)
+        t_bin = autofocus.estimateAutoFocusTime(self.ccd, None)
+        t_pip = autofocus.estimateAutoFocusTime(self.ccd, None, method=MTD_PIPELINED)
+        self.assertGreaterEqual(t_pip, autofocus.PIPELINED_COARSE_STEPS * et)
+        self.assertLess(t_pip, t_bin)
+
+    def test_fit_focus_peak(self):
+        """
+        Test the estimation of the focus peak from a few measurements
+        """
+        pos = numpy.linspace(-100e-6, 100e-6, 11)
+        levels = 3 + 50 * numpy.exp(-(pos - 12e-6) ** 2 / (2 * 30e-6 ** 2))
+        peak = autofocus._fitFocusPeak(pos, levels)
+        self.assertAlmostEqual(peak, 12e-6, delta=5e-6)
+
+        # Peak outside of the measured positions
+        levels = numpy.exp(-(pos - 150e-6) ** 2 / (2 * 30e-6 ** 2))
+        self.assertIsNone(autofocus._fitFocusPeak(pos, levels))
+
     @timeout(1000)
     def test_autofocus_sem(self):
         """
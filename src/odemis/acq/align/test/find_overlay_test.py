@@ -25,6 +25,7 @@ from concurrent import futures
 import logging
 from odemis import model, dataio
 from odemis.acq import align
+from odemis.acq.align import find_overlay
 from odemis.driver import semcomedi, andorcam2
 from odemis.util import test
 import os
@@ -189,6 +190,58 @@ class TestOverlay(unittest.TestCase):
         self.assertIn(model.MD_PIXEL_SIZE_COR, opt_md)
         self.assertIn(model.MD_SHEAR_COR, sem_md)
 
+    def test_interleaved_acquisition(self):
+        """
+        Test the acquisition of the grid as several sub-grids
+        """
+        self._prepare_hardware()
+
+        gscanner = find_overlay.GridScanner((4, 4), 0.01, self.ebeam, self.ccd, self.sed)
+        gscanner._save_hw_settings()
+        gscanner._acq_state = find_overlay.RUNNING
+        try:
+            images, ecoords, scale = gscanner._doInterleavedAcquisition((100, 100), (2, 2))
+        finally:
+            gscanner._restore_hw_settings()
+
+        self.assertEqual(len(images), 4)
+        for im, sub_rep, sub_scale in images:
+            self.assertEqual(im.ndim, 2)
+            self.assertEqual(tuple(sub_rep), (2, 2))
+            self.assertEqual(tuple(sub_scale), (200, 200))
+
+        # All the spots of the whole grid are scanned, once
+        exp_coords = [(x, y) for x in (-150, -50, 50, 150) for y in (-150, -50, 50, 150)]
+        self.assertEqual(sorted(ecoords), exp_coords)
+        self.assertEqual(scale, (100, 100))
+
+
+class TestInterleave(unittest.TestCase):
+    """
+    Test the computation of the interleaved sub-grids
+    """
+
+    def test_far_spots(self):
+        inter = find_overlay._computeInterleave((4, 4), (2e-6, 2e-6), 0.1, 10)
+        self.assertEqual(inter, (1, 1))
+
+    def test_close_spots(self):
+        inter = find_overlay._computeInterleave((8, 8), (0.5e-6, 1e-6), 0.1, 10)
+        self.assertEqual(inter, (3, 2))
+
+        # Never more sub-grids than spots
+        inter = find_overlay._computeInterleave((2, 2), (1e-9, 1e-9), 0.1, 10)
+        self.assertEqual(inter, (2, 2))
+
+    def test_long_exposure(self):
+        # 16 s needed for the whole grid, but the CCD can only expose 5 s
+        inter = find_overlay._computeInterleave((4, 4), (2e-6, 2e-6), 1, 5)
+        self.assertEqual(inter, (2, 2))
+
+        # Even one spot is too long => one spot per sub-grid
+        inter = find_overlay._computeInterleave((4, 4), (2e-6, 2e-6), 10, 5)
+        self.assertEqual(inter, (4, 4))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -30,7 +30,7 @@ from scipy import misc
 import threading
 import cv2
 
-from odemis.acq.align.shift import MeasureShift
+from odemis.acq.align.shift import MeasureShift, ShiftReference
 
 MIN_RESOLUTION = (20, 20) # seems 10x10 sometimes work, but let's not tent it
 MAX_PIXELS = 128 ** 2  # px
@@ -65,6 +65,8 @@ class AnchoredEstimator(object):
         self.max_drift = (0, 0) # in sem px
 
         self.raw = []  # first 2 and last 2 anchor areas acquired (in order)
+        # int -> (DataArray, ShiftReference): id of an image in .raw -> image and its reference
+        self._shift_refs = {}
         self._acq_sem_complete = threading.Event()
 
         # Calculate initial translation for anchor region acquisition
@@ -168,11 +170,15 @@ class AnchoredEstimator(object):
             # include also the drift of the previous image.
             # Also, MeasureShift return the shift in image pixels, which is
             # different (usually bigger) from the SEM px.
-            prev_drift = MeasureShift(self.raw[-2], self.raw[-1], 10)
+            # The Fourier transforms of the images are cached, so each new
+            # image only needs to be transformed once.
+            prev_drift = MeasureShift(self._getShiftReference(self.raw[-2]),
+                                      self._getShiftReference(self.raw[-1]), 10)
             prev_drift = (prev_drift[0] * self._scale[0] + self.drift[0],
                           prev_drift[1] * self._scale[1] + self.drift[1])
 
-            orig_drift = MeasureShift(self.raw[0], self.raw[-1], 10)
+            orig_drift = MeasureShift(self._getShiftReference(self.raw[0]),
+                                      self._getShiftReference(self.raw[-1]), 10)
             self.drift = (orig_drift[0] * self._scale[0],
                           orig_drift[1] * self._scale[1])
 
@@ -195,6 +201,25 @@ class AnchoredEstimator(object):
 
         return self.drift
 
+    def _getShiftReference(self, da):
+        """
+        Returns the ShiftReference of an image, computing it only the first time
+        da (DataArray): one of the images in .raw
+        return (ShiftReference)
+        """
+        try:
+            return self._shift_refs[id(da)][1]
+        except KeyError:
+            pass
+
+        # Forget the references of the images which have been discarded
+        ids = {id(d) for d in self.raw}
+        self._shift_refs = {k: v for k, v in self._shift_refs.items() if k in ids}
+        ref = ShiftReference(da)
+        # The image is kept, so that its id cannot be reused by another one
+        self._shift_refs[id(da)] = (da, ref)
+        return ref
+
     def estimateAcquisitionTime(self):
         """
         return (float): estimated time to acquire 1 anchor area
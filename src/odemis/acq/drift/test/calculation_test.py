@@ -26,9 +26,10 @@ import math
 from numpy import fft
 from numpy import random
 import numpy
-from odemis.acq.align.shift import MeasureShift
+from odemis.acq.align.shift import MeasureShift, ShiftReference
 from odemis.dataio import hdf5
 import os
+import time
 import unittest
 
 
@@ -207,5 +208,55 @@ class TestShiftCalculation(unittest.TestCase):
         drift = MeasureShift(self.small_data, self.small_data_random_drifted_noisy, 10)
         numpy.testing.assert_almost_equal(drift, (self.small_deltac, self.small_deltar), 0)
 
+    # @unittest.skip("skip")
+    def test_prepared_reference(self):
+        """
+        Tests that passing ShiftReferences gives the same result as the images
+        """
+        ref = ShiftReference(self.data[0])
+        for img in (self.data_drifted[0], self.data_random_drifted_noisy, self.data_noisy):
+            cur = ShiftReference(img)
+            for precision in (1, 10, 100):
+                drift = MeasureShift(self.data[0], img, precision)
+                numpy.testing.assert_almost_equal(MeasureShift(ref, cur, precision), drift)
+                numpy.testing.assert_almost_equal(MeasureShift(ref, img, precision), drift)
+                numpy.testing.assert_almost_equal(MeasureShift(self.data[0], cur, precision), drift)
+
+        # Odd shape
+        small = self.small_data[:-1, :]
+        small_drifted = self.small_data_random_drifted[:-1, :].real
+        drift = MeasureShift(ShiftReference(small), ShiftReference(small_drifted), 10)
+        numpy.testing.assert_almost_equal(drift, (self.small_deltac, self.small_deltar), 0)
+
+    # @unittest.skip("skip")
+    def test_speed(self):
+        """
+        Measures the time spent per drift correction, as done by the
+        AnchoredEstimator: the new anchor image is compared to the previous and
+        the first one.
+        """
+        anchor = self.data[0][:128, :128]
+        imgs = [numpy.roll(anchor, (i // 3, i // 5), axis=(0, 1)) + random.normal(0, 100, anchor.shape)
+                for i in range(50)]
+
+        startt = time.time()
+        for i in range(2, len(imgs)):
+            MeasureShift(imgs[i - 1], imgs[i], 10)
+            MeasureShift(imgs[0], imgs[i], 10)
+        dur_imgs = (time.time() - startt) / (len(imgs) - 2)
+
+        startt = time.time()
+        first = ShiftReference(imgs[0])
+        prev = ShiftReference(imgs[1])
+        for i in range(2, len(imgs)):
+            cur = ShiftReference(imgs[i])
+            MeasureShift(prev, cur, 10)
+            MeasureShift(first, cur, 10)
+            prev = cur
+        dur_refs = (time.time() - startt) / (len(imgs) - 2)
+
+        logging.info("Drift correction on %s px takes %g ms with images, %g ms with references",
+                     anchor.shape, dur_imgs * 1e3, dur_refs * 1e3)
+
 if __name__ == '__main__':
     unittest.main()
@@ -296,6 +296,28 @@ def affectsGraph(microscope):
     return graph
 
 
+def reachabilityIndex(graph):
+    """
+    Computes the transitive closure of a graph, so that checking whether a node
+    can be reached from another one is just a lookup.
+    graph (dict str->(set of str)): the edges, as returned by affectsGraph()
+    returns (dict str->(frozenset of str)): for each node of the graph, all
+      the nodes which can be reached from it (including itself)
+    """
+    reachable = {}
+    for start in graph:
+        seen = {start}
+        todo = [start]
+        while todo:
+            node = todo.pop()
+            for n in graph.get(node, ()):
+                if n not in seen:
+                    seen.add(n)
+                    todo.append(n)
+        reachable[start] = frozenset(seen)
+    return reachable
+
+
 class OpticalPathManager(object):
     """
     The purpose of this module is setting the physical components contained in
@@ -308,7 +330,6 @@ class OpticalPathManager(object):
             handle all the components needed
         """
         self.microscope = microscope
-        self._graph = affectsGraph(self.microscope)
         self._chamber_view_own_focus = False
 
         # Use subset for modes guessed
@@ -326,13 +347,19 @@ class OpticalPathManager(object):
 
         # keep list of all components, to avoid creating new proxies
         # every time the mode changes
-        self._cached_components = model.getComponents()
-
+        self._cached_components = []
         # All the actuators in the microscope, to cache proxy's to them
         self._actuators = []
-        for comp in self._cached_components:
-            if hasattr(comp, 'axes') and isinstance(comp.axes, dict):
-                self._actuators.append(comp)
+        self._graph = {}  # str -> set of str: component name -> affected components
+        self._reachable = {}  # str -> frozenset of str: transitive closure of _graph
+        # Memoization of the graph work done when setting a path. It only
+        # depends on the components, so it's reset whenever they change.
+        self._mode_comps = {}  # (str, str) -> list of (str, Component, dict): (mode, detector name) -> (role, actuator, conf)
+        # str -> list of (Component, dict, str or None): target name -> selector,
+        # choice axes moves, and metadata key of the favourite position to also apply
+        self._selector_moves = {}
+        # Computes all of these, and update them if some components (dis)appear
+        microscope.alive.subscribe(self._onAlive, init=True)
 
         # last known axes position (before going to an alignment mode)
         self._stored = {}  # (str, str) -> pos: (comp role, axis name) -> position
@@ -399,6 +426,11 @@ class OpticalPathManager(object):
     def __del__(self):
         logging.debug("Ending path manager")
 
+        try:
+            self.microscope.alive.unsubscribe(self._onAlive)
+        except Exception:
+            pass  # Microscope already gone
+
         # Restore the spectrometer focus, so that on next start, this value will
         # be used again as "out of chamber view".
         if self._chamber_view_own_focus and self._last_mode == "chamber-view":
@@ -416,6 +448,26 @@ class OpticalPathManager(object):
         except AttributeError:
             pass  # Not created
 
+    def _onAlive(self, alive):
+        """
+        Called when the set of running components changes. Updates the cached
+        components, and the reachability index of the affects graph.
+        """
+        comps = model.getComponents()
+        graph = affectsGraph(self.microscope)
+        reachable = reachabilityIndex(graph)
+        actuators = [c for c in comps if hasattr(c, 'axes') and isinstance(c.axes, dict)]
+
+        # Each attribute is replaced atomically, so a path change in progress
+        # sees either the old or the new version.
+        self._cached_components = comps
+        self._actuators = actuators
+        self._graph = graph
+        self._reachable = reachable
+        self._mode_comps = {}
+        self._selector_moves = {}
+        logging.debug("Path manager updated with %d components", len(comps))
+
     def _getComponent(self, role):
         """
         same as model.getComponent, but optimised by caching the result.
@@ -526,22 +578,7 @@ class OpticalPathManager(object):
                               self._focus_out_chamber_view)
                 fmoves.append((focus_comp.moveAbs(self._focus_out_chamber_view), focus_comp, self._focus_out_chamber_view))
 
-        modeconf = self._modes[mode][1]
-        for comp_role, conf in modeconf.items():
-            # Try to access the component needed
-            try:
-                comp = self._getComponent(comp_role)
-            except LookupError:
-                logging.debug("Failed to find component %s, skipping it", comp_role)
-                continue
-
-            # Check whether that actuator affects the target
-            targets = {target.name} | set(target.affects.value)
-            if not any(self.affects(comp.name, n) for n in targets):
-                logging.debug("Actuator %s doesn't affect %s, so not moving it",
-                              comp.name, target.name)
-                continue
-
+        for comp_role, comp, conf in self._getModeComponents(mode, target):
             mv = {}
             for axis, pos in conf.items():
                 if axis == "power":
@@ -708,6 +745,41 @@ class OpticalPathManager(object):
                 except IOError as e:
                     logging.warning("Actuator move failed giving the error %s", e)
 
+    def _getModeComponents(self, mode, target):
+        """
+        Finds the components of the mode configuration which affect the target.
+        The result is memoized per (mode, target).
+        mode (str): the optical path mode
+        target (Component): the detector targeted
+        return (list of (str, Component, dict)): the role, the component, and
+          its configuration in the mode
+        """
+        key = mode, target.name
+        try:
+            return self._mode_comps[key]
+        except KeyError:
+            pass
+
+        comps = []
+        targets = {target.name} | set(target.affects.value)
+        for comp_role, conf in self._modes[mode][1].items():
+            # Try to access the component needed
+            try:
+                comp = self._getComponent(comp_role)
+            except LookupError:
+                logging.debug("Failed to find component %s, skipping it", comp_role)
+                continue
+
+            # Check whether that actuator affects the target
+            if not any(self.affects(comp.name, n) for n in targets):
+                logging.debug("Actuator %s doesn't affect %s, so not moving it",
+                              comp.name, target.name)
+                continue
+            comps.append((comp_role, comp, conf))
+
+        self._mode_comps[key] = comps
+        return comps
+
     def selectorsToPath(self, target):
         """
         Sets the selectors so the optical path leads to the target component
@@ -717,8 +789,46 @@ class OpticalPathManager(object):
           future, the component, and the new position requested
         """
         fmoves = []
+        for comp, mv in self._getSelectorMoves(target):
+            logging.debug("Move %s added so %s targets to %s", mv, comp.name, target)
+            fmoves.append((comp.moveAbs(mv), comp, mv))
+        return fmoves
+
+    def _getSelectorMoves(self, target):
+        """
+        Computes the moves of the selectors needed so that the optical path
+        leads to the target component.
+        target (str): component name
+        return (list of tuple (Component, dict)): the component and the new
+          position to request
+        """
+        moves = []
+        for comp, mv, fav_key in self._getSelectors(target):
+            if fav_key is not None:
+                # The favourite positions can be changed at runtime (eg, during
+                # alignment), so always read the latest version.
+                mv = dict(mv)
+                mv.update(comp.getMetadata()[fav_key])
+            if mv:
+                moves.append((comp, mv))
+        return moves
+
+    def _getSelectors(self, target):
+        """
+        Finds the selectors which need to move so that the optical path leads
+        to the target component. The result is memoized per target.
+        target (str): component name
+        return (list of tuple (Component, dict, str or None)): the component,
+          the axes moves to the choices leading to the target, and the metadata
+          key of the favourite position to apply too (or None).
+        """
+        try:
+            return self._selector_moves[target]
+        except KeyError:
+            pass
+
+        selectors = []
         for comp in self._actuators:
-            # TODO: pre-cache this as comp/target -> axis/pos
             # TODO: don't do moves already done
 
             # TODO: extend the path computation to "for every actuator which _affects_
@@ -734,17 +844,19 @@ class OpticalPathManager(object):
 
             comp_md = comp.getMetadata()
             if target in comp_md.get(model.MD_FAV_POS_ACTIVE_DEST, {}):
-                mv.update(comp_md[model.MD_FAV_POS_ACTIVE])
+                fav_key = model.MD_FAV_POS_ACTIVE
             elif target in comp_md.get(model.MD_FAV_POS_DEACTIVE_DEST, {}):
-                mv.update(comp_md[model.MD_FAV_POS_DEACTIVE])
+                fav_key = model.MD_FAV_POS_DEACTIVE
+            else:
+                fav_key = None
 
-            if mv:
-                logging.debug("Move %s added so %s targets to %s", mv, comp.name, target)
-                fmoves.append((comp.moveAbs(mv), comp, mv))
+            if mv or fav_key is not None:
+                selectors.append((comp, mv, fav_key))
                 # make sure this component is also on the optical path
-                fmoves.extend(self.selectorsToPath(comp.name))
+                selectors.extend(self._getSelectors(comp.name))
 
-        return fmoves
+        self._selector_moves[target] = selectors
+        return selectors
 
     def guessMode(self, guess_stream):
         """
@@ -844,11 +956,9 @@ class OpticalPathManager(object):
         affected (str): component name
         return bool
         """
-        path = self.findPath(affecting, affected)
-        if path is None:
-            return False
-        else:
+        if affecting == affected:
             return True
+        return affected in self._reachable.get(affecting, ())
 
     def findPath(self, node1, node2, path=None):
         """
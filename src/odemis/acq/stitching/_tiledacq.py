@@ -32,7 +32,7 @@ import psutil
 from odemis import model, dataio
 from odemis.acq import acqmng
 from odemis.acq import stitching
-from odemis.acq.align.autofocus import MeasureOpticalFocus, AutoFocus, MTD_EXHAUSTIVE
+from odemis.acq.align.autofocus import MeasureOpticalFocus, AutoFocus, MTD_PIPELINED
 from odemis.acq.stitching._constants import WEAVER_COLLAGE_REVERSE
 from odemis.acq.stream import Stream, SEMStream, CameraStream, RepetitionStream, EMStream, ARStream, \
     SpectrumStream, FluoStream, MultipleDetectorStream, util, executeAsyncTask, \
@@ -47,6 +47,74 @@ FOCUS_FIDELITY = 0.3
 FOCUS_RANGE_MARGIN = 10e-5
 # Indicate the number of tiles to skip during focus adjustment
 SKIP_TILES = 3
+# Minimum number of points in the focus map to fit a quadratic surface instead of a plane
+FOCUS_MAP_QUAD_POINTS = 6
+
+
+class FocusMap(object):
+    """
+    Estimates the good focus position at any stage position, by fitting a surface
+    on the good focus positions found at a few stage positions.
+    With less than 3 points, the surface is flat. With 3 points or more, it's
+    a plane (ie, a tilted sample), and with FOCUS_MAP_QUAD_POINTS points or
+    more, it's a quadratic surface (ie, a bent sample).
+    """
+
+    def __init__(self):
+        self._points = []  # list of (float, float, float): x, y, z
+        self._fit = None  # (x0, y0, scale, coefficients), or None if not yet fitted
+
+    def __len__(self):
+        return len(self._points)
+
+    def add(self, x, y, z):
+        """
+        Record a good focus position
+        x, y (float): stage position (m)
+        z (float): focus position (m)
+        """
+        self._points.append((x, y, z))
+        self._fit = None  # will be fitted again on the next prediction
+
+    @staticmethod
+    def _getTerms(x, y, n):
+        """
+        return (ndarray of shape (len(x), T)): the terms of the polynomial surface
+          for a given number of points
+        """
+        terms = [numpy.ones_like(x)]
+        if n >= 3:
+            terms += [x, y]
+        if n >= FOCUS_MAP_QUAD_POINTS:
+            terms += [x * x, x * y, y * y]
+        return numpy.column_stack(terms)
+
+    def _fitSurface(self):
+        pts = numpy.array(self._points, dtype=float)
+        # Fit on normalised coordinates, to keep the system well conditioned
+        x0, y0 = pts[:, 0].mean(), pts[:, 1].mean()
+        scale = max(numpy.ptp(pts[:, 0]), numpy.ptp(pts[:, 1])) or 1
+        a = self._getTerms((pts[:, 0] - x0) / scale, (pts[:, 1] - y0) / scale, len(pts))
+        # In case of degenerated positions (eg, all on a line), the least-squares
+        # solution with minimum norm is used, which means no slope along the
+        # unknown direction.
+        coefs = numpy.linalg.lstsq(a, pts[:, 2], rcond=None)[0]
+        self._fit = x0, y0, scale, coefs
+
+    def predict(self, x, y):
+        """
+        Estimate the good focus position
+        x, y (float): stage position (m)
+        return (float or None): focus position (m), or None if no point is known
+        """
+        if not self._points:
+            return None
+        if self._fit is None:
+            self._fitSurface()
+        x0, y0, scale, coefs = self._fit
+        a = self._getTerms(numpy.array([(x - x0) / scale]), numpy.array([(y - y0) / scale]),
+                           len(self._points))
+        return float(a.dot(coefs)[0])
 
 
 class TiledAcquisitionTask(object):
@@ -93,12 +161,11 @@ class TiledAcquisitionTask(object):
         if self._focus_stream:
             # save initial focus value to be used in the AutoFocus function
             self._good_focus = self._focus_stream.focuser.position.value['z']
-            focuser_range = self._focus_stream.focuser.axes['z'].range
-            # Calculate the focus range by half the focus margin on each side of good focus
-            focus_rng = (self._good_focus - FOCUS_RANGE_MARGIN / 2, self._good_focus + FOCUS_RANGE_MARGIN / 2)
-            # Clip values with focuser_range
-            self._focus_rng = (max(focus_rng[0], focuser_range[0]), min((focus_rng[1], focuser_range[1])))
+            self._focus_rng = self._getFocusRange(self._good_focus)
             logging.debug("Calculated focus range ={}".format(self._focus_rng))
+            # Good focus positions found during the acquisition, to predict the
+            # focus on the next tiles
+            self._focus_map = FocusMap()
 
         self._stage = stage
         self._starting_pos = {'x': area[0], 'y': area[1]}  # left, top
@@ -156,6 +223,16 @@ class TiledAcquisitionTask(object):
         return (min(f[0] for f in fovs),
                 min(f[1] for f in fovs))
 
+    def _getFocusRange(self, good_focus):
+        """
+        Calculate the focus range by half the focus margin on each side of good focus
+        good_focus (float): focus position (m)
+        return (float, float): min/max focus position (m), clipped to the focuser range
+        """
+        focuser_range = self._focus_stream.focuser.axes['z'].range
+        focus_rng = (good_focus - FOCUS_RANGE_MARGIN / 2, good_focus + FOCUS_RANGE_MARGIN / 2)
+        return max(focus_rng[0], focuser_range[0]), min(focus_rng[1], focuser_range[1])
+
     def _getNumberOfTiles(self):
         """
         Calculate needed number of tiles (horizontal and vertical) to cover the whole area
@@ -205,24 +282,45 @@ class TiledAcquisitionTask(object):
 
             direction *= -1
 
+    def _getTilePosition(self, idx, tile_size):
+        """
+        Compute the stage position of a tile
+        :param idx: (tuple (float, float)) index of tile
+        :param tile_size: (tuple (float, float)) total tile size
+        :return: (float, float) x, y position of the stage (m)
+        """
+        overlap = 1 - self._overlap
+        return (self._starting_pos["x"] + idx[0] * tile_size[0] * overlap,
+                self._starting_pos["y"] - idx[1] * tile_size[1] * overlap)
+
     def _moveToTile(self, idx, prev_idx, tile_size):
         """
-        Move the stage to the tile position
+        Move the stage to the tile position. If the focus map can predict the
+        focus of the tile, the focus is moved at the same time.
         :param idx: (tuple (float, float)) current index of tile
         :param prev_idx: (tuple (float, float)) previous index of tile
         :param tile_size: (tuple (float, float)) total tile size
         """
         overlap = 1 - self._overlap
+        pos = self._getTilePosition(idx, tile_size)
         # don't move on the axis that is not supposed to have changed
         m = {}
         idx_change = numpy.subtract(idx, prev_idx)
         if idx_change[0]:
-            m["x"] = self._starting_pos["x"] + idx[0] * tile_size[0] * overlap
+            m["x"] = pos[0]
         if idx_change[1]:
-            m["y"] = self._starting_pos["y"] - idx[1] * tile_size[1] * overlap
+            m["y"] = pos[1]
 
         logging.debug("Moving to tile %s at %s m", idx, m)
         f = self._stage.moveAbs(m)
+
+        ff = None
+        if self._focus_stream and len(self._focus_map):
+            focuser = self._focus_stream.focuser
+            rng = focuser.axes["z"].range
+            z = min(max(rng[0], self._focus_map.predict(*pos)), rng[1])
+            logging.debug("Moving focus to predicted position %s m", z)
+            ff = focuser.moveAbs({"z": z})
         try:
             speed = min(self._stage.speed.value.values()) if model.hasVA(self._stage, "speed") else 10e-6
             # add 1 to make sure it doesn't time out in case of a very small move
@@ -234,6 +332,12 @@ class TiledAcquisitionTask(object):
             self._future.running_subf.cancel()
             # Continue acquiring anyway... maybe it has moved somewhere near
 
+        if ff is not None:
+            try:
+                ff.result(10)
+            except Exception:
+                logging.warning("Failed to move focus for tile %s", idx, exc_info=True)
+
     def _sortDAs(self, das, ss):
         """
         Sorts das based on priority for stitching, i.e. largest SEM da first, then
@@ -351,24 +455,40 @@ class TiledAcquisitionTask(object):
         return px
 
     MEMPP = 22  # bytes per pixel, found empirically
+    STITCHPP = 2  # bytes per pixel of the stitched image (typically uint16)
 
     def estimateMemory(self):
         """
         Makes an estimate for the amount of memory that will be consumed during
         stitching and compares it to the available memory on the computer.
+        The stitched images which are big enough to be stored on disk (see
+        model.allocateDataArray()) are compared to the space available in the
+        scratch directory instead.
         :returns (bool) True if sufficient memory available, (float) estimated memory
         """
-        # Number of pixels for acquisition
-        pxs = sum(self._estimateStreamPixels(s) for s in self._streams)
-        pxs *= self._nx * self._ny
+        # Number of pixels for acquisition, per stream
+        stream_pxs = [self._estimateStreamPixels(s) * self._nx * self._ny for s in self._streams]
+        pxs = sum(stream_pxs)
 
         # Memory calculation
         mem_est = pxs * self.MEMPP
         mem_computer = psutil.virtual_memory().total
-        logging.debug("Estimating %g GB needed, while %g GB available",
-                      mem_est / 1024 ** 3, mem_computer / 1024 ** 3)
+
+        # Part of the memory which will be on disk
+        mmap_threshold = model.getMemmapThreshold()
+        disk_est = 0
+        if mmap_threshold is not None:
+            disk_est = sum(p * self.STITCHPP for p in stream_pxs
+                           if p * self.STITCHPP >= mmap_threshold)
+
+        logging.debug("Estimating %g GB needed (of which %g GB on disk), while %g GB available",
+                      mem_est / 1024 ** 3, disk_est / 1024 ** 3, mem_computer / 1024 ** 3)
         # Assume computer is using 2 GB RAM for odemis and other programs
-        mem_sufficient = mem_est < mem_computer - (2 * 1024 ** 3)
+        mem_sufficient = mem_est - disk_est < mem_computer - (2 * 1024 ** 3)
+        if disk_est:
+            disk_computer = model.getScratchSpace()
+            logging.debug("%g GB available on disk", disk_computer / 1024 ** 3)
+            mem_sufficient = mem_sufficient and disk_est < disk_computer
 
         return mem_sufficient, mem_est
 
@@ -479,16 +599,24 @@ class TiledAcquisitionTask(object):
             # Use initial optical focus level to be compared to next tiles
             # TODO: instead of using the first image, use the best 10% images (excluding outliers)
             self._good_focus_level = current_focus_level
-        # Run autofocus if current focus got worse than permitted deviation
+
+        pos = self._getTilePosition((ix, iy), self._sfov)
+        # Run autofocus if current focus got worse than permitted deviation,
+        # which means the focus map failed to predict the focus of this tile
         if abs(current_focus_level - self._good_focus_level) / self._good_focus_level > FOCUS_FIDELITY:
+            good_focus = self._focus_map.predict(*pos)
+            if good_focus is None:
+                good_focus, focus_rng = self._good_focus, self._focus_rng
+            else:
+                focus_rng = self._getFocusRange(good_focus)
             try:
                 self._future.running_subf = AutoFocus(self._focus_stream.detector,
                                                       self._focus_stream.emitter,
                                                       self._focus_stream.focuser,
-                                                      good_focus=self._good_focus,
-                                                      rng_focus=self._focus_rng,
-                                                      method=MTD_EXHAUSTIVE)
-                self._future.running_subf.result()  # blocks until autofocus is finished
+                                                      good_focus=good_focus,
+                                                      rng_focus=focus_rng,
+                                                      method=MTD_PIPELINED)
+                foc_pos, foc_lev = self._future.running_subf.result()  # blocks until autofocus is finished
                 if self._future._task_state == CANCELLED:
                     raise CancelledError()
             except CancelledError:
@@ -496,8 +624,12 @@ class TiledAcquisitionTask(object):
             except Exception as ex:
                 logging.exception("Running autofocus failed on image i= %s." % i)
             else:
+                self._focus_map.add(pos[0], pos[1], foc_pos)
                 # Reacquire the out of focus tile (which should be corrected now)
                 das = self._acquireTile(i, ix, iy)
+        else:
+            # The focus is good, so it's a sample for the focus map
+            self._focus_map.add(pos[0], pos[1], self._focus_stream.focuser.position.value['z'])
         return das
 
     def _stitchTiles(self, da_list):
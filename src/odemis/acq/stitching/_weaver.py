@@ -111,7 +111,7 @@ class CollageWeaver(object):
         # Paste each tile
         logging.debug("Generating global image of size %dx%d px",
                       gbbx_px[-2], gbbx_px[-1])
-        im = numpy.empty((gbbx_px[-1], gbbx_px[-2]), dtype=tiles[0].dtype)
+        im = model.allocateDataArray((gbbx_px[-1], gbbx_px[-2]), tiles[0].dtype)
         # Use minimum of the values in the tiles for background
         im[:] = numpy.amin(tiles)
         for b, t in zip(tbbx_px, tiles):
@@ -198,7 +198,7 @@ class CollageWeaverReverse(object):
         # Paste each tile
         logging.debug("Generating global image of size %dx%d px",
                       gbbx_px[-2], gbbx_px[-1])
-        im = numpy.empty((gbbx_px[-1], gbbx_px[-2]), dtype=tiles[0].dtype)
+        im = model.allocateDataArray((gbbx_px[-1], gbbx_px[-2]), tiles[0].dtype)
         # Use minimum of the values in the tiles for background
         im[:] = numpy.amin(tiles)
 
@@ -311,7 +311,7 @@ class MeanWeaver(object):
         # Paste each tile
         logging.debug("Generating global image of size %dx%d px",
                       gbbx_px[-2], gbbx_px[-1])
-        im = numpy.empty((gbbx_px[-1], gbbx_px[-2]), dtype=tiles[0].dtype)
+        im = model.allocateDataArray((gbbx_px[-1], gbbx_px[-2]), tiles[0].dtype)
         # Use minimum of the values in the tiles for background
         im[:] = numpy.amin(tiles)
 
@@ -21,6 +21,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import logging
+import numpy
 import os
 import time
 import unittest
@@ -30,7 +31,7 @@ import odemis
 import odemis.acq.stream as stream
 from odemis import model
 from odemis.acq.acqmng import SettingsObserver
-from odemis.acq.stitching._tiledacq import TiledAcquisitionTask, acquireTiledArea
+from odemis.acq.stitching._tiledacq import TiledAcquisitionTask, acquireTiledArea, FocusMap
 from odemis.util import test
 from odemis.util.comp import compute_camera_fov
 from odemis.util.test import assert_pos_almost_equal
@@ -41,6 +42,57 @@ CONFIG_PATH = os.path.dirname(odemis.__file__) + "/../../install/linux/usr/share
 CRYOSECOM_CONFIG = CONFIG_PATH + "sim/cryosecom-sim.yaml"
 
 
+class FocusMapTestCase(unittest.TestCase):
+    """
+    Test the focus map estimation
+    """
+
+    def test_empty(self):
+        fm = FocusMap()
+        self.assertEqual(len(fm), 0)
+        self.assertIsNone(fm.predict(0, 0))
+
+    def test_flat(self):
+        fm = FocusMap()
+        fm.add(1e-3, 1e-3, 10e-6)
+        self.assertAlmostEqual(fm.predict(-1e-3, 5e-3), 10e-6)
+        fm.add(2e-3, 1e-3, 12e-6)
+        self.assertAlmostEqual(fm.predict(-1e-3, 5e-3), 11e-6)
+
+    def test_tilted(self):
+        """
+        A tilted sample is exactly predicted from 3 points, even far away
+        """
+        def tilted_focus(x, y):
+            return 20e-6 + 0.01 * x - 0.02 * y
+
+        fm = FocusMap()
+        for x, y in ((0, 0), (100e-6, 0), (0, -100e-6)):
+            fm.add(x, y, tilted_focus(x, y))
+        for x, y in ((1e-3, -1e-3), (-2e-3, 0.5e-3), (50e-6, 50e-6)):
+            self.assertAlmostEqual(fm.predict(x, y), tilted_focus(x, y), delta=1e-9)
+
+        # Points all on a line only predict along the line
+        fm = FocusMap()
+        for x in (0, 100e-6, 200e-6, 300e-6):
+            fm.add(x, 0, tilted_focus(x, 0))
+        self.assertAlmostEqual(fm.predict(1e-3, 0), tilted_focus(1e-3, 0), delta=1e-9)
+
+    def test_bent(self):
+        """
+        A bent sample is approximated by a quadratic surface
+        """
+        def bent_focus(x, y):
+            return 20e-6 + 0.01 * x + 5 * (x ** 2 + y ** 2)
+
+        fm = FocusMap()
+        for x in numpy.linspace(-1e-3, 1e-3, 4):
+            for y in numpy.linspace(-1e-3, 1e-3, 4):
+                fm.add(x, y, bent_focus(x, y))
+        for x, y in ((0, 0), (0.5e-3, -0.2e-3), (-0.9e-3, 0.9e-3)):
+            self.assertAlmostEqual(fm.predict(x, y), bent_focus(x, y), delta=1e-9)
+
+
 class CRYOSECOMTestCase(unittest.TestCase):
     backend_was_running = False
 
@@ -159,6 +211,30 @@ class CRYOSECOMTestCase(unittest.TestCase):
         exp_pos = {'x': -0.001, 'y': -0.001008}
         assert_pos_almost_equal(self.stage.position.value, exp_pos, atol=100e-9, match_all=False)
 
+    def test_move_to_tiles_focus_map(self):
+        """
+        Test the focus is moved to the position predicted by the focus map
+        """
+        area = (-0.001, -0.001, 0.001, 0.001)
+        overlap = 0.2
+        tiled_acq_task = TiledAcquisitionTask(self.fm_streams, self.stage,
+                                              area=area, overlap=overlap, future=model.InstantaneousFuture())
+        fov = (10 ** -5, 10 ** -5)
+        self.stage.moveAbs({'x': -0.001, 'y': -0.001}).result()
+        z0 = self.focus.position.value["z"]
+
+        # Tilted sample: focus changes by 1µm every 10µm along X
+        def tilted_focus(x, y):
+            return z0 + (x + 0.001) * 0.1
+
+        for x, y in ((-0.001, -0.001), (-0.00099, -0.001), (-0.001, -0.00101)):
+            tiled_acq_task._focus_map.add(x, y, tilted_focus(x, y))
+
+        tiled_acq_task._moveToTile((3, 0), (0, 0), fov)
+        pos = tiled_acq_task._getTilePosition((3, 0), fov)
+        self.assertAlmostEqual(self.focus.position.value["z"], tilted_focus(*pos), delta=100e-9)
+        self.focus.moveAbs({"z": z0}).result()
+
     def test_get_fov(self):
         """
         Test getting the fov for sem and fm streams
@@ -108,6 +108,10 @@ class Stream(object):
     # Minimum overhead time in seconds when acquiring an image
     SETUP_OVERHEAD = 0.1
 
+    # Maximum number of pixels used to compute the histogram. For larger images,
+    # only a regular subset of the pixels is used. None means all the pixels.
+    HISTOGRAM_MAX_PIXELS = None
+
     def __init__(self, name, detector, dataflow, emitter, focuser=None, opm=None,
                  hwdetvas=None, hwemtvas=None, detvas=None, emtvas=None, axis_map={},
                  raw=None, acq_type=None):
@@ -205,6 +209,10 @@ class Stream(object):
         self._drange = None  # min/max data range, or None if unknown
         self._drange_unreliable = True  # if current values are a rough guess (based on detector)
 
+        # To compute the histogram, reusing the buffers between images
+        self._histogram_lock = threading.Lock()
+        self._histogram_acc = None  # img.HistogramAccumulator or None
+
         # drange_raw is the smaller (less zoomed) image of an pyramidal image. It is used
         # instead of the full image because it would be too slow or even impossible to read
         # the full data from the image to the memory. It is also not the tiles from the tiled
@@ -1175,7 +1183,25 @@ class Stream(object):
         self._updateDRange(data)
 
         # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
+        if self._drange is None:
+            hist, edges = img.histogram(img.subsample(data, self.HISTOGRAM_MAX_PIXELS))
+        else:
+            with self._histogram_lock:
+                acc = self._histogram_acc
+                if acc is None or acc.irange != tuple(self._drange):
+                    acc = img.HistogramAccumulator(self._drange, max_pixels=self.HISTOGRAM_MAX_PIXELS)
+                    self._histogram_acc = acc
+                hist, edges = acc.compute(data)
+                hist = hist.copy()  # The accumulator reuses its buffer for the next image
+        self._setHistogram(hist, edges)
+
+    def _setHistogram(self, hist, edges):
+        """
+        Update the histogram VA
+        hist (ndarray of ints): the full histogram
+        edges (tuple of 2 numbers): the min/max values of the histogram
+        If will also update the intensityRange if auto_bc is enabled.
+        """
         if hist.size > 256:
             chist = img.compactHistogram(hist, 256)
         else:
@@ -41,6 +41,10 @@ class LiveStream(Stream):
     Abstract class for any stream that can do continuous acquisition.
     """
 
+    # The histogram is recomputed for every new image, so use only a subset of
+    # the pixels of large images (eg, 4096x4096 -> 1 pixel every 4x4 pixels).
+    HISTOGRAM_MAX_PIXELS = 1024 * 1024
+
     def __init__(self, name, detector, dataflow, emitter, forcemd=None, **kwargs):
         """
         forcemd (None or dict of MD_* -> value): force the metadata of the
@@ -68,6 +72,15 @@ class LiveStream(Stream):
         self._prev_dur = None
         self._prep_future = model.InstantaneousFuture()
 
+        # To handle the frames received by blocks of lines (partial frames)
+        self._raw_partial = False  # True if the latest data was a partial frame
+        self._lines_lock = threading.Lock()  # to update the raw data and the following attributes
+        self._updated_lines = None  # (int, int): first and last+1 lines not yet projected
+        # list of (int, DataArray, ndarray): offset, new and old lines not yet in the histogram
+        self._hist_blocks = []
+        self._lines_histogram_acc = None  # img.HistogramAccumulator of the raw data
+        self._last_projection = None  # (DataArray, list, tint): latest RGB image, irange and tint used
+
     def _find_metadata(self, md):
         simpl_md = super(LiveStream, self)._find_metadata(md)
 
@@ -186,6 +199,11 @@ class LiveStream(Stream):
         gc.collect()
 
     def _onNewData(self, dataflow, data):
+        if model.MD_LINE_OFFSET in data.metadata:
+            self._onNewLines(data)
+            return
+
+        self._raw_partial = False
         if not self.raw:
             self.raw.append(data)
         else:
@@ -194,6 +212,131 @@ class LiveStream(Stream):
         self._shouldUpdateHistogram()
         self._shouldUpdateImage()
 
+    def _onNewLines(self, data):
+        """
+        Update the raw data with a block of lines of a 2D frame (partial frame).
+        The lines not yet scanned keep the values of the previous frame.
+        data (DataArray): the lines, with MD_LINE_OFFSET and MD_FRAME_SHAPE
+        """
+        md = data.metadata.copy()
+        offset = md.pop(model.MD_LINE_OFFSET)
+        shape = tuple(md.pop(model.MD_FRAME_SHAPE))
+        nlines = data.shape[0]
+
+        with self._lines_lock:
+            prev = self.raw[0] if self.raw else None
+            if (not self._raw_partial or prev is None or
+                prev.shape != shape or prev.dtype != data.dtype):
+                # Different kind of frame => start from an empty one
+                raw = model.DataArray(numpy.zeros(shape, dtype=data.dtype), md)
+                self._lines_histogram_acc = None  # Needs a full recomputation
+                self._hist_blocks = []
+                self._updated_lines = (0, shape[0])
+            elif offset == 0:
+                # New frame: start from the previous one, so that it is still
+                # visible until the lines are scanned again. (Don't modify the
+                # previous frame in place, as it might be used somewhere else.)
+                raw = model.DataArray(prev.copy(), md)
+            else:
+                raw = prev
+
+            if self._lines_histogram_acc is not None:
+                self._hist_blocks.append((offset, data, raw[offset:offset + nlines].copy()))
+                if len(self._hist_blocks) > shape[0]:
+                    # Histogram not updated for a long time => it'll be faster
+                    # to just recompute it
+                    self._lines_histogram_acc = None
+                    self._hist_blocks = []
+
+            raw[offset:offset + nlines] = data
+
+            if self._updated_lines is None:
+                self._updated_lines = (offset, offset + nlines)
+            else:
+                self._updated_lines = (min(offset, self._updated_lines[0]),
+                                       max(offset + nlines, self._updated_lines[1]))
+
+            self._raw_partial = True
+            if not self.raw:
+                self.raw.append(raw)
+            else:
+                self.raw[0] = raw
+
+        self._shouldUpdateHistogram()
+        self._shouldUpdateImage()
+
+    def _updateHistogram(self, data=None):
+        if data is None and self._raw_partial and self.background.value is None:
+            self._updateHistogramLines()
+        else:
+            super(LiveStream, self)._updateHistogram(data)
+
+    def _updateHistogramLines(self):
+        """
+        Update the histogram of the raw data received by partial frames, by
+        only taking into account the lines received since the last update.
+        """
+        with self._lines_lock:
+            raw = self.raw[0]
+            blocks, self._hist_blocks = self._hist_blocks, []
+            # Depth can change at each image (depends on hardware settings)
+            for offset, new, old in blocks:
+                self._updateDRange(new)
+
+            acc = self._lines_histogram_acc
+            if (acc is None or self._drange is None or acc.shape != raw.shape or
+                acc.irange != tuple(self._drange)):
+                self._updateDRange(raw)
+                if self._drange is None:
+                    self._lines_histogram_acc = None
+                    hist, edges = img.histogram(img.subsample(raw, self.HISTOGRAM_MAX_PIXELS))
+                else:
+                    acc = img.HistogramAccumulator(self._drange, max_pixels=self.HISTOGRAM_MAX_PIXELS)
+                    hist, edges = acc.compute(raw)
+                    self._lines_histogram_acc = acc
+            else:
+                for offset, new, old in blocks:
+                    acc.update(new, offset, old)
+                hist, edges = acc.hist, acc.edges
+            hist = hist.copy()  # The accumulator reuses its buffer
+
+        self._setHistogram(hist, edges)
+
+    def _updateImage(self):
+        if self._raw_partial and self.background.value is None:
+            self._updateImageLines()
+        else:
+            self._last_projection = None
+            super(LiveStream, self)._updateImage()
+
+    def _updateImageLines(self):
+        """
+        Update the image of the raw data received by partial frames, by only
+        projecting the lines received since the last update.
+        """
+        with self._lines_lock:
+            raw = self.raw[0]
+            lines, self._updated_lines = self._updated_lines, None
+
+        try:
+            irange = self._getDisplayIRange()
+            tint = self.tint.value
+            prev = self._last_projection
+            if (lines is not None and prev is not None and
+                prev[0].shape[:2] == raw.shape and prev[1] == irange and prev[2] == tint):
+                rgbim = prev[0].copy()
+                rgbim[lines[0]:lines[1]] = img.DataArray2RGB(raw[lines[0]:lines[1]], irange, tint)
+            else:
+                rgbim = img.DataArray2RGB(raw, irange, tint)
+            rgbim.flags.writeable = False
+            md = self._find_metadata(raw.metadata)
+            md[model.MD_DIMS] = "YXC"  # RGB format
+            rgbim = model.DataArray(rgbim, md)
+            self._last_projection = (rgbim, irange, tint)
+            self.image.value = rgbim
+        except Exception:
+            logging.exception("Updating %s %s image", self.__class__.__name__, self.name.value)
+
     def _onBackground(self, data):
         """Called when the background is changed"""
 
@@ -238,17 +381,24 @@ class SEMStream(LiveStream):
     # (with .accelVotage, .spotSize, .power) and the scanner (with .resolution,
     # .scale, .rotation, etc). They'd need to be decoupled to fit this model.
 
-    def __init__(self, name, detector, dataflow, emitter, blanker=None, **kwargs):
+    def __init__(self, name, detector, dataflow, emitter, blanker=None, partial_frames=False, **kwargs):
         """
         emitter (Emitter): this is the scanner, with a .resolution and a .dwellTime
         blanker (BooleanVA or None): to control the blanker (False = disabled,
           when acquiring, and True = enabled, when stream is paused).
+        partial_frames (bool): if True, and the detector supports it, the
+          image is updated as soon as lines are scanned, instead of at the end
+          of each frame. Only useful for the live view.
         """
 
         if "acq_type" not in kwargs:
             kwargs["acq_type"] = model.MD_AT_EM
         super(SEMStream, self).__init__(name, detector, dataflow, emitter, **kwargs)
 
+        # Whether the frames are received by blocks of lines, when playing
+        self.partial_frames = model.BooleanVA(partial_frames)
+        self.partial_frames.subscribe(self._onPartialFrames)
+
         # To restart directly acquisition if settings change
         try:
             self._getEmitterVA("dwellTime").subscribe(self._onDwellTime)
@@ -351,6 +501,7 @@ class SEMStream(LiveStream):
     def _onActive(self, active):
         super(SEMStream, self)._onActive(active)
         if not active:
+            self._setPartialFrames(False)
             # blank the beam
             try:
                 if self._blanker:
@@ -358,9 +509,30 @@ class SEMStream(LiveStream):
             except Exception:
                 logging.exception("Failed to enable the blanker")
 
+    def _setPartialFrames(self, enabled):
+        """
+        Select whether the detector sends the frames by blocks of lines, if it
+        supports it.
+        """
+        if model.hasVA(self._detector, "partialFrames"):
+            try:
+                self._detector.partialFrames.value = enabled
+            except Exception:
+                logging.exception("Failed to change the partial frames of %s", self._detector.name)
+
+    def _onPartialFrames(self, enabled):
+        """
+        Called when the partial_frames VA is updated
+        """
+        # only change hw settings if stream is active
+        if self.is_active.value:
+            self._setPartialFrames(enabled)
+
     def _startAcquisition(self, future=None):
         # update Hw settings to our own ROI
         self._applyROI()
+        # Show the lines as soon as they are scanned, if requested
+        self._setPartialFrames(self.partial_frames.value)
 
         super(SEMStream, self)._startAcquisition()
 
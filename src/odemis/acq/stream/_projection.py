@@ -22,6 +22,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from collections import OrderedDict
 import threading
 import weakref
 import logging
@@ -39,13 +40,164 @@ except ImportError:
 
 from odemis import model
 from odemis.util import img, angleres
-from scipy import ndimage
+from scipy import sparse
 from odemis.model import MD_PIXEL_SIZE, MD_POL_EPHI, MD_POL_EX, MD_POL_EY, MD_POL_EZ, MD_POL_ETHETA, MD_POL_DS0, \
     MD_POL_S0, MD_POL_DOP, MD_POL_DOLP, MD_POL_UP
 from odemis.acq.stream._static import StaticSpectrumStream
 from abc import abstractmethod
 
 
+# Maximum amount of memory (in bytes) used to keep the data gathered on a disc
+# of pixels at once. Beyond, the pixels are summed by batches.
+MAX_DISC_BLOCK_SIZE = 64 * 2 ** 20
+
+
+def _get_disc_indices(x, y, width, shape):
+    """
+    Find the pixels which are within a disc centred on a given pixel.
+    x, y (int): centre of the disc
+    width (int): diameter of the disc, in pixels
+    shape (int, int): shape of the (spatial) data, as YX
+    return ys, xs (numpy.ndarray of int): the Y and X indices of all the pixels
+      whose centre is inside the disc (and inside the data).
+    """
+    radius = width / 2
+    pxs = numpy.arange(max(0, int(x - radius)), min(int(x + radius) + 1, shape[1]))
+    pys = numpy.arange(max(0, int(y - radius)), min(int(y + radius) + 1, shape[0]))
+    gys, gxs = numpy.meshgrid(pys, pxs, indexing="ij")
+    inside = numpy.hypot(x - gxs, y - gys) <= radius
+    return gys[inside], gxs[inside]
+
+
+def _mean_disc(data, x, y, width):
+    """
+    Average the data over all the pixels within a disc.
+    data (numpy.ndarray of shape ...YX): the data. The last two dimensions are
+      the spatial dimensions.
+    x, y (int): centre of the disc
+    width (int): diameter of the disc, in pixels
+    return (numpy.ndarray of float64 of shape ...): the mean over all the pixels
+      whose centre is inside the disc
+    """
+    ys, xs = _get_disc_indices(x, y, width, data.shape[-2:])
+    # Gather the pixels by batch, to avoid copying a huge part of the data at once
+    px_size = max(1, numpy.prod(data.shape[:-2]) * data.itemsize)
+    batch = max(1, int(MAX_DISC_BLOCK_SIZE // px_size))
+    datasum = numpy.zeros(data.shape[:-2], dtype=numpy.float64)
+    for i in range(0, len(ys), batch):
+        datasum += data[..., ys[i:i + batch], xs[i:i + batch]].sum(axis=-1, dtype=numpy.float64)
+
+    return datasum / len(ys)
+
+
+def _get_line_weights(start, end, width, shape):
+    """
+    Compute the weights to apply to each pixel of the data in order to
+    interpolate the values along a line (of a given width). The interpolation
+    is bi-linear, and equivalent to ndimage.map_coordinates(order=1), with the
+    points outside of the data counting as 0.
+    start, end (float, float): position of the beginning and end of the line, as XY
+    width (int): number of pixels to average perpendicular to the line
+    shape (int, int): shape of the (spatial) data, as YX
+    return:
+      pxs (numpy.ndarray of int): the (flattened) index of each pixel used
+      weights (scipy.sparse.csr_matrix of shape N, len(pxs)): the weight of each
+        pixel for each point on the line. N is the number of points on the line.
+    """
+    v = (end[0] - start[0], end[1] - start[1])
+    l = math.hypot(*v)
+    n = 1 + int(l)
+
+    # Coordinates of each point on the line, for each position along the width
+    xs = numpy.linspace(start[0], end[0], n)
+    ys = numpy.linspace(start[1], end[1], n)
+    # perpendicular unit vector
+    pv = (-v[1] / l, v[0] / l)
+    spread = (width - 1) / 2
+    xs = xs + numpy.linspace(pv[0] * -spread, pv[0] * spread, width)[:, numpy.newaxis]
+    ys = ys + numpy.linspace(pv[1] * -spread, pv[1] * spread, width)[:, numpy.newaxis]
+    rows = numpy.broadcast_to(numpy.arange(n), xs.shape)
+
+    # The points outside of the data are 0 (but still count in the mean)
+    inside = (xs >= 0) & (xs <= shape[1] - 1) & (ys >= 0) & (ys <= shape[0] - 1)
+    xs, ys, rows = xs[inside], ys[inside], rows[inside]
+
+    # The 4 neighbours of each point
+    x0 = numpy.clip(numpy.floor(xs).astype(numpy.intp), 0, max(shape[1] - 2, 0))
+    y0 = numpy.clip(numpy.floor(ys).astype(numpy.intp), 0, max(shape[0] - 2, 0))
+    x1 = numpy.minimum(x0 + 1, shape[1] - 1)
+    y1 = numpy.minimum(y0 + 1, shape[0] - 1)
+    fx = xs - x0
+    fy = ys - y0
+
+    idx = numpy.concatenate([y0 * shape[1] + x0, y0 * shape[1] + x1,
+                             y1 * shape[1] + x0, y1 * shape[1] + x1])
+    w = numpy.concatenate([(1 - fy) * (1 - fx), (1 - fy) * fx,
+                           fy * (1 - fx), fy * fx]) / width
+    rows = numpy.concatenate([rows] * 4)
+
+    # Only keep the pixels actually used, to select the minimum amount of data
+    pxs, cols = numpy.unique(idx, return_inverse=True)
+    weights = sparse.coo_matrix((w, (rows, cols.ravel())), shape=(n, len(pxs))).tocsr()
+    return pxs, weights
+
+
+class _ProjectionCache(object):
+    """
+    Keeps the latest computed projections, indexed by the selection used to
+    compute them. The cache is bounded in memory, and the least recently used
+    projections are discarded first.
+    """
+
+    def __init__(self, max_size=128 * 2 ** 20):
+        """
+        max_size (int): maximum memory used by the cached data, in bytes
+        """
+        self._max_size = max_size
+        self._cache = OrderedDict()  # key -> DataArray or None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        key (hashable): the selection
+        return (DataArray or None): the projection computed. The data must not
+          be modified.
+        raise KeyError: if the projection is not in the cache
+        """
+        with self._lock:
+            data = self._cache.pop(key)
+            self._cache[key] = data  # Move to the end = most recently used
+
+        if data is None:
+            return None
+        # Same data, but a separate metadata, as the caller might modify it
+        return model.DataArray(data, data.metadata.copy())
+
+    def put(self, key, data):
+        """
+        key (hashable): the selection
+        data (DataArray or None): the projection computed
+        """
+        size = 0 if data is None else data.nbytes
+        if size > self._max_size:
+            return
+        with self._lock:
+            if key in self._cache:
+                old = self._cache.pop(key)
+                self._size -= 0 if old is None else old.nbytes
+            self._cache[key] = data
+            self._size += size
+            while self._size > self._max_size:
+                _, old = self._cache.popitem(last=False)
+                self._size -= 0 if old is None else old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._size = 0
+
+
 class DataProjection(object):
 
     def __init__(self, stream):
@@ -1090,6 +1242,12 @@ class RGBSpatialProjection(RGBProjection):
             self._rawTilesCache = {}
             self._projectedTilesCache = {}
 
+            # If the data supports it, start fetching all the missing tiles
+            # simultaneously, instead of one at a time
+            if hasattr(das, "prefetchTiles"):
+                das.prefetchTiles([(x, y) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)
+                                   if "%d-%d-%d" % (x, y, z) not in prev_raw_cache], z)
+
             raw_tiles = []
             projected_tiles = []
             need_recompute = False
@@ -1345,6 +1503,12 @@ class LineSpectrumProjection(RGBProjection):
 
         super(LineSpectrumProjection, self).__init__(stream)
 
+        # Spectra already computed for the current data, to not recompute them
+        # when moving back to a previous selection.
+        self._cache = _ProjectionCache()
+        # (key, pxs, weights): the interpolation weights of the latest line
+        self._line_weights = (None, None, None)
+
         if model.hasVA(self.stream, "selected_time"):
             self.stream.selected_time.subscribe(self._on_selected_time)
         self.stream.selectionWidth.subscribe(self._on_selected_width)
@@ -1353,6 +1517,7 @@ class LineSpectrumProjection(RGBProjection):
         self._shouldUpdateImage()
 
     def _on_new_data(self, _):
+        self._cache.clear()
         self._shouldUpdateImage()
 
     def _on_selected_width(self, _):
@@ -1367,6 +1532,17 @@ class LineSpectrumProjection(RGBProjection):
     def _find_metadata(self, md):
         return md  # The data from _computeSpec() should already be correct
 
+    def _getLineWeights(self, start, end, width, shape):
+        """
+        Same as _get_line_weights(), but reuses the previous result if the
+        line is the same (eg, when only the time or the data changed).
+        """
+        key = (start, end, width, shape)
+        if self._line_weights[0] != key:
+            pxs, weights = _get_line_weights(start, end, width, shape)
+            self._line_weights = (key, pxs, weights)
+        return self._line_weights[1:]
+
     def _computeSpec(self):
         """
         Compute the 1D spectrum from the stream.calibrated VA using the
@@ -1375,9 +1551,9 @@ class LineSpectrumProjection(RGBProjection):
         return DataArray of of shape XC: the line spectrum
            the distance increases in X and the wavelength increases in C
         """
-
+        data = self.stream.calibrated.value
         if ((None, None) in self.stream.selected_line.value or
-                self.stream.calibrated.value.shape[0] == 1):
+                data.shape[0] == 1):
             return None
 
         if model.hasVA(self.stream, "selected_time"):
@@ -1385,56 +1561,48 @@ class LineSpectrumProjection(RGBProjection):
         else:
             t = 0
 
-        spec2d = self.stream.calibrated.value[:, t, 0, :, :]  # same data but remove useless dims
         width = self.stream.selectionWidth.value
 
         # Number of points to return: the length of the line
-        start, end = self.stream.selected_line.value
+        start, end = (tuple(p) for p in self.stream.selected_line.value)
         v = (end[0] - start[0], end[1] - start[1])
         l = math.hypot(*v)
         n = 1 + int(l)
         if l < 1:  # a line of just one pixel is considered not valid
             return None
 
+        key = (id(data), start, end, width, int(t))
+        try:
+            return self._cache.get(key)
+        except KeyError:
+            pass
+
+        spec2d = data[:, t, 0, :, :]  # same data but remove useless dims
+
         # FIXME: if the data has a width of 1 (ie, just a line), and the
         # requested width is an even number, the output is empty (because all
         # the interpolated points are outside of the data.
 
-        # Coordinates of each point: ndim of data (5-2), pos on line (Y), spectrum (X)
         # The line is scanned from the end till the start so that the spectra
         # closest to the origin of the line are at the bottom.
-        coord = numpy.empty((3, width, n, spec2d.shape[0]))
-        coord[0] = numpy.arange(spec2d.shape[0])  # spectra = all
-        coord_spc = coord.swapaxes(2, 3)  # just a view to have (line) space as last dim
-        coord_spc[-1] = numpy.linspace(start[0], end[0], n)  # X axis
-        coord_spc[-2] = numpy.linspace(start[1], end[1], n)  # Y axis
-
-        # Spread over the width
-        # perpendicular unit vector
-        pv = (-v[1] / l, v[0] / l)
-        width_coord = numpy.empty((2, width))
-        spread = (width - 1) / 2
-        width_coord[-1] = numpy.linspace(pv[0] * -spread, pv[0] * spread, width)  # X axis
-        width_coord[-2] = numpy.linspace(pv[1] * -spread, pv[1] * spread, width)  # Y axis
-
-        coord_cw = coord[1:].swapaxes(0, 2).swapaxes(1, 3)  # view with coordinates and width as last dims
-        coord_cw += width_coord
-
-        # Interpolate the values based on the data
+        # The interpolation weights only depend on the line, so they are
+        # computed once, and applied to all the wavelengths at once.
+        # FIXME: the mean should be dependent on how many pixels inside the
+        # original data were pick on each line. Currently if some pixels fall
+        # out of the original data, the outside pixels count as 0.
+        pxs, weights = self._getLineWeights(start, end, width, spec2d.shape[-2:])
+        # Only pick the pixels used (as CX), which is much smaller than the whole data
+        spec_pxs = spec2d.reshape(spec2d.shape[0], -1)[:, pxs]
+        spec1d = weights.dot(spec_pxs.T.astype(numpy.float64))
         if width == 1:
-            # simple version for the most usual case
-            spec1d = ndimage.map_coordinates(spec2d, coord[:, 0, :, :], order=1)
-        else:
-            # FIXME: the mean should be dependent on how many pixels inside the
-            # original data were pick on each line. Currently if some pixels fall
-            # out of the original data, the outside pixels count as 0.
-            # force the intermediate values to float, as mean() still needs to run
-            spec1d_w = ndimage.map_coordinates(spec2d, coord, output=numpy.float, order=1)
-            spec1d = spec1d_w.mean(axis=0)
+            # simple version for the most usual case: keep the same type as the data
+            if spec2d.dtype.kind in "iu":
+                spec1d = numpy.round(spec1d)
+            spec1d = spec1d.astype(spec2d.dtype)
         assert spec1d.shape == (n, spec2d.shape[0])
 
         # Use metadata to indicate spatial distance between pixel
-        pxs_data = self.stream.calibrated.value.metadata[MD_PIXEL_SIZE]
+        pxs_data = data.metadata[MD_PIXEL_SIZE]
 
         if pxs_data[0] is not None:
             pxs = math.hypot(v[0] * pxs_data[0], v[1] * pxs_data[1]) / (n - 1)
@@ -1442,11 +1610,11 @@ class LineSpectrumProjection(RGBProjection):
             logging.warning("Pixel size should have two dimensions")
             return None
 
-        raw_md = self.stream.calibrated.value.metadata
-        md = raw_md.copy()
+        md = data.metadata.copy()
         md[model.MD_DIMS] = "XC"  # wavelength horizontal, distance vertical
         md[MD_PIXEL_SIZE] = (None, pxs)  # for the spectrum, use get_spectrum_range()
-        return model.DataArray(spec1d, md)
+        self._cache.put(key, model.DataArray(spec1d, md))
+        return model.DataArray(spec1d, md.copy())
 
     def projectAsRaw(self):
         try:
@@ -1506,6 +1674,8 @@ class PixelTemporalSpectrumProjection(RGBProjection):
     def __init__(self, stream):
 
         super(PixelTemporalSpectrumProjection, self).__init__(stream)
+        # Temporal spectra already computed for the current data
+        self._cache = _ProjectionCache()
         self.stream.selectionWidth.subscribe(self._on_selection_width)
         self.stream.selected_pixel.subscribe(self._on_selected_pixel)
         self.stream.calibrated.subscribe(self._on_new_data)
@@ -1513,6 +1683,7 @@ class PixelTemporalSpectrumProjection(RGBProjection):
         self._shouldUpdateImage()
 
     def _on_new_data(self, _):
+        self._cache.clear()
         self._shouldUpdateImage()
 
     def _on_selection_width(self, _):
@@ -1540,7 +1711,7 @@ class PixelTemporalSpectrumProjection(RGBProjection):
 
         x, y = self.stream.selected_pixel.value
 
-        spec2d = self.stream.calibrated.value[:, :, 0, :, :]  # same data but remove useless dims
+        spec2d = data[:, :, 0, :, :]  # same data but remove useless dims
         md = dict(data.metadata)
         md[model.MD_DIMS] = "TC"
 
@@ -1552,26 +1723,16 @@ class PixelTemporalSpectrumProjection(RGBProjection):
             data = numpy.swapaxes(data, 0, 1)
             return model.DataArray(data, md)
 
-        # There are various ways to do it with numpy. As typically the spectrum
-        # dimension is big, and the number of pixels to sum is small, it seems
-        # the easiest way is to just do some kind of "clever" mean. Using a
-        # masked array would also work, but that'd imply having a huge mask.
-        radius = width / 2
-        n = 0
-        # TODO: use same cleverness as mean() for dtype?
-        datasum = numpy.zeros((spec2d.shape[0], spec2d.shape[1]), dtype=numpy.float64)
-        # Scan the square around the point, and only pick the points in the circle
-        for px in range(max(0, int(x - radius)),
-                        min(int(x + radius) + 1, spec2d.shape[-1])):
-            for py in range(max(0, int(y - radius)),
-                            min(int(y + radius) + 1, spec2d.shape[-2])):
-                if math.hypot(x - px, y - py) <= radius:
-                    n += 1
-                    datasum += spec2d[:, :, py, px]
-
-        mean = datasum / n
-        mean = numpy.swapaxes(mean, 0, 1)
-        return model.DataArray(mean.astype(spec2d.dtype), md)
+        key = (id(data), x, y, width)
+        try:
+            return self._cache.get(key)
+        except KeyError:
+            pass
+
+        mean = _mean_disc(spec2d, x, y, width)
+        mean = numpy.swapaxes(mean, 0, 1).astype(spec2d.dtype)
+        self._cache.put(key, model.DataArray(mean, md))
+        return model.DataArray(mean, md.copy())
 
     def projectAsRaw(self):
         """
@@ -1639,6 +1800,8 @@ class SinglePointSpectrumProjection(DataProjection):
     def __init__(self, stream):
 
         super(SinglePointSpectrumProjection, self).__init__(stream)
+        # Spectra already computed for the current data
+        self._cache = _ProjectionCache()
         self.stream.selected_pixel.subscribe(self._on_selected_pixel)
         self.stream.selectionWidth.subscribe(self._on_selected_width)
         if model.hasVA(self.stream, "selected_time"):
@@ -1646,6 +1809,7 @@ class SinglePointSpectrumProjection(DataProjection):
         self.stream.calibrated.subscribe(self._on_new_spec_data, init=True)
 
     def _on_new_spec_data(self, _):
+        self._cache.clear()
         self._shouldUpdateImage()
 
     def _on_selected_pixel(self, _):
@@ -1674,7 +1838,7 @@ class SinglePointSpectrumProjection(DataProjection):
             t = numpy.searchsorted(self.stream._tl_px_values, self.stream.selected_time.value)
         else:
             t = 0
-        spec2d = self.stream.calibrated.value[:, t, 0, :, :]  # same data but remove useless dims
+        spec2d = data[:, t, 0, :, :]  # same data but remove useless dims
 
         md = dict(data.metadata)
         md[model.MD_DIMS] = "C"
@@ -1686,26 +1850,15 @@ class SinglePointSpectrumProjection(DataProjection):
             data = spec2d[:, y, x]
             return model.DataArray(data, md)
 
-        # There are various ways to do it with numpy. As typically the spectrum
-        # dimension is big, and the number of pixels to sum is small, it seems
-        # the easiest way is to just do some kind of "clever" mean. Using a
-        # masked array would also work, but that'd imply having a huge mask.
-        radius = width / 2
-        n = 0
-        # TODO: use same cleverness as mean() for dtype?
-        datasum = numpy.zeros(spec2d.shape[0], dtype=numpy.float64)
-        # Scan the square around the point, and only pick the points in the circle
-        for px in range(max(0, int(x - radius)),
-                        min(int(x + radius) + 1, spec2d.shape[-1])):
-            for py in range(max(0, int(y - radius)),
-                            min(int(y + radius) + 1, spec2d.shape[-2])):
-                if math.hypot(x - px, y - py) <= radius:
-                    n += 1
-                    datasum += spec2d[:, py, px]
-
-        mean = datasum / n
-
-        return model.DataArray(mean, md)
+        key = (id(data), x, y, width, int(t))
+        try:
+            return self._cache.get(key)
+        except KeyError:
+            pass
+
+        mean = _mean_disc(spec2d, x, y, width)
+        self._cache.put(key, model.DataArray(mean, md))
+        return model.DataArray(mean, md.copy())
 
     def projectAsRaw(self):
         return self._computeSpec()
@@ -1773,24 +1926,7 @@ class SinglePointTemporalProjection(DataProjection):
             data = chrono2d[:, y, x]
             return model.DataArray(data, md)
 
-        # There are various ways to do it with numpy. As typically the spectrum
-        # dimension is big, and the number of pixels to sum is small, it seems
-        # the easiest way is to just do some kind of "clever" mean. Using a
-        # masked array would also work, but that'd imply having a huge mask.
-        radius = width / 2
-        n = 0
-        # TODO: use same cleverness as mean() for dtype?
-        datasum = numpy.zeros(chrono2d.shape[0], dtype=numpy.float64)
-        # Scan the square around the point, and only pick the points in the circle
-        for px in range(max(0, int(x - radius)),
-                        min(int(x + radius) + 1, chrono2d.shape[-1])):
-            for py in range(max(0, int(y - radius)),
-                            min(int(y + radius) + 1, chrono2d.shape[-2])):
-                if math.hypot(x - px, y - py) <= radius:
-                    n += 1
-                    datasum += chrono2d[:, py, px]
-
-        mean = datasum / n
+        mean = _mean_disc(chrono2d, x, y, width)
         return model.DataArray(mean.astype(chrono2d.dtype), md)
 
     def projectAsRaw(self):
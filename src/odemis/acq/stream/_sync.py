@@ -681,11 +681,17 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
         # N = len(data_list)
         T, S = data_list[0].shape
         X, Y = rep
-        # copy into one big array N, Y, X
-        arr = numpy.array(data_list)
+
+        # start with the metadata from the first point
+        md = data_list[0].metadata.copy()
+        center, pxs = self._get_center_pxs(rep, (T, S), data_list[0])
+        md.update({MD_POS: center,
+                   MD_PIXEL_SIZE: pxs})
 
         if T == 1 and S == 1:
             # fast path: the data is already ordered just copy
+            # copy into one big array N, Y, X
+            arr = numpy.array(data_list)
             # reshape to get a 2D image
             # check if number of px scans (rep) is equal to number of images acquired (arr)
             # else: multiple images for same pixel were acquired (e.g. multiple polarization settings)
@@ -696,25 +702,17 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
                 arr.shape = rep[::-1] + (im_px,)
                 # average images
                 arr = numpy.mean(arr, 2).astype(data_list[0].dtype)
+            return model.DataArray(arr, md)
 
-        else:
-            # need to reorder data by tiles
-            # change N to Y, X
-            arr.shape = (Y, X, T, S)
-            # change to Y, T, X, S by moving the "T" axis
-            arr = numpy.rollaxis(arr, 2, 1)
-            # and apply the change in memory (= 1 copy)
-            arr = numpy.ascontiguousarray(arr)
-            # reshape to apply the tiles
-            arr.shape = (Y * T, X * S)
+        # need to reorder data by tiles: copy each tile at its place in the
+        # final image (X first, then Y). It can be big, so allocate it via the
+        # model, which may store it on disk.
+        arr = model.allocateDataArray((Y * T, X * S), data_list[0].dtype, md)
+        for i, d in enumerate(data_list):
+            y, x = divmod(i, X)
+            arr[y * T:(y + 1) * T, x * S:(x + 1) * S] = d
 
-        # start with the metadata from the first point
-        md = data_list[0].metadata.copy()
-        center, pxs = self._get_center_pxs(rep, (T, S), data_list[0])
-        md.update({MD_POS: center,
-                   MD_PIXEL_SIZE: pxs})
-
-        return model.DataArray(arr, md)
+        return arr
 
     def _assembleAnchorData(self, data_list):
         """
@@ -823,7 +821,7 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
             md.update({MD_POS: center,
                        MD_PIXEL_SIZE: pxs,
                        MD_DESCRIPTION: self._streams[n].name.value})
-            da = model.DataArray(numpy.zeros(shape=rep[::-1] * numpy.array(tile_shape), dtype=raw_data.dtype), md)
+            da = model.allocateDataArray(rep[::-1] * numpy.array(tile_shape), raw_data.dtype, md)
             self._live_data[n].append(da)
             self._acq_mask = numpy.zeros(shape=rep[::-1] * numpy.array(tile_shape), dtype=numpy.bool)
 
@@ -860,7 +858,7 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
             md.update({MD_POS: center,
                        MD_PIXEL_SIZE: pxs,
                        MD_DESCRIPTION: self._streams[n].name.value})
-            da = model.DataArray(numpy.zeros(shape=rep[::-1], dtype=raw_data.dtype), md)
+            da = model.allocateDataArray(rep[::-1], raw_data.dtype, md)
             self._live_data[n].append(da)
             self._acq_mask = numpy.zeros(rep[::-1], dtype=numpy.bool)
 
@@ -2167,8 +2165,8 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
             md[MD_DESCRIPTION] = self._streams[n].name.value
 
             # Shape of spectrum data = C11YX
-            da = numpy.zeros(shape=(spec_shape[1], 1, 1, rep[1], rep[0]), dtype=raw_data.dtype)
-            self._live_data[n].append(model.DataArray(da, md))
+            da = model.allocateDataArray((spec_shape[1], 1, 1, rep[1], rep[0]), raw_data.dtype, md)
+            self._live_data[n].append(da)
 
         self._live_data[n][pol_idx][:, 0, 0, px_idx[0], px_idx[1]] = raw_data.reshape(spec_shape[1])
 
@@ -2454,8 +2452,8 @@ class SEMTemporalSpectrumMDStream(SEMCCDMDStream):
             md[MD_DESCRIPTION] = self._streams[n].name.value
 
             # Shape of spectrum data = CT1YX
-            da = numpy.zeros(shape=(spec_res, temp_res, 1, rep[1], rep[0]), dtype=raw_data.dtype)
-            self._live_data[n].append(model.DataArray(da, md))
+            da = model.allocateDataArray((spec_res, temp_res, 1, rep[1], rep[0]), raw_data.dtype, md)
+            self._live_data[n].append(da)
 
         # Detector image has a shape of (time, lambda)
         raw_data = raw_data.T  # transpose to (lambda, time)
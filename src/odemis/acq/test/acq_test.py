@@ -208,6 +208,29 @@ class SECOMTestCase(unittest.TestCase):
         self.assertTrue(self.done)
         self.assertTrue(f.cancelled())
 
+    def test_sem_partial_frames(self):
+        """
+        Check that a SEM stream updated by blocks of lines still acquires whole frames
+        """
+        self.ebeam.dwellTime.value = 1e-6
+        for partial_frames in (False, True):
+            sems = stream.SEMStream("sem", self.sed, self.sed.data, self.ebeam,
+                                    partial_frames=partial_frames)
+            sems.roi.value = (0.1, 0.1, 0.9, 0.9)
+
+            f = acqmng.acquire([sems])
+            data, e = f.result(30)
+            self.assertIsNone(e)
+            self.assertEqual(len(data), 1)
+            self.assertEqual(data[0].shape[::-1], self.ebeam.resolution.value)
+            # The simulated image has no black line, so a line full of 0's is
+            # a line which was never scanned
+            empty_lines = numpy.all(data[0] == 0, axis=1)
+            self.assertFalse(numpy.any(empty_lines),
+                             "%d lines not filled" % numpy.count_nonzero(empty_lines))
+            # The stream setting is back to its original value
+            self.assertEqual(sems.partial_frames.value, partial_frames)
+
     def on_done(self, future):
         self.done = True
 
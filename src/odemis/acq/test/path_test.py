@@ -59,6 +59,22 @@ SPARC2_POLARIZATIONANALYZER_CONFIG = CONFIG_PATH + "sim/sparc2-polarizer-sim.odm
 SPARC2_4SPEC_CONFIG = CONFIG_PATH + "sim/sparc2-4spec-sim.odm.yaml"
 
 
+class ReachabilityTestCase(unittest.TestCase):
+
+    def test_simple(self):
+        graph = {"a": {"b"}, "b": {"c", "d"}, "c": set(), "d": {"b"}, "e": {"a"}}
+        reachable = path.reachabilityIndex(graph)
+        self.assertEqual(reachable["a"], {"a", "b", "c", "d"})
+        self.assertEqual(reachable["b"], {"b", "c", "d"})  # loop b <-> d
+        self.assertEqual(reachable["c"], {"c"})
+        self.assertEqual(reachable["e"], {"a", "b", "c", "d", "e"})
+
+    def test_unknown_node(self):
+        # A component can affect a component not in the graph (eg, not running)
+        reachable = path.reachabilityIndex({"a": {"x"}})
+        self.assertEqual(reachable, {"a": {"a", "x"}})
+
+
 # @skip("faster")
 class SimPathTestCase(unittest.TestCase):
     """
@@ -605,6 +621,28 @@ class Sparc2PathTestCase(unittest.TestCase):
         guess = self.optmngr.guessMode(sps)
         self.assertEqual(guess, "spectral")
 
+    # @skip("simple")
+    def test_affects(self):
+        """
+        Check the reachability index gives the same results as a path search
+        """
+        names = [c.name for c in model.getComponents()]
+        for a in names:
+            for b in names:
+                has_path = self.optmngr.findPath(a, b) is not None
+                self.assertEqual(self.optmngr.affects(a, b), has_path,
+                                 "%s -> %s" % (a, b))
+
+        # Memoized moves are reused, and give the same result
+        self.optmngr.setPath("spectral").result()
+        mode_comps = self.optmngr._mode_comps[("spectral", self.spec.name)]
+        self.optmngr.setPath("ar").result()
+        self.optmngr.setPath("spectral").result()
+        self.assertIs(self.optmngr._mode_comps[("spectral", self.spec.name)], mode_comps)
+        self.assertEqual(self.optmngr.guessMode(
+            stream.SpectrumSettingsStream("test spec", self.spec, self.spec.data, self.ebeam)),
+            "spectral")
+
 #   @skip("simple")
     def test_set_path_stream(self):
         sems = stream.SEMStream("test sem", self.sed, self.sed.data, self.ebeam)
@@ -1026,6 +1064,26 @@ class Sparc2ExtSpecPathTestCase(unittest.TestCase):
         spec_sel_pos = self.spec_sel.position.value["x"]
         self.assertAlmostEqual(spec_sel_pos, act_pos["x"])
 
+    # @skip("simple")
+    def test_set_path_fav_pos_change(self):
+        """
+        Check that a change of the favourite positions (eg, during alignment)
+        is taken into account the next time the path is set
+        """
+        orig_act_pos = self.spec_sel.getMetadata()[model.MD_FAV_POS_ACTIVE]
+        try:
+            self.optmngr.setPath("fiber-align").result()
+            self.assertAlmostEqual(self.spec_sel.position.value["x"], orig_act_pos["x"])
+
+            self.optmngr.setPath("chamber-view").result()
+            new_act_pos = {"x": orig_act_pos["x"] + 0.5e-3}
+            self.spec_sel.updateMetadata({model.MD_FAV_POS_ACTIVE: new_act_pos})
+
+            self.optmngr.setPath("fiber-align").result()
+            self.assertAlmostEqual(self.spec_sel.position.value["x"], new_act_pos["x"])
+        finally:
+            self.spec_sel.updateMetadata({model.MD_FAV_POS_ACTIVE: orig_act_pos})
+
     # @skip("simple")
     def test_guess_mode(self):
         # test guess mode for ar
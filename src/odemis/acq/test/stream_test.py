@@ -33,7 +33,7 @@ from odemis.acq.leech import ProbeCurrentAcquirer
 from odemis.acq.stream import POL_POSITIONS, POL_POSITIONS_RESULTS
 from odemis.acq.stream import RGBSpatialSpectrumProjection, \
     SinglePointSpectrumProjection, SinglePointTemporalProjection, \
-    LineSpectrumProjection, MeanSpectrumProjection
+    LineSpectrumProjection, MeanSpectrumProjection, PixelTemporalSpectrumProjection
 from odemis.dataio import tiff, hdf5
 from odemis.driver import simcam
 from odemis.model import MD_POL_NONE, MD_POL_HORIZONTAL, MD_POL_VERTICAL, \
@@ -42,6 +42,7 @@ from odemis.util import test, conversion, img, spectrum, find_closest
 from odemis.util.test import assert_array_not_equal
 import os
 from past.builtins import long
+from scipy import ndimage
 import threading
 import time
 import unittest
@@ -321,6 +322,67 @@ class StreamTestCase(unittest.TestCase):
         self.assertLessEqual(len(h), 1024)
         self.assertEqual((ir[0][0], ir[1][1]), (0, (2 ** 12) - 1))
 
+    def test_partial_frames(self):
+        """
+        Check the histogram and image computed incrementally, when the frames
+        are received by blocks of lines, are the same as computed on the whole
+        frame
+        """
+        ebeam = FakeEBeam("ebeam")
+        se = FakeDetector("se")
+        ss = stream.SEMStream("test", se, se.data, ebeam, partial_frames=True)
+        # Reference stream, which receives the whole frames
+        se_ref = FakeDetector("se ref")
+        ss_ref = stream.SEMStream("ref", se_ref, se_ref.data, ebeam)
+        for s in (ss, ss_ref):
+            s.auto_bc.value = False
+            s.intensityRange.value = (100, 3000)
+            s.should_update.value = True
+            s.is_active.value = True
+
+        shape = (64, 80)
+        md = {model.MD_BPP: 12,
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6),  # m/px
+              model.MD_POS: (1e-3, -30e-3),  # m
+              }
+
+        def send_lines(frame, start, end, nlines=10):
+            for offset in range(start, end, nlines):
+                lmd = md.copy()
+                lmd[model.MD_LINE_OFFSET] = offset
+                lmd[model.MD_FRAME_SHAPE] = shape
+                se.data.notify(model.DataArray(frame[offset:min(offset + nlines, end)], lmd))
+                # Sometimes, give time to update the histogram and image
+                time.sleep(0.3 if offset % 30 == 0 else 0.01)
+
+        def check_same(full):
+            se_ref.data.notify(model.DataArray(full, md.copy()))
+            time.sleep(1)  # make sure all the delayed code is executed
+            numpy.testing.assert_array_equal(ss.raw[0], full)
+            numpy.testing.assert_array_equal(ss.histogram.value, ss_ref.histogram.value)
+            numpy.testing.assert_array_equal(ss.histogram._full_hist, ss_ref.histogram._full_hist)
+            numpy.testing.assert_array_equal(ss.image.value, ss_ref.image.value)
+
+        # First frame, entirely scanned
+        frame1 = numpy.random.randint(0, 4096, shape).astype(numpy.uint16)
+        send_lines(frame1, 0, shape[0])
+        check_same(frame1)
+
+        # Next frame, restarting at offset 0, and only half scanned => the end
+        # of the previous frame is still there
+        frame2 = numpy.random.randint(0, 2048, shape).astype(numpy.uint16)
+        send_lines(frame2, 0, shape[0] // 2)
+        full = frame1.copy()
+        full[:shape[0] // 2] = frame2[:shape[0] // 2]
+        check_same(full)
+
+        # Rest of the frame
+        send_lines(frame2, shape[0] // 2, shape[0], nlines=7)
+        check_same(frame2)
+
+        for s in (ss, ss_ref):
+            s.is_active.value = False
+
     def test_hwvas(self):
         ebeam = FakeEBeam("ebeam")
         se = FakeDetector("se")
@@ -4693,6 +4755,143 @@ class StaticStreamsTestCase(unittest.TestCase):
                         self.assertListEqual(proj_point_chrono.image.value.tolist(),
                                              temporalspectrum[wl_index, :, 0, y, x].tolist())
 
+    @staticmethod
+    def _ref_mean_disc(data, x, y, width):
+        """
+        Reference (slow) computation of the mean of the pixels within a disc
+        data (ndarray of shape ...YX)
+        return (ndarray of shape ...): the mean over the disc
+        """
+        radius = width / 2
+        n = 0
+        datasum = numpy.zeros(data.shape[:-2], dtype=numpy.float64)
+        for px in range(max(0, int(x - radius)), min(int(x + radius) + 1, data.shape[-1])):
+            for py in range(max(0, int(y - radius)), min(int(y + radius) + 1, data.shape[-2])):
+                if math.hypot(x - px, y - py) <= radius:
+                    n += 1
+                    datasum += data[..., py, px]
+        return datasum / n
+
+    @staticmethod
+    def _ref_line_spectrum(spec2d, start, end, width):
+        """
+        Reference (slow) computation of the line spectrum, by interpolating the
+        whole data with ndimage.map_coordinates()
+        spec2d (ndarray of shape CYX)
+        return (ndarray of shape XC)
+        """
+        v = (end[0] - start[0], end[1] - start[1])
+        l = math.hypot(*v)
+        n = 1 + int(l)
+        coord = numpy.empty((3, width, n, spec2d.shape[0]))
+        coord[0] = numpy.arange(spec2d.shape[0])
+        coord_spc = coord.swapaxes(2, 3)
+        coord_spc[-1] = numpy.linspace(start[0], end[0], n)
+        coord_spc[-2] = numpy.linspace(start[1], end[1], n)
+        pv = (-v[1] / l, v[0] / l)
+        width_coord = numpy.empty((2, width))
+        spread = (width - 1) / 2
+        width_coord[-1] = numpy.linspace(pv[0] * -spread, pv[0] * spread, width)
+        width_coord[-2] = numpy.linspace(pv[1] * -spread, pv[1] * spread, width)
+        coord_cw = coord[1:].swapaxes(0, 2).swapaxes(1, 3)
+        coord_cw += width_coord
+        spec1d_w = ndimage.map_coordinates(spec2d, coord, output=numpy.float64, order=1)
+        return spec1d_w.mean(axis=0)
+
+    def test_temporal_spectrum_selection_speed(self):
+        """
+        Check the latency of the projections when moving the selection over a
+        temporal spectrum, as it happens when the user moves the pointer.
+        The durations are only reported, as they depend on the computer.
+        """
+        temporalspectrum = self._create_temporal_spectrum_data()
+        tss = stream.StaticSpectrumStream("test temporal spectrum speed", temporalspectrum)
+        proj_point_spectrum = SinglePointSpectrumProjection(tss)
+        proj_temporal_spectrum = PixelTemporalSpectrumProjection(tss)
+        proj_line_spectrum = LineSpectrumProjection(tss)
+        time.sleep(0.5)
+
+        tss.selectionWidth.value = 5
+        positions = [(x, y) for y in range(2, 18, 3) for x in range(2, 28, 3)]
+
+        # First pass: everything has to be computed
+        tstart = time.time()
+        for p in positions:
+            tss.selected_pixel.value = p
+            tss.selected_line.value = [(1, 1), p]
+            proj_point_spectrum.projectAsRaw()
+            proj_temporal_spectrum.projectAsRaw()
+            proj_line_spectrum.projectAsRaw()
+        dur_compute = (time.time() - tstart) / len(positions)
+        logging.info("Took %g ms per selection change", dur_compute * 1000)
+
+        # Second pass: going back to the same positions should use the cache
+        tstart = time.time()
+        for p in positions:
+            tss.selected_pixel.value = p
+            tss.selected_line.value = [(1, 1), p]
+            proj_point_spectrum.projectAsRaw()
+            proj_temporal_spectrum.projectAsRaw()
+            proj_line_spectrum.projectAsRaw()
+        dur_cached = (time.time() - tstart) / len(positions)
+        logging.info("Took %g ms per selection change, with cache", dur_cached * 1000)
+
+    def test_temporal_spectrum_selection(self):
+        """
+        Check the projections when moving the selection over a temporal spectrum,
+        as it happens when the user moves the pointer, compared to a
+        straightforward computation.
+        """
+        temporalspectrum = self._create_temporal_spectrum_data()
+        tss = stream.StaticSpectrumStream("test temporal spectrum selection", temporalspectrum)
+        proj_point_spectrum = SinglePointSpectrumProjection(tss)
+        proj_temporal_spectrum = PixelTemporalSpectrumProjection(tss)
+        proj_line_spectrum = LineSpectrumProjection(tss)
+        time.sleep(0.5)
+
+        tss.selectionWidth.value = 5
+        # Also go along the borders, where part of the selection is outside of the data
+        start = (2, 3)
+        positions = [(x, y) for y in (0, 1, 5, 9, 13, 18, 19) for x in (0, 1, 7, 14, 21, 28, 29)]
+        t = numpy.searchsorted(tss._tl_px_values, tss.selected_time.value)
+        data = tss.calibrated.value
+
+        # First pass: everything has to be computed
+        specs = {}
+        for p in positions:
+            tss.selected_pixel.value = p
+            tss.selected_line.value = [start, p]
+            specs[p] = (proj_point_spectrum.projectAsRaw(),
+                        proj_temporal_spectrum.projectAsRaw(),
+                        proj_line_spectrum.projectAsRaw())
+
+            sp0d, sptc, sp1d = specs[p]
+            numpy.testing.assert_array_almost_equal(sp0d, self._ref_mean_disc(data[:, t, 0], p[0], p[1], 5))
+            exp_tc = self._ref_mean_disc(data[:, :, 0], p[0], p[1], 5).swapaxes(0, 1).astype(data.dtype)
+            numpy.testing.assert_array_equal(sptc, exp_tc)
+            numpy.testing.assert_array_almost_equal(sp1d, self._ref_line_spectrum(data[:, t, 0], start, p, 5))
+
+        # Second pass: going back to the same positions should give the same
+        # results (from the cache)
+        for p in positions:
+            tss.selected_pixel.value = p
+            tss.selected_line.value = [start, p]
+            sp0d, sptc, sp1d = (proj_point_spectrum.projectAsRaw(),
+                                proj_temporal_spectrum.projectAsRaw(),
+                                proj_line_spectrum.projectAsRaw())
+            numpy.testing.assert_array_equal(sp0d, specs[p][0])
+            numpy.testing.assert_array_equal(sptc, specs[p][1])
+            numpy.testing.assert_array_equal(sp1d, specs[p][2])
+
+        # New data => the cache should be discarded
+        sp0d = proj_point_spectrum.projectAsRaw()
+        tss.background.value = model.DataArray(numpy.ones(temporalspectrum.shape, dtype=numpy.uint16),
+                                                metadata={model.MD_WL_LIST: list(temporalspectrum.metadata[model.MD_WL_LIST]),
+                                                          model.MD_STREAK_MODE: True,
+                                                          model.MD_STREAK_TIMERANGE: 1e-9})
+        sp0d_bg = proj_point_spectrum.projectAsRaw()
+        assert_array_not_equal(sp0d_bg, sp0d)
+
     def test_temporal_spectrum_calib_bg(self):
         """Test StaticSpectrumStream calibration and background image correction
          with temporal spectrum data."""
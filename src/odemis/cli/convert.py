@@ -24,7 +24,11 @@ You should have received a copy of the GNU General Public License along with Ode
 from __future__ import division, print_function
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from gettext import ngettext
+import glob
+import hashlib
+import json
 import logging
 import numpy
 from odemis import dataio, model
@@ -35,13 +39,21 @@ from odemis.acq import stitching
 from odemis.util import spectrum
 from odemis.util import dataio as io
 import os
+import shutil
 import sys
+import tempfile
+import time
 
 from odemis.acq.stitching import WEAVER_MEAN, WEAVER_COLLAGE, WEAVER_COLLAGE_REVERSE, \
                                 REGISTER_SHIFT, REGISTER_IDENTITY, REGISTER_GLOBAL_SHIFT
 
 logging.getLogger().setLevel(logging.INFO) # use DEBUG for more messages
 
+# Name of the file, in the output directory of a batch conversion, which lists
+# the files converted, with the hash of their source.
+BATCH_MANIFEST = ".odemis-convert.json"
+HASH_BLOCK_SIZE = 1024 * 1024  # bytes read at once when computing the hash of a file
+
 
 def open_acq(fn):
     """
@@ -79,6 +91,60 @@ def open_acq(fn):
     return data, thumb
 
 
+def read_tiled(das):
+    """
+    Read the full resolution data of a pyramidal image, one tile at a time,
+    into a memory-mapped buffer. So the data doesn't need to fit in memory.
+    das (DataArrayShadow): image with .maxzoom and .getTile(). Only the last
+      2 dimensions (YX) can be bigger than 1.
+    return (DataArray): the whole image, with the metadata of the shadow
+    """
+    # The temporary file is automatically deleted when the memmap is freed
+    with tempfile.TemporaryFile() as f:
+        buf = numpy.memmap(f, dtype=das.dtype, mode="w+", shape=das.shape)
+
+    tw, th = das.tile_shape
+    nx = (das.shape[-1] + tw - 1) // tw
+    ny = (das.shape[-2] + th - 1) // th
+    for x in range(nx):
+        for y in range(ny):
+            tile = das.getTile(x, y, 0)
+            buf[..., y * th:y * th + tile.shape[-2], x * tw:x * tw + tile.shape[-1]] = tile
+
+    return model.DataArray(buf, das.metadata.copy())
+
+
+def open_acq_tiled(fn):
+    """
+    Same as open_acq(), but if the format allows it, the pyramidal images are
+    read tile by tile, instead of loading them entirely in memory.
+    return (list of DataArray, list of DataArray):
+        list of the data in the file
+        thumbnail (if available, might be empty)
+    """
+    fmt_mng = dataio.find_fittest_converter(fn, default=None, mode=os.O_RDONLY)
+    if not hasattr(fmt_mng, "open_data"):
+        return open_acq(fn)
+
+    try:
+        acd = fmt_mng.open_data(fn)
+    except Exception:
+        raise ValueError("Failed to open the file '%s' as %s" % (fn, fmt_mng.FORMAT))
+
+    data = []
+    for das in acd.content:
+        if hasattr(das, "maxzoom") and all(s == 1 for s in das.shape[:-2]):
+            try:
+                data.append(read_tiled(das))
+                continue
+            except NotImplementedError:
+                logging.debug("Cannot read %s per tile, will read it at once", das)
+        data.append(das.getData())
+
+    thumb = [t.getData() for t in acd.thumbnails]
+    return data, thumb
+
+
 def open_ec(fn):
     """
     Read a csv file of format "wavelength(nm)\tcoefficient" into a standard
@@ -182,6 +248,199 @@ def minus(data_a, data_b):
     return ret
 
 
+def remove_spikes(das, threshold):
+    """
+    Remove the spikes (eg, caused by cosmic rays) in the spectral data.
+    das (list of DataArrays): the data, only the spectra (CTZYX with T = Z = 1)
+      are corrected, the other data is passed as-is.
+    threshold (float): sensitivity of the detection (the lower, the more sensitive)
+    returns (list of DataArrays): the data, with the spectra corrected
+    """
+    ret = []
+    for da in das:
+        if da.ndim == 5 and da.shape[0] > 1 and da.shape[1] == da.shape[2] == 1:
+            da, npixels, nspikes = spectrum.remove_spikes(da, threshold)
+            logging.info("Removed %d spikes in %d pixels", nspikes, npixels)
+        ret.append(da)
+    return ret
+
+
+def process_acq(data, thumbs, minus_fns=(), spike_removal=None):
+    """
+    Applies the corrections requested to the data of an acquisition
+    data (list of DataArrays): the data
+    thumbs (list of DataArrays): the thumbnails
+    minus_fns (list of str): acquisition files whose data is subtracted
+    spike_removal (None or float): threshold to remove spikes, if not None
+    returns (list of DataArrays, list of DataArrays): the data and thumbnails
+    """
+    if minus_fns:
+        if thumbs:
+            logging.info("Dropping thumbnail due to subtraction")
+            thumbs = []
+        for fn in minus_fns:
+            sdata, _ = open_acq(fn)
+            data = minus(data, sdata)
+
+    if spike_removal is not None:
+        data = remove_spikes(data, spike_removal)
+
+    return data, thumbs
+
+
+def file_hash(fn):
+    """
+    Computes the hash of the content of a file, reading it block by block
+    fn (str): path to the file
+    return (str): SHA-1 hexadecimal digest
+    """
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def convert_file(infn, outfn, minus_fns=(), spike_removal=None, pyramid=False):
+    """
+    Converts one acquisition file. It is the unit of work of the batch mode,
+    so it's picklable, and can run in a separate process.
+    infn (str): path to the acquisition file
+    outfn (str): path to the file to create
+    minus_fns, spike_removal: see process_acq()
+    pyramid (bool): see save_acq()
+    """
+    data, thumbs = open_acq_tiled(infn)
+    data, thumbs = process_acq(data, thumbs, minus_fns, spike_removal)
+    save_acq(outfn, data, thumbs, pyramid)
+    logging.debug("Converted %s into %s", infn, outfn)
+
+
+def find_batch_files(pattern):
+    """
+    Lists the acquisition files to convert in batch
+    pattern (str): a directory, in which case all the files it contains in a
+      readable format are returned, or a glob pattern (** is recursive)
+    return (list of str): the paths of the files, sorted
+    """
+    if os.path.isdir(pattern):
+        fmts = dataio.get_available_formats(os.O_RDONLY, allowlossy=True)
+        exts = tuple(e for fes in fmts.values() for e in fes)
+        fns = [os.path.join(pattern, f) for f in os.listdir(pattern)
+               if f.lower().endswith(exts)]
+    else:
+        fns = glob.glob(pattern, recursive=True)
+
+    return sorted(fn for fn in fns if os.path.isfile(fn))
+
+
+def _read_manifest(outdir):
+    """
+    return (dict str -> dict): output file name -> info about its source
+    """
+    try:
+        with open(os.path.join(outdir, BATCH_MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_manifest(outdir, manifest):
+    fn = os.path.join(outdir, BATCH_MANIFEST)
+    # Write the whole file first, so that it's never left half-written
+    with open(fn + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(fn + ".tmp", fn)
+
+
+def batch_convert(infns, outdir, ext, jobs=None, minus_fns=(), spike_removal=None,
+                  pyramid=False):
+    """
+    Converts many acquisition files, in parallel. A file is not converted again
+    if the output directory already contains its conversion, with the same
+    settings, of a file with the same content. Files with identical content
+    are only converted once.
+    infns (list of str): the acquisition files
+    outdir (str): the directory where to write the converted files. It is
+      created if it doesn't exist.
+    ext (str): file name extension of the output files, which defines the format
+    jobs (None or 1 <= int): number of files converted simultaneously. If None,
+      the number of CPUs is used.
+    minus_fns, spike_removal, pyramid: see convert_file()
+    return (int, int, int): number of files converted, reused, and failed
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    manifest = _read_manifest(outdir)
+    # Anything which changes the converted data
+    settings = {"minus": [file_hash(fn) for fn in minus_fns],
+                "spike_removal": spike_removal,
+                "pyramid": pyramid}
+
+    nconverted = nreused = nfailed = 0
+    with ProcessPoolExecutor(jobs) as executor:
+        hashes = list(executor.map(file_hash, infns, chunksize=16))
+
+        outfns = set()
+        converting = {}  # str -> str: hash -> output file being converted
+        fconversions = {}  # Future -> (str, str, str): input file, output file, hash
+        copies = []  # list of (str, str, str, str): converted file, input file, output file, hash
+        for infn, h in zip(infns, hashes):
+            outfn = os.path.join(outdir, os.path.basename(io.splitext(infn)[0]) + ext)
+            if outfn in outfns:
+                logging.error("Skipping %s, as %s is already the output of another file",
+                              infn, outfn)
+                nfailed += 1
+                continue
+            outfns.add(outfn)
+
+            entry = {"input": infn, "hash": h, "settings": settings}
+            prev = manifest.get(os.path.basename(outfn), {})
+            if (prev.get("hash") == h and prev.get("settings") == settings
+                and os.path.exists(outfn)):
+                logging.debug("Reusing %s, already converted from %s", outfn, infn)
+                manifest[os.path.basename(outfn)] = entry
+                nreused += 1
+            elif h in converting:
+                copies.append((converting[h], infn, outfn, h))
+            else:
+                converting[h] = outfn
+                f = executor.submit(convert_file, infn, outfn, minus_fns, spike_removal, pyramid)
+                fconversions[f] = (infn, outfn, h)
+
+        failed = set()  # hashes of the files which failed
+        try:
+            for f in as_completed(fconversions):
+                infn, outfn, h = fconversions[f]
+                try:
+                    f.result()
+                except Exception:
+                    logging.exception("Failed to convert %s", infn)
+                    manifest.pop(os.path.basename(outfn), None)
+                    failed.add(h)
+                    nfailed += 1
+                else:
+                    manifest[os.path.basename(outfn)] = {"input": infn, "hash": h, "settings": settings}
+                    nconverted += 1
+
+            # Files with the same content as a file just converted
+            for srcfn, infn, outfn, h in copies:
+                if h in failed:
+                    nfailed += 1
+                    continue
+                shutil.copyfile(srcfn, outfn)
+                manifest[os.path.basename(outfn)] = {"input": infn, "hash": h, "settings": settings}
+                nreused += 1
+        finally:
+            _write_manifest(outdir, manifest)
+
+    return nconverted, nreused, nfailed
+
+
 def add_acq_type_md(das):
     """
     Add acquisition type to das.
@@ -286,6 +545,9 @@ def main(args):
                         help="name of the input file")
     parser.add_argument("--tiles", "-t", dest="tiles", nargs="+",
                         help="list of files acquired in tiles to re-assemble")
+    parser.add_argument("--batch", "-b", dest="batch",
+                        help="glob pattern or directory of acquisition files to convert "
+                        "all at once. The output is then the directory where the files are written.")
     parser.add_argument("--effcomp", dest="effcomp",
                         help="name of a spectrum efficiency compensation table (in CSV format)")
     fmts = dataio.get_available_formats(os.O_WRONLY)
@@ -298,8 +560,17 @@ def main(args):
                         help="Export the data in pyramidal format. "
                         "It takes about 2x more space, but allows to visualise large images. "
                         "Currently, only the TIFF format supports this option.")
+    parser.add_argument("--extension", "-e", dest="extension", default=dataio.tiff.EXTENSIONS[0],
+                        help="file name extension of the converted files, in batch mode "
+                        "(default: %(default)s).")
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int,
+                        help="number of files converted in parallel, in batch mode "
+                        "(default: number of CPUs).")
     parser.add_argument("--minus", "-m", dest="minus", action='append',
             help="name of an acquisition file whose data is subtracted from the input file.")
+    parser.add_argument("--spike-removal", dest="spike_removal", type=float,
+            help="remove the spikes (eg, caused by cosmic rays) in the spectral data, "
+            "with the given sensitivity threshold (the lower, the more sensitive, typically 8).")
     parser.add_argument("--weaver", "-w", dest="weaver",
             help="name of weaver to be used during stitching. Options: 'mean': MeanWeaver " 
             "(blend overlapping regions of adjacent tiles), 'collage': CollageWeaver "
@@ -328,14 +599,35 @@ def main(args):
 
     infn = options.input
     tifns = options.tiles
+    batch = options.batch
     ecfn = options.effcomp
     outfn = options.output
 
-    if not (infn or tifns or ecfn) or not outfn:
-        raise ValueError("--input/--tiles/--effcomp and --output arguments must be provided.")
-
-    if sum(not not o for o in (infn, tifns, ecfn)) != 1:
-        raise ValueError("--input, --tiles, --effcomp cannot be provided simultaneously.")
+    if not (infn or tifns or batch or ecfn) or not outfn:
+        raise ValueError("--input/--tiles/--batch/--effcomp and --output arguments must be provided.")
+
+    if sum(not not o for o in (infn, tifns, batch, ecfn)) != 1:
+        raise ValueError("--input, --tiles, --batch, --effcomp cannot be provided simultaneously.")
+
+    if options.jobs is not None and options.jobs < 1:
+        raise ValueError("--jobs must be at least 1.")
+
+    if batch:
+        infns = find_batch_files(batch)
+        if not infns:
+            raise ValueError("No acquisition file found in %s." % (batch,))
+        logging.info("Converting %d files", len(infns))
+        startt = time.time()
+        nconverted, nreused, nfailed = batch_convert(infns, outfn, options.extension,
+                                                     options.jobs, options.minus or (),
+                                                     options.spike_removal, options.pyramid)
+        dur = time.time() - startt
+        logging.info("Converted %d files and reused %d in %g s (%g files/s)",
+                     nconverted, nreused, dur, len(infns) / dur)
+        if nfailed:
+            logging.error("Failed to convert %d files", nfailed)
+            return 1
+        return 0
 
     if infn:
         data, thumbs = open_acq(infn)
@@ -356,28 +648,21 @@ def main(args):
         thumbs = []
         logging.info("File contains %d coefficients", data[0].shape[0])
 
-    if options.minus:
-        if thumbs:
-            logging.info("Dropping thumbnail due to subtraction")
-            thumbs = []
-        for fn in options.minus:
-            sdata, _ = open_acq(fn)
-            data = minus(data, sdata)
+    data, thumbs = process_acq(data, thumbs, options.minus, options.spike_removal)
 
     save_acq(outfn, data, thumbs, options.pyramid)
 
     logging.info("Successfully generated file %s", outfn)
+    return 0
 
 
 if __name__ == '__main__':
     try:
-        main(sys.argv)
+        ret = main(sys.argv)
     except ValueError as e:
         logging.error(e)
         ret = 127
     except Exception:
         logging.exception("Error while running the action")
         ret = 128
-    else:
-        ret = 0
     exit(ret)
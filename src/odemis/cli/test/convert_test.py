@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Testing class for convert.py of cli.
+
+Copyright © 2020 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+from __future__ import division
+
+import logging
+import numpy
+from odemis import model
+from odemis.cli import convert
+from odemis.dataio import hdf5, tiff
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+
+def create_acq(fn, seed, shape=(256, 256)):
+    """
+    Writes a synthetic acquisition file
+    """
+    rng = numpy.random.RandomState(seed)
+    md = {model.MD_DESCRIPTION: "Synthetic %d" % (seed,),
+          model.MD_ACQ_DATE: time.time(),
+          model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+          model.MD_POS: (1e-3, -30e-3),
+          }
+    da = model.DataArray(rng.randint(0, 4096, shape).astype(numpy.uint16), md)
+    hdf5.export(fn, da)
+
+
+class TestTiled(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_open_pyramidal(self):
+        """
+        Reading a pyramidal TIFF per tile gives the same data as reading it at once
+        """
+        fn = os.path.join(self.dir, "pyramid.ome.tiff")
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_POS: (1e-3, -30e-3)}
+        # Not a multiple of the tile size
+        da = model.DataArray(numpy.random.randint(0, 4096, (1000, 1500)).astype(numpy.uint16), md)
+        tiff.export(fn, da, pyramid=True)
+
+        data, thumbs = convert.open_acq(fn)
+        tdata, tthumbs = convert.open_acq_tiled(fn)
+        self.assertEqual(len(tdata), len(data))
+        numpy.testing.assert_array_equal(tdata[0], data[0])
+        numpy.testing.assert_array_equal(tdata[0], da)
+        self.assertEqual(tdata[0].metadata[model.MD_PIXEL_SIZE], md[model.MD_PIXEL_SIZE])
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.indir = tempfile.mkdtemp()
+        self.outdir = os.path.join(tempfile.mkdtemp(), "converted")
+
+    def tearDown(self):
+        shutil.rmtree(self.indir)
+        shutil.rmtree(os.path.dirname(self.outdir))
+
+    def test_find_files(self):
+        for i in range(3):
+            create_acq(os.path.join(self.indir, "acq%d.h5" % i), i)
+        with open(os.path.join(self.indir, "notes.txt"), "w") as f:
+            f.write("not an acquisition")
+
+        fns = convert.find_batch_files(self.indir)
+        self.assertEqual([os.path.basename(fn) for fn in fns], ["acq0.h5", "acq1.h5", "acq2.h5"])
+        fns = convert.find_batch_files(os.path.join(self.indir, "acq[01].h5"))
+        self.assertEqual(len(fns), 2)
+
+    def test_reuse(self):
+        """
+        Files already converted, or with identical content, are not converted again
+        """
+        for i in range(4):
+            create_acq(os.path.join(self.indir, "acq%d.h5" % i), i)
+        # Same content as acq0
+        shutil.copyfile(os.path.join(self.indir, "acq0.h5"), os.path.join(self.indir, "dup.h5"))
+        infns = convert.find_batch_files(self.indir)
+
+        res = convert.batch_convert(infns, self.outdir, ".h5", jobs=2)
+        self.assertEqual(res, (4, 1, 0))
+        for fn in infns:
+            outfn = os.path.join(self.outdir, os.path.basename(fn))
+            outdata = hdf5.read_data(outfn)
+            numpy.testing.assert_array_equal(outdata[0], hdf5.read_data(fn)[0])
+
+        # Second time, nothing to convert
+        res = convert.batch_convert(infns, self.outdir, ".h5", jobs=2)
+        self.assertEqual(res, (0, 5, 0))
+
+        # Changing one file only converts this one
+        create_acq(os.path.join(self.indir, "acq1.h5"), 10)
+        res = convert.batch_convert(infns, self.outdir, ".h5", jobs=2)
+        self.assertEqual(res, (1, 4, 0))
+
+        # Different settings => everything is converted again
+        res = convert.batch_convert(infns, self.outdir, ".h5", jobs=2, spike_removal=8)
+        self.assertEqual(res, (4, 1, 0))
+
+    def test_failure(self):
+        create_acq(os.path.join(self.indir, "acq0.h5"), 0)
+        with open(os.path.join(self.indir, "bad.h5"), "w") as f:
+            f.write("not an acquisition")
+        infns = convert.find_batch_files(self.indir)
+
+        res = convert.batch_convert(infns, self.outdir, ".h5", jobs=2)
+        self.assertEqual(res, (1, 0, 1))
+
+    def test_main(self):
+        for i in range(3):
+            create_acq(os.path.join(self.indir, "acq%d.h5" % i), i)
+
+        ret = convert.main(["odemis-convert", "--batch", self.indir,
+                            "--output", self.outdir, "--extension", ".h5"])
+        self.assertEqual(ret, 0)
+        self.assertEqual(len(convert.find_batch_files(self.outdir)), 3)
+
+    def test_throughput(self):
+        """
+        Measures the number of files converted per second, depending on the
+        number of parallel jobs
+        """
+        nfiles = 32
+        for i in range(nfiles):
+            create_acq(os.path.join(self.indir, "acq%d.h5" % i), i, shape=(1024, 1024))
+        infns = convert.find_batch_files(self.indir)
+
+        for jobs in sorted({1, os.cpu_count()}):
+            outdir = "%s-%d" % (self.outdir, jobs)
+            startt = time.time()
+            res = convert.batch_convert(infns, outdir, ".h5", jobs=jobs)
+            dur = time.time() - startt
+            self.assertEqual(res, (nfiles, 0, 0))
+            logging.info("Converted %d files with %d jobs in %g s: %g files/s",
+                         nfiles, jobs, dur, nfiles / dur)
+
+            # Everything is reused the second time
+            startt = time.time()
+            res = convert.batch_convert(infns, outdir, ".h5", jobs=jobs)
+            dur = time.time() - startt
+            self.assertEqual(res, (0, nfiles, 0))
+            logging.info("Reused %d files with %d jobs in %g s: %g files/s",
+                         nfiles, jobs, dur, nfiles / dur)
+            shutil.rmtree(outdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -37,6 +37,8 @@ from odemis.dataio import tiff
 #  * export (callable): write model.DataArray into a file
 #  * read_data (callable): read a file into model.DataArray
 #  * read_thumbnail (callable): read the thumbnail(s) of a file
+#  * open_stack (callable, optional): open a file to write a Z or T stack,
+#    one plane at a time
 #  if it doesn't support writing, then is has no .export(), and if it doesn't
 #  support reading, then it has not read_data().
 _iomodules = ["tiff", "stiff", "hdf5", "png", "csv", "catmaid"]
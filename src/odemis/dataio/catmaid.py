@@ -27,11 +27,16 @@ try:
 except ImportError:  # Python 3 naming
     import configparser as ConfigParser
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import logging
 import math
 import numpy
+import os
 import re
 import requests
+import threading
 from future.moves.urllib.parse import urlparse, parse_qs
 
 from PIL import Image
@@ -82,6 +87,19 @@ SUPPORTED_CONTENT_TYPES = {
 
 KEY_PATH = "~/.local/share/odemis/catmaid.key"
 
+# The tiles are cached on disk, to avoid fetching them again every time the
+# same area is browsed.
+CACHE_DIR = "~/.cache/odemis/catmaid"
+CACHE_MAX_SIZE = 1024 * 2 ** 20  # B
+
+# Maximum number of tiles fetched simultaneously
+MAX_CONNECTIONS = 8
+# Number of tiles prefetched simultaneously (in addition to MAX_CONNECTIONS)
+MAX_PREFETCH_CONNECTIONS = 2
+# Maximum number of tiles waiting to be prefetched. When more tiles are
+# prefetched, the oldest ones are dropped, as they are likely not needed anymore.
+MAX_PREFETCH_QUEUE = 32
+
 # Tile Source Types
 FILE_BASED = 1
 REQUEST_QUERY = 2
@@ -146,13 +164,18 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
     This class implements the read of a Pyramidal Catmaid instance.
     """
 
-    def __init__(self, stack_info, base_url):
+    def __init__(self, stack_info, base_url, cache=None, revalidate=False, prefetch=True):
         """
         Constructor
         stack_info (dict): information about the Catmaid stack and tiles in the stack.
         base_url (str): URL where the Catmaid instance is hosted.
-        dtype (numpy.dtype): the data type
-        metadata (dict str->val): The metadata
+        cache (TileCache or None): cache to store the tiles. If None, the
+          default (shared) cache is used, if available.
+        revalidate (bool): if True, the tiles in the cache are checked to still
+          be up-to-date on the server (using their ETag). Otherwise, the tiles
+          in the cache are considered always valid.
+        prefetch (bool): if True, every time a tile is fetched, the
+          neighbouring tiles (in X, Y and Z) are fetched in the background.
         """
         shape = (stack_info["dimension"]["x"], stack_info["dimension"]["y"])
         tile_shape = (stack_info["mirrors"][0]["tile_width"], stack_info["mirrors"][0]["tile_height"])
@@ -172,12 +195,43 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
         DataArrayShadow.__init__(self, shape, dtype, metadata, maxzoom=maxzoom, tile_shape=tile_shape)
 
         self._base_url = base_url
+        # The connection pool must be big enough for all the tiles fetched simultaneously
         self._session = requests.Session()
+        nconn = MAX_CONNECTIONS + MAX_PREFETCH_CONNECTIONS
+        adapter = requests.adapters.HTTPAdapter(pool_connections=nconn, pool_maxsize=nconn)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
         _, username, password = read_config_file(self._base_url, username=True, password=True)
         self._auth = (username, password)
         self._stack_info = stack_info
         file_extension = self._stack_info["mirrors"][0]["file_extension"]
         self._file_extension = file_extension[1:] if file_extension.startswith(".") else file_extension
+        self._depth = stack_info["dimension"].get("z", 1)
+
+        self._cache = cache if cache is not None else get_tile_cache()
+        self.revalidate = revalidate
+        self.prefetch = prefetch
+
+        # The tiles explicitly requested and the prefetched ones are fetched
+        # by separate threads, so that prefetching never delays the requests.
+        self._executor = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS)
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=MAX_PREFETCH_CONNECTIONS)
+        self._fetching_lock = threading.RLock()  # Reentrant, as a done callback can be called immediately
+        self._fetching = {}  # (x, y, zoom, depth) -> Future returning the image
+        # Same as _fetching, but only the tiles prefetched, from the oldest to the newest
+        self._prefetching = collections.OrderedDict()
+
+    def close(self):
+        """
+        Stops fetching the tiles, and releases the threads and connections.
+        No tile can be fetched afterwards. Can be called multiple times.
+        """
+        with self._fetching_lock:
+            for f in list(self._fetching.values()):
+                f.cancel()
+        self._executor.shutdown(wait=False)
+        self._prefetch_executor.shutdown(wait=False)
+        self._session.close()
 
     def getTile(self, x, y, zoom, depth=0):
         """
@@ -190,8 +244,102 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
         return:
             tile (DataArray): tile containing the image data and the relevant metadata.
         """
+        image = self._fetchTileAsync(x, y, zoom, depth).result()
+        if self.prefetch:
+            self._prefetchNeighbours(x, y, zoom, depth)
+        return self._imageToTile(image, x, y, zoom)
+
+    def getTiles(self, positions, zoom, depth=0):
+        """
+        Fetches multiple tiles simultaneously
+        positions (list of (0<=int, 0<=int)): X and Y index of each tile
+        zoom (0<=int): zoom level to use
+        depth (0<=int): The Z index of the stack.
+        return (list of DataArrays): the tiles, in the same order as the positions
+        """
+        fs = [self._fetchTileAsync(x, y, zoom, depth) for x, y in positions]
+        return [self._imageToTile(f.result(), x, y, zoom) for f, (x, y) in zip(fs, positions)]
+
+    def prefetchTiles(self, positions, zoom, depth=0):
+        """
+        Starts fetching tiles simultaneously in the background, so that the
+        next calls to getTile() on these tiles are faster.
+        positions (list of (0<=int, 0<=int)): X and Y index of each tile
+        zoom (0<=int): zoom level to use
+        depth (0<=int): The Z index of the stack.
+        """
+        for x, y in positions:
+            self._fetchTileAsync(x, y, zoom, depth)
+
+    def _prefetchNeighbours(self, x, y, zoom, depth):
+        """
+        Prefetch the tiles around the given tile, in X, Y, and Z
+        """
+        ntx, nty = self._getNumberOfTiles(zoom)
+        neighbours = [(x + dx, y + dy, depth) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+        neighbours += [(x, y, depth - 1), (x, y, depth + 1)]
+        for nx, ny, nd in neighbours:
+            if 0 <= nx < ntx and 0 <= ny < nty and 0 <= nd < self._depth:
+                self._fetchTileAsync(nx, ny, zoom, nd, prefetch=True)
+
+    def _getNumberOfTiles(self, zoom):
+        """
+        return (int, int): the number of tiles in X and Y at the given zoom level
+        """
+        return tuple(int(math.ceil(s / 2 ** zoom / ts)) for s, ts in zip(self.shape, self.tile_shape))
+
+    def _fetchTileAsync(self, x, y, zoom, depth, prefetch=False):
+        """
+        Start fetching the image of a tile, or reuse the fetch already going on
+        prefetch (bool): if True, the tile is fetched with a lower priority, and
+          nothing happens if it's already in the cache.
+        return (Future): returns the image (numpy.ndarray)
+        """
+        key = (x, y, zoom, depth)
+        with self._fetching_lock:
+            f = self._fetching.get(key)
+            if f is not None:
+                # If the tile is only waiting to be prefetched, fetch it now,
+                # instead of waiting for all the other tiles to prefetch.
+                if prefetch or key not in self._prefetching or not f.cancel():
+                    return f
+
+            if prefetch:
+                if self._cache is None or self._getTileURL(*key) in self._cache:
+                    return None
+                f = self._prefetch_executor.submit(self._fetchTile, *key)
+                self._prefetching[key] = f
+                self._dropOldPrefetches()
+            else:
+                f = self._executor.submit(self._fetchTile, *key)
+            self._fetching[key] = f
+            f.add_done_callback(lambda f: self._onFetchDone(key, f))
+        return f
+
+    def _dropOldPrefetches(self):
+        """
+        Cancel the oldest tiles waiting to be prefetched, so that at most
+        MAX_PREFETCH_QUEUE tiles are prefetched. Must be called with _fetching_lock.
+        """
+        while len(self._prefetching) > MAX_PREFETCH_QUEUE:
+            key, f = self._prefetching.popitem(last=False)
+            # If it's already being fetched, just let it finish
+            f.cancel()
+
+    def _onFetchDone(self, key, f):
+        with self._fetching_lock:
+            # The future might have been replaced, if it was cancelled
+            if self._fetching.get(key) is f:
+                del self._fetching[key]
+            if self._prefetching.get(key) is f:
+                del self._prefetching[key]
+
+    def _getTileURL(self, x, y, zoom, depth):
+        """
+        return (str): the URL of the tile
+        """
         tile_width, tile_height = self.tile_shape
-        tile_url = format_tile_url(
+        return format_tile_url(
             tile_source_type=self._stack_info["mirrors"][0]["tile_source_type"],
             image_base=self._stack_info["mirrors"][0]["image_base"],
             zoom=zoom,
@@ -202,15 +350,50 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
             tile_width=tile_width,
             tile_height=tile_height,
         )
+
+    def _fetchTile(self, x, y, zoom, depth):
+        """
+        Get the image of a tile, from the cache, or from the server
+        return (numpy.ndarray): the image of the tile
+        """
+        # The URL is unique for each stack, zoom, depth, row and column
+        tile_url = self._getTileURL(x, y, zoom, depth)
+        cached, etag = None, None
+        if self._cache is not None:
+            try:
+                cached, etag = self._cache.get(tile_url)
+            except KeyError:
+                pass
+            else:
+                if not (self.revalidate and etag):
+                    return cached
+
+        headers = {}
+        if cached is not None:
+            headers["If-None-Match"] = etag
         try:
-            image = response_to_array(self._session.get(tile_url, auth=self._auth))
+            response = self._session.get(tile_url, auth=self._auth, headers=headers)
+            if cached is not None and response.status_code == 304:
+                # Not modified => the cached version is correct
+                return cached
+            image = response_to_array(response)
         except HTTPError as e:
             if e.response.status_code == 401:
                 raise AuthenticationError("Authentication failed while getting tiles at {}".format(tile_url))
             else:
+                tile_width, tile_height = self.tile_shape
                 logging.error("No tile at %s (error %s), returning blank tile", tile_url, e.response.status_code)
-                image = numpy.zeros((tile_width, tile_height), dtype=self.dtype)
+                return numpy.zeros((tile_width, tile_height), dtype=self.dtype)
 
+        if self._cache is not None:
+            self._cache.put(tile_url, image, response.headers.get("ETag"))
+        return image
+
+    def _imageToTile(self, image, x, y, zoom):
+        """
+        Convert the image of a tile to a DataArray with the corresponding metadata
+        return (DataArray): the tile
+        """
         tile = model.DataArray(image, self.metadata.copy())
         orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1e-6, 1e-6))
         # calculate the pixel size of the tile for the zoom level
@@ -243,6 +426,191 @@ class AcquisitionDataCatmaid(AcquisitionData):
         data = [DataArrayShadowPyramidalCatmaid(stack_info, base_url)]
         AcquisitionData.__init__(self, tuple(data))
 
+    def close(self):
+        """
+        Stops fetching the tiles of all the images. They cannot be read anymore
+        afterwards.
+        """
+        for das in self.content:
+            das.close()
+
+
+class TileCache(object):
+    """
+    Cache of tiles on disk, with a maximum size. Each tile is stored as a .npy
+    file, named after the hash of its key. When the cache is full, the least
+    recently used tiles are deleted.
+    It can be used from multiple threads simultaneously.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_MAX_SIZE):
+        """
+        directory (str): the directory where to store the tiles. It's created
+          if it doesn't exist yet.
+        max_size (0<int): maximum size of the cache, in bytes
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self._lock = threading.Lock()
+        # hash -> size of the file (in B), the least recently used first
+        self._entries = collections.OrderedDict()
+        self._size = 0  # B, sum of all the entries
+
+        # Reload the tiles already present, the last used is the latest modified
+        tiles = []
+        for fn in os.listdir(self.directory):
+            h, ext = os.path.splitext(fn)
+            if ext != ".npy":
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, fn))
+            except OSError:
+                continue
+            tiles.append((st.st_mtime, h, st.st_size))
+        for _, h, size in sorted(tiles):
+            self._entries[h] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def _hash(key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _path(self, h, ext=".npy"):
+        return os.path.join(self.directory, h + ext)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._hash(key) in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def size(self):
+        """
+        (int): the total size of the tiles in the cache, in bytes
+        """
+        with self._lock:
+            return self._size
+
+    def get(self, key):
+        """
+        key (str): identifier of the tile
+        return (numpy.ndarray, str or None): the image, and its ETag
+        raise KeyError: if the tile is not in the cache
+        """
+        h = self._hash(key)
+        with self._lock:
+            if h not in self._entries:
+                raise KeyError(key)
+            # Now the most recently used
+            self._entries[h] = self._entries.pop(h)
+
+        path = self._path(h)
+        try:
+            image = numpy.load(path)
+            # Update the modification time, to keep the LRU order the next time the cache is opened
+            os.utime(path, None)
+            try:
+                with open(self._path(h, ".etag"), "r") as f:
+                    etag = f.read()
+            except IOError:
+                etag = None
+        except (IOError, OSError, ValueError):
+            # Probably removed by another process using the same directory
+            logging.warning("Failed to read cached tile %s", key, exc_info=True)
+            with self._lock:
+                self._remove(h)
+            raise KeyError(key)
+
+        return image, etag
+
+    def put(self, key, image, etag=None):
+        """
+        Store a tile in the cache (replacing the previous version, if any)
+        key (str): identifier of the tile
+        image (numpy.ndarray): the image of the tile
+        etag (str or None): the ETag of the tile, as sent by the server
+        """
+        h = self._hash(key)
+        path = self._path(h)
+        # Write in a temporary file first, so that a partially written tile is never read
+        tmp_path = "%s.%d.tmp" % (path, threading.current_thread().ident)
+        try:
+            with open(tmp_path, "wb") as f:
+                numpy.save(f, image)
+            os.rename(tmp_path, path)
+            if etag:
+                with open(self._path(h, ".etag"), "w") as f:
+                    f.write(etag)
+            elif os.path.exists(self._path(h, ".etag")):
+                os.remove(self._path(h, ".etag"))
+            size = os.path.getsize(path)
+        except (IOError, OSError):
+            logging.warning("Failed to store tile %s in the cache", key, exc_info=True)
+            return
+
+        with self._lock:
+            self._size -= self._entries.pop(h, 0)
+            self._entries[h] = size
+            self._size += size
+            self._evict()
+
+    def clear(self):
+        """
+        Remove all the tiles from the cache
+        """
+        with self._lock:
+            for h in list(self._entries.keys()):
+                self._remove(h)
+
+    def _remove(self, h):
+        """
+        Remove one tile. Must be called with the lock taken.
+        """
+        self._size -= self._entries.pop(h, 0)
+        for ext in (".npy", ".etag"):
+            try:
+                os.remove(self._path(h, ext))
+            except OSError:
+                pass
+
+    def _evict(self):
+        """
+        Remove the least recently used tiles until the cache is small enough.
+        Must be called with the lock taken.
+        """
+        while self._size > self.max_size and self._entries:
+            h = next(iter(self._entries))
+            self._remove(h)
+
+
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache():
+    """
+    return (TileCache or None): the cache of tiles shared by all the Catmaid
+      instances, or None if it cannot be used.
+    """
+    global _tile_cache
+    with _tile_cache_lock:
+        if _tile_cache is None:
+            try:
+                _tile_cache = TileCache()
+            except (IOError, OSError):
+                logging.warning("Failed to open the tile cache at %s, tiles will not be cached",
+                                CACHE_DIR, exc_info=True)
+                _tile_cache = False  # To not try again
+        return _tile_cache or None
+
 
 TILE_URLS = {
     FILE_BASED: '{image_base}{depth}/{row}_{col}_{zoom}.{file_extension}',
@@ -139,7 +139,16 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     """
     assert(len(image.shape) >= 2)
     image_dataset = group.create_dataset(dataset_name, data=image, **kwargs)
+    _set_image_attrs(image_dataset, image)
+    return image_dataset
+
 
+def _set_image_attrs(image_dataset, image):
+    """
+    Sets the attributes of a dataset following the HDF5 image specification
+    image_dataset (HDF Dataset): the dataset containing the image
+    image (numpy.ndimage): the image (or part of it), to find out its type
+    """
     # numpy.string_ is to force fixed-length string (necessary for compatibility)
     # FIXME: needs to be NULLTERM, not NULLPAD... but h5py doesn't allow to distinguish
     image_dataset.attrs["CLASS"] = numpy.string_("IMAGE")
@@ -162,8 +171,6 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     image_dataset.attrs["DISPLAY_ORIGIN"] = numpy.string_("UL") # not rotated
     image_dataset.attrs["IMAGE_VERSION"] = numpy.string_("1.2")
 
-    return image_dataset
-
 
 def _read_image_dataset(dataset):
     """
@@ -1508,8 +1515,184 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
     f.close()
 
 
-# TODO: allow to append data to a file, or any other way to allow saving large
-# data without having everything in memory simultaneously.
+class StackWriter(object):
+    """
+    Writes a stack of images into a HDF5 (SVI) file, one plane at a time.
+    Each plane is written to the file as soon as it is appended, so that the
+    memory usage doesn't depend on the number of planes. The dimension of the
+    stack (Z or T) is extended every time a plane is appended.
+    Several acquisitions (eg, one per stream) can be stacked simultaneously:
+    at every append, one image for each of them must be passed, always in the
+    same order.
+    """
+
+    def __init__(self, filename, dim="Z", compressed=True):
+        """
+        filename (unicode): name of the file to create (including path). If the
+          file already exists, it is overwritten.
+        dim ("Z" or "T"): the dimension along which the planes are stacked
+        compressed (boolean): whether the file is compressed or not
+        """
+        if dim not in ("Z", "T"):
+            raise ValueError("Stack dimension must be Z or T, but got %s" % (dim,))
+        self._dim = dim
+        self._dimi = "CTZYX".index(dim)
+        self._compression = "gzip" if compressed else None
+
+        # h5py will extend the current file by default, so we want to make sure
+        # there is no file at all.
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        self._file = h5py.File(filename, "w")
+        self._acqs = None  # list of (Group, Dataset, dict): per acquisition, the ImageData group, the image, and the metadata
+        self._ranges = None  # list of [min, max]: value range per acquisition
+        self._dates = []  # list of float: acquisition date of each plane
+        self.count = 0  # number of planes written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _create(self, das):
+        """
+        Creates the acquisitions, based on the first planes received
+        das (list of DataArray): 5D CTZYX
+        """
+        self._acqs = []
+        self._ranges = []
+        for i, da in enumerate(das):
+            ga = self._file.create_group("Acquisition%d" % i)
+            # FIXME: should be done by _h5svi_set_state (and used)
+            _h5py_enum_commit(ga, b"StateEnumeration", _dtstate)
+            gi = ga.create_group("ImageData")
+
+            # One chunk per plane, and unlimited size along the stack dimension
+            shape = list(da.shape)
+            shape[self._dimi] = 0
+            maxshape = list(da.shape)
+            maxshape[self._dimi] = None
+            ids = gi.create_dataset("Image", shape=tuple(shape), maxshape=tuple(maxshape),
+                                    dtype=da.dtype, chunks=da.shape,
+                                    compression=self._compression)
+            _set_image_attrs(ids, da)
+            self._acqs.append((gi, ids, da.metadata))
+            self._ranges.append([da.min(), da.max()])
+
+    def append(self, data):
+        """
+        Writes one more plane at the end of the stack.
+        data (DataArray or list of DataArray): one image per acquisition. The
+          shape and dtype of each image must be the same for all the planes.
+          The metadata is taken from the first plane.
+        raises ValueError: if the data doesn't fit the previous planes
+        """
+        if self._file is None:
+            raise IOError("Stack writer is already closed")
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+
+        das = [_adjustDimensions(_mergeCorrectionMetadata(da)) for da in data]
+        for da in das:
+            if da.ndim != 5 or da.shape[self._dimi] != 1:
+                raise ValueError("Cannot stack data of shape %s along %s" % (da.shape, self._dim))
+
+        if self._acqs is None:
+            self._create(das)
+        elif len(das) != len(self._acqs):
+            raise ValueError("Expected %d images, but got %d" % (len(self._acqs), len(das)))
+
+        for (gi, ids, md), rng, da in zip(self._acqs, self._ranges, das):
+            shape = list(ids.shape)
+            shape[self._dimi] += 1
+            if tuple(shape[:self._dimi] + shape[self._dimi + 1:]) != da.shape[:self._dimi] + da.shape[self._dimi + 1:]:
+                raise ValueError("Image of shape %s cannot be stacked on images of shape %s" %
+                                 (da.shape, ids.shape))
+            ids.resize(shape)
+            idx = [slice(None)] * 5
+            idx[self._dimi] = slice(self.count, self.count + 1)
+            ids[tuple(idx)] = da
+            rng[0] = min(rng[0], da.min())
+            rng[1] = max(rng[1], da.max())
+
+        self._dates.append(das[0].metadata.get(model.MD_ACQ_DATE, time.time()))
+        self.count += 1
+
+    def _reverse(self, ids):
+        """
+        Reverses the order of the planes, by swapping them two by two
+        """
+        n = ids.shape[self._dimi]
+        for i in range(n // 2):
+            idxa = [slice(None)] * 5
+            idxa[self._dimi] = slice(i, i + 1)
+            idxb = [slice(None)] * 5
+            idxb[self._dimi] = slice(n - 1 - i, n - i)
+            a = ids[tuple(idxa)]
+            ids[tuple(idxa)] = ids[tuple(idxb)]
+            ids[tuple(idxb)] = a
+
+    def close(self, md=None, reverse=False):
+        """
+        Writes the metadata, and closes the file. Can be called multiple times.
+        md (None, dict or list of dict): metadata to update the metadata of the
+          first plane, either for all the acquisitions, or per acquisition.
+          Typically, this contains the 3D MD_PIXEL_SIZE and MD_POS of a Z stack.
+          For a T stack, MD_TIME_LIST is set by default to the acquisition
+          time of each plane, relative to the first one.
+        reverse (bool): if True, the order of the planes is reversed (eg, for
+          a Z stack acquired top to bottom)
+        """
+        if self._file is None:
+            return
+
+        try:
+            if self._acqs is None:
+                logging.warning("Closing stack file without any data")
+                return
+
+            if md is None:
+                md = {}
+            if isinstance(md, dict):
+                md = [md] * len(self._acqs)
+
+            for (gi, ids, md0), rng, mdu in zip(self._acqs, self._ranges, md):
+                if reverse:
+                    self._reverse(ids)
+                fmd = md0.copy()
+                if self._dim == "T":
+                    dates = self._dates[::-1] if reverse else self._dates
+                    fmd[model.MD_TIME_LIST] = [d - dates[0] for d in dates]
+                fmd.update(mdu)
+                fmd[model.MD_DIMS] = "CTZYX"
+
+                # Only the shape and metadata are needed, so there is no need
+                # to read back the data
+                im = model.DataArray(numpy.broadcast_to(numpy.zeros((), dtype=ids.dtype), ids.shape), fmd)
+                ids.attrs["IMAGE_MINMAXRANGE"] = rng
+                _add_image_info(gi, ids, im)
+                _add_image_metadata(gi.parent, im, None)
+                _add_svi_info(gi.parent)
+        finally:
+            self._file.close()
+            self._file = None
+            self._acqs = None
+
+
+def open_stack(filename, dim="Z", compressed=True):
+    """
+    Opens a file to write a stack of images, one plane at a time.
+    filename (unicode): filename of the file to create (including path)
+    dim ("Z" or "T"): the dimension along which the planes are stacked
+    compressed (boolean): whether the file is compressed or not
+    return (StackWriter): call .append() for each plane, and finally .close()
+    """
+    return StackWriter(filename, dim, compressed)
+
+
 def export(filename, data, thumbnail=None):
     '''
     Write an HDF5 file with the given image and metadata
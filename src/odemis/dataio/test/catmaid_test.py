@@ -22,13 +22,23 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 """
 from __future__ import division
 
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+import json
+import shutil
+from socketserver import ThreadingMixIn
+import tempfile
+import threading
+import time
 import unittest
 
 import numpy
+from PIL import Image
 from requests import ConnectionError
 
 from odemis.dataio import AuthenticationError
-from odemis.dataio.catmaid import open_data
+from odemis.dataio.catmaid import open_data, TileCache, DataArrayShadowPyramidalCatmaid, \
+    get_stack_info, MAX_PREFETCH_QUEUE
 
 
 class TestCatmaid(unittest.TestCase):
@@ -92,5 +102,258 @@ class TestCatmaid(unittest.TestCase):
         numpy.testing.assert_array_equal(tile, numpy.zeros(size))
 
 
+TILE_SHAPE = (64, 32)  # X, Y
+STACK_SHAPE = (512, 256, 5)  # X, Y, Z
+
+
+def tile_value(zoom, depth, row, col):
+    """
+    return (0<=int<256): the (uniform) value of the tile generated by the fake server
+    """
+    return (zoom * 100 + depth * 20 + row * 8 + col) % 256
+
+
+class FakeCatmaidHandler(BaseHTTPRequestHandler):
+    """
+    Serves a Catmaid stack info and its tiles. Each tile has a uniform value,
+    based on its position. The server counts the requests received.
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        time.sleep(server.delay)
+
+        if self.path == "/1/stack/1/info":
+            content = json.dumps(server.stack_info).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+
+        # DIR_BASED: /tiles/{zoom}/{depth}/{row}/{col}.png
+        try:
+            zoom, depth, row, col = [int(p) for p in self.path[len("/tiles/"):-len(".png")].split("/")]
+        except ValueError:
+            self.send_error(404)
+            return
+
+        etag = '"%d-%d-%d-%d-v%d"' % (zoom, depth, row, col, server.version)
+        if self.headers.get("If-None-Match") == etag:
+            with server.lock:
+                server.not_modified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        im = numpy.full(TILE_SHAPE[::-1], tile_value(zoom, depth, row, col), dtype=numpy.uint8)
+        buf = BytesIO()
+        Image.fromarray(im).save(buf, "PNG")
+        content = buf.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # Don't spam the output
+
+
+class FakeCatmaidServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeCatmaidHandler)
+        self.lock = threading.Lock()
+        self.requests = []  # paths requested
+        self.not_modified = 0  # number of 304 answers
+        self.delay = 0  # s, to simulate a slow server
+        self.version = 0  # changes the ETag of all the tiles
+        self.base_url = "http://127.0.0.1:%d" % (self.server_address[1],)
+        self.stack_info = {
+            "dimension": {"x": STACK_SHAPE[0], "y": STACK_SHAPE[1], "z": STACK_SHAPE[2]},
+            "resolution": {"x": 4.0, "y": 4.0, "z": 40.0},
+            "num_zoom_levels": 3,
+            "mirrors": [{"tile_width": TILE_SHAPE[0],
+                         "tile_height": TILE_SHAPE[1],
+                         "file_extension": "png",
+                         "tile_source_type": 5,  # DIR_BASED
+                         "image_base": self.base_url + "/tiles/",
+                         }],
+        }
+
+    def tile_requests(self):
+        with self.lock:
+            return [p for p in self.requests if p.startswith("/tiles/")]
+
+
+class TestCatmaidCache(unittest.TestCase):
+    """
+    Test the tile cache and concurrent fetching, with a local fake server
+    """
+
+    def setUp(self):
+        self.server = FakeCatmaidServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.stack_info = get_stack_info(self.server.base_url, 1, 1)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def _open(self, **kwargs):
+        kwargs.setdefault("cache", TileCache(self.cache_dir))
+        kwargs.setdefault("prefetch", False)
+        return DataArrayShadowPyramidalCatmaid(self.stack_info, self.server.base_url, **kwargs)
+
+    def assert_tile(self, tile, x, y, zoom, depth=0):
+        self.assertEqual(tile.shape, TILE_SHAPE[::-1])
+        self.assertTrue(numpy.all(tile == tile_value(zoom, depth, y, x)))
+
+    def test_cache(self):
+        das = self._open()
+        tile = das.getTile(1, 2, 0, depth=3)
+        self.assert_tile(tile, 1, 2, 0, 3)
+        self.assertEqual(len(self.server.tile_requests()), 1)
+
+        # Same tile => from the cache
+        tile = das.getTile(1, 2, 0, depth=3)
+        self.assert_tile(tile, 1, 2, 0, 3)
+        self.assertEqual(len(self.server.tile_requests()), 1)
+
+        # Different depth => from the server
+        tile = das.getTile(1, 2, 0, depth=4)
+        self.assert_tile(tile, 1, 2, 0, 4)
+        self.assertEqual(len(self.server.tile_requests()), 2)
+
+        # The cache is persistent
+        das = self._open()
+        tile = das.getTile(1, 2, 0, depth=3)
+        self.assert_tile(tile, 1, 2, 0, 3)
+        self.assertEqual(len(self.server.tile_requests()), 2)
+
+    def test_eviction(self):
+        cache = TileCache(self.cache_dir)
+        das = self._open(cache=cache)
+        das.getTile(0, 0, 0)
+        tile_size = cache.size
+        self.assertGreater(tile_size, TILE_SHAPE[0] * TILE_SHAPE[1])
+
+        # Only space for 3 tiles
+        cache = TileCache(self.cache_dir, max_size=3 * tile_size)
+        das = self._open(cache=cache)
+        for x in range(1, 4):
+            das.getTile(x, 0, 0)
+        self.assertEqual(len(cache), 3)
+        self.assertLessEqual(cache.size, 3 * tile_size)
+        # The least recently used tile (0, 0) was removed
+        nreq = len(self.server.tile_requests())
+        das.getTile(3, 0, 0)
+        self.assertEqual(len(self.server.tile_requests()), nreq)
+        das.getTile(0, 0, 0)
+        self.assertEqual(len(self.server.tile_requests()), nreq + 1)
+
+    def test_revalidate(self):
+        das = self._open(revalidate=True)
+        das.getTile(1, 1, 1)
+        self.assertEqual(len(self.server.tile_requests()), 1)
+
+        # Same tile => the server is asked if the tile is still the same
+        tile = das.getTile(1, 1, 1)
+        self.assert_tile(tile, 1, 1, 1)
+        self.assertEqual(len(self.server.tile_requests()), 2)
+        self.assertEqual(self.server.not_modified, 1)
+
+        # The tile changed => full answer
+        self.server.version += 1
+        tile = das.getTile(1, 1, 1)
+        self.assert_tile(tile, 1, 1, 1)
+        self.assertEqual(len(self.server.tile_requests()), 3)
+        self.assertEqual(self.server.not_modified, 1)
+
+    def test_get_tiles(self):
+        """
+        The tiles should be fetched simultaneously
+        """
+        self.server.delay = 0.1  # s
+        das = self._open()
+        positions = [(x, y) for x in range(4) for y in range(4)]
+        startt = time.time()
+        tiles = das.getTiles(positions, 0, depth=2)
+        dur = time.time() - startt
+        for (x, y), tile in zip(positions, tiles):
+            self.assert_tile(tile, x, y, 0, 2)
+        self.assertEqual(len(self.server.tile_requests()), len(positions))
+        # 16 tiles, 8 at a time => ~0.2 s (instead of 1.6 s if one at a time)
+        self.assertLess(dur, len(positions) * self.server.delay / 2)
+
+        # Prefetch, and then get the tiles => no new request
+        positions = [(x, y) for x in range(4, 8) for y in range(4, 8)]
+        das.prefetchTiles(positions, 0)
+        for x, y in positions:
+            self.assert_tile(das.getTile(x, y, 0), x, y, 0)
+        self.assertEqual(len(self.server.tile_requests()), 32)
+
+    def test_close(self):
+        das = self._open(prefetch=True)
+        das.getTile(0, 1, 0)
+        das.close()
+        self.assertRaises(RuntimeError, das.getTile, 1, 1, 0)
+        das.close()  # Should do nothing
+
+    def test_prefetch_neighbours(self):
+        das = self._open(prefetch=True)
+        das.getTile(0, 1, 0, depth=0)
+        # Neighbours: 5 in XY (on the border), and 1 in Z
+        time.sleep(1)
+        self.assertEqual(len(self.server.tile_requests()), 1 + 5 + 1)
+
+        # Already prefetched => no new request
+        for x, y in ((0, 0), (1, 0), (1, 1), (1, 2), (0, 2)):
+            self.assert_tile(das.getTile(x, y, 0), x, y, 0)
+        self.assert_tile(das.getTile(0, 1, 0, depth=1), 0, 1, 0, 1)
+        # (But these new calls cause more prefetching)
+        requested = self.server.tile_requests()
+        self.assertEqual(len(requested), len(set(requested)))
+
+    def test_prefetch_priority(self):
+        """
+        A tile waiting to be prefetched is fetched immediately when requested
+        """
+        self.server.delay = 0.2  # s
+        das = self._open(prefetch=True)
+        das.getTile(3, 3, 0, depth=2)
+        # 10 neighbours, prefetched 2 at a time => ~1 s. The last one is at depth + 1.
+        startt = time.time()
+        self.assert_tile(das.getTile(3, 3, 0, depth=3), 3, 3, 0, 3)
+        dur = time.time() - startt
+        self.assertLess(dur, 0.6)
+        das.close()
+
+        requested = self.server.tile_requests()
+        self.assertEqual(len(requested), len(set(requested)))
+
+    def test_prefetch_queue(self):
+        """
+        The number of tiles waiting to be prefetched is limited
+        """
+        self.server.delay = 0.1  # s
+        das = self._open(prefetch=True)
+        for x in range(0, 8, 2):
+            for y in range(0, 8, 2):
+                das._prefetchNeighbours(x, y, 0, 2)
+        self.assertLessEqual(len(das._prefetching), MAX_PREFETCH_QUEUE)
+        das.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -258,6 +258,71 @@ class TestHDF5IO(unittest.TestCase):
         subim = im[0, 0, 0] # just one channel
         self.assertEqual(subim.shape, size[-1::-1])
 
+    def testStackZ(self):
+        """
+        Check it's possible to write a Z stack plane by plane
+        """
+        size = (64, 32)  # X, Y
+        dtype = numpy.uint16
+        nz = 5
+        metadata = {model.MD_DESCRIPTION: u"tÉst",
+                    model.MD_ACQ_DATE: time.time(),
+                    model.MD_PIXEL_SIZE: (1e-6, 1e-6),  # m/px
+                    model.MD_POS: (1e-3, -30e-3),  # m
+                    model.MD_IN_WL: (500e-9, 520e-9),  # m
+                    }
+        metadata2 = dict(metadata)
+        metadata2[model.MD_DESCRIPTION] = "second"
+
+        with hdf5.open_stack(FILENAME, "Z") as writer:
+            for i in range(nz):
+                da = model.DataArray(numpy.full(size[::-1], i, dtype), metadata)
+                da2 = model.DataArray(numpy.full(size[::-1], i + 10, dtype), metadata2)
+                writer.append([da, da2])
+            self.assertEqual(writer.count, nz)
+            writer.close(md={model.MD_PIXEL_SIZE: (1e-6, 1e-6, 2e-6),
+                             model.MD_POS: (1e-3, -30e-3, 5e-6)},
+                         reverse=True)
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 2)
+        for im, off in zip(rdata, (0, 10)):
+            self.assertEqual(im.shape, (1, 1, nz) + size[::-1])
+            # Reversed: first plane is the last one written
+            for i in range(nz):
+                self.assertEqual(im[0, 0, i, 0, 0], nz - 1 - i + off)
+            self.assertEqual(im.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6, 2e-6))
+            self.assertEqual(im.metadata[model.MD_POS], (1e-3, -30e-3, 5e-6))
+        self.assertEqual(rdata[1].metadata[model.MD_DESCRIPTION], "second")
+
+    def testStackT(self):
+        """
+        Check it's possible to write a timelapse plane by plane
+        """
+        size = (64, 32)  # X, Y
+        dtype = numpy.float32
+        nt = 4
+        t0 = time.time()
+        writer = hdf5.open_stack(FILENAME, "T")
+        for i in range(nt):
+            md = {model.MD_ACQ_DATE: t0 + i * 2, model.MD_PIXEL_SIZE: (1e-6, 1e-6)}
+            writer.append(model.DataArray(numpy.full(size[::-1], i, dtype), md))
+        writer.close()
+        writer.close()  # No-op
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 1)
+        im = rdata[0]
+        self.assertEqual(im.shape, (1, nt, 1) + size[::-1])
+        numpy.testing.assert_array_equal(im[0, :, 0, 0, 0], range(nt))
+        numpy.testing.assert_almost_equal(im.metadata[model.MD_TIME_LIST], [0, 2, 4, 6])
+
+        # Appending data of different shape is not possible
+        with hdf5.open_stack(FILENAME, "T") as writer:
+            writer.append(model.DataArray(numpy.zeros((5, 6), dtype)))
+            with self.assertRaises(ValueError):
+                writer.append(model.DataArray(numpy.zeros((6, 6), dtype)))
+
     def testExportSpatialCube(self):
         """
         Check it's possible to export 3D spatial data
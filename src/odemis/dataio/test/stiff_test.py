@@ -195,6 +195,68 @@ class TestTiffIO(unittest.TestCase):
             # No thumbnail handling for now, so assert that is empty
             self.assertEqual(rthumbnail, [])
 
+    def testIndexCache(self):
+        """
+        Check the index cache is used to open the files again
+        """
+        size = (64, 32)
+        dtype = numpy.uint16
+        ldata = []
+        self.no_of_images = 2
+        for i in range(self.no_of_images):
+            md = {model.MD_EXP_TIME: 0.2 * (i + 1),  # s
+                  model.MD_TIME_LIST: [0.1 * j for j in range(5)],
+                 }
+            a = model.DataArray(numpy.zeros((1, 5, 1) + size[::-1], dtype), md)
+            a[:, :, :, i, i] = 124 + i
+            ldata.append(a)
+
+        stiff.export(FILENAME, ldata)
+        self.addCleanup(self._remove_index_cache)
+
+        tiff.INDEX_CACHE = True
+        self._orig_read_index = tiff._readTIFFIndex
+        self._indexed = []
+        tiff._readTIFFIndex = self._read_index
+        try:
+            rdata = tiff.read_data(FILENAME)
+            self.assertEqual(len(self._indexed), self.no_of_images)
+            self.assertTrue(os.path.exists(FILENAME + tiff.INDEX_CACHE_EXT))
+
+            # Opening again => no file needs to be indexed
+            self._indexed = []
+            rdata_cached = tiff.read_data(FILENAME)
+            self.assertEqual(self._indexed, [])
+
+            # A modified file is indexed again
+            self._indexed = []
+            fname = FILENAME.replace(".0.", ".1.")
+            st = os.stat(fname)
+            os.utime(fname, (st.st_atime, st.st_mtime + 1))
+            tiff.read_data(FILENAME)
+            self.assertEqual(self._indexed, [fname])
+        finally:
+            tiff._readTIFFIndex = self._orig_read_index
+            tiff.INDEX_CACHE = False
+
+        self.assertEqual(len(rdata), self.no_of_images)
+        self.assertEqual(len(rdata_cached), self.no_of_images)
+        for im, imc, a in zip(rdata, rdata_cached, ldata):
+            self.assertEqual(im.shape, a.shape)
+            numpy.testing.assert_array_equal(imc, im)
+            self.assertEqual(imc.metadata, im.metadata)
+            self.assertAlmostEqual(im.metadata[model.MD_EXP_TIME], a.metadata[model.MD_EXP_TIME])
+
+    def _read_index(self, filename):
+        self._indexed.append(filename)
+        return self._orig_read_index(filename)
+
+    def _remove_index_cache(self):
+        try:
+            os.remove(FILENAME + tiff.INDEX_CACHE_EXT)
+        except OSError:
+            pass
+
     def testMissing(self):
         """
         Check it's at least possible to open one DataArray, when the other parts
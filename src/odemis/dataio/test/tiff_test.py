@@ -1715,6 +1715,118 @@ class TestTiffIO(unittest.TestCase):
             self.assertEqual(rmd[model.MD_DESCRIPTION], emd[model.MD_DESCRIPTION])
             self.assertEqual(rmd[model.MD_DIMS], emd[model.MD_DIMS])
 
+    def testReadIndex(self):
+        """
+        Checks the fast index gives the same images as reading all the TIFF
+        directories
+        """
+        md = {model.MD_DESCRIPTION: "timelapse",
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6),  # m/px
+              model.MD_POS: (13.7e-3, -30e-3),  # m
+              model.MD_EXP_TIME: 0.1,  # s
+              model.MD_HW_NAME: "fake hw",
+              model.MD_DIMS: "CTZYX",
+             }
+        shape = (1, 20, 3, 32, 24)
+        data = model.DataArray(numpy.zeros(shape, numpy.uint16), md)
+        for i, hi in enumerate(numpy.ndindex(*shape[:-2])):
+            data[hi] = i  # "watermark" each plane
+
+        # thumbnail : small RGB completely red
+        thumbnail = model.DataArray(numpy.zeros((8, 6, 3), numpy.uint8))
+        thumbnail[:, :, 0] += 255
+
+        tiff.export(FILENAME, data, thumbnail)
+
+        index = tiff._readTIFFIndex(FILENAME)
+        f = libtiff.TIFF.open(FILENAME)
+        for i in tiff.AcquisitionDataTIFF._iterDirectories(f):
+            ifd = index["ifds"][i]
+            self.assertEqual(ifd["thumbnail"], tiff._isThumbnail(f))
+            im = f.read_image()
+            self.assertEqual(tuple(ifd["shape"]), im.shape)
+            self.assertEqual(numpy.dtype(ifd["dtype"]), im.dtype)
+        self.assertEqual(len(index["ifds"]), i + 1)
+        f.SetDirectory(0)  # The OME-XML is in the first IFD
+        root = ET.fromstring(f.GetField(T.TIFFTAG_IMAGEDESCRIPTION))
+        self.assertEqual(index["uuid"], root.attrib.get("UUID"))
+        f.close()
+
+        acd = tiff.open_data(FILENAME)
+        rdata = acd.content[0].getData()
+        numpy.testing.assert_array_equal(rdata, data)
+        self.assertEqual(len(acd.thumbnails), 1)
+
+        # Compare to reading every directory
+        orig_read_index = tiff._readTIFFIndex
+        tiff._readTIFFIndex = self._fail_read_index
+        try:
+            acd_full = tiff.open_data(FILENAME)
+        finally:
+            tiff._readTIFFIndex = orig_read_index
+
+        self.assertEqual(len(acd.content), len(acd_full.content))
+        for das, das_full in zip(acd.content, acd_full.content):
+            self.assertEqual(das.shape, das_full.shape)
+            self.assertEqual(das.dtype, das_full.dtype)
+            self.assertEqual(das.metadata, das_full.metadata)
+
+    def testReadIndexDimOrder(self):
+        """
+        Checks the fast index gives the same images as reading all the TIFF
+        directories, for channels which cannot be merged, stored with C not
+        as the last dimension.
+        """
+        shape = (1, 3, 2, 32, 24)
+        ldata = []
+        for c, (inwl, outwl) in enumerate((((500e-9, 520e-9), (650e-9, 660e-9)),
+                                            ((600e-9, 630e-9), (620e-9, 650e-9)))):
+            md = {model.MD_DESCRIPTION: "green dye %d" % c,
+                  model.MD_PIXEL_SIZE: (1e-6, 1e-6),  # m/px
+                  model.MD_POS: (13.7e-3, -30e-3),  # m
+                  model.MD_EXP_TIME: 0.1 * (c + 1),  # s
+                  model.MD_IN_WL: inwl,  # m
+                  model.MD_OUT_WL: outwl,  # m
+                  model.MD_HW_NAME: "fake hw",
+                  model.MD_DIMS: "CTZYX",
+                 }
+            data = model.DataArray(numpy.zeros(shape, numpy.uint16), md)
+            for i, hi in enumerate(numpy.ndindex(*shape[:-2])):
+                data[hi] = c * 100 + i  # "watermark" each plane
+            ldata.append(data)
+
+        tiff.export(FILENAME, ldata)
+
+        # Change the dimension order to XYCZT. As the position of each IFD is
+        # explicit in the TiffData, the file stays valid, with the high dims TZC.
+        with open(FILENAME, "rb") as f:
+            content = f.read()
+        self.assertEqual(content.count(b'DimensionOrder="XYZTC"'), 1)
+        with open(FILENAME, "wb") as f:
+            f.write(content.replace(b'DimensionOrder="XYZTC"', b'DimensionOrder="XYCZT"'))
+
+        acd = tiff.open_data(FILENAME)
+
+        # Compare to reading every directory
+        orig_read_index = tiff._readTIFFIndex
+        tiff._readTIFFIndex = self._fail_read_index
+        try:
+            acd_full = tiff.open_data(FILENAME)
+        finally:
+            tiff._readTIFFIndex = orig_read_index
+
+        self.assertEqual(len(acd.content), len(acd_full.content))
+        self.assertGreater(len(acd.content), 1)  # Not merged
+        for das, das_full in zip(acd.content, acd_full.content):
+            self.assertEqual(das.shape, das_full.shape)
+            self.assertEqual(das.dtype, das_full.dtype)
+            self.assertEqual(das.metadata, das_full.metadata)
+            numpy.testing.assert_array_equal(das.getData(), das_full.getData())
+
+    @staticmethod
+    def _fail_read_index(filename):
+        raise ValueError("Index disabled for testing")
+
     def testBadTIFFMD(self):
         """
         Checks that can both write and read back data with a negative MD_POS.
@@ -39,6 +39,7 @@ from odemis.util.conversion import get_tile_md_pos, JsonExtraEncoder
 import operator
 import os
 import re
+import struct
 import sys
 import threading
 import time
@@ -71,6 +72,13 @@ CAN_SAVE_PYRAMID = True # indicates the support for pyramidal export
 TILE_SIZE = 256 # Tile size of pyramidal images
 LOSSY = False
 
+# If True, when opening an OME-TIFF file, the index of the TIFF files is saved
+# in a sidecar file (the filename + INDEX_CACHE_EXT), which is used to open it
+# faster the next time, as long as the TIFF files are not modified.
+INDEX_CACHE = False
+INDEX_CACHE_EXT = ".idx.json"
+INDEX_CACHE_VERSION = 1
+
 # We try to make it as much as possible looking like a normal (multi-page) TIFF,
 # with as much metadata as possible saved in the known TIFF tags. In addition,
 # we ensure it's compatible with OME-TIFF, which support much more metadata, and
@@ -504,20 +512,21 @@ def _findElementByID(root, eid, tag=None):
     return None
 
 
-def _updateMDFromOME(root, das):
+def _updateMDFromOME(root, das, ifds=None):
     """
     Updates the metadata of DAs according to OME XML
     root (ET.Element): the root (i.e., OME) element of the XML description
     data (list of DataArrays): DataArrays at the same place as the TIFF IFDs
+    ifds (None or list): the IFDs of each image, as returned by
+      _getAllIFDsFromOME(). If None, it is computed from the root.
     return None: only the metadata of DA's inside is updated
     """
+    if ifds is None:
+        ifds = _getAllIFDsFromOME(root)
+
     # For each Image in the XML, gorge ourself from all the metadata we can
     # find, and then use it to update the metadata of each IFD referenced.
-    # In case of multiple files, add an offset to the ifd based on the number of
-    # images found in the files that are already accessed
-    ifd_offset = 0
-
-    for ime in root.findall("Image"):
+    for ime, (hd_2_ifd, hdims) in zip(root.findall("Image"), ifds):
         md = {}
         try:
             md[model.MD_DESCRIPTION] = ime.attrib["Name"]
@@ -616,9 +625,6 @@ def _updateMDFromOME(root, das):
         except (KeyError, ValueError):
             pass
 
-        hd_2_ifd, hdims = _getIFDsFromOME(pxe, offset=ifd_offset)
-        ifd_offset += len(hd_2_ifd)
-
         # Channels are a bit tricky, because apparently they are associated to
         # each C only by the order they are specified.
         wl_list = [] # we'll know it only once all the channels are passed
@@ -1059,6 +1065,26 @@ def _getIFDsFromOME(pxe, offset=0):
 
     return imsetn, hdims
 
+
+def _getAllIFDsFromOME(root):
+    """
+    Return the IFDs of all the images of an OME XML description
+    root (ET.Element): the root (i.e., OME) element of the XML description
+    return (list of (numpy.array of int, str)): for each Image, the IFD of each
+      high dimension, and the high dimensions, as returned by _getIFDsFromOME().
+    """
+    ifds = []
+    # In case of multiple files, add an offset to the ifd based on the number of
+    # images found in the files that are already accessed
+    ifd_offset = 0
+    for ime in root.findall("Image"):
+        pxe = ime.find("Pixels")  # there must be only one per Image
+        imsetn, hdims = _getIFDsFromOME(pxe, offset=ifd_offset)
+        ifd_offset += len(imsetn)
+        ifds.append((imsetn, hdims))
+
+    return ifds
+
 # List of metadata which is allowed to merge (and possibly loose it partially)
 WHITELIST_MD_MERGE = frozenset([model.MD_FILTER_NAME,
                                 model.MD_HW_NAME, model.MD_HW_VERSION,
@@ -1914,6 +1940,230 @@ def export(filename, data, thumbnail=None, compressed=True, multiple_files=False
         _saveAsMultiTiffLT(filename, [data], thumbnail, compressed, pyramid=pyramid)
 
 
+# numpy type of the TIFF field types which can be read from the index
+_TIFF_FIELD_TYPES = {
+    1: "u1",  # BYTE
+    2: "S1",  # ASCII
+    3: "u2",  # SHORT
+    4: "u4",  # LONG
+    6: "i1",  # SBYTE
+    8: "i2",  # SSHORT
+    9: "i4",  # SLONG
+    13: "u4",  # IFD
+    16: "u8",  # LONG8 (BigTIFF)
+    17: "i8",  # SLONG8 (BigTIFF)
+    18: "u8",  # IFD8 (BigTIFF)
+}
+
+# The TIFF tags needed to index the images
+_INDEX_TAGS = (T.TIFFTAG_SUBFILETYPE, T.TIFFTAG_IMAGEWIDTH, T.TIFFTAG_IMAGELENGTH,
+               T.TIFFTAG_BITSPERSAMPLE, T.TIFFTAG_SAMPLESPERPIXEL,
+               T.TIFFTAG_SAMPLEFORMAT, T.TIFFTAG_TILEWIDTH, T.TIFFTAG_TILELENGTH)
+
+# Maximum number of bytes of the OME XML to read to find the UUID of the file.
+# The UUID is in the root element, so it's always at the beginning.
+_UUID_SEARCH_SIZE = 4096
+
+
+def _readTagValues(f, byteorder, entry, offset_dtype, max_size=None):
+    """
+    Read the values of a tag of an IFD
+    f (File): the TIFF file, opened in binary mode
+    byteorder (str): "<" or ">", the numpy byte order of the file
+    entry (numpy.void): the IFD entry, with the "type", "count" and "value"
+      fields.
+    offset_dtype (str): numpy type of the "value" field, when it's an offset
+    max_size (None or int): maximum number of bytes to read
+    return (None or bytes or numpy.array): the values, as bytes for ASCII. None
+      if the type is not supported.
+    """
+    try:
+        dtype = numpy.dtype(byteorder + _TIFF_FIELD_TYPES[int(entry["type"])])
+    except KeyError:
+        return None
+    size = int(entry["count"]) * dtype.itemsize
+    if max_size is not None:
+        size = min(size, max_size)
+
+    raw = entry["value"].tobytes()
+    if size > len(raw):
+        # The value doesn't fit in the entry => it's stored at the offset
+        f.seek(int(numpy.frombuffer(raw, byteorder + offset_dtype)[0]))
+        raw = f.read(size)
+        if len(raw) < size:
+            raise ValueError("Tag value truncated")
+
+    if dtype.kind == "S":
+        return raw[:size].split(b"\0", 1)[0]
+    return numpy.frombuffer(raw, dtype, count=size // dtype.itemsize)
+
+
+def _getNumpyType(bits, sample_format=None):
+    """
+    Same as TIFF.get_numpy_type(), but without opening the file
+    bits (int): number of bits per sample
+    sample_format (None or int): the TIFF SAMPLEFORMAT
+    return (numpy type): the type corresponding to the TIFF format
+    raise ValueError: if the format is not supported
+    """
+    if sample_format == T.SAMPLEFORMAT_IEEEFP:
+        name = "float%d" % (bits,)
+    elif sample_format in (T.SAMPLEFORMAT_UINT, None):
+        name = "uint%d" % (bits,)
+    elif sample_format == T.SAMPLEFORMAT_INT:
+        name = "int%d" % (bits,)
+    elif sample_format == T.SAMPLEFORMAT_COMPLEXIEEEFP:
+        name = "complex%d" % (bits,)
+    else:
+        raise ValueError("Sample format %s not supported" % (sample_format,))
+
+    try:
+        return numpy.dtype(name).type
+    except TypeError:
+        raise ValueError("Type %s not supported" % (name,))
+
+
+def _readTIFFIndex(filename):
+    """
+    Read the list of images of a TIFF file, without decoding them. This is much
+    faster than going through every directory with libtiff, as only the few
+    tags needed are decoded, and not the strip/tile offsets. In particular, this
+    doesn't read the whole OME XML (only the UUID).
+    filename (str): path to the TIFF file
+    return (dict): the index of the file, with the following keys:
+      "uuid" (str or None): the UUID of the OME-TIFF file, if any
+      "ifds" (list of dict): for each IFD (aka directory) of the file:
+        "shape" (list of int), "dtype" (str), "thumbnail" (bool), "tiled" (bool)
+    raise:
+      IOError: if the file cannot be read
+      ValueError: if the file is not a TIFF file or it has unsupported images
+    """
+    with open(filename, "rb") as f:
+        header = f.read(16)
+        if header[:2] == b"II":
+            bo = "<"
+        elif header[:2] == b"MM":
+            bo = ">"
+        else:
+            raise ValueError("%s is not a TIFF file" % (filename,))
+
+        version = struct.unpack(bo + "H", header[2:4])[0]
+        if version == 42:  # Classic TIFF
+            offset = struct.unpack(bo + "I", header[4:8])[0]
+            count_fmt, offset_fmt, offset_dtype = "H", "I", "u4"
+        elif version == 43:  # BigTIFF
+            offset = struct.unpack(bo + "Q", header[8:16])[0]
+            count_fmt, offset_fmt, offset_dtype = "Q", "Q", "u8"
+        else:
+            raise ValueError("%s has unknown TIFF version %d" % (filename, version))
+        count_size = struct.calcsize(count_fmt)
+        offset_size = struct.calcsize(offset_fmt)
+        entry_dtype = numpy.dtype([("tag", bo + "u2"), ("type", bo + "u2"),
+                                   ("count", bo + offset_dtype), ("value", "V%d" % offset_size)])
+
+        fuuid = None
+        ifds = []
+        offsets_read = set()
+        while offset:
+            if offset in offsets_read:
+                raise ValueError("IFD at %d is referenced multiple times" % (offset,))
+            offsets_read.add(offset)
+
+            # Read all the entries of the IFD + the offset of the next IFD in one go
+            f.seek(offset)
+            count = struct.unpack(bo + count_fmt, f.read(count_size))[0]
+            size = count * entry_dtype.itemsize
+            buf = f.read(size + offset_size)
+            if len(buf) < size + offset_size:
+                raise ValueError("IFD at %d is truncated" % (offset,))
+            entries = numpy.frombuffer(buf, entry_dtype, count=count)
+            offset = struct.unpack(bo + offset_fmt, buf[size:])[0]
+
+            tags = {}
+            for e in entries[numpy.isin(entries["tag"], _INDEX_TAGS)]:
+                tags[int(e["tag"])] = _readTagValues(f, bo, e, offset_dtype)
+
+            if not ifds:
+                # The OME XML is in the description of the first IFD
+                for e in entries[entries["tag"] == T.TIFFTAG_IMAGEDESCRIPTION]:
+                    desc = _readTagValues(f, bo, e, offset_dtype, _UUID_SEARCH_SIZE)
+                    m = re.search(br"<OME\s[^>]*\bUUID=[\"']([^\"']*)", desc or b"")
+                    if m:
+                        fuuid = m.group(1).decode("ascii", "ignore")
+
+            ifds.append(_indexIFD(tags))
+
+    return {"uuid": fuuid, "ifds": ifds}
+
+
+def _indexIFD(tags):
+    """
+    Convert the tags of an IFD into its index entry
+    tags (dict int -> numpy.array): the tags (as read from the file)
+    return (dict): the index entry, as in _readTIFFIndex()
+    raise ValueError: if some tags are missing or not supported
+    """
+    def get_value(tag, default=None):
+        vals = tags.get(tag)
+        if vals is None or not len(vals):
+            return default
+        return int(vals[0])
+
+    width = get_value(T.TIFFTAG_IMAGEWIDTH)
+    height = get_value(T.TIFFTAG_IMAGELENGTH)
+    if width is None or height is None:
+        raise ValueError("IFD without image size")
+
+    shape = [height, width]
+    samples_pp = get_value(T.TIFFTAG_SAMPLESPERPIXEL, 1)  # this number includes extra samples
+    if samples_pp > 1:
+        shape.append(samples_pp)
+
+    typ = _getNumpyType(get_value(T.TIFFTAG_BITSPERSAMPLE, 1),
+                        get_value(T.TIFFTAG_SAMPLEFORMAT))
+
+    return {"shape": shape,
+            "dtype": numpy.dtype(typ).name,
+            "thumbnail": bool(get_value(T.TIFFTAG_SUBFILETYPE, 0) & T.FILETYPE_REDUCEDIMAGE),
+            "tiled": bool(get_value(T.TIFFTAG_TILEWIDTH) and get_value(T.TIFFTAG_TILELENGTH)),
+            }
+
+
+def _readIndexCache(filename):
+    """
+    Read the sidecar index cache of a file
+    filename (str): path to the (main) TIFF file
+    return (dict str -> dict): basename of each TIFF file -> its index (as
+      returned by _readTIFFIndex(), with "size" and "mtime" of the file). It's
+      empty if there is no (valid) cache.
+    """
+    try:
+        with open(filename + INDEX_CACHE_EXT, "r") as f:
+            cache = json.load(f)
+        if cache["version"] != INDEX_CACHE_VERSION:
+            logging.info("Skipping index cache of %s with version %s", filename, cache["version"])
+            return {}
+        return cache["files"]
+    except IOError:
+        return {}  # No cache yet
+    except (ValueError, KeyError, TypeError) as ex:
+        logging.info("Failed to read the index cache of %s: %s", filename, ex)
+        return {}
+
+
+def _writeIndexCache(filename, files):
+    """
+    Save the sidecar index cache of a file
+    filename (str): path to the (main) TIFF file
+    files (dict str -> dict): see _readIndexCache()
+    """
+    try:
+        with open(filename + INDEX_CACHE_EXT, "w") as f:
+            json.dump({"version": INDEX_CACHE_VERSION, "files": files}, f)
+    except IOError as ex:
+        logging.info("Failed to save the index cache of %s: %s", filename, ex)
+
+
 def read_data(filename):
     """
     Read an TIFF file and return its content (skipping the thumbnail).
@@ -1969,12 +2219,15 @@ class DataArrayShadowTIFF(DataArrayShadow):
         depending if the image is pyramidal or not.
         """
         if isinstance(tiff_info, list):
-            tiff_handle = tiff_info[0]['handle']
+            tiff_info = tiff_info[0]
+        if 'tiled' in tiff_info:  # Already known from the index
+            tiled = tiff_info['tiled']
         else:
             tiff_handle = tiff_info['handle']
-        num_tcols = tiff_handle.GetField(T.TIFFTAG_TILEWIDTH)
-        num_trows = tiff_handle.GetField(T.TIFFTAG_TILELENGTH)
-        if num_tcols and num_trows:
+            num_tcols = tiff_handle.GetField(T.TIFFTAG_TILEWIDTH)
+            num_trows = tiff_handle.GetField(T.TIFFTAG_TILELENGTH)
+            tiled = bool(num_tcols and num_trows)
+        if tiled:
             subcls = DataArrayShadowPyramidalTIFF
         else:
             subcls = DataArrayShadowTIFF
@@ -1990,6 +2243,8 @@ class DataArrayShadowTIFF(DataArrayShadow):
             The dictionary (or each dictionary in the list) has 2 values:
             'tiff_file' (handle): Handle of the tiff file
             'dir_index' (int): Index of the directory
+            It can also have 'tiled' (bool), if it's already known whether the
+            image is tiled.
         shape (tuple of int): The shape of the corresponding DataArray
         dtype (numpy.dtype): The data type
         metadata (dict str->val): The metadata
@@ -2070,15 +2325,15 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
             tiff_info0 = tiff_info
         tiff_file = tiff_info0['handle']
 
-        num_tcols = tiff_file.GetField(T.TIFFTAG_TILEWIDTH)
-        num_trows = tiff_file.GetField(T.TIFFTAG_TILELENGTH)
-        if num_tcols is None or num_trows is None:
-            raise ValueError("The image is not tiled")
-
         with tiff_info0['lock']:
             tiff_file.SetDirectory(tiff_info0['dir_index'])
+            num_tcols = tiff_file.GetField(T.TIFFTAG_TILEWIDTH)
+            num_trows = tiff_file.GetField(T.TIFFTAG_TILELENGTH)
             sub_ifds = tiff_file.GetField(T.TIFFTAG_SUBIFD)
 
+        if num_tcols is None or num_trows is None:
+            raise ValueError("The image is not tiled")
+
         # add the number of subdirectories, and the main image
         if sub_ifds:
             maxzoom = len(sub_ifds)
@@ -2137,6 +2392,24 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
         return tile
 
 
+class _IFDInfo(object):
+    """
+    Stand-in for a DataArrayShadowTIFF of an IFD which is only used as part of
+    a larger array. It has the same attributes, but cannot read the data. This
+    avoids reading the TIFF tags of every IFD.
+    """
+
+    def __init__(self, tiff_info, shape, dtype, metadata=None):
+        """
+        Same arguments as DataArrayShadowTIFF
+        """
+        self.tiff_info = tiff_info
+        self.shape = shape
+        self.ndim = len(shape)
+        self.dtype = dtype
+        self.metadata = metadata if metadata else {}
+
+
 class AcquisitionDataTIFF(AcquisitionData):
     """
     Implements AcquisitionData for TIFF files
@@ -2212,6 +2485,13 @@ class AcquisitionDataTIFF(AcquisitionData):
         except LookupError as ex:
             raise ValueError("%s" % (ex,))
 
+        try:
+            return self._getIndexedOMEDataArrayShadows(filename, tfile, omeroot)
+        except ValueError as ex:
+            logging.info("Cannot open the file via its index (%s), will read all the directories", ex)
+        except Exception:
+            logging.exception("Failed to open the file via its index, will read all the directories")
+
         # TODO: flip the whole procedure on its head: based on the OME metadata,
         # load the right metadata. If that doesn't go fine, just fallback to
         # reading the data from the TIFF.
@@ -2258,8 +2538,9 @@ class AcquisitionDataTIFF(AcquisitionData):
                 # Nothing loading (not even the current file) => load this file
                 data, thumbnails = self._getAllDataArrayShadows(tfile, self._lock)
 
-            _updateMDFromOME(omeroot, data)
-            data = AcquisitionDataTIFF._foldArrayShadowsFromOME(omeroot, data)
+            ifds = _getAllIFDsFromOME(omeroot)
+            _updateMDFromOME(omeroot, data, ifds)
+            data = AcquisitionDataTIFF._foldArrayShadowsFromOME(omeroot, data, ifds)
         except Exception:
             logging.exception("Failed to decode OME XML")
             raise ValueError("Failure during OME XML decoding")
@@ -2268,6 +2549,160 @@ class AcquisitionDataTIFF(AcquisitionData):
         data = [i for i in data if i is not None]
         return data, thumbnails
 
+    def _getIndexedOMEDataArrayShadows(self, filename, tfile, omeroot):
+        """
+        Same as _getAllOMEDataArrayShadows(), but faster for files with many
+        IFDs. The IFDs are listed directly from the TIFF files (and possibly
+        from the index cache), and the TIFF tags are only read for the first
+        IFD of each channel. The rest of the metadata is in the OME XML, and
+        the metadata of the other IFDs would be dropped when merging them anyway.
+        filename (str): the name of the TIFF file
+        tfile (tiff handle): Handle for the TIFF file
+        omeroot (ET.Element): the OME XML root of the TIFF file
+        return data, thumbnails: see _getAllOMEDataArrayShadows()
+        raise ValueError: if the files cannot be indexed
+        """
+        cache = _readIndexCache(filename) if INDEX_CACHE else {}
+        prev_cache = dict(cache)
+
+        # Find all the files, in the same order as _getAllOMEDataArrayShadows()
+        files = []  # (str, dict) or (None, None): path and index of each file
+        uuids_read = set()
+        for tiff_data in omeroot.findall("Image/Pixels/TiffData"):
+            uuide = tiff_data.find("UUID")
+            if uuide is None:
+                continue
+
+            try:
+                u = uuid.UUID(uuide.text)
+                ofn = uuide.get("FileName")
+            except (ValueError, KeyError) as ex:
+                logging.warning("Failed to decode UUID %s: %s", uuide.text, ex)
+                continue
+
+            if u in uuids_read:
+                continue  # Already done
+
+            try:
+                files.append(self._findIndexByUUID(u, ofn, filename, cache))
+            except LookupError:
+                logging.warning("File '%s' enlisted in the OME-XML header is missing.", u)
+                files.append((None, None))  # place-holder
+                continue
+            uuids_read.add(u)
+
+        if not files:
+            files.append((filename, self._getFileIndex(filename, cache)))
+
+        if INDEX_CACHE and any(index is not prev_cache.get(bn) for bn, index in cache.items()):
+            _writeIndexCache(filename, cache)
+
+        # Only the first IFD of each channel needs to have its TIFF tags read
+        ifds = _getAllIFDsFromOME(omeroot)
+        first_ifds = set()
+        for imsetn, hdims in ifds:
+            firsts = tuple(slice(None) if d == "C" else 0 for d in hdims)
+            first_ifds.update(imsetn[firsts].flat)
+            # If the channels cannot be merged, the image is split along the
+            # first high dim, and each part gets the metadata of its first IFD.
+            if imsetn.ndim:
+                first_ifds.update(sub_imsetn.flat[0] for sub_imsetn in imsetn)
+
+        data, thumbnails = [], []
+        handles = {filename: tfile}
+        try:
+            for fn, index in files:
+                if fn is None:
+                    data.append(None)
+                    continue
+
+                if fn not in handles:
+                    handles[fn] = TIFF.open(fn, mode='r')
+                stfile = handles[fn]
+                for dir_index, ifd in enumerate(index["ifds"]):
+                    tiff_info = {'handle': stfile, 'dir_index': dir_index,
+                                 'lock': self._lock, 'tiled': ifd["tiled"]}
+                    shape = tuple(ifd["shape"])
+                    typ = numpy.dtype(ifd["dtype"]).type
+                    if ifd["thumbnail"] or len(data) in first_ifds:
+                        stfile.SetDirectory(dir_index)
+                        md = _readTiffTag(stfile)  # reads tag of the current image
+                        das = DataArrayShadowTIFF(tiff_info, shape, typ, md)
+                        if ifd["thumbnail"]:
+                            data.append(None)
+                            thumbnails.append(das)
+                            continue
+                    else:
+                        das = _IFDInfo(tiff_info, shape, typ)
+                    data.append(das)
+
+            _updateMDFromOME(omeroot, data, ifds)
+            data = AcquisitionDataTIFF._foldArrayShadowsFromOME(omeroot, data, ifds)
+            if any(isinstance(das, _IFDInfo) for das in data):
+                raise ValueError("Some images are not defined by their first IFD")
+        except Exception:
+            # The caller will reopen all the files, so don't leak these ones
+            for h in handles.values():
+                if h is not tfile:
+                    h.close()
+            raise
+
+        return data, thumbnails
+
+    @staticmethod
+    def _getFileIndex(fn, cache):
+        """
+        Get the index of a TIFF file, from the cache if it's up-to-date
+        fn (str): path to the TIFF file
+        cache (dict str -> dict): the index cache (see _readIndexCache()). It's
+          updated if the file is (re)indexed.
+        return (dict): the index of the file, as returned by _readTIFFIndex()
+        raise:
+          IOError: if the file cannot be read
+          ValueError: if the file cannot be indexed
+        """
+        st = os.stat(fn)
+        bn = os.path.basename(fn)
+        index = cache.get(bn)
+        if index and index.get("size") == st.st_size and index.get("mtime") == st.st_mtime:
+            return index
+
+        index = _readTIFFIndex(fn)
+        index["size"] = st.st_size
+        index["mtime"] = st.st_mtime
+        cache[bn] = index
+        return index
+
+    def _findIndexByUUID(self, suuid, orig_fn, root_fn, cache):
+        """
+        Same as _findFileByUUID(), but only reads the index of the files
+        suuid, orig_fn, root_fn: see _findFileByUUID()
+        cache (dict str -> dict): see _getFileIndex()
+        return filename (str): the whole path of the file found
+               index (dict): the index of the file
+        raise:
+            LookupError: if no file could be found
+            ValueError: if a file cannot be indexed
+        """
+        for fn in self._listCandidateFiles(orig_fn, root_fn):
+            try:
+                index = self._getFileIndex(fn, cache)
+            except IOError:
+                continue  # No file found
+
+            try:
+                fuuid = uuid.UUID(index["uuid"])
+            except (TypeError, ValueError):
+                logging.info("Found file %s, but couldn't read UUID", fn)
+                continue
+
+            if fuuid != suuid:
+                logging.warning("Found file %s, but UUID is %s instead of %s",
+                                fn, fuuid, suuid)
+            return fn, index
+
+        raise LookupError("Failed to find file with UUID %s" % (suuid,))
+
     def _findFileByUUID(self, suuid, orig_fn, root_fn):
         """
         Find the file with the given UUID. In addition to immediately
@@ -2283,9 +2718,6 @@ class AcquisitionDataTIFF(AcquisitionData):
         raise LookupError:
             if no file could be found
         """
-        path, root_bn = os.path.split(root_fn)
-        _, orig_bn = os.path.split(orig_fn)
-
         def try_filename(fn):
             # try to find and open the enlisted file
             try:
@@ -2304,14 +2736,31 @@ class AcquisitionDataTIFF(AcquisitionData):
             if fuuid != suuid:
                 logging.warning("Found file %s, but UUID is %s instead of %s",
                                 fn, fuuid, suuid)
-            return full_fn, tfile
+            return fn, tfile
+
+        for full_fn in self._listCandidateFiles(orig_fn, root_fn):
+            try:
+                return try_filename(full_fn)
+            except LookupError:
+                pass
+
+        raise LookupError("Failed to find file with UUID %s" % (suuid,))
+
+    @staticmethod
+    def _listCandidateFiles(orig_fn, root_fn):
+        """
+        List the paths where a file referenced in the OME XML could be
+        orig_fn (str): most probable name of the file (just the basename
+          is fine)
+        root_fn (str): path to the file where UUID reference was found,
+            should contain the whole path
+        return (list of str): the paths, from the most probable
+        """
+        path, root_bn = os.path.split(root_fn)
+        _, orig_bn = os.path.split(orig_fn)
 
         # Look in the same directory as the root file
-        full_fn = os.path.join(path, orig_bn)
-        try:
-            return try_filename(full_fn)
-        except LookupError:
-            pass
+        fns = [os.path.join(path, orig_bn)]
 
         # In case the root file has been renamed, let's try to rename the
         # file we are looking for in the same way.
@@ -2321,13 +2770,9 @@ class AcquisitionDataTIFF(AcquisitionData):
         if m_root and m_orig:
             try_bn = m_root.groupdict()["b"] + m_orig.groupdict()["n"] + m_root.groupdict()["ext"]
             if try_bn != orig_bn:
-                full_fn = os.path.join(path, try_bn)
-                try:
-                    return try_filename(full_fn)
-                except LookupError:
-                    pass
+                fns.append(os.path.join(path, try_bn))
 
-        raise LookupError("Failed to find file with UUID %s" % (suuid,))
+        return fns
 
     def _getOMEXML(self, tfile):
         """
@@ -2394,7 +2839,7 @@ class AcquisitionDataTIFF(AcquisitionData):
         return das, _isThumbnail(tfile)
 
     @staticmethod
-    def _foldArrayShadowsFromOME(root, das):
+    def _foldArrayShadowsFromOME(root, das, ifds=None):
         """
         Reorganize DataArrayShadows with more than 2 dimensions according to OME XML
         Note: it expects _updateMDFromOME has been run before and so each array
@@ -2403,15 +2848,17 @@ class AcquisitionDataTIFF(AcquisitionData):
         base arrays of 3D if the data is RGB (3rd dimension has length 3).
         root (ET.Element): the root (i.e., OME) element of the XML description
         das (list of DataArrayShadows): DataArrayShadows at the same place as the TIFF IFDs
+        ifds (None or list): the IFDs of each image, as returned by
+          _getAllIFDsFromOME(). If None, it is computed from the root.
         return (list of DataArrayShadows): new shorter list of DASs positions
         """
+        if ifds is None:
+            ifds = _getAllIFDsFromOME(root)
+
         omedas = []
 
         n = 0 # just for logging
-        # In case of multiple files, add an offset to the ifd based on the number of
-        # images found in the files that are already accessed
-        ifd_offset = 0
-        for ime in root.findall("Image"):
+        for ime, (imsetn, hdims) in zip(root.findall("Image"), ifds):
             n += 1
             pxe = ime.find("Pixels") # there must be only one per Image
 
@@ -2424,8 +2871,6 @@ class AcquisitionDataTIFF(AcquisitionData):
             # and Plane refers to the C dimension.
     #        spp = int(pxe.get("Channel/SamplesPerPixel", "1"))
 
-            imsetn, hdims = _getIFDsFromOME(pxe, offset=ifd_offset)
-            ifd_offset += len(imsetn)
             # For now we expect RGB as (SPP=3,) SizeC=3, PlaneCount=1, and 1 3D IFD,
             # or as (SPP=3,) SizeC=3, PlaneCount=3 and 3 2D IFDs.
 
@@ -19,6 +19,7 @@ from __future__ import division
 
 from concurrent import futures
 from ctypes import *
+from ctypes import POINTER, byref, c_int, c_uint32, cast
 import ctypes
 from decorator import decorator
 import logging
@@ -39,6 +40,10 @@ MAXDEVNUM = 8
 HISTCHAN = 65536  # number of histogram channels
 TTREADMAX = 131072  # 128K event records
 
+T2_WRAPAROUND = 210698240  # time tag increase at each overflow record
+T3_WRAPAROUND = 65536  # nsync increase at each overflow record
+T3_DTIME_BINS = 4096  # number of start-stop time bins in T3 mode (12 bits)
+
 MODE_HIST = 0
 MODE_T2 = 2
 MODE_T3 = 3
@@ -55,6 +60,15 @@ FLAG_SYSERROR = 0x0100  # Hardware problem
 
 BINSTEPSMAX = 8
 
+# Default markers bits in TTTR mode, as sent by the scanner
+MARKER_LINE = 0x1  # start of a line
+MARKER_PIXEL = 0x2  # start of a pixel
+MARKER_FRAME = 0x4  # start of a frame
+
+FIFO_POLL_PERIOD = 5e-3  # s, time to wait after reading an empty FIFO
+
+FLIM_MAX_RES = (1024, 1024)  # X, Y maximum size of the scanned area in FLIM
+
 SYNCDIVMIN = 1
 SYNCDIVMAX = 8
 
@@ -228,7 +242,8 @@ class PH300(model.Detector):
           or None if any device is fine.
         dependencies (dict str -> Component): shutters components (shutter0 and shutter1 are valid)
         children (dict str -> kwargs): the names of the detectors (detector0 and
-         detector1 are valid)
+         detector1 are valid), and "flim" for the acquisition of the time
+         histogram of each pixel of a scanned area (in T3 mode).
         disc_volt (2 (0 <= float <= 0.8)): discriminator voltage for the APD 0 and 1 (in V)
         zero_cross (2 (0 <= float <= 2e-3)): zero cross voltage for the APD0 and 1 (in V)
         shutter_axes (dict str -> str, value, value): internal child role of the photo-detector ->
@@ -258,7 +273,10 @@ class PH300(model.Detector):
 
         # TODO: metadata for indicating the range? cf WL_LIST?
 
-        # TODO: do we need TTTR mode?
+        # The device is in histogram mode, unless the FLIM child is acquiring
+        # (in T3 mode). Only one measurement can run at a time.
+        self._acq_lock = threading.Lock()
+        self._mode = None
         self.Initialise(MODE_HIST)
         self._swVersion = self.GetLibraryVersion()
         self._metadata[model.MD_SW_VERSION] = self._swVersion
@@ -279,6 +297,7 @@ class PH300(model.Detector):
         # It could also go into just separate DataFlow, but then it's difficult
         # to allow using these DataFlows in a standard way.
         self._detectors = {}
+        self._flim = None
         self._shutters = {}
         self._shutter_axes = shutter_axes or {}
         for name, ckwargs in children.items():
@@ -296,8 +315,11 @@ class PH300(model.Detector):
                     shutter_name = None
                 self._detectors[name] = PH300RawDetector(channel=1, parent=self, shutter_name=shutter_name, daemon=daemon, **ckwargs)
                 self.children.value.add(self._detectors[name])
+            elif name == "flim":
+                self._flim = PH300FLIMDetector(parent=self, daemon=daemon, **ckwargs)
+                self.children.value.add(self._flim)
             else:
-                raise ValueError("Child %s not recognized, should be detector0 or detector1.")
+                raise ValueError("Child %s not recognized, should be detector0, detector1 or flim." % (name,))
         for name, comp in dependencies.items():
             if name == "shutter0":
                 if "shutter0" not in shutter_axes.keys():
@@ -319,8 +341,9 @@ class PH300(model.Detector):
         self._shape = (HISTCHAN, 1, 2**16) # Histogram is 32 bits, but only return 16 bits info
 
         # Set the CFD parameters (in mV)
-        for i, (dv, zc) in enumerate(zip(disc_volt, zero_cross)):
-            self.SetInputCFD(i, int(dv * 1000), int(zc * 1000))
+        self._cfd = [(int(dv * 1000), int(zc * 1000)) for dv, zc in zip(disc_volt, zero_cross)]
+        for i, (dv, zc) in enumerate(self._cfd):
+            self.SetInputCFD(i, dv, zc)
 
         tresbase, bs = self.GetBaseResolution()
         tres = self.GetResolution()
@@ -384,6 +407,8 @@ class PH300(model.Detector):
             raise HwError("No PicoHarp300 found, check the device is turned on and connected to the computer")
 
     def terminate(self):
+        if self._flim:
+            self._flim.terminate()
         self.stop_generate()
         if self._generator:
             self._genmsg.put(GEN_TERM)
@@ -407,6 +432,25 @@ class PH300(model.Detector):
         """
         logging.debug("Initializing device %d", self._idx)
         self._dll.PH_Initialize(self._idx, mode)
+        self._mode = mode
+
+    def _setMode(self, mode):
+        """
+        Switch the device to the given mode, if it's not already in this mode.
+        As the initialisation resets the device, all the settings are applied again.
+        mode (MODE_*)
+        """
+        if self._mode == mode:
+            return
+        logging.debug("Switching device %d to mode %d", self._idx, mode)
+        self.Initialise(mode)
+        self.Calibrate()
+        self.SetOffset(0)
+        for i, (dv, zc) in enumerate(self._cfd):
+            self.SetInputCFD(i, dv, zc)
+        self._setPixelDuration(self.pixelDuration.value)
+        self._setSyncDiv(self.syncDiv.value)
+        self._setSyncOffset(self.syncOffset.value)
 
     def GetHardwareInfo(self):
         mod = create_string_buffer(16)
@@ -576,6 +620,14 @@ class PH300(model.Detector):
         self._dll.PH_GetElapsedMeasTime(self._idx, byref(elapsed))
         return elapsed.value * 1e-3
 
+    def GetFlags(self):
+        """
+        return (int): the flags (FLAG_*) of the device
+        """
+        flags = c_int()
+        self._dll.PH_GetFlags(self._idx, byref(flags))
+        return flags.value
+
     def ReadFiFo(self, count):
         """
         Warning, the device must be initialised in a special mode (T2 or T3)
@@ -786,26 +838,28 @@ class PH300(model.Detector):
                         break
 
                     logging.debug("Starting new acquisition")
-                    self.ClearHistMem()
-                    self.StartMeas(int(tacq * 1e3))
-
-                    # Wait for the acquisition to be done or until a stop or
-                    # terminate message comes
-                    try:
-                        if self._acq_wait_data(tstart + tacq, timeout=tacq * 3 + 1):
-                            # Stop message received
-                            break
-                        logging.debug("Acq complete")
-                    except TimeoutError as ex:
-                        logging.error(ex)
-                        # TODO: try to reset the hardware?
-                        continue
-                    finally:
-                        # Must always be called, whether the measurement finished or not
-                        self.StopMeas()
-
-                    # Read data and pass it
-                    data = self.GetHistogram()
+                    with self._acq_lock:
+                        self._setMode(MODE_HIST)
+                        self.ClearHistMem()
+                        self.StartMeas(int(tacq * 1e3))
+
+                        # Wait for the acquisition to be done or until a stop or
+                        # terminate message comes
+                        try:
+                            if self._acq_wait_data(tstart + tacq, timeout=tacq * 3 + 1):
+                                # Stop message received
+                                break
+                            logging.debug("Acq complete")
+                        except TimeoutError as ex:
+                            logging.error(ex)
+                            # TODO: try to reset the hardware?
+                            continue
+                        finally:
+                            # Must always be called, whether the measurement finished or not
+                            self.StopMeas()
+
+                        # Read data and pass it
+                        data = self.GetHistogram()
                     da = model.DataArray(data, md)
                     self.data.notify(da)
 
@@ -823,6 +877,37 @@ class PH300(model.Detector):
 
         logging.debug("Acquisition thread ended")
 
+    def _acquireT3(self, shape, bin_shift, tacq, must_stop):
+        """
+        Acquire in T3 mode the time histogram of each pixel of a scanned area.
+        The scan position is followed using the markers sent by the scanner.
+        shape (int, int, int): Y, X, T size of the histogram cube
+        bin_shift (0 <= int): binning of the time bins, as a power of 2
+        tacq (float): duration of the measurement (s)
+        must_stop (threading.Event): when set, the measurement is stopped early
+        returns:
+          hist (ndarray of uint32 of shape YXT): the number of photons detected
+          frames (int): the number of frames started during the measurement
+        """
+        histogrammer = T3Histogrammer(shape, bin_shift=bin_shift)
+        with self._acq_lock:
+            self._setMode(MODE_T3)
+            reader = FiFoReader(self, histogrammer.add_records)
+            reader.start()
+            completed = False
+            try:
+                self.StartMeas(int(tacq * 1e3))
+                while not must_stop.wait(min(0.1, tacq / 2)):
+                    if self.CTCStatus():
+                        completed = True
+                        break
+            finally:
+                # Once the measurement is over, read the records left in the FIFO
+                reader.stop(drain=completed)
+                self.StopMeas()
+
+        return histogrammer.hist, histogrammer.frames
+
     @classmethod
     def scan(cls):
         """
@@ -910,6 +995,96 @@ class PH300RawDetector(model.Detector):
         self.data.notify(img)
 
 
+class PH300FLIMDetector(model.Detector):
+    """
+    Represents the fluorescence lifetime imaging (FLIM) acquisition of the
+    PicoQuant PicoHarp 300: the device is used in T3 mode, and each data is the
+    time histogram of every pixel of the area scanned. The scanner must send
+    the line (and pixel and frame) markers to the device.
+    Cannot be directly created. It must be done via PH300 child.
+    """
+
+    def __init__(self, name, role, parent, time_bins=256, **kwargs):
+        """
+        time_bins (1 <= int <= 4096): number of time bins of the histogram of
+          each pixel. Must be a power of 2. The start-stop times are binned
+          accordingly.
+        """
+        if not 1 <= time_bins <= T3_DTIME_BINS or time_bins & (time_bins - 1):
+            raise ValueError("time_bins should be a power of 2 between 1 and %d, but got %s" %
+                             (T3_DTIME_BINS, time_bins))
+        self._bin_shift = int(math.log(T3_DTIME_BINS // time_bins, 2))
+        super(PH300FLIMDetector, self).__init__(name, role, parent=parent, **kwargs)
+
+        # T, X, Y + depth, so that the data is YXT
+        self._shape = (time_bins,) + FLIM_MAX_RES + (2**32,)
+        self._metadata[model.MD_DET_TYPE] = model.MD_DT_NORMAL
+        self._metadata[model.MD_DIMS] = "YXT"
+
+        # Size of the scanned area, which must correspond to the scanner settings
+        self.resolution = model.ResolutionVA((64, 64), ((1, 1), FLIM_MAX_RES))
+
+        # dwellTime = measurement duration
+        dt_rng = (ACQTMIN * 1e-3, ACQTMAX * 1e-3)  # s
+        self.dwellTime = model.FloatContinuous(1, dt_rng, unit="s")
+
+        self.data = BasicDataFlow(self)
+        self._generator = None
+        self._must_stop = None  # threading.Event to stop the current generator
+
+    def terminate(self):
+        self.stop_generate()
+
+    def start_generate(self):
+        if self._generator is not None:
+            logging.warning("Generator already running")
+            return
+        # Each generator has its own event, so that a new one can be started
+        # while the previous one is still finishing
+        self._must_stop = threading.Event()
+        self._generator = threading.Thread(target=self._acquire, args=(self._must_stop,),
+                                           name="PicoHarp300 FLIM acquisition thread")
+        self._generator.start()
+
+    def stop_generate(self):
+        if self._generator is not None:
+            # Don't wait for the thread to end, as it might be the one calling
+            self._must_stop.set()
+            self._generator = None
+
+    def _acquire(self, must_stop):
+        """
+        Acquisition thread, which acquires until must_stop is set
+        must_stop (threading.Event)
+        """
+        shutters = list(self.parent._shutters.keys())
+        try:
+            self.parent._toggle_shutters(shutters, True)
+            while not must_stop.is_set():
+                tacq = self.dwellTime.value
+                res = self.resolution.value
+                nt = self._shape[0]
+                md = self._metadata.copy()
+                md[model.MD_ACQ_DATE] = time.time()
+                md[model.MD_DWELL_TIME] = tacq
+                pxd = self.parent.pixelDuration.value * 2 ** self._bin_shift
+                md[model.MD_TIME_LIST] = numpy.arange(nt) * pxd + self.parent.syncOffset.value
+
+                logging.debug("Starting new FLIM acquisition")
+                hist, frames = self.parent._acquireT3((res[1], res[0], nt), self._bin_shift,
+                                                      tacq, must_stop)
+                if must_stop.is_set():
+                    break  # Incomplete data
+                logging.debug("FLIM acquisition of %d frames complete", frames)
+                self.data.notify(model.DataArray(hist, md))
+        except Exception:
+            logging.exception("Failure in FLIM acquisition thread")
+        finally:
+            self.parent._toggle_shutters(shutters, False)
+
+        logging.debug("FLIM acquisition thread ended")
+
+
 class BasicDataFlow(model.DataFlow):
     def __init__(self, detector):
         """
@@ -926,6 +1101,253 @@ class BasicDataFlow(model.DataFlow):
         self._detector.stop_generate()
 
 
+def decode_t3_records(records, ofl_count=0):
+    """
+    Decode records acquired in T3 mode. Each record is 32 bits, with 4 bits for
+    the channel, 12 bits for the start-stop time (dtime) and 16 bits for the
+    sync counter (nsync). Special records have the channel 15: the 4 lowest
+    bits of the dtime are the markers, and if they are all 0, it's a sync
+    counter overflow.
+    records (ndarray of uint32): records as read from the FIFO
+    ofl_count (0 <= int): number of overflows before these records
+    returns:
+      channel (ndarray of uint8): channel of each record (1->4 for photons)
+      dtime (ndarray of uint16): start-stop time, in bins
+      nsync (ndarray of uint64): number of sync pulses since the beginning
+      markers (ndarray of uint8): bits of the markers (0 if not a marker)
+      ofl_count (int): number of overflows after these records
+    """
+    records = numpy.asarray(records, dtype=numpy.uint32)
+    channel = (records >> 28).astype(numpy.uint8)
+    dtime = ((records >> 16) & 0xfff).astype(numpy.uint16)
+    special = (channel == 15)
+    markers = numpy.where(special, dtime & 0xf, 0).astype(numpy.uint8)
+    overflow = special & (markers == 0)
+
+    ofls = numpy.cumsum(overflow, dtype=numpy.uint64) + ofl_count
+    nsync = (records & 0xffff).astype(numpy.uint64) + ofls * T3_WRAPAROUND
+    if ofls.size:
+        ofl_count = int(ofls[-1])
+    return channel, dtime, nsync, markers, ofl_count
+
+
+def decode_t2_records(records, ofl_count=0):
+    """
+    Decode records acquired in T2 mode. Each record is 32 bits, with 4 bits for
+    the channel and 28 bits for the time tag. Special records have the channel
+    15: the 4 lowest bits of the time tag are the markers, and if they are
+    all 0, it's a time tag overflow.
+    records (ndarray of uint32): records as read from the FIFO
+    ofl_count (0 <= int): number of overflows before these records
+    returns:
+      channel (ndarray of uint8): channel of each record (0->4 for photons)
+      time (ndarray of uint64): time tag since the beginning, in base resolution
+      markers (ndarray of uint8): bits of the markers (0 if not a marker)
+      ofl_count (int): number of overflows after these records
+    """
+    records = numpy.asarray(records, dtype=numpy.uint32)
+    channel = (records >> 28).astype(numpy.uint8)
+    ttag = records & 0x0fffffff
+    special = (channel == 15)
+    markers = numpy.where(special, ttag & 0xf, 0).astype(numpy.uint8)
+    overflow = special & (markers == 0)
+    # For the markers, the lowest bits of the time tag are not valid
+    ttag = numpy.where(special, ttag & ~numpy.uint32(0xf), ttag)
+
+    ofls = numpy.cumsum(overflow, dtype=numpy.uint64) + ofl_count
+    time_tag = ttag.astype(numpy.uint64) + ofls * T2_WRAPAROUND
+    if ofls.size:
+        ofl_count = int(ofls[-1])
+    return channel, time_tag, markers, ofl_count
+
+
+class T3Histogrammer(object):
+    """
+    Accumulates the photons of T3 records into a time histogram for each pixel
+    of a scanned area (ie, FLIM). The position of the scanner is followed
+    using the markers: a line marker indicates the start of a new line (and
+    of its first pixel), a pixel marker indicates the start of the next pixel,
+    and a frame marker indicates the start of a new frame (and the next line
+    marker is the first line).
+    The records can be passed in chunks of any size, the state of the scan is
+    kept between each chunk. It's thread-safe.
+    """
+
+    def __init__(self, shape, channels=None, line_marker=MARKER_LINE,
+                 pixel_marker=MARKER_PIXEL, frame_marker=MARKER_FRAME, bin_shift=0):
+        """
+        shape (int, int, int): Y, X, T size of the histogram cube
+        channels (None or set of 1<=int<=4): channels of the photons to
+          accumulate. If None, all of them are used.
+        line_marker (int): bits of the marker indicating a new line
+        pixel_marker (int): bits of the marker indicating a new pixel
+        frame_marker (int): bits of the marker indicating a new frame. 0 if
+          there is no such marker, in which case a new frame starts after the
+          last line of the shape.
+        bin_shift (0 <= int): number of bits to shift the dtime by, to merge
+          the consecutive time bins (ie, binning = 2 ** bin_shift).
+        """
+        self._shape = tuple(shape)
+        self._channels = channels
+        self._line_marker = line_marker
+        self._pixel_marker = pixel_marker
+        self._frame_marker = frame_marker
+        self._bin_shift = bin_shift
+        self._lock = threading.Lock()
+        self._hist = numpy.zeros(self._shape, dtype=numpy.uint32)
+        self.reset()
+
+    def reset(self):
+        """
+        Empty the histogram and start from a new scan
+        """
+        with self._lock:
+            self._hist[...] = 0
+            self._ofl_count = 0
+            self._x = 0  # current pixel in the line
+            self._y = -1  # current line in the frame (-1 = before the first line)
+            self.frames = 0  # number of frames started
+            self.photons = 0  # number of photons accumulated
+
+    @property
+    def hist(self):
+        """
+        (ndarray of uint32 of shape YXT): copy of the current histogram
+        """
+        with self._lock:
+            return self._hist.copy()
+
+    def add_records(self, records):
+        """
+        Accumulate the photons of the given records
+        records (ndarray of uint32): records in T3 mode, following the previous
+          records passed
+        """
+        with self._lock:
+            channel, dtime, nsync, markers, self._ofl_count = decode_t3_records(records, self._ofl_count)
+            if not channel.size:
+                return
+
+            ny, nx, nt = self._shape
+            is_line = (markers & self._line_marker) != 0
+            is_frame = (markers & self._frame_marker) != 0
+            # A line marker is also the beginning of the first pixel
+            is_pixel = ((markers & self._pixel_marker) != 0) & ~is_line
+
+            # Pixel index = number of pixel markers since the last line marker
+            cp = numpy.cumsum(is_pixel)
+            reset = numpy.maximum.accumulate(numpy.where(is_line, cp, -1))
+            x = numpy.where(reset < 0, self._x + cp, cp - reset)
+
+            # Line index = number of line markers since the last frame marker - 1
+            # (if both markers are on the same record, the frame is first)
+            cl = numpy.cumsum(is_line)
+            reset = numpy.maximum.accumulate(numpy.where(is_frame, cl - is_line, -1))
+            y = numpy.where(reset < 0, self._y + cl, cl - reset - 1)
+
+            if self._frame_marker:
+                self.frames += int(numpy.count_nonzero(is_frame))
+            else:
+                # No frame marker => the line index wraps around at the last line
+                y = numpy.where(y >= 0, y % ny, y)
+                self.frames += int(numpy.count_nonzero(is_line & (y == 0)))
+            self._x, self._y = int(x[-1]), int(y[-1])
+
+            # Only keep the photons within the scanned area
+            t = dtime >> self._bin_shift
+            if self._channels is None:
+                valid = (channel >= 1) & (channel <= 4)
+            else:
+                valid = numpy.isin(channel, list(self._channels))
+            valid &= (y >= 0) & (y < ny) & (x < nx) & (t < nt)
+
+            # Flat index in the cube, and count the photons for each index
+            idx = (y[valid] * nx + x[valid]) * nt + t[valid]
+            idx, counts = numpy.unique(idx, return_counts=True)
+            self._hist.reshape(-1)[idx] += counts.astype(numpy.uint32)
+            self.photons += int(counts.sum())
+
+
+class FiFoReader(object):
+    """
+    Reads continuously the FIFO of the device (in T2 or T3 mode), and passes the
+    records to a processing function. The FIFO is read in a dedicated thread,
+    while the records are processed in a separate thread, so that a slow
+    processing never causes the FIFO to overflow.
+    """
+
+    def __init__(self, device, process, count=TTREADMAX // 2):
+        """
+        device (PH300): the device, initialised in T2 or T3 mode, and with the
+          measurement started
+        process (callable ndarray of uint32 -> None): function called on each
+          set of records read (eg, T3Histogrammer.add_records)
+        count (0 < int < TTREADMAX): max number of records to read at once
+        """
+        self._device = device
+        self._process = process
+        self._count = count
+        self._queue = queue.Queue()
+        self._must_stop = threading.Event()
+        self._drain = False
+        self._reader = None
+        self._processor = None
+
+    def start(self):
+        self._must_stop.clear()
+        self._drain = False
+        self._processor = threading.Thread(target=self._run_process,
+                                           name="PicoHarp300 records processing")
+        self._processor.start()
+        self._reader = threading.Thread(target=self._run_read,
+                                        name="PicoHarp300 FIFO reading")
+        self._reader.start()
+
+    def stop(self, drain=False):
+        """
+        Stop reading the FIFO, and wait until all the records read are processed
+        drain (bool): if True, the FIFO is read until it's empty, typically
+          because the measurement is over.
+        """
+        self._drain = drain
+        self._must_stop.set()
+        if self._reader:
+            self._reader.join()
+            self._reader = None
+        if self._processor:
+            self._queue.put(None)
+            self._processor.join()
+            self._processor = None
+
+    def _run_read(self):
+        try:
+            while not (self._must_stop.is_set() and not self._drain):
+                records = self._device.ReadFiFo(self._count)
+                if records.size == self._count:
+                    # The FIFO might have been filled up
+                    if self._device.GetFlags() & FLAG_FIFOFULL:
+                        logging.error("FIFO overrun, some records have been lost")
+                elif records.size == 0:
+                    if self._must_stop.is_set():
+                        return  # All the records have been read
+                    # FIFO empty, it's fine to wait a little
+                    self._must_stop.wait(FIFO_POLL_PERIOD)
+                    continue
+                self._queue.put(records)
+        except Exception:
+            logging.exception("Failure while reading the FIFO")
+
+    def _run_process(self):
+        while True:
+            records = self._queue.get()
+            if records is None:
+                return
+            try:
+                self._process(records)
+            except Exception:
+                logging.exception("Failure while processing the records")
+
+
 # Only for testing/simulation purpose
 # Very rough version that is just enough so that if the wrapper behaves correctly,
 # it returns the expected values.
@@ -956,6 +1378,10 @@ def _val(obj):
         return obj
 
 
+FAKE_T3_SCAN = (16, 16)  # Y, X size of the simulated scan in T3 mode
+FAKE_T3_RATE = 1e6  # records/s generated in T3 mode
+
+
 class FakePHDLL(object):
     """
     Fake PHDLL. It basically simulates one connected device, which returns
@@ -975,6 +1401,40 @@ class FakePHDLL(object):
         self._acq_end = None
         self._last_acq_dur = None  # s
 
+        # In T3 mode, the records of one frame, which are sent repeatedly
+        self.t3_counts, self._t3_frame = self._generate_t3_frame(FAKE_T3_SCAN)
+        self._fifo_sent = 0  # number of records sent since the start of the acquisition
+
+    @staticmethod
+    def _generate_t3_frame(shape):
+        """
+        Generates the T3 records of one frame of a simulated scan, with
+        fluorescence decaying exponentially.
+        shape (int, int): Y, X number of pixels of the frame
+        returns:
+          counts (ndarray of int of shape YX): number of photons on each pixel
+          records (ndarray of uint32): the records of the frame
+        """
+        ny, nx = shape
+        counts = 1 + (numpy.arange(ny)[:, None] + numpy.arange(nx)) % 4
+        sync_per_px = T3_WRAPAROUND // (nx * ny)  # exactly one overflow per frame
+        records = []
+        nsync = 0
+        for y in range(ny):
+            for x in range(nx):
+                if x == 0:
+                    markers = MARKER_LINE | (MARKER_FRAME if y == 0 else 0)
+                else:
+                    markers = MARKER_PIXEL
+                records.append((15 << 28) | (markers << 16) | nsync)
+                for i in range(counts[y, x]):
+                    dtime = min(int(random.expovariate(1 / 200)), 0xfff)
+                    channel = 1 + i % 2
+                    records.append((channel << 28) | (dtime << 16) | (nsync + i))
+                nsync += sync_per_px
+        records.append(15 << 28)  # overflow
+        return counts, numpy.array(records, dtype=numpy.uint32)
+
     def PH_OpenDevice(self, i, sn_str):
         if i == self._idx:
             sn_str.value = self._sn
@@ -1043,6 +1503,7 @@ class FakePHDLL(object):
         if self._acq_start is not None:
             raise PHError(-16, PHDLL.err_code[-16])
         self._acq_start = time.time()
+        self._fifo_sent = 0
         self._acq_end = self._acq_start + _val(tacq) * 1e-3
 
     def PH_StopMeas(self, i):
@@ -1082,3 +1543,24 @@ class FakePHDLL(object):
 
         # Old numpy doesn't support dtype argument for randint
         ndbuffer[...] = numpy.random.randint(0, maxval + 1, HISTCHAN).astype(numpy.uint32)
+
+    def PH_GetFlags(self, i, p_flags):
+        flags = _deref(p_flags, c_int)
+        flags.value = 0
+
+    def PH_ReadFiFo(self, i, p_buffer, count, p_nactual):
+        nactual = _deref(p_nactual, c_int)
+        if self._mode != MODE_T3 or self._acq_start is None:
+            nactual.value = 0
+            return
+
+        # Send all the records which would have been recorded so far
+        now = min(time.time(), self._acq_end)
+        n = min(int((now - self._acq_start) * FAKE_T3_RATE) - self._fifo_sent, _val(count))
+        n = max(0, n)
+        p = cast(p_buffer, POINTER(c_uint32))
+        ndbuffer = numpy.ctypeslib.as_array(p, (_val(count),))
+        idx = (self._fifo_sent + numpy.arange(n)) % len(self._t3_frame)
+        ndbuffer[:n] = self._t3_frame[idx]
+        self._fifo_sent += n
+        nactual.value = n
@@ -111,6 +111,89 @@ NI_AO_TRIG_AI_START1 = 19  # Trigger number for AI Start1 (= beginning of a comm
 ACQ_CMD_UPD = 1
 ACQ_CMD_TERM = 2
 
+# Maximum memory used to keep the scan arrays already computed, so that
+# switching back to previous scan settings doesn't require to compute them again
+SCAN_CACHE_MAX_SIZE = 64 * 2 ** 20  # B
+# Minimum time between two blocks of lines, when sending partial frames (s)
+PARTIAL_FRAME_PERIOD = 0.1
+
+
+# Conversion between raw and physical values of whole arrays. They do the same
+# computations as their equivalent in comedilib (comedi_to_phys(),
+# comedi_from_phys(), comedi_to_physical(), and comedi_from_physical()), but
+# on all the values at once.
+def array_to_phys(data, rmin, rmax, maxdata):
+    """
+    Converts raw values to physical values, using the linear approximation of
+      the range (ie, for non-calibrated devices).
+    data (numpy.ndarray of uint): the raw values
+    rmin, rmax (float): the minimum and maximum physical value of the range
+    maxdata (0<int): the maximum raw value
+    return (numpy.ndarray of float): the physical values. The values at the
+      limits (0 and maxdata) are NaN, as it's the out-of-range behaviour used.
+    """
+    x = numpy.asarray(data, dtype=numpy.double)
+    phys = x / maxdata * (rmax - rmin) + rmin
+    return numpy.where((x == 0) | (x == maxdata), numpy.nan, phys)
+
+
+def array_from_phys(data, rmin, rmax, maxdata):
+    """
+    Converts physical values to raw values, using the linear approximation of
+      the range (ie, for non-calibrated devices).
+    data (numpy.ndarray of float): the physical values
+    rmin, rmax (float): the minimum and maximum physical value of the range
+    maxdata (0<int): the maximum raw value
+    return (numpy.ndarray of float): the raw values (integers, clipped between
+      0 and maxdata)
+    """
+    s = (numpy.asarray(data, dtype=numpy.double) - rmin) / (rmax - rmin) * maxdata
+    return numpy.clip(numpy.floor(s + 0.5), 0, maxdata)
+
+
+def _apply_polynomial(coefs, origin, data):
+    """
+    coefs (list of float): the polynomial coefficients, from the order 0
+    origin (float): the expansion origin
+    data (numpy.ndarray): the values to apply the polynomial on
+    return (numpy.ndarray of float): the result of the polynomial
+    """
+    x = numpy.asarray(data, dtype=numpy.double) - origin
+    # Same order of operations as comedilib, for the exact same result
+    value = numpy.zeros(x.shape, dtype=numpy.double)
+    term = numpy.ones(x.shape, dtype=numpy.double)
+    for i, c in enumerate(coefs):
+        value += c * term
+        if i < len(coefs) - 1:
+            term *= x
+    return value
+
+
+def array_to_physical(data, coefs, origin):
+    """
+    Converts raw values to physical values, using a calibration polynomial
+    data (numpy.ndarray of uint): the raw values
+    coefs (list of float): the polynomial coefficients, from the order 0
+    origin (float): the expansion origin
+    return (numpy.ndarray of float): the physical values
+    """
+    return _apply_polynomial(coefs, origin, data)
+
+
+def array_from_physical(data, coefs, origin, maxdata):
+    """
+    Converts physical values to raw values, using a calibration polynomial
+    data (numpy.ndarray of float): the physical values
+    coefs (list of float): the polynomial coefficients, from the order 0
+    origin (float): the expansion origin
+    maxdata (0<int): the maximum raw value
+    return (numpy.ndarray of float): the raw values (integers, clipped between
+      0 and maxdata)
+    """
+    raw = _apply_polynomial(coefs, origin, data)
+    # comedilib uses nearbyint(), which rounds half to even, as rint()
+    return numpy.clip(numpy.rint(raw), 0, maxdata)
+
 
 class CancelledError(Exception):
     """
@@ -230,6 +313,9 @@ class SEMComedi(model.HwComponent):
         # subdevice, channel, range -> converter from value to value
         self._convert_to_phys = {}
         self._convert_from_phys = {}
+        # array converters: dict (4-tuple int -> callable(ndarray)):
+        # subdevice, channel, range, direction -> converter from array to array
+        self._array_converters = {}
 
         # TODO only look for 2 output channels and len(detectors) input channels
         # On the NI-6251, according to the doc:
@@ -514,14 +600,15 @@ class SEMComedi(model.HwComponent):
 
         return bufsz
 
-    def _get_converter_actual(self, subdevice, channel, range, direction):
+    def _get_polynomial(self, subdevice, channel, range, direction):
         """
-        Finds the best converter available for the given conditions
+        Finds the calibration polynomial for the given conditions
         subdevice (int): the subdevice index
         channel (int): the channel index
         range (int): the range index
         direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
-        return a callable number -> number
+        return (comedi.polynomial_t or None): the polynomial, or None if the
+          device is not calibrated
         """
         assert(direction in [comedi.TO_PHYSICAL, comedi.FROM_PHYSICAL])
 
@@ -552,6 +639,18 @@ class SEMComedi(model.HwComponent):
                 logging.warning("Failed to get converter from calibration")
                 poly = None
 
+        return poly
+
+    def _get_converter_actual(self, subdevice, channel, range, direction):
+        """
+        Finds the best converter available for the given conditions
+        subdevice (int): the subdevice index
+        channel (int): the channel index
+        range (int): the range index
+        direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
+        return a callable number -> number
+        """
+        poly = self._get_polynomial(subdevice, channel, range, direction)
         if poly is None:
             # not calibrated
             logging.debug("creating a non calibrated converter for s%dc%dr%d",
@@ -585,15 +684,62 @@ class SEMComedi(model.HwComponent):
         direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
         return a callable number -> number
         """
+        if direction == comedi.TO_PHYSICAL:
+            cache = self._convert_to_phys
+        else:
+            cache = self._convert_from_phys
+
         # get the cached converter, or create a new one
         try:
-            converter = self._convert_to_phys[subdevice, channel, range]
+            converter = cache[subdevice, channel, range]
         except KeyError:
             converter = self._get_converter_actual(subdevice, channel, range, direction)
-            self._convert_to_phys[subdevice, channel, range] = converter
+            cache[subdevice, channel, range] = converter
 
         return converter
 
+    def _get_array_converter(self, subdevice, channel, range, direction):
+        """
+        Finds the best converter available for the given conditions, which
+          converts all the values of an array at once. It gives the same
+          result as the converter returned by _get_converter(), on each value.
+        subdevice (int): the subdevice index
+        channel (int): the channel index
+        range (int): the range index
+        direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
+        return a callable ndarray -> ndarray of float
+        """
+        key = (subdevice, channel, range, direction)
+        try:
+            return self._array_converters[key]
+        except KeyError:
+            pass
+
+        # The calibration polynomial is only read once, and then applied to
+        # whole arrays.
+        poly = self._get_polynomial(subdevice, channel, range, direction)
+        if poly is None:
+            maxdata = comedi.get_maxdata(self._device, subdevice, channel)
+            range_info = comedi.get_range(self._device, subdevice,
+                                          channel, range)
+            rmin, rmax = range_info.min, range_info.max
+            if direction == comedi.TO_PHYSICAL:
+                converter = functools.partial(array_to_phys, rmin=rmin, rmax=rmax, maxdata=maxdata)
+            else:
+                converter = functools.partial(array_from_phys, rmin=rmin, rmax=rmax, maxdata=maxdata)
+        else:
+            coefs = [poly.coefficients[i] for i in range(poly.order + 1)]
+            if direction == comedi.TO_PHYSICAL:
+                converter = functools.partial(array_to_physical, coefs=coefs,
+                                              origin=poly.expansion_origin)
+            else:
+                maxdata = comedi.get_maxdata(self._device, subdevice, channel)
+                converter = functools.partial(array_from_physical, coefs=coefs,
+                                              origin=poly.expansion_origin, maxdata=maxdata)
+
+        self._array_converters[key] = converter
+        return converter
+
     def _to_phys(self, subdevice, channel, range, value):
         """
         Converts a raw value to the physical value, using the best converter
@@ -629,44 +775,10 @@ class SEMComedi(model.HwComponent):
           same as the channels and ranges. dtype should be uint (of any size)
         return (numpy.ndarray of the same shape as data, dtype=double): physical values
         """
-        # FIXME: this is very slow (2us/element), might need to go into numba,
-        # cython, C, or be avoided.
         array = numpy.empty(shape=data.shape, dtype=numpy.double)
-        converters = []
-        for i, c in enumerate(channels):
-            converters.append(self._get_converter(subdevice, c, ranges[i],
-                                                  comedi.TO_PHYSICAL))
-
-        # converter needs lsampl (uint32). So for lsampl devices, it's pretty
-        # straightforward, just a matter of convincing SWIG that a numpy.uint32
-        # is a uint32. For sampl devices, everything needs to be converted.
-
-        # Note: it should be possible to access always the values as ctypes
-        # using data.ctypes.strides and
-        # cbuf = data.ctypes.data_as(ctypes.POINTER(ctypes.c_uint32))
-        # but ctypes.addressof(cbuf) != data.ctypes.data
-        # which is a sign of copy (bad)
-        try:
-            flat_data = numpy.reshape(data, numpy.prod(data.shape))
-            cbuf = numpy.ctypeslib.as_ctypes(flat_data)
-        except TypeError:
-            # strided array
-            cbuf = None
-
-        if data.dtype.char == 'L' and cbuf is not None:
-            logging.debug("Using casting to access the raw data")
-            # can just force-cast to a ctype buffer of unsigned int (that swig accepts)
-            # TODO: maybe could be speed-up by something like vectorize()/map()?
-            flat_array = numpy.reshape(array, numpy.prod(data.shape))
-            nchans = len(channels)
-            for i in range(flat_data.size / nchans):
-                for j in range(nchans):
-                    flat_array[nchans * i + j] = converters[j](cbuf[nchans * i + j])
-        else:
-            # Needs real conversion
-            logging.debug("Using full conversion of the raw data")
-            for i, v in numpy.ndenumerate(data):
-                array[i] = converters[i[-1]](int(v))
+        for i, (c, r) in enumerate(zip(channels, ranges)):
+            converter = self._get_array_converter(subdevice, c, r, comedi.TO_PHYSICAL)
+            array[..., i] = converter(data[..., i])
 
         return array
 
@@ -681,22 +793,12 @@ class SEMComedi(model.HwComponent):
         return (numpy.ndarray of shape ..., L): raw values, the dtype
           fits the subdevice
         """
-        # FIXME: this is very slow (2us/element), might need to go into numba,
-        # cython, C, or be avoided.
         dtype = self._get_dtype(subdevice)
         # forcing the order is not necessary but just to ensure good performance
         buf = numpy.empty(shape=data.shape, dtype=dtype, order='C')
-
-        # prepare the converters
-        converters = []
-        for i, c in enumerate(channels):
-            converters.append(self._get_converter(subdevice, c, ranges[i],
-                                                  comedi.FROM_PHYSICAL))
-
-        # TODO: check if it's possible to avoid multiple type conversion in the call
-
-        for i, v in numpy.ndenumerate(data):
-            buf[i] = converters[i[-1]](v)
+        for i, (c, r) in enumerate(zip(channels, ranges)):
+            converter = self._get_array_converter(subdevice, c, r, comedi.FROM_PHYSICAL)
+            buf[..., i] = converter(data[..., i])
 
         return buf
 
@@ -925,7 +1027,7 @@ class SEMComedi(model.HwComponent):
         comedi.command(self._device, cmd)
 
     def write_read_2d_data_raw(self, wchannels, wranges, rchannels, rranges,
-                               period, margin, osr, dpr, data):
+                               period, margin, osr, dpr, data, lines_cb=None):
         """
         write data on the given analog output channels and read synchronously on
          the given analog input channels and convert back to 2d array
@@ -941,6 +1043,10 @@ class SEMComedi(model.HwComponent):
         data (3D numpy.ndarray of int): array to write (raw values)
           first dimension is along the slow axis, second is along the fast axis,
           third is along the channels
+        lines_cb (None or callable (list of 2D numpy.array, int, int)): called
+          every time some lines are completely read, with the buffers being
+          filled (same as the returned value), the index of the first line and
+          the number of lines read.
         return (list of 2D numpy.array with shape=(data.shape[0], data.shape[1]-margin)
          and dtype=device type): the data read (raw) for each channel, after
          decimation.
@@ -962,7 +1068,7 @@ class SEMComedi(model.HwComponent):
         if linesz < self._max_bufsz and not force_per_pixel:
             lines = self._max_bufsz // linesz
             return self._write_read_2d_lines(wchannels, wranges, rchannels, rranges,
-                                             period, margin, osr, lines, data)
+                                             period, margin, osr, lines, data, lines_cb)
 
         # fit a pixel
         max_dpr = (self._max_bufsz / self._reader.dtype.itemsize) // osr
@@ -975,7 +1081,7 @@ class SEMComedi(model.HwComponent):
                               "<= %d", pixelsz / 2 ** 20, dpr, max_dpr)
 
             return self._write_read_2d_pixel(wchannels, wranges, rchannels, rranges,
-                                             period, margin, osr, dpr, data)
+                                             period, margin, osr, dpr, data, lines_cb)
 
         # separate each pixel into #dpr acquisitions
         pixelsz = nrchans * osr * self._reader.dtype.itemsize
@@ -986,10 +1092,10 @@ class SEMComedi(model.HwComponent):
                           pixelsz / 2 ** 20, osr, dpr)
 
         return self._write_read_2d_subpixel(wchannels, wranges, rchannels, rranges,
-                                            period, margin, osr, dpr, data)
+                                            period, margin, osr, dpr, data, lines_cb)
 
     def _write_read_2d_lines(self, wchannels, wranges, rchannels, rranges,
-                             period, margin, osr, maxlines, data):
+                             period, margin, osr, maxlines, data, lines_cb=None):
         """
         Implementation of write_read_2d_data_raw by reading the input data n
           lines at a time.
@@ -1029,6 +1135,8 @@ class SEMComedi(model.HwComponent):
                 self._scan_raw_to_lines(rshape, margin, osr, x,
                                         rbuf[..., i], b[x:x + lines, ...], adtype)
 
+            if lines_cb:
+                lines_cb(buf, x, lines)
             x += lines
 
         return buf
@@ -1059,7 +1167,7 @@ class SEMComedi(model.HwComponent):
             umath.true_divide(acc, osr, out=oarray, casting='unsafe', subok=False)
 
     def _write_read_2d_pixel(self, wchannels, wranges, rchannels, rranges,
-                             period, margin, osr, dpr, data):
+                             period, margin, osr, dpr, data, lines_cb=None):
         """
         Implementation of write_read_2d_data_raw by reading the input data one
           pixel at a time.
@@ -1093,10 +1201,13 @@ class SEMComedi(model.HwComponent):
             for i, b in enumerate(buf):
                 self._scan_raw_to_pixel(rshape, margin, osr, dpr, x, y,
                                         rbuf[..., i], b, adtype)
+
+            if lines_cb and y == data.shape[1] - 1:
+                lines_cb(buf, x, 1)
         return buf
 
     def _write_read_2d_subpixel(self, wchannels, wranges, rchannels, rranges,
-                                period, margin, osr, dpr, data):
+                                period, margin, osr, dpr, data, lines_cb=None):
         """
         Implementation of write_read_2d_data_raw by reading the input data one
          part of a pixel at a time.
@@ -1136,6 +1247,9 @@ class SEMComedi(model.HwComponent):
                 self._scan_raw_to_pixel(rshape, margin, osr, dpr, x, y,
                                         px_rbuf[..., i], b, adtype)
 
+            if lines_cb and y == data.shape[1] - 1:
+                lines_cb(buf, x, 1)
+
         return buf
 
     @staticmethod
@@ -1684,6 +1798,8 @@ class SEMComedi(model.HwComponent):
                     nfailures = 0
 
                     for d, da in zip(detectors, rdas):
+                        if da is None:  # Already sent as partial frames
+                            continue
                         if d.inverted:
                             da = (d.shape[0] - 1) - da
                         d.data.notify(da)
@@ -1757,7 +1873,8 @@ class SEMComedi(model.HwComponent):
         """
         Run the acquisition for multiple analog detectors (and no counters)
         detectors (AnalogDetectors)
-        return (list of DataArrays): acquisition for each detector in order
+        return (list of DataArrays or None): acquisition for each detector in
+          order. None if the data was already sent as partial frames.
         """
         rchannels = tuple(d.channel for d in detectors)
         rranges = tuple(d._range for d in detectors)
@@ -1791,9 +1908,17 @@ class SEMComedi(model.HwComponent):
             mdi.update(det.getMetadata())
             mdi.update(metadata)
 
+        # Detectors which want to receive the data by blocks of lines
+        partial = [i for i, d in enumerate(detectors) if d.partialFrames.value]
+        if partial:
+            lines_cb = self._get_partial_frame_sender(detectors, partial, md,
+                                                      scan.shape[0], scan.shape[1] - margin)
+        else:
+            lines_cb = None
+
         # write and read the raw data
         rbuf = self.write_read_2d_data_raw(wchannels, wranges, rchannels,
-                            rranges, period, margin, osr, dpr, scan)
+                            rranges, period, margin, osr, dpr, scan, lines_cb)
 
         # TODO: if fast_park, immediately go to rest position, and otherwise,
         # immediately go to initial position, to already position the beam for
@@ -1811,10 +1936,47 @@ class SEMComedi(model.HwComponent):
         # Transform raw data + metadata into a 2D DataArray
         rdas = []
         for i, b in enumerate(rbuf):
-            rdas.append(model.DataArray(b, md[i]))
+            if i in partial:
+                rdas.append(None)  # Already sent
+            else:
+                rdas.append(model.DataArray(b, md[i]))
 
         return rdas
 
+    def _get_partial_frame_sender(self, detectors, partial, md, height, width):
+        """
+        Creates a function to send the lines read as partial frames. To avoid
+        too many small messages, the lines are sent at most every
+        PARTIAL_FRAME_PERIOD, and always at the end of the frame.
+        detectors (list of AnalogDetectors): all the detectors acquired
+        partial (list of int): index of the detectors which receive partial frames
+        md (list of dict): metadata of the frame, for each detector
+        height (int): number of lines in the frame
+        width (int): number of pixels per line
+        return (callable (list of 2D numpy.array, int, int)): the function to
+          pass as lines_cb to write_read_2d_data_raw()
+        """
+        sent = [0, time.time()]  # number of lines already sent, time of the last block
+
+        def send_lines(buf, x, lines):
+            end = x + lines
+            now = time.time()
+            if end < height and now - sent[1] < PARTIAL_FRAME_PERIOD:
+                return
+            start = sent[0]
+            for i in partial:
+                d = detectors[i]
+                block = buf[i][start:end]
+                if d.inverted:
+                    block = (d.shape[0] - 1) - block
+                bmd = md[i].copy()
+                bmd[model.MD_FRAME_SHAPE] = (height, width)
+                bmd[model.MD_LINE_OFFSET] = start
+                d.data.notify(model.DataArray(block, bmd))
+            sent[:] = [end, now]
+
+        return send_lines
+
     def _acquire_counting_detector(self, detectors):
         """
         Run the acquisition for one counting detector (and the other detectors
@@ -2803,6 +2965,9 @@ class Scanner(model.Emitter):
 
         self._prev_settings = [None, None, None, None] # resolution, scale, translation, margin
         self._scan_array = None # last scan array computed
+        # (shape, scale, translation, margin) -> (scan array, ranges), with
+        # the least recently used first
+        self._scan_cache = collections.OrderedDict()
 
     def terminate(self):
         if self._scanning_mng:
@@ -3130,9 +3295,9 @@ class Scanner(model.Emitter):
 
         new_settings = [resolution, scale, translation, margin]
         if self._prev_settings != new_settings:
-            # TODO: if only margin changes, just duplicate the margin columns
-            # need to recompute the scanning array
-            self._update_raw_scan_array(resolution[::-1], scale[::-1],
+            # need to recompute (or reuse) the scanning array
+            self._scan_array, self._ranges = self._get_raw_scan_array(
+                                        resolution[::-1], scale[::-1],
                                         translation[::-1], margin)
 
             self._prev_settings = new_settings
@@ -3140,6 +3305,40 @@ class Scanner(model.Emitter):
         return (self._scan_array, dwell_time, resolution[::-1],
                 margin, self._channels, self._ranges, osr, dpr)
 
+    def _get_raw_scan_array(self, shape, scale, translation, margin):
+        """
+        Get the raw array of values to send to scan the 2D area. The arrays
+        previously computed are kept (within SCAN_CACHE_MAX_SIZE), and reused
+        when the same settings are requested again. If only the margin is
+        different, the array is just updated with the new margin.
+        Same arguments as _update_raw_scan_array()
+        returns (3D ndarray, list of int): the scan array and the ranges
+        """
+        key = (tuple(shape), tuple(scale), tuple(translation), margin)
+        try:
+            entry = self._scan_cache.pop(key)
+            logging.debug("Reusing scan array for shape %s + margin %d", shape, margin)
+        except KeyError:
+            for (kshape, kscale, ktrans, kmargin), (scan, ranges) in self._scan_cache.items():
+                if (kshape, kscale, ktrans) == key[:3]:
+                    logging.debug("Reusing scan array for shape %s, with margin %d -> %d",
+                                  shape, kmargin, margin)
+                    entry = (self._change_scan_margin(scan, kmargin, margin), ranges)
+                    break
+            else:
+                self._update_raw_scan_array(shape, scale, translation, margin)
+                entry = (self._scan_array, self._ranges)
+
+        # Put it back (or add it) as most recently used, and drop the least
+        # recently used ones if too much memory is used (but keep the current one)
+        self._scan_cache[key] = entry
+        cache_size = sum(s.nbytes for s, r in self._scan_cache.values())
+        while cache_size > SCAN_CACHE_MAX_SIZE and len(self._scan_cache) > 1:
+            _, (s, r) = self._scan_cache.popitem(last=False)
+            cache_size -= s.nbytes
+
+        return entry
+
     def _update_raw_scan_array(self, shape, scale, translation, margin):
         """
         Update the raw array of values to send to scan the 2D area.
@@ -3263,12 +3462,29 @@ class Scanner(model.Emitter):
 
         # fill the margin with the first pixel (X dimension is already filled)
         if margin:
-            fp = scan[:, margin, 1]
-            # use the transpose, as the broadcast rule is to extend on the row
-            scan[:, :margin, 1].T[:] = fp
+            scan[:, :margin, 1] = scan[:, margin:margin + 1, 1]
 
         return scan
 
+    @staticmethod
+    def _change_scan_margin(scan, margin, new_margin):
+        """
+        Create a scan array with a different margin, from an existing one
+        scan (3D ndarray of shape[0] x (shape[1] + margin) x 2): scan array,
+          as generated by _generate_scan_array() (or converted to raw values)
+        margin (0<=int): number of margin pixels in the given scan array
+        new_margin (0<=int): number of margin pixels in the new scan array
+        returns (3D ndarray of shape[0] x (shape[1] + new_margin) x 2): the
+          same scan array, but with the new margin
+        """
+        pixels = scan[:, margin:]
+        full_shape = (pixels.shape[0], pixels.shape[1] + new_margin, pixels.shape[2])
+        new_scan = numpy.empty(full_shape, dtype=scan.dtype, order='C')
+        new_scan[:, new_margin:] = pixels
+        # The margin is just the first pixel of each line, repeated
+        new_scan[:, :new_margin] = pixels[:, :1]
+        return new_scan
+
 
 class AnalogDetector(model.Detector):
     """
@@ -3318,6 +3534,9 @@ class AnalogDetector(model.Detector):
         self._shape = (maxdata + 1,) # only one point
         self.data = SEMDataFlow(self, parent)
 
+        # If True, the frames are sent by blocks of lines, as they are scanned
+        self.partialFrames = model.BooleanVA(False)
+
         # Special event to request software unblocking on the scan
         self.softwareTrigger = model.Event()
 
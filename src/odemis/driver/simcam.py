@@ -21,6 +21,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 from __future__ import division
 
+import collections
 import threading
 from past.builtins import long
 from builtins import str
@@ -30,19 +31,29 @@ import numpy
 from odemis import model, util, dataio
 from odemis.model import BASE_DIRECTORY, oneway
 import os
+import random
 from scipy import ndimage
 import time
 from PIL import Image, ImageDraw, ImageFont
 
 ERROR_STATE_FILE = "simcam-hw.error"
 
+# In high-rate mode, the defocus is rounded to this precision (in px), so that
+# the blurred images can be reused.
+DEFOCUS_STEP = 0.5
+# Maximum number of blurred images kept in high-rate mode
+DEFOCUS_CACHE_SIZE = 8
+# Number of noise images precomputed in high-rate mode
+NOISE_BANK_SIZE = 4
+
 class Camera(model.DigitalCamera):
     '''
     This represent a fake digital camera, which generates as data the image
     given at initialisation.
     '''
 
-    def __init__(self, name, role, image, dependencies=None, daemon=None, blur_factor=1e4, max_res=None, **kwargs):
+    def __init__(self, name, role, image, dependencies=None, daemon=None, blur_factor=1e4, max_res=None,
+                 high_rate=False, **kwargs):
         """
         dependencies (dict string->Component): If "focus" is passed, and it's an
             actuator with a z axis, the image will be blurred based on the
@@ -50,6 +61,10 @@ class Camera(model.DigitalCamera):
         image (str or None): path to a file to use as fake image (relative to the directory of this class)
         max_res (tuple of (int, int) or None): maximum resolution to clip simulated image, if None whole image shape
             will be used. The simulated image will be a part of the original image based on the MD_POS metadata.
+        high_rate (bool): if True, the defocused images and the noise are
+            precomputed and reused, so that hundreds of frames per second can
+            be generated (with short exposure times). It uses more memory, and
+            the defocus is rounded to DEFOCUS_STEP px.
         """
         # TODO: support transpose? If not, warn that it's not accepted
         # fake image setup
@@ -94,6 +109,11 @@ class Camera(model.DigitalCamera):
             if max_res:
                 res = clip_max_res(res)
             self._shape = res  # X, Y,...
+        self._img_max = self._img.max()
+        self._high_rate = high_rate
+        self._defocus_cache = collections.OrderedDict()  # defocus (px) -> DataArray
+        self._noise_bank = []  # list of ndarrays of the same shape as the image
+
         # TODO: handle non integer dtypes
         depth = 2 ** (self._img.dtype.itemsize * 8)
         self._shape += (depth,)
@@ -263,19 +283,24 @@ class Camera(model.DigitalCamera):
         metadata[model.MD_EXP_TIME] = exp
         logging.debug("Generating new fake image of shape %s", gen_img.shape)
 
-        if self._focus:
-            # apply the defocus
-            pos = self._focus.position.value['z']
-            dist = abs(pos - self._metadata[model.MD_FAV_POS_ACTIVE]["z"]) * self._blur_factor
-            logging.debug("Focus dist = %g", dist)
+        if self._focus and not self._high_rate:
+            # apply the defocus (in high-rate mode, it's already in the source image)
+            dist = self._get_defocus()
             img = ndimage.gaussian_filter(gen_img, sigma=dist)
         else:
             img = gen_img
         # to simulate changing the exposure time exp/self._orig_exp
-        numpy.multiply(img, exp/self._orig_exp, out=img, casting="unsafe")
+        if exp != self._orig_exp:
+            numpy.multiply(img, exp / self._orig_exp, out=img, casting="unsafe")
 
         img = model.DataArray(img, metadata)
 
+        if self._generator is not timer:
+            # The generation was stopped (or restarted) during the computation,
+            # so the image might not correspond to the current settings
+            logging.debug("Dropping image generated by a stopped generator")
+            return
+
         # send the new image (if anyone is interested)
         self.data.notify(img)
 
@@ -307,17 +332,81 @@ class Camera(model.DigitalCamera):
         Args:
             new_img: a new image with the light on
         """
+        imshp = new_img.shape
+        if len(imshp) == 3 and imshp[-1] in {3, 4}:
+            self._img_res = imshp[-2::-1]
+        else:
+            self._img_res = imshp[::-1]
+        self._img_max = new_img.max()
+        # The precomputed images correspond to the previous image
+        self._defocus_cache = collections.OrderedDict()
+        self._noise_bank = []
         self._img = new_img
 
+    def _get_defocus(self):
+        """
+        return (0<=float): the amount of blur (in px) caused by the focus position
+        """
+        pos = self._focus.position.value['z']
+        dist = abs(pos - self._metadata[model.MD_FAV_POS_ACTIVE]["z"]) * self._blur_factor
+        logging.debug("Focus dist = %g", dist)
+        return dist
+
+    def _get_source_image(self):
+        """
+        return (DataArray): the whole image to crop the frame from. In high-rate
+          mode, it's already blurred according to the focus position.
+        """
+        if not (self._high_rate and self._focus):
+            return self._img
+
+        dist = round(self._get_defocus() / DEFOCUS_STEP) * DEFOCUS_STEP
+        if dist == 0:
+            return self._img
+
+        try:
+            blurred = self._defocus_cache.pop(dist)
+        except KeyError:
+            logging.debug("Computing image with defocus of %g px", dist)
+            blurred = model.DataArray(ndimage.gaussian_filter(self._img, sigma=dist),
+                                      self._img.metadata)
+            if len(self._defocus_cache) >= DEFOCUS_CACHE_SIZE:
+                self._defocus_cache.popitem(last=False)  # remove the least recently used
+        self._defocus_cache[dist] = blurred  # put it (back) at the end
+        return blurred
+
+    def _get_noise(self, shape):
+        """
+        shape (tuple of int): shape of the noise to add
+        return (ndarray of the same dtype as the image): random noise
+        """
+        mx = self._img_max
+        nmax = max(mx // 100, 10)
+        if not self._high_rate:
+            return numpy.random.randint(0, nmax, shape, dtype=self._img.dtype)
+
+        # Pick a random area of one of the precomputed noise images
+        if not self._noise_bank:
+            logging.debug("Precomputing %d noise images", NOISE_BANK_SIZE)
+            self._noise_bank = [numpy.random.randint(0, nmax, self._img.shape, dtype=self._img.dtype)
+                                for i in range(NOISE_BANK_SIZE)]
+        noise = random.choice(self._noise_bank)
+        t = random.randint(0, noise.shape[0] - shape[0])
+        l = random.randint(0, noise.shape[1] - shape[1])
+        return noise[t:t + shape[0], l:l + shape[1]]
+
     def _get_center(self):
         """
-        Get the center in pixels to crop the image from
+        Get the center in pixels (of the original image, not binned) to crop
+        the image from
         """
-        res = self.resolution.value
+        binning = self.binning.value
+        # Size of the area covered by the ROI, in (not binned) pixels
+        res = [r * b for r, b in zip(self.resolution.value, binning)]
         # MD_POS would be the starting point to crop from otherwise (0, 0)
         pos = self._metadata.get(model.MD_POS, (0, 0))
         pixel_size = self._metadata.get(model.MD_PIXEL_SIZE, self.pixelSize.value)
-        pxs = [p / b for p, b in zip(pixel_size, self.binning.value)]
+        pxs = [p / b for p, b in zip(pixel_size, binning)]
         pos_pxs = abs(pos[0] / pxs[0]), abs(pos[1] / pxs[1])
         # Get largest center point to clip calculated center to it (to always fit within the image.)
         largest_center = self._img_res[0] - (res[0] / 2), self._img_res[1] - (res[1]/2)
@@ -336,25 +425,37 @@ class Camera(model.DigitalCamera):
         center = self._get_center()
         lt = (center[0] + pxs_pos[0] - (res[0] / 2) * binning[0],
               center[1] + pxs_pos[1] - (res[1] / 2) * binning[1])
-        assert(lt[0] >= 0 and lt[1] >= 0)
-        # compute each row and column that will be included
+        # Pick every "binning" pixel of the ROI, as a view on the image
         # TODO: Could use something more hardwarish like that:
         # data0 = data0.reshape(shape[0]//b0, b0, shape[1]//b1, b1).mean(3).mean(1)
         # (or use sum, to simulate binning)
-        # Alternatively, it could use just [lt:lt+res:binning]
-        coord = ([int(round(lt[0] + i * binning[0])) for i in range(res[0])],
-                 [int(round(lt[1] + i * binning[1])) for i in range(res[1])])
-        sim_img = self._img[numpy.ix_(coord[1], coord[0])]  # copy
-
-        # Add some noise
-        mx = self._img.max()
-        sim_img += numpy.random.randint(0, max(mx // 100, 10), sim_img.shape, dtype=sim_img.dtype)
-        # Clip, but faster than clip() on big array.
-        # There can still be some overflow, but let's just consider this "strong noise"
-        sim_img[sim_img > mx] = mx
+        src_img = self._get_source_image()
+        l, t = self._clip_roi_start(lt, res, binning, src_img.shape[1::-1])
+        roi = src_img[t:t + (res[1] - 1) * binning[1] + 1:binning[1],
+                      l:l + (res[0] - 1) * binning[0] + 1:binning[0]]
+
+        # Add some noise (and copy the data at the same time)
+        sim_img = numpy.add(roi, self._get_noise(roi.shape))
+        # Clip. There can still be some overflow, but let's just consider this
+        # "strong noise"
+        numpy.minimum(sim_img, self._img_max, out=sim_img)
 
         return sim_img
 
+    @staticmethod
+    def _clip_roi_start(lt, res, binning, size):
+        """
+        Compute the first pixel of the ROI, ensuring the whole ROI fits in the image
+        lt (float, float): left-top position of the ROI (px)
+        res (int, int): resolution of the ROI
+        binning (int, int): distance between two pixels of the ROI (px)
+        size (int, int): size (X, Y) of the image
+        return (int, int): the left-top position of the ROI (px), between 0 and
+          size - extent of the ROI
+        """
+        return tuple(max(0, min(int(round(p)), s - ((r - 1) * b + 1)))
+                     for p, r, b, s in zip(lt, res, binning, size))
+
     def _state_error_run(self):
         '''
         Creates or fixes an hardware error in the simcam if an file is present.
@@ -23,6 +23,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 from builtins import str
+import collections
 import queue
 from past.builtins import long
 import logging
@@ -38,6 +39,14 @@ import threading
 import time
 import weakref
 
+# In high-rate mode, the defocus is rounded to this precision (in px), so that
+# the blurred images can be reused.
+DEFOCUS_STEP = 0.5
+# Maximum number of (blurred and depth-reduced) images kept in high-rate mode
+FRAME_CACHE_SIZE = 8
+# Minimum time between two blocks of lines, when sending partial frames (s)
+PARTIAL_FRAME_PERIOD = 0.1
+
 
 class SimSEM(model.HwComponent):
     '''
@@ -48,7 +57,7 @@ class SimSEM(model.HwComponent):
     '''
 
     def __init__(self, name, role, children, image=None, drift_period=None,
-                 daemon=None, **kwargs):
+                 high_rate=False, daemon=None, **kwargs):
         '''
         children (dict string->kwargs): parameters setting for the children.
             Known children are "scanner", "detector0", and the optional "focus"
@@ -56,6 +65,11 @@ class SimSEM(model.HwComponent):
         image (str or None): path to a file to use as fake image (relative to
          the directory of this class)
         drift_period (None or 0<float): time period for drift updating in seconds
+        high_rate (bool): if True, the defocused and depth-reduced images are
+         precomputed and reused, so that hundreds of frames per second can be
+         generated (with short dwell times). It uses more memory, the defocus
+         is rounded to DEFOCUS_STEP px, and the depth reduction is based on
+         the whole image instead of the scanned area.
         Raise an exception if the device cannot be opened
         '''
         # fake image setup
@@ -69,6 +83,7 @@ class SimSEM(model.HwComponent):
         self.fake_img = img.ensure2DImage(converter.read_data(image)[0])
 
         self._drift_period = drift_period
+        self._high_rate = high_rate
 
         # we will fill the set of children with Components later in ._children
         model.HwComponent.__init__(self, name, role, daemon=daemon, **kwargs)
@@ -341,6 +356,7 @@ class Detector(model.Detector):
         self._acquisition_must_stop = threading.Event()
 
         self.fake_img = self.parent.fake_img
+        self._frame_cache = collections.OrderedDict()  # (bpp, defocus) -> ndarray
         # The shape is just one point, the depth
         idt = numpy.iinfo(self.fake_img.dtype)
         data_depth = idt.max - idt.min + 1
@@ -353,6 +369,9 @@ class Detector(model.Detector):
             bpp = 16
         self.bpp = model.IntEnumerated(bpp, {8, 16})
 
+        # If True, the frames are sent by blocks of lines, as they are scanned
+        self.partialFrames = model.BooleanVA(False)
+
         # Simulate the Hw brightness/contrast, but don't actually do anything
         self.contrast = model.FloatContinuous(0.5, [0, 1], unit="")
         self.brightness = model.FloatContinuous(0.5, [0, 1], unit="")
@@ -472,29 +491,30 @@ class Detector(model.Detector):
                 ltrb[1] -= ltrb[3] - (shape[0] - 1)
             assert(ltrb[0] >= 0 and ltrb[1] >= 0)
 
-            # compute each row and column that will be included
-            coord = ([int(round(ltrb[0] + i * scale[0])) for i in range(res[0])],
-                     [int(round(ltrb[1] + i * scale[1])) for i in range(res[1])])
-            sim_img = self.fake_img[numpy.ix_(coord[1], coord[0])] # copy
-
-            # reduce image depth if requested
             bpp = self.bpp.value
-            if bpp < 16:
-                mind, maxd = sim_img.min(), sim_img.max()
-                maxf = 2 ** bpp - 1
-                b = maxf / max(1, (maxd - mind))
-                # Multiply by a float and drop to the original dtype
-                numpy.multiply(sim_img - mind, b, out=sim_img, casting="unsafe")
-                if bpp <= 8:
-                    sim_img = sim_img.astype(numpy.uint8)
-
-            metadata[model.MD_BPP] = bpp
-
             if self.parent._focus:
-                # apply the defocus
                 pos = self.parent._focus.position.value['z']
                 dist = abs(pos - self.parent._focus._good_focus) * 1e4
-                sim_img = ndimage.gaussian_filter(sim_img, sigma=dist)
+            else:
+                dist = 0
+
+            if self.parent._high_rate:
+                # Depth reduction and defocus are already applied on the whole image
+                src_img = self._get_source_image(bpp, dist)
+            else:
+                src_img = self.fake_img
+            sim_img = self._crop(src_img, ltrb[:2], res, scale)  # copy
+
+            if not self.parent._high_rate:
+                # reduce image depth if requested
+                if bpp < 16:
+                    sim_img = self._reduce_depth(sim_img, bpp)
+
+                if dist:
+                    # apply the defocus
+                    sim_img = ndimage.gaussian_filter(sim_img, sigma=dist)
+
+            metadata[model.MD_BPP] = bpp
 
             # update fake output metadata
             metadata[model.MD_POS] = updated_phy_pos
@@ -506,6 +526,93 @@ class Detector(model.Detector):
             metadata[model.MD_EBEAM_VOLTAGE] = scanner.accelVoltage.value
             return model.DataArray(sim_img, metadata)
 
+    @staticmethod
+    def _crop(im, lt, res, scale):
+        """
+        Pick the pixels scanned
+        im (ndarray of shape YX): the whole image
+        lt (float, float): position of the first pixel (px)
+        res (int, int): number of pixels scanned
+        scale (float, float): distance between two pixels (px)
+        return (ndarray of shape res[::-1]): a copy of the pixels
+        """
+        if all(s == int(s) for s in scale):
+            # Simple (and fast) case: every n pixel. Just ensure it fits in the image
+            step = [int(s) for s in scale]
+            l, t = [min(int(round(p)), sz - ((r - 1) * s + 1))
+                    for p, r, s, sz in zip(lt, res, step, im.shape[::-1])]
+            return im[t:t + (res[1] - 1) * step[1] + 1:step[1],
+                      l:l + (res[0] - 1) * step[0] + 1:step[0]].copy()
+
+        # compute each row and column that will be included
+        coord = ([int(round(lt[0] + i * scale[0])) for i in range(res[0])],
+                 [int(round(lt[1] + i * scale[1])) for i in range(res[1])])
+        return im[numpy.ix_(coord[1], coord[0])]  # copy
+
+    @staticmethod
+    def _reduce_depth(im, bpp):
+        """
+        Stretch the values of the image over the given depth
+        im (ndarray): the image
+        bpp (int): number of bits per pixel
+        return (ndarray): the image with values between 0 and 2**bpp - 1
+        """
+        mind, maxd = im.min(), im.max()
+        maxf = 2 ** bpp - 1
+        b = maxf / max(1, (maxd - mind))
+        # Multiply by a float and drop to the original dtype
+        red = im - mind
+        numpy.multiply(red, b, out=red, casting="unsafe")
+        if bpp <= 8:
+            red = red.astype(numpy.uint8)
+        return red
+
+    def _get_source_image(self, bpp, defocus):
+        """
+        Used in high-rate mode, to get the whole image, with the depth reduced and
+        the defocus applied. The images are cached, as they are slow to compute.
+        bpp (int): number of bits per pixel
+        defocus (0<=float): amount of blur (px)
+        return (ndarray): the whole image
+        """
+        key = (bpp, round(defocus / DEFOCUS_STEP) * DEFOCUS_STEP)
+        try:
+            src_img = self._frame_cache.pop(key)
+        except KeyError:
+            logging.debug("Computing image with %d bpp and defocus of %g px", key[0], key[1])
+            src_img = self.fake_img
+            if bpp < 16:
+                src_img = self._reduce_depth(src_img, bpp)
+            if key[1]:
+                src_img = ndimage.gaussian_filter(src_img, sigma=key[1])
+            if len(self._frame_cache) >= FRAME_CACHE_SIZE:
+                self._frame_cache.popitem(last=False)  # remove the least recently used
+        self._frame_cache[key] = src_img  # put it (back) at the end
+        return src_img
+
+    def _acquire_partial_frame(self, callback, dwelltime, resolution):
+        """
+        Simulates the acquisition of one frame, sent by blocks of lines.
+        The blocks are sent at most every PARTIAL_FRAME_PERIOD.
+        callback (callable): called with each block of lines (DataArray)
+        dwelltime (float): time spent per pixel (s)
+        resolution (int, int): number of pixels in the frame (X, Y)
+        """
+        self.data._waitSync()
+        sim_img = self._simulate_image()
+        md = sim_img.metadata
+        md[model.MD_FRAME_SHAPE] = sim_img.shape
+
+        line_dur = resolution[0] * dwelltime
+        nlines = max(1, int(math.ceil(PARTIAL_FRAME_PERIOD / line_dur)))
+        for offset in range(0, sim_img.shape[0], nlines):
+            block = sim_img[offset:offset + nlines]
+            if self._acquisition_must_stop.wait(line_dur * block.shape[0]):
+                return
+            bmd = md.copy()
+            bmd[model.MD_LINE_OFFSET] = offset
+            callback(model.DataArray(block, bmd))
+
     def _acquire_thread(self, callback):
         """
         Thread that simulates the SEM acquisition. It calculates and updates the
@@ -517,6 +624,10 @@ class Detector(model.Detector):
             while not self._acquisition_must_stop.is_set():
                 dwelltime = self.parent._scanner.dwellTime.value
                 resolution = self.parent._scanner.resolution.value
+                if self.partialFrames.value:
+                    self._acquire_partial_frame(callback, dwelltime, resolution)
+                    continue
+
                 duration = numpy.prod(resolution) * dwelltime
                 if self._acquisition_must_stop.wait(duration):
                     break
@@ -22,6 +22,7 @@ from __future__ import division, print_function
 
 import copy
 import logging
+import numpy
 from odemis import model
 from odemis.driver import picoquant, simulated
 import os
@@ -38,6 +39,7 @@ TEST_NOHW = (os.environ.get("TEST_NOHW", 0) != 0)  # Default to Hw testing
 # arguments used for the creation of basic components
 CONFIG_DET0 = {"name": "APD0", "role": "cl-detector"}
 CONFIG_DET1 = {"name": "APD1", "role": "cl-detector2"}
+CONFIG_FLIM = {"name": "FLIM", "role": "flim-detector", "time_bins": 256}
 
 CONFIG_PH = {"name": "HP300", "role": "time-correlator", "device": None,
              "disc_volt": [0.1, 0.1], "zero_cross": [1e-3, 1e-3],
@@ -70,6 +72,196 @@ class TestPH300Static(unittest.TestCase):
         self.assertRaises(Exception, picoquant.PH300, **wrong_config)
 
 
+class TestTTTR(unittest.TestCase):
+    """
+    Tests the decoding and histogramming of the TTTR records
+    """
+
+    def test_decode_t3(self):
+        records = numpy.array([(1 << 28) | (100 << 16) | 10,  # photon on channel 1
+                               (15 << 28),  # overflow
+                               (2 << 28) | (4095 << 16) | 5,  # photon on channel 2
+                               (15 << 28) | (0x3 << 16) | 20,  # markers 1 + 2
+                               ], dtype=numpy.uint32)
+        channel, dtime, nsync, markers, ofl = picoquant.decode_t3_records(records, ofl_count=2)
+        numpy.testing.assert_array_equal(channel, [1, 15, 2, 15])
+        self.assertEqual(dtime[0], 100)
+        self.assertEqual(dtime[2], 4095)
+        numpy.testing.assert_array_equal(nsync[[0, 2, 3]],
+                                         [2 * 65536 + 10, 3 * 65536 + 5, 3 * 65536 + 20])
+        numpy.testing.assert_array_equal(markers, [0, 0, 0, 3])
+        self.assertEqual(ofl, 3)
+
+        # Only the markers indicate an overflow, not the other bits of the dtime
+        records = numpy.array([(15 << 28) | (0x120 << 16),  # overflow
+                               (15 << 28) | (0x124 << 16) | 7,  # marker 4
+                               ], dtype=numpy.uint32)
+        channel, dtime, nsync, markers, ofl = picoquant.decode_t3_records(records)
+        numpy.testing.assert_array_equal(markers, [0, 4])
+        self.assertEqual(nsync[1], 65536 + 7)
+        self.assertEqual(ofl, 1)
+
+        # Empty records
+        channel, dtime, nsync, markers, ofl = picoquant.decode_t3_records([], ofl_count=2)
+        self.assertEqual(channel.size, 0)
+        self.assertEqual(ofl, 2)
+
+    def test_decode_t2(self):
+        records = numpy.array([(1 << 28) | 1000,  # photon on channel 1
+                               (15 << 28),  # overflow
+                               (0 << 28) | 50,  # photon on channel 0
+                               (15 << 28) | 0x1230 | 0x4,  # marker 4
+                               ], dtype=numpy.uint32)
+        channel, ttag, markers, ofl = picoquant.decode_t2_records(records)
+        numpy.testing.assert_array_equal(channel, [1, 15, 0, 15])
+        numpy.testing.assert_array_equal(ttag[[0, 2, 3]],
+                                         [1000, 210698240 + 50, 210698240 + 0x1230])
+        numpy.testing.assert_array_equal(markers, [0, 0, 0, 4])
+        self.assertEqual(ofl, 1)
+
+    def test_histogram_fake(self):
+        """
+        Accumulate the records simulated, passed in chunks of various sizes
+        """
+        counts, frame = picoquant.FakePHDLL._generate_t3_frame((16, 8))
+        records = numpy.concatenate([frame] * 3)
+        hist = picoquant.T3Histogrammer((16, 8, 4096))
+        for i in numpy.arange(0, len(records), 137):
+            hist.add_records(records[i:i + 137])
+        self.assertEqual(hist.frames, 3)
+        self.assertEqual(hist.photons, counts.sum() * 3)
+        numpy.testing.assert_array_equal(hist.hist.sum(axis=2), counts * 3)
+
+        # Only one channel, and a smaller area and binned time
+        hist = picoquant.T3Histogrammer((4, 8, 32), channels={2}, bin_shift=7)
+        hist.add_records(records)
+        h = hist.hist
+        self.assertEqual(h.shape, (4, 8, 32))
+        numpy.testing.assert_array_equal(h.sum(axis=2), (counts[:4] // 2) * 3)
+
+        hist.reset()
+        self.assertEqual(hist.hist.sum(), 0)
+
+    def test_histogram_no_frame_marker(self):
+        """
+        Without frame marker, the scan restarts after the last line
+        """
+        counts, frame = picoquant.FakePHDLL._generate_t3_frame((16, 8))
+        records = numpy.concatenate([frame] * 3)
+        hist = picoquant.T3Histogrammer((16, 8, 4096), frame_marker=0)
+        for i in numpy.arange(0, len(records), 137):
+            hist.add_records(records[i:i + 137])
+        self.assertEqual(hist.frames, 3)
+        self.assertEqual(hist.photons, counts.sum() * 3)
+        numpy.testing.assert_array_equal(hist.hist.sum(axis=2), counts * 3)
+
+    def test_histogram_speed(self):
+        counts, frame = picoquant.FakePHDLL._generate_t3_frame((64, 64))
+        records = numpy.concatenate([frame] * 100)
+        hist = picoquant.T3Histogrammer((64, 64, 4096))
+        startt = time.time()
+        for i in range(0, len(records), picoquant.TTREADMAX // 2):
+            hist.add_records(records[i:i + picoquant.TTREADMAX // 2])
+        dur = time.time() - startt
+        logging.info("Histogramming %d records took %g s (%g records/s)",
+                     len(records), dur, len(records) / dur)
+        numpy.testing.assert_array_equal(hist.hist.sum(axis=2), counts * 100)
+
+    def test_fifo_reader(self):
+        """
+        Read the FIFO of the simulator in T3 mode, while histogramming
+        """
+        sim_config = copy.deepcopy(CONFIG_PH)
+        sim_config["device"] = "fake"
+        dev = picoquant.PH300(**sim_config)
+        try:
+            dev.Initialise(picoquant.MODE_T3)
+            counts = dev._dll.t3_counts
+            hist = picoquant.T3Histogrammer(counts.shape + (4096,))
+            reader = picoquant.FiFoReader(dev, hist.add_records)
+            dev.StartMeas(1000)
+            reader.start()
+            time.sleep(0.5)
+            reader.stop()
+            dev.StopMeas()
+        finally:
+            dev.Initialise(picoquant.MODE_HIST)
+            dev.terminate()
+
+        # Every pixel is in between the number of complete frames, and one more frame
+        self.assertGreater(hist.frames, 10)
+        h = hist.hist.sum(axis=2)
+        numpy.testing.assert_array_less(counts * (hist.frames - 1) - 1, h)
+        numpy.testing.assert_array_less(h, counts * hist.frames + 1)
+
+
+class TestPH300FLIM(unittest.TestCase):
+    """
+    Tests the FLIM acquisition (in T3 mode) on the simulator
+    """
+    @classmethod
+    def setUpClass(cls):
+        sim_config = copy.deepcopy(CONFIG_PH)
+        sim_config["device"] = "fake"
+        sim_config["children"]["flim"] = CONFIG_FLIM
+        cls.dev = picoquant.PH300(**sim_config)
+
+        for child in cls.dev.children.value:
+            if child.name == CONFIG_FLIM["name"]:
+                cls.flim = child
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dev.terminate()
+
+    def test_acquire_get(self):
+        counts = self.dev._dll.t3_counts
+        self.flim.resolution.value = counts.shape[::-1]
+        self.flim.dwellTime.value = 0.5
+        nt = CONFIG_FLIM["time_bins"]
+        for i in range(2):
+            data = self.flim.data.get()
+            self.assertEqual(data.shape, counts.shape + (nt,))
+            self.assertEqual(data.metadata[model.MD_DWELL_TIME], 0.5)
+            tl = data.metadata[model.MD_TIME_LIST]
+            self.assertEqual(len(tl), nt)
+            self.assertAlmostEqual(tl[1] - tl[0], self.dev.pixelDuration.value * 4096 / nt)
+
+            # Every pixel receives the same number of frames (+/- the first
+            # and last ones, which are partial)
+            h = data.sum(axis=2)
+            frames = h.sum() / counts.sum()
+            self.assertGreater(frames, 10)
+            numpy.testing.assert_array_less(counts * (frames - 2), h)
+            numpy.testing.assert_array_less(h, counts * (frames + 2))
+
+        # The histogram mode still works after the T3 acquisition
+        self.dev.dwellTime.value = self.dev.dwellTime.range[0]
+        data = self.dev.data.get()
+        self.assertEqual(data.shape, self.dev.shape[-2::-1])
+
+    def test_acquire_sub(self):
+        self.flim.resolution.value = (8, 4)
+        self.flim.dwellTime.value = 0.1
+        self._cnt = 0
+        self._lastdata = None
+        self.flim.data.subscribe(self._on_det)
+        time.sleep(1)
+        self.flim.data.unsubscribe(self._on_det)
+        self.assertGreater(self._cnt, 3)
+        self.assertEqual(self._lastdata.shape, (4, 8, CONFIG_FLIM["time_bins"]))
+
+    def _on_det(self, df, data):
+        self._cnt += 1
+        self._lastdata = data
+
+    def test_wrong_time_bins(self):
+        sim_config = copy.deepcopy(CONFIG_PH)
+        sim_config["device"] = "fake"
+        sim_config["children"]["flim"] = dict(CONFIG_FLIM, time_bins=100)
+        self.assertRaises(ValueError, picoquant.PH300, **sim_config)
+
+
 class TestPH300(unittest.TestCase):
     """
     Tests which can share one PH300 device
@@ -159,6 +159,45 @@ class TestSEMStatic(unittest.TestCase):
             comp = diffx >= 0 # must be decreasing
         self.assertTrue(comp.all())
 
+    def test_change_scan_margin(self):
+        """
+        Test the _change_scan_margin static method of the Scanner
+        """
+        limits = numpy.array([[30320, 35215], [40943, 24592]], dtype="uint16")
+        shape = (64, 128)
+        for margin in (0, 1, 5):
+            scan = semcomedi.Scanner._generate_scan_array(shape, limits, margin)
+            for new_margin in (0, 2, 5, 13):
+                exp_scan = semcomedi.Scanner._generate_scan_array(shape, limits, new_margin)
+                new_scan = semcomedi.Scanner._change_scan_margin(scan, margin, new_margin)
+                self.assertEqual(new_scan.dtype, exp_scan.dtype)
+                numpy.testing.assert_array_equal(new_scan, exp_scan)
+
+    def test_array_conversion(self):
+        """
+        Test the vectorized conversion functions
+        """
+        raw = numpy.arange(0, 2 ** 16, dtype=numpy.uint16)
+        # Linear: 0 and maxdata are out of range
+        phys = semcomedi.array_to_phys(raw, -10, 10, 2 ** 16 - 1)
+        self.assertTrue(numpy.isnan(phys[0]) and numpy.isnan(phys[-1]))
+        numpy.testing.assert_allclose(phys[1:-1], -10 + raw[1:-1] * (20 / (2 ** 16 - 1)))
+        raw_back = semcomedi.array_from_phys(phys[1:-1], -10, 10, 2 ** 16 - 1)
+        numpy.testing.assert_array_equal(raw_back, raw[1:-1])
+        # Out of range values are clipped
+        numpy.testing.assert_array_equal(semcomedi.array_from_phys(numpy.array([-20, 20]), -10, 10, 4095),
+                                         [0, 4095])
+
+        # Polynomial
+        coefs, origin = [-10.01, 3.05e-4, 1.2e-12], 1000
+        phys = semcomedi.array_to_physical(raw, coefs, origin)
+        exp_phys = numpy.polynomial.polynomial.polyval(raw.astype(numpy.double) - origin, coefs)
+        numpy.testing.assert_allclose(phys, exp_phys)
+        inv_coefs, inv_origin = [32768.5, 3276.8], 0  # 10 V = 65536
+        raw_back = semcomedi.array_from_physical(numpy.array([-10.1, -0.5, 0, 1, 9.99, 20]),
+                                                 inv_coefs, inv_origin, 2 ** 16 - 1)
+        numpy.testing.assert_array_equal(raw_back, [0, 31130, 32768, 36045, 65504, 65535])
+
 #@unittest.skip("simple")
 class TestSEM(unittest.TestCase):
     """
@@ -199,6 +238,69 @@ class TestSEM(unittest.TestCase):
         size = self.scanner.resolution.value
         return size[0] * size[1] * dwell + size[1] * settle
 
+    def test_array_converters(self):
+        """
+        Check the array conversion gives the same results as the per-value one
+        """
+        sem = self.sem
+        csimple = semcomedi.comedi
+        for subd, channels, direction in ((sem._ai_subdevice, [CONFIG_SED["channel"]], csimple.TO_PHYSICAL),
+                                          (sem._ao_subdevice, CONFIG_SCANNER["channels"], csimple.FROM_PHYSICAL),
+                                          ):
+            ranges = [0] * len(channels)
+            maxdata = csimple.get_maxdata(sem._device, subd, channels[0])
+            if direction == csimple.TO_PHYSICAL:
+                data = numpy.linspace(0, maxdata, 10000).astype(sem._get_dtype(subd))
+                data = numpy.column_stack([data] * len(channels))
+                startt = time.time()
+                res = sem._array_to_phys(subd, channels, ranges, data)
+                dur_array = time.time() - startt
+                startt = time.time()
+                exp = numpy.empty(data.shape)
+                for i, v in numpy.ndenumerate(data):
+                    exp[i] = sem._to_phys(subd, channels[i[-1]], ranges[i[-1]], int(v))
+                dur_single = time.time() - startt
+            else:
+                rinfo = csimple.get_range(sem._device, subd, channels[0], 0)
+                data = numpy.linspace(rinfo.min, rinfo.max, 10000)
+                data = numpy.column_stack([data] * len(channels))
+                startt = time.time()
+                res = sem._array_from_phys(subd, channels, ranges, data)
+                dur_array = time.time() - startt
+                startt = time.time()
+                exp = numpy.empty(data.shape, dtype=res.dtype)
+                for i, v in numpy.ndenumerate(data):
+                    exp[i] = sem._from_phys(subd, channels[i[-1]], ranges[i[-1]], v)
+                dur_single = time.time() - startt
+
+            numpy.testing.assert_array_equal(res, exp)
+            logging.info("Converting %d values took %g s per array, and %g s per value",
+                         data.size, dur_array, dur_single)
+            self.assertLess(dur_array, dur_single)
+
+    def test_scan_cache(self):
+        """
+        Check the scan arrays are reused when going back to previous settings
+        """
+        res1, res2 = (512, 256), (64, 32)
+        self.scanner.resolution.value = res1
+        scan1 = self.scanner.get_scan_data(1)[0]
+        self.scanner.resolution.value = res2
+        scan2 = self.scanner.get_scan_data(1)[0]
+        self.assertNotEqual(scan1.shape, scan2.shape)
+
+        # Going back to the first settings => same array
+        self.scanner.resolution.value = res1
+        scan = self.scanner.get_scan_data(1)[0]
+        self.assertIs(scan, scan1)
+
+        # Only the margin changes => same pixels
+        self.scanner.dwellTime.value = self.scanner.dwellTime.range[0] * 10
+        scan, _, shape, margin = self.scanner.get_scan_data(1)[:4]
+        self.assertEqual(scan.shape[:2], (shape[0], shape[1] + margin))
+        numpy.testing.assert_array_equal(scan[:, margin:], scan1[:, -shape[1]:])
+        self.scanner.dwellTime.value = self.scanner.dwellTime.range[0]
+
     def test_ttl(self):
         # Just check the VA are created and support changing the values
         for v in (True, False, None):
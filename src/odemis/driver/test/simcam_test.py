@@ -19,9 +19,11 @@ You should have received a copy of the GNU General Public License along with Ode
 from __future__ import division
 
 import logging
+import numpy
 from odemis import model
 from odemis.driver import simcam, simulated
 from odemis.util.test import assert_array_not_equal, assert_tuple_almost_equal
+import queue
 import time
 import unittest
 from unittest.case import skip
@@ -327,6 +329,138 @@ class TestSimCam(unittest.TestCase):
 
 
 
+class TestSimCamHighRate(unittest.TestCase):
+    """
+    Tests of the camera with the precomputed frames
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.focus = simulated.Stage(**KWARGS_FOCUS)
+        cls.camera = CLASS(dependencies={"focus": cls.focus}, high_rate=True, **KWARGS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.camera.terminate()
+
+    def setUp(self):
+        size = self.camera.shape[:-1]
+        self.is_rgb = (len(size) >= 3 and size[-1] in {3, 4})
+        self.camera.binning.value = (1, 1)
+        self.camera.resolution.value = self.camera.resolution.range[1]
+        self.camera.translation.value = (0, 0)
+
+    def _get_exp_shape(self, res):
+        """
+        return (tuple of int): shape of the image for the given resolution
+        """
+        if self.is_rgb:
+            return res[::-1] + self.camera.shape[-2:-1]  # RGB dim at the end
+        else:
+            return res[::-1]
+
+    def test_frame_rate(self):
+        """
+        Check many frames can be generated per second, of the expected shape
+        """
+        self.camera.exposureTime.value = self.camera.exposureTime.range[0]
+        self.camera.binning.value = (2, 2)
+        res = self.camera.resolution.value
+        self.frames = []
+        self.camera.data.subscribe(self.receive_image)
+        time.sleep(2)
+        self.camera.data.unsubscribe(self.receive_image)
+        fps = len(self.frames) / 2
+        logging.info("Generated %g fps", fps)
+        self.assertGreater(fps, 20)
+        for im in self.frames:
+            self.assertEqual(im.shape, self._get_exp_shape(res))
+
+        # The noise is different on each frame
+        assert_array_not_equal(self.frames[0], self.frames[1])
+
+    def receive_image(self, dataflow, image):
+        self.frames.append(image)
+
+    def _get_image(self, timeout=10):
+        """
+        Acquires one image, but fails instead of blocking if the camera doesn't
+        generate any image
+        return (DataArray)
+        """
+        q = queue.Queue()
+
+        def listener(df, im):
+            q.put(im)
+
+        self.camera.data.subscribe(listener)
+        try:
+            return q.get(timeout=timeout)
+        except queue.Empty:
+            self.fail("No image received after %g s" % (timeout,))
+        finally:
+            self.camera.data.unsubscribe(listener)
+
+    def test_roi(self):
+        """
+        Check the frames correspond to the ROI and binning requested
+        """
+        self.camera.exposureTime.value = 0.01
+        max_res = self.camera.resolution.range[1]
+        self.camera.binning.value = (4, 4)
+        self.camera.resolution.value = (max_res[0] // 16, max_res[1] // 16)
+        self.camera.translation.value = (-5, 3)
+        res = self.camera.resolution.value
+        im = self._get_image()
+        self.assertEqual(im.shape, self._get_exp_shape(res))
+
+    def test_focus(self):
+        """
+        Check the defocused images are reused
+        """
+        self.camera.exposureTime.value = 0.01
+        pos = self.focus.position.value
+        self.focus.moveRel({"z": 1e-3}).result()  # 1 mm
+        self._get_image()
+        self.assertEqual(len(self.camera._defocus_cache), 1)
+        self._get_image()
+        self.assertEqual(len(self.camera._defocus_cache), 1)
+
+        # restore original position => no blur
+        self.focus.moveAbs(pos).result()
+        self._get_image()
+        self.assertEqual(len(self.camera._defocus_cache), 1)
+
+    def test_set_image(self):
+        """
+        Check a new image is used entirely, even if brighter and larger
+        """
+        # Use the original exposure time, so that the intensity is not scaled
+        self.camera.exposureTime.value = self.camera._orig_exp
+        self._get_image()  # Fill the precomputed noise
+        orig_img = self.camera._img
+        orig_max = int(orig_img.max())
+        self.assertLess(orig_max, 250)
+
+        shape = list(orig_img.shape)
+        shape[0] += 50
+        shape[1] += 100
+        new_img = model.DataArray(numpy.full(shape, 250, dtype=orig_img.dtype),
+                                  orig_img.metadata.copy())
+        self.camera.set_image(new_img)
+        try:
+            res = self.camera.resolution.value
+            im = self._get_image()
+            self.assertEqual(im.shape, self._get_exp_shape(res))
+            self.assertEqual(im.max(), 250)
+            self.assertEqual(self.camera._noise_bank[0].shape, new_img.shape)
+        finally:
+            self.camera.set_image(orig_img)
+
+        im = self._get_image()
+        self.assertLessEqual(im.max(), orig_max)
+
+
 class TestSimCamWithPolarization(unittest.TestCase):
 
     @classmethod
@@ -23,6 +23,7 @@ from __future__ import division
 import Pyro4
 import copy
 import logging
+import numpy
 from odemis import model
 from odemis.driver import simsem
 from odemis.util import test
@@ -356,6 +357,36 @@ class TestSEM(unittest.TestCase):
 
         self.assertEqual(self.left, 0)
 
+    def test_partial_frames(self):
+        """
+        Check the frames can be received by blocks of lines
+        """
+        self.scanner.dwellTime.value = 10e-6  # s
+        size = self.scanner.resolution.value
+        self.sed.partialFrames.value = True
+        try:
+            # get() still returns the whole frame
+            im = self.sed.data.get()
+            self.assertEqual(im.shape, size[::-1])
+            self.assertNotIn(model.MD_LINE_OFFSET, im.metadata)
+
+            self.blocks = []
+            self.sed.data.subscribe(self.receive_block)
+            time.sleep(self.compute_expected_duration() * 1.5)
+            self.sed.data.unsubscribe(self.receive_block)
+        finally:
+            self.sed.partialFrames.value = False
+
+        self.assertGreater(len(self.blocks), 2)
+        for b in self.blocks:
+            self.assertEqual(tuple(b.metadata[model.MD_FRAME_SHAPE]), size[::-1])
+            self.assertEqual(b.shape[1], size[0])
+            self.assertLessEqual(b.metadata[model.MD_LINE_OFFSET] + b.shape[0], size[1])
+            self.assertLess(b.shape[0], size[1])
+
+    def receive_block(self, dataflow, image):
+        self.blocks.append(image)
+
     def test_acquire_with_va(self):
         """
         Change some settings before and while acquiring
@@ -456,5 +487,90 @@ class TestSEM(unittest.TestCase):
         f.result()
         self.assertEqual(self.focus.position.value, pos)
 
+
+class TestSEMHighRate(unittest.TestCase):
+    """
+    Tests of the SEM with the precomputed frames
+    """
+    @classmethod
+    def setUpClass(cls):
+        # No drift, to be able to compare frames
+        config = dict(CONFIG_SEM, drift_period=None, high_rate=True)
+        cls.sem = simsem.SimSEM(**config)
+
+        for child in cls.sem.children.value:
+            if child.name == CONFIG_SED["name"]:
+                cls.sed = child
+            elif child.name == CONFIG_SCANNER["name"]:
+                cls.scanner = child
+            elif child.name == CONFIG_FOCUS["name"]:
+                cls.focus = child
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sem.terminate()
+        time.sleep(3)
+
+    def setUp(self):
+        self.scanner.scale.value = (1, 1)
+        self.scanner.resolution.value = (512, 256)
+        self.sed.bpp.value = max(self.sed.bpp.choices)
+        self.scanner.dwellTime.value = self.scanner.dwellTime.range[0]
+
+    def test_frame_rate(self):
+        """
+        Check many frames can be generated per second, with the right depth
+        """
+        self.sed.bpp.value = 8
+        self.scanner.resolution.value = (256, 256)
+        size = self.scanner.resolution.value
+        self.frames = []
+        self.sed.data.subscribe(self.receive_image)
+        time.sleep(2)
+        self.sed.data.unsubscribe(self.receive_image)
+        fps = len(self.frames) / 2
+        logging.info("Generated %g fps", fps)
+        self.assertGreater(fps, 20)
+        for im in self.frames:
+            self.assertEqual(im.shape, size[::-1])
+            self.assertEqual(im.dtype, numpy.uint8)
+            self.assertEqual(im.metadata[model.MD_BPP], 8)
+
+    def receive_image(self, dataflow, image):
+        self.frames.append(image)
+
+    def test_scale(self):
+        """
+        Check the frames are the same as without high-rate mode, when the
+        depth is not reduced and no defocus
+        """
+        for scale in ((2, 2), (1.5, 1.5)):
+            self.scanner.scale.value = scale
+            self.scanner.resolution.value = (100, 50)
+            self.scanner.translation.value = (-10, 15)
+            size = self.scanner.resolution.value
+            im = self.sed.data.get()
+            self.assertEqual(im.shape, size[::-1])
+            # Same frame as without the precomputation
+            self.sem._high_rate = False
+            try:
+                im_ref = self.sed.data.get()
+            finally:
+                self.sem._high_rate = True
+            numpy.testing.assert_array_equal(im, im_ref)
+
+    def test_focus(self):
+        """
+        Check the defocused images are reused
+        """
+        pos = self.focus.position.value
+        self.focus.moveRel({"z": 1e-3}).result()  # 1 mm
+        self.sed.data.get()
+        ncached = len(self.sed._frame_cache)
+        self.sed.data.get()
+        self.assertEqual(len(self.sed._frame_cache), ncached)
+
+        self.focus.moveAbs(pos).result()
+
 if __name__ == "__main__":
     unittest.main()
@@ -24,9 +24,12 @@ from __future__ import division, print_function
 
 import logging
 import os
+import threading
 import time
 import unittest
 
+import Pyro5.api
+
 from odemis.driver import xt_client
 from odemis.driver.xt_client import DETECTOR2CHANNELNAME
 from odemis.model import ProgressiveFuture
@@ -684,5 +687,193 @@ class TestMicroscopeInternal(unittest.TestCase):
         self.assertEqual(autofocus_state, False)
 
 
+@Pyro5.api.expose
+class FakeMicroscope(object):
+    """
+    Minimal stand-in for the XT adapter, which only supports reading and
+    setting a few settings. It counts the number of calls received.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self._dwell_time = 1e-6
+        self._fwd = 4e-3
+        self._stage_pos = {"x": 1e-3, "y": 2e-3, "z": 3e-3}
+
+    def _count(self):
+        self.calls += 1
+
+    def get_software_version(self):
+        return "fake xtlib 1.0"
+
+    def get_hardware_version(self):
+        return "fake SEM"
+
+    def dwell_time_info(self):
+        return {"range": (1e-8, 1e-3), "unit": "s"}
+
+    def ht_voltage_info(self):
+        return {"range": (200, 30e3), "unit": "V"}
+
+    def spotsize_info(self):
+        return {"range": (1, 10), "unit": None}
+
+    def beam_shift_info(self):
+        return {"range": {"x": (-1e-4, 1e-4), "y": (-1e-4, 1e-4)}, "unit": "m"}
+
+    def rotation_info(self):
+        return {"range": (0, 6.28), "unit": "rad"}
+
+    def scanning_size_info(self):
+        return {"range": {"x": (1e-7, 1e-3), "y": (1e-7, 1e-3)}, "unit": "m"}
+
+    def stage_info(self):
+        return {"range": {"x": (-0.1, 0.1), "y": (-0.1, 0.1), "z": (-0.01, 0.1)}, "unit": "m"}
+
+    def fwd_info(self):
+        return {"range": (0, 0.1), "unit": "m"}
+
+    def get_dwell_time(self):
+        self._count()
+        return self._dwell_time
+
+    def set_dwell_time(self, dwell_time):
+        self._count()
+        self._dwell_time = dwell_time
+
+    def get_ht_voltage(self):
+        self._count()
+        return 10e3
+
+    def beam_is_blanked(self):
+        self._count()
+        return False
+
+    def get_ebeam_spotsize(self):
+        self._count()
+        return 3.0
+
+    def get_beam_shift(self):
+        self._count()
+        return (1e-6, 2e-6)
+
+    def get_rotation(self):
+        self._count()
+        return 0.1
+
+    def get_scanning_size(self):
+        self._count()
+        return (1e-4, 1e-4)
+
+    def get_stage_position(self):
+        self._count()
+        return self._stage_pos
+
+    def get_free_working_distance(self):
+        self._count()
+        return self._fwd
+
+
+@Pyro5.api.expose
+class FakeMicroscopeBulk(FakeMicroscope):
+    """
+    Stand-in for the XT adapter supporting reading multiple settings at once
+    """
+
+    def get_settings(self, names):
+        self._count()
+        calls = self.calls
+        values = {n: getattr(self, n)() for n in names}
+        self.calls = calls  # Only count it as one call
+        return values
+
+
+class TestSettingsPolling(unittest.TestCase):
+    """
+    Test the polling of the settings, using a local stand-in for the XT adapter
+    """
+
+    server_class = FakeMicroscopeBulk
+
+    def setUp(self):
+        self.fake = self.server_class()
+        self.daemon = Pyro5.api.Daemon(host="localhost", port=0)
+        uri = self.daemon.register(self.fake, objectId="Microscope")
+        self._daemon_thread = threading.Thread(target=self.daemon.requestLoop)
+        self._daemon_thread.daemon = True
+        self._daemon_thread.start()
+
+        config = dict(CONFIG_SEM, address=str(uri))
+        self.microscope = xt_client.SEM(**config)
+        for child in self.microscope.children.value:
+            if child.name == CONFIG_SCANNER["name"]:
+                self.scanner = child
+            elif child.name == CONFIG_FOCUS["name"]:
+                self.efocus = child
+            elif child.name == CONFIG_STAGE["name"]:
+                self.stage = child
+
+    def tearDown(self):
+        self.microscope.terminate()
+        self.daemon.shutdown()
+        self._daemon_thread.join(5)
+
+    def test_polling(self):
+        """
+        All the children should be updated with only one call to the server
+        """
+        self.fake.calls = 0
+        self.fake._fwd = 6e-3
+        self.microscope._pollSettings()
+        if self.microscope._has_get_settings:
+            self.assertEqual(self.fake.calls, 1)
+        else:
+            self.assertEqual(self.fake.calls, len(xt_client.SCANNER_SETTINGS) + 2)
+        self.assertEqual(self.efocus.position.value, {"z": 6e-3})
+
+        # Same thing when the children read the settings themselves
+        self.microscope._invalidate_settings()
+        self.fake.calls = 0
+        self.scanner._updateSettings()
+        self.stage._refreshPosition()
+        self.efocus._refreshPosition()
+        if self.microscope._has_get_settings:
+            self.assertEqual(self.fake.calls, 1)
+        else:
+            self.assertEqual(self.fake.calls, len(xt_client.SCANNER_SETTINGS) + 2)
+
+        # Within the TTL, no call at all
+        self.fake.calls = 0
+        self.stage._refreshPosition()
+        self.efocus._refreshPosition()
+        self.assertEqual(self.fake.calls, 0)
+        self.assertEqual(self.efocus.position.value, {"z": self.fake._fwd})
+
+        # After the TTL, the values are read again
+        time.sleep(xt_client.SETTINGS_TTL + 0.1)
+        self.fake._fwd = 5e-3
+        self.efocus._refreshPosition()
+        self.assertGreaterEqual(self.fake.calls, 1)
+        self.assertEqual(self.efocus.position.value, {"z": 5e-3})
+
+    def test_change_setting(self):
+        """
+        A setting changed should not be reverted by the cached values
+        """
+        self.scanner._updateSettings()
+        self.scanner.dwellTime.value = 2e-6
+        self.assertEqual(self.scanner.dwellTime.value, 2e-6)
+        self.scanner._updateSettings()
+        self.assertEqual(self.scanner.dwellTime.value, 2e-6)
+
+
+class TestSettingsPollingNoBulk(TestSettingsPolling):
+    """
+    Same tests, with an XT adapter which doesn't support get_settings()
+    """
+
+    server_class = FakeMicroscope
+
+
 if __name__ == '__main__':
     unittest.main()
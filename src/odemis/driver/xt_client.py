@@ -45,6 +45,16 @@ DETECTOR2CHANNELNAME = {
     "se-detector": "electron1",
 }
 
+# Period (s) at which the settings and positions are read from the server
+POLL_PERIOD = 5
+# Maximum age (s) of a value read with SEM.get_settings() to be reused when a
+# component reads again the settings, instead of asking again the server.
+SETTINGS_TTL = 1
+
+# Getters of the settings polled by the Scanner
+SCANNER_SETTINGS = ("get_dwell_time", "get_ht_voltage", "beam_is_blanked", "get_ebeam_spotsize",
+                    "get_beam_shift", "get_rotation", "get_scanning_size")
+
 class SEM(model.HwComponent):
     """
     Driver to communicate with XT software on TFS microscopes. XT is the software TFS uses to control their microscopes.
@@ -75,6 +85,19 @@ class SEM(model.HwComponent):
                           "uri is correct and XT server is"
                           " connected to the network. %s" % (address, err))
 
+        # Older versions of the XT adapter cannot read multiple settings at once
+        self._has_get_settings = "get_settings" in self.server._pyroMethods
+        if not self._has_get_settings:
+            logging.info("XT adapter doesn't support get_settings(), settings will be read one at a time")
+
+        # Latest values read by get_settings()
+        self._settings_lock = threading.Lock()
+        self._settings_cache = {}  # str (getter name) -> (float (timestamp), value)
+        self._settings_gen = 0  # incremented every time the cache is invalidated
+        # Getters which are regularly polled for the children, and so read
+        # together whenever one of them is read from the server.
+        self._polled_settings = set()
+
         # create the scanner child
         try:
             kwargs = children["scanner"]
@@ -95,6 +118,94 @@ class SEM(model.HwComponent):
             self._focus = Focus(parent=self, daemon=daemon, **ckwargs)
             self.children.value.add(self._focus)
 
+        # Refresh regularly the values of all the children, with a single read
+        self._settings_poll = util.RepeatingTimer(POLL_PERIOD, self._pollSettings, "Settings polling")
+        self._settings_poll.start()
+
+    def terminate(self):
+        """
+        Must be called at the end of the usage. Can be called multiple times,
+        but the component shouldn't be used afterwards.
+        """
+        self._settings_poll.cancel()
+        self._settings_poll.join(5)
+        self._scanner.terminate()
+        if hasattr(self, "_stage"):
+            self._stage.terminate()
+        if hasattr(self, "_focus"):
+            self._focus.terminate()
+        super(SEM, self).terminate()
+
+    def get_settings(self, names, max_age=0):
+        """
+        Read multiple settings at once. If the XT adapter supports it, all the
+        settings are read in a single call to the server. In addition to the
+        requested settings, all the settings regularly polled are also read,
+        so that they are available in the cache for the next calls.
+
+        Parameters
+        ----------
+        names: iterable of str
+            the names of the getters (eg, "get_dwell_time").
+        max_age: float
+            Maximum time (s) since the values were read from the server. If all the requested values are
+            more recent, they are returned without contacting the server.
+
+        Returns
+        -------
+        settings: dict(str->value)
+            the getter name -> the value returned by the getter.
+        """
+        names = set(names)
+        now = time.time()
+        with self._settings_lock:
+            gen = self._settings_gen
+            cached = {n: v for n, (t, v) in self._settings_cache.items()
+                      if n in names and now - t <= max_age}
+        if len(cached) == len(names):
+            return cached
+
+        to_read = sorted(names | self._polled_settings)
+        with self._proxy_access:
+            self.server._pyroClaimOwnership()
+            if self._has_get_settings:
+                values = self.server.get_settings(to_read)
+            else:
+                values = {n: getattr(self.server, n)() for n in to_read}
+
+        with self._settings_lock:
+            # Don't cache the values if a setting changed in the meantime
+            if gen == self._settings_gen:
+                for n, v in values.items():
+                    self._settings_cache[n] = (now, v)
+        return {n: values[n] for n in names}
+
+    def _pollSettings(self):
+        """
+        Called regularly to read all the settings polled, and pass them to the
+        children, so that they update their VAs.
+        """
+        logging.debug("Polling SEM settings")
+        try:
+            settings = self.get_settings(self._polled_settings)
+        except Exception:
+            logging.exception("Unexpected failure when polling settings")
+            return
+
+        self._scanner._updateSettings(settings)
+        if hasattr(self, "_stage"):
+            self._stage._refreshPosition(settings)
+        if hasattr(self, "_focus"):
+            self._focus._refreshPosition(settings)
+
+    def _invalidate_settings(self):
+        """
+        Forget all the values read by get_settings(), typically because a setting has changed.
+        """
+        with self._settings_lock:
+            self._settings_cache.clear()
+            self._settings_gen += 1
+
     def list_available_channels(self):
         """
         List all available channels and their current state as a dict.
@@ -124,6 +235,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.move_stage(position, rel)
+        self._invalidate_settings()
 
     def stage_is_moving(self):
         """Returns: (bool) True if the stage is moving and False if the stage is not moving."""
@@ -136,6 +248,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.stop_stage_movement()
+        self._invalidate_settings()
 
     def get_stage_position(self):
         """
@@ -243,6 +356,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.set_scanning_size(x)
+        self._invalidate_settings()
 
     def get_scanning_size(self):
         """
@@ -269,6 +383,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.set_ebeam_spotsize(spotsize)
+        self._invalidate_settings()
 
     def get_ebeam_spotsize(self):
         """Returns: (float) the current spotsize of the electron beam (unitless)."""
@@ -293,6 +408,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.set_dwell_time(dwell_time)
+        self._invalidate_settings()
 
     def get_dwell_time(self):
         """Returns: (float) the dwell time in seconds."""
@@ -319,6 +435,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.set_ht_voltage(voltage)
+        self._invalidate_settings()
 
     def get_ht_voltage(self):
         """Returns: (float) the HT Voltage in volt."""
@@ -337,12 +454,14 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.blank_beam()
+        self._invalidate_settings()
 
     def unblank_beam(self):
         """Unblank the electron beam."""
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.unblank_beam()
+        self._invalidate_settings()
 
     def beam_is_blanked(self):
         """Returns: (bool) True if the beam is blanked and False if the beam is not blanked."""
@@ -379,6 +498,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.home_stage()
+        self._invalidate_settings()
 
     def is_homed(self):
         """Returns: (bool) True if the stage is homed and False otherwise."""
@@ -442,6 +562,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.set_free_working_distance(free_working_distance)
+        self._invalidate_settings()
 
     def fwd_info(self):
         """Returns the unit and range of the free working distance."""
@@ -470,6 +591,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.set_fwd_follows_z(follow_z)
+        self._invalidate_settings()
 
     def set_autofocusing(self, name, state):
         """
@@ -539,6 +661,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.set_beam_shift(x_shift, y_shift)
+        self._invalidate_settings()
 
     def beam_shift_info(self):
         """Returns: (dict) the unit and xy-range of the beam shift."""
@@ -575,6 +698,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.set_rotation(rotation)
+        self._invalidate_settings()
 
     def rotation_info(self):
         """Returns: (dict) the unit and range of the rotation."""
@@ -594,6 +718,7 @@ class SEM(model.HwComponent):
         with self._proxy_access:
             self.server._pyroClaimOwnership()
             self.server.set_beam_power(state)
+        self._invalidate_settings()
 
     def get_beam_is_on(self):
         """Returns True if the beam is on and False if the beam is off."""
@@ -869,10 +994,10 @@ class Scanner(model.Emitter):
                                                   unit="m", readonly=True)
         self._updateDepthOfField()
 
-        # Refresh regularly the values, from the hardware, starting from now
+        # Refresh regularly the values, from the hardware, starting from now.
+        # The SEM takes care of the polling, together with the other children.
+        self.parent._polled_settings.update(SCANNER_SETTINGS)
         self._updateSettings()
-        self._va_poll = util.RepeatingTimer(5, self._updateSettings, "Settings polling")
-        self._va_poll.start()
 
     # TODO Commented out code because it is currently not supproted by XT. An update or another implementation may be
     # made later
@@ -987,17 +1112,29 @@ class Scanner(model.Emitter):
                 logging.warning("Failed to cancel auto brightness contrast: %s", error_msg)
                 return False
 
-    def _updateSettings(self):
+    def terminate(self):
+        if self._executor:
+            self._executor.cancel()
+            self._executor.shutdown()
+            self._executor = None
+        super(Scanner, self).terminate()
+
+    def _updateSettings(self, settings=None):
         """
         Read all the current settings from the SEM and reflects them on the VAs
+        settings (None or dict str -> value): the settings, as returned by
+          SEM.get_settings(). If None, they are read from the SEM.
         """
         logging.debug("Updating SEM settings")
         try:
-            dwell_time = self.parent.get_dwell_time()
+            if settings is None:
+                # Read all the settings at once, in a single call to the server
+                settings = self.parent.get_settings(SCANNER_SETTINGS, max_age=SETTINGS_TTL)
+            dwell_time = settings["get_dwell_time"]
             if dwell_time != self.dwellTime.value:
                 self.dwellTime._value = dwell_time
                 self.dwellTime.notify(dwell_time)
-            voltage = self.parent.get_ht_voltage()
+            voltage = settings["get_ht_voltage"]
             v_range = self.accelVoltage.range
             if not v_range[0] <= voltage <= v_range[1]:
                 logging.info("Voltage {} V is outside of range {}, clipping to nearest value.".format(voltage, v_range))
@@ -1005,23 +1142,23 @@ class Scanner(model.Emitter):
             if voltage != self.accelVoltage.value:
                 self.accelVoltage._value = voltage
                 self.accelVoltage.notify(voltage)
-            blanked = self.parent.beam_is_blanked()
+            blanked = settings["beam_is_blanked"]
             if blanked != self.blanker.value:
                 self.blanker._value = blanked
                 self.blanker.notify(blanked)
-            spot_size = self.parent.get_ebeam_spotsize()
+            spot_size = settings["get_ebeam_spotsize"]
             if spot_size != self.spotSize.value:
                 self.spotSize._value = spot_size
                 self.spotSize.notify(spot_size)
-            beam_shift = self.parent.get_beam_shift()
+            beam_shift = tuple(settings["get_beam_shift"])
             if beam_shift != self.beamShift.value:
                 self.beamShift._value = beam_shift
                 self.beamShift.notify(beam_shift)
-            rotation = self.parent.get_rotation()
+            rotation = settings["get_rotation"]
             if rotation != self.rotation.value:
                 self.rotation._value = rotation
                 self.rotation.notify(rotation)
-            fov = self.parent.get_scanning_size()[0]
+            fov = settings["get_scanning_size"][0]
             if fov != self.horizontalFoV.value:
                 self.horizontalFoV._value = fov
                 mag = self._hfw_nomag / fov
@@ -1109,9 +1246,8 @@ class Stage(model.Actuator):
                                                 readonly=True)
         self._updatePosition()
 
-        # Refresh regularly the position
-        self._pos_poll = util.RepeatingTimer(5, self._refreshPosition, "Position polling")
-        self._pos_poll.start()
+        # Refresh regularly the position (done by the SEM)
+        self.parent._polled_settings.add("get_stage_position")
 
     def _updatePosition(self, raw_pos=None):
         """
@@ -1130,15 +1266,19 @@ class Stage(model.Actuator):
                }
         self.position._set_value(self._applyInversion(pos), force_write=True)
 
-    def _refreshPosition(self):
+    def _refreshPosition(self, settings=None):
         """
         Called regularly to update the current position
+        settings (None or dict str -> value): the settings, as returned by
+          SEM.get_settings(). If None, they are read from the SEM.
         """
         # We don't use the VA setters, to avoid sending back to the hardware a
         # set request
         logging.debug("Updating SEM stage position")
         try:
-            self._updatePosition()
+            if settings is None:
+                settings = self.parent.get_settings(["get_stage_position"], max_age=SETTINGS_TTL)
+            self._updatePosition(settings["get_stage_position"])
         except Exception:
             logging.exception("Unexpected failure when updating position")
 
@@ -1252,6 +1392,13 @@ class Stage(model.Actuator):
         except Exception:
             logging.exception("Unexpected failure when updating position")
 
+    def terminate(self):
+        if self._executor:
+            self._executor.cancel()
+            self._executor.shutdown()
+            self._executor = None
+        super(Stage, self).terminate()
+
     def _createFuture(self):
         """
         Return (CancellableFuture): a future that can be used to manage a move
@@ -1308,9 +1455,8 @@ class Focus(model.Actuator):
         self.position = model.VigilantAttribute({}, unit="m", readonly=True)
         self._updatePosition()
 
-        # Refresh regularly the position
-        self._pos_poll = util.RepeatingTimer(5, self._refreshPosition, "Position polling")
-        self._pos_poll.start()
+        # Refresh regularly the position (done by the SEM)
+        self.parent._polled_settings.add("get_free_working_distance")
 
     @isasync
     def applyAutofocus(self, detector):
@@ -1369,22 +1515,29 @@ class Focus(model.Actuator):
                 logging.warning("Failed to cancel autofocus: %s", error_msg)
                 return False
 
-    def _updatePosition(self):
+    def _updatePosition(self, z=None):
         """
         update the position VA
+        z (None or float): the free working distance (as received from the SEM).
+          If None, it's read from the SEM.
         """
-        z = self.parent.get_free_working_distance()
+        if z is None:
+            z = self.parent.get_free_working_distance()
         self.position._set_value({"z": z}, force_write=True)
 
-    def _refreshPosition(self):
+    def _refreshPosition(self, settings=None):
         """
         Called regularly to update the current position
+        settings (None or dict str -> value): the settings, as returned by
+          SEM.get_settings(). If None, they are read from the SEM.
         """
         # We don't use the VA setters, to avoid sending back to the hardware a
         # set request
         logging.debug("Updating SEM stage position")
         try:
-            self._updatePosition()
+            if settings is None:
+                settings = self.parent.get_settings(["get_free_working_distance"], max_age=SETTINGS_TTL)
+            self._updatePosition(settings["get_free_working_distance"])
         except Exception:
             logging.exception("Unexpected failure when updating position")
 
@@ -1449,3 +1602,10 @@ class Focus(model.Actuator):
             self._updatePosition()
         except Exception:
             logging.exception("Unexpected failure when updating position")
+
+    def terminate(self):
+        if self._executor:
+            self._executor.cancel()
+            self._executor.shutdown()
+            self._executor = None
+        super(Focus, self).terminate()
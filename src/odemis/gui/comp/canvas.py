@@ -122,11 +122,11 @@ Graphical data is drawn using the following sequence of method calls:
 
                 * _draw_merged_images
 
-                   * for all but last image:
-                        * _draw_image()
+                    * for each image whose layer is out of date:
+                        * _draw_image() or _draw_tiles(), into the cached layer
 
-                    * for last image:
-                        * _draw_image()
+                    * for each image:
+                        * compose the cached layer into the buffer
 
             * Refresh/Update canvas
 
@@ -136,8 +136,10 @@ from __future__ import division
 
 from abc import abstractmethod
 import cairo
+import collections
 from decorator import decorator
 import logging
+import math
 from odemis import util, gui
 from odemis.gui import BLEND_DEFAULT, BLEND_SCREEN, BufferSizeEvent
 from odemis.gui import img
@@ -150,6 +152,7 @@ from odemis.gui.util.img import add_alpha_byte, apply_rotation, apply_shear, app
 from odemis.util import intersect
 import os
 import sys
+import time
 import wx
 from wx.lib import wxcairo
 
@@ -159,6 +162,9 @@ CAN_DRAG = 1    # Content can be dragged
 CAN_FOCUS = 2   # Can adjust focus
 CAN_ZOOM = 4    # Can adjust scale
 
+# Number of latest frames used to compute the drawing statistics
+FPS_HISTORY = 20
+
 
 @decorator
 def ignore_if_disabled(f, self, *args, **kwargs):
@@ -167,6 +173,60 @@ def ignore_if_disabled(f, self, *args, **kwargs):
         return f(self, *args, **kwargs)
 
 
+def _get_device_extents(ctx, width, height):
+    """ Compute the area a rectangle drawn from the current origin covers on the device
+
+    :param ctx: (cairo.Context) Context with the transformation of the drawing
+    :param width, height: (float) Size of the rectangle in user coordinates
+
+    :return: (int, int, int, int) left, top, right, bottom in device coordinates
+
+    """
+    corners = [ctx.user_to_device(x, y) for x, y in ((0, 0), (width, 0), (0, height), (width, height))]
+    xs, ys = zip(*corners)
+    return (int(math.floor(min(xs))), int(math.floor(min(ys))),
+            int(math.ceil(max(xs))), int(math.ceil(max(ys))))
+
+
+def _is_same_image(im1, im2):
+    """ Check whether two images (DataArray or tuple of tuple of tiles) are the same objects """
+    if isinstance(im1, tuple):
+        if not isinstance(im2, tuple) or len(im1) != len(im2):
+            return False
+        for col1, col2 in zip(im1, im2):
+            if len(col1) != len(col2) or any(t1 is not t2 for t1, t2 in zip(col1, col2)):
+                return False
+        return True
+    return im1 is im2
+
+
+class _ImageLayer(object):
+    """ Rendering of one image at the resolution of the buffer
+
+    The layer is only valid as long as the image and the way it's drawn on the
+    buffer (position, scale, transformations, blend mode, buffer size and
+    position...) stay the same.
+    """
+
+    def __init__(self, image, key, surface, extents):
+        """
+        :param image: (DataArray or tuple of tuple of DataArray) The image rendered
+        :param key: (tuple) All the drawing parameters used for the rendering
+        :param surface: (cairo.ImageSurface or None) The rendered image, of the
+            size of the buffer. None if the image is not visible.
+        :param extents: (None or 4 ints) The left, top, right, bottom of the area
+            of the buffer covered by the image
+        """
+        self.image = image
+        self.key = key
+        self.surface = surface
+        self.extents = extents
+
+    def is_valid(self, image, key):
+        """ Check whether the layer can be used to draw the given image with the given parameters """
+        return self.key == key and _is_same_image(self.image, image)
+
+
 class BufferedCanvas(wx.Panel):
     """ Abstract base class for buffered canvasses that display graphical data """
 
@@ -784,11 +844,38 @@ class BitmapCanvas(BufferedCanvas):
         self.scale = 1.0  # px/m
         self.margins = (0, 0)
 
+        # _ImageLayer of each image drawn in the latest frame. They are composed
+        # into the buffer, and only rendered again when the image changed.
+        self._layers = []
+
+        # Drawing statistics
+        self._frame_times = collections.deque(maxlen=FPS_HISTORY)  # end time of each draw
+        self._draw_durations = collections.deque(maxlen=FPS_HISTORY)  # s
+        self.layers_rendered = 0  # number of layers rendered during the latest draw
+
     def clear(self):
         """ Remove the images and clear the canvas """
         self.images = [None]
+        self._layers = []
         BufferedCanvas.clear(self)
 
+    @property
+    def fps(self):
+        """ (float) Number of frames drawn per second, over the latest frames """
+        if len(self._frame_times) < 2:
+            return 0
+        dur = self._frame_times[-1] - self._frame_times[0]
+        if dur <= 0:
+            return float("inf")
+        return (len(self._frame_times) - 1) / dur
+
+    @property
+    def draw_duration(self):
+        """ (float) Average time it took to draw a frame, over the latest frames, in s """
+        if not self._draw_durations:
+            return 0
+        return sum(self._draw_durations) / len(self._draw_durations)
+
     def set_images(self, im_args):
         """ Set (or update)  image
 
@@ -812,11 +899,8 @@ class BitmapCanvas(BufferedCanvas):
 
         """
 
-        # TODO:
-        # * take an image composition tree (operator + images + scale + pos)
-        # * allow to indicate just one image has changed (and so the rest
-        #   doesn't need to be recomputed)
-
+        # Note: the images which haven't changed (ie, same object with the same
+        # parameters) are not rendered again, thanks to the layer cache.
         images = []
 
         for args in im_args:
@@ -879,6 +963,7 @@ class BitmapCanvas(BufferedCanvas):
         if not self or 0 in self.ClientSize:
             return
 
+        tstart = time.time()
         ctx = wxcairo.ContextFromDC(self._dc_buffer)
 
         self._draw_background(ctx)
@@ -898,6 +983,10 @@ class BitmapCanvas(BufferedCanvas):
                 logging.exception("Failed to draw world overlay %s", o)
             ctx.restore()
 
+        tend = time.time()
+        self._frame_times.append(tend)
+        self._draw_durations.append(tend - tstart)
+
     def _draw_merged_images(self, ctx, interpolate_data=False):
         """ Draw the images on the DC buffer, centred around their _dc_center, with their own
         scale and an opacity of "mergeratio" for im1.
@@ -907,9 +996,13 @@ class BitmapCanvas(BufferedCanvas):
         All _dc_center's should be close in order to have the parts with only one picture drawn
         without transparency
 
-        :param interpolate_data: (boolean) Apply interpolation if True
+        Each image is first rendered in its own layer (at the buffer resolution),
+        which is kept as long as the image and the drawing parameters don't
+        change. The layers are then composed into the buffer. So when only one
+        image changed, or only an overlay moved, just the layers need to be
+        composed again.
 
-        :return: (int) Frames per second
+        :param interpolate_data: (boolean) Apply interpolation if True
 
         ..note::
             This is a very rough implementation. It's not fully optimized and uses only a basic
@@ -921,6 +1014,8 @@ class BitmapCanvas(BufferedCanvas):
         # will do a element-by element comparison. (Or at least value == None will, it might have
         # been a false positive). Instead, when working with NDArrays, use `value is None`
         if not self.images or all(i is None for i in self.images):
+            self._layers = []
+            self.layers_rendered = 0
             return
 
         # The idea:
@@ -934,54 +1029,114 @@ class BitmapCanvas(BufferedCanvas):
 
         images = [im for im in self.images if im is not None]
 
-        if images:
-            n = len(images)
-            for i, im in enumerate(images):
-                if isinstance(im, tuple):
-                    first_tile = im[0][0]
-                    md = first_tile.metadata
-                    tiles_merged_shape = util.img.getTilesSize(im)
-                    # the center of the image composed of the tiles
-                    center = util.img.getCenterOfTiles(im, tiles_merged_shape)
-                else:
-                    md = im.metadata
+        prev_layers = self._layers
+        layers = []
+        self.layers_rendered = 0
+        n = len(images)
+        for i, im in enumerate(images):
+            if isinstance(im, tuple):
+                md = im[0][0].metadata
+            else:
+                md = im.metadata
 
-                if md['blend_mode'] == BLEND_SCREEN:
+            if md['blend_mode'] == BLEND_SCREEN:
+                merge_ratio = 1.0
+            elif i == n - 1: # last image
+                if n == 1:
                     merge_ratio = 1.0
-                elif i == n - 1: # last image
-                    if n == 1:
-                        merge_ratio = 1.0
-                    else:
-                        merge_ratio = self.merge_ratio
                 else:
-                    merge_ratio = 1 - i / n
+                    merge_ratio = self.merge_ratio
+            else:
+                merge_ratio = 1 - i / n
 
-                if isinstance(im, tuple):
-                    self._draw_tiles(
-                        ctx,
-                        im,
-                        center,
-                        merge_ratio,
-                        im_scale=md['dc_scale'],
-                        rotation=md['dc_rotation'],
-                        shear=md['dc_shear'],
-                        flip=md['dc_flip'],
-                        blend_mode=md['blend_mode'],
-                        interpolate_data=interpolate_data
-                    )
-                else:
-                    self._draw_image(
-                        ctx,
-                        im,
-                        im.metadata['dc_center'],
-                        merge_ratio,
-                        im_scale=im.metadata['dc_scale'],
-                        rotation=im.metadata['dc_rotation'],
-                        shear=im.metadata['dc_shear'],
-                        flip=im.metadata['dc_flip'],
-                        blend_mode=im.metadata['blend_mode'],
-                        interpolate_data=interpolate_data
-                    )
+            # Fully transparent image does not need to be drawn
+            if merge_ratio < 1e-8:
+                logging.debug("Skipping draw: image fully transparent")
+                continue
+
+            layer = self._get_layer(im, md, prev_layers, interpolate_data)
+            layers.append(layer)
+            if layer.surface is None:
+                continue
+
+            # The layer is only composed on the area covered by the image, so
+            # that the rest of the buffer is not affected, whatever the blend mode.
+            l, t, r, b = layer.extents
+            ctx.save()
+            ctx.rectangle(l, t, r - l, b - t)
+            ctx.clip()
+            ctx.set_source_surface(layer.surface, 0, 0)
+            ctx.set_operator(md['blend_mode'])
+            if merge_ratio < 1.0:
+                ctx.paint_with_alpha(merge_ratio)
+            else:
+                ctx.paint()
+            ctx.restore()
+
+        # Drop the layers of the images not displayed anymore
+        self._layers = layers
+
+    def _get_layer(self, im, md, prev_layers, interpolate_data=False):
+        """ Get the layer of an image, rendering it only if it's not already in
+        the previous layers.
+
+        :param im: (DataArray or tuple of tuple of DataArray) The image (or tiles) to draw
+        :param md: (dict) The metadata containing the drawing parameters of the image
+        :param prev_layers: (list of _ImageLayer) The layers which can be reused
+        :param interpolate_data: (boolean) Apply interpolation if True
+
+        :return: (_ImageLayer) The layer of the image
+
+        """
+        if isinstance(im, tuple):
+            # the center of the image composed of the tiles
+            center = util.img.getCenterOfTiles(im, util.img.getTilesSize(im))
+        else:
+            center = md['dc_center']
+
+        key = (center, md['dc_scale'], md['dc_rotation'], md['dc_shear'], md['dc_flip'],
+               md['dc_keepalpha'], md['blend_mode'], interpolate_data,
+               self.scale, self.p_buffer_center, self._bmp_buffer_size)
+
+        for layer in prev_layers:
+            if layer.is_valid(im, key):
+                return layer
+
+        # The image is rendered with full opacity on a transparent surface, and
+        # the merge ratio is only applied when composing the layer.
+        self.layers_rendered += 1
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *self._bmp_buffer_size)
+        lctx = cairo.Context(surface)
+        if isinstance(im, tuple):
+            extents = self._draw_tiles(
+                lctx,
+                im,
+                center,
+                im_scale=md['dc_scale'],
+                rotation=md['dc_rotation'],
+                shear=md['dc_shear'],
+                flip=md['dc_flip'],
+                blend_mode=md['blend_mode'],
+                interpolate_data=interpolate_data
+            )
+        else:
+            extents = self._draw_image(
+                lctx,
+                im,
+                center,
+                im_scale=md['dc_scale'],
+                rotation=md['dc_rotation'],
+                shear=md['dc_shear'],
+                flip=md['dc_flip'],
+                blend_mode=md['blend_mode'],
+                interpolate_data=interpolate_data
+            )
+        del lctx
+
+        if extents is None:
+            surface = None
+
+        return _ImageLayer(im, key, surface, extents)
 
     def _draw_tiles(self, ctx, tiles, p_im_center, opacity=1.0,
                     im_scale=(1.0, 1.0), rotation=None, shear=None, flip=None,
@@ -1003,6 +1158,9 @@ class BitmapCanvas(BufferedCanvas):
         :param blend_mode: (int) Graphical blending type used for transparency
         :param interpolate_data: (boolean) Apply interpolation if True
 
+        :return: (None or 4 ints) The left, top, right, bottom of the area covered
+            by the image in the context, or None if nothing was drawn
+
         """
         first_tile = tiles[0][0]
         ftmd = first_tile.metadata
@@ -1010,7 +1168,7 @@ class BitmapCanvas(BufferedCanvas):
         # Fully transparent image does not need to be drawn
         if opacity < 1e-8:
             logging.debug("Skipping draw: image fully transparent")
-            return
+            return None
 
         # calculates the shape of the image composed from the tiles
         im_shape = util.img.getTilesSize(tiles)
@@ -1021,7 +1179,7 @@ class BitmapCanvas(BufferedCanvas):
         if b_im_rect[2] < 1 or b_im_rect[3] < 1:
             # TODO: compute the mean, and display one pixel with it
             logging.debug("Skipping draw: too small")
-            return
+            return None
 
         # Get the intersection with the actual buffer
         buffer_rect = (0, 0) + self._bmp_buffer_size
@@ -1031,7 +1189,7 @@ class BitmapCanvas(BufferedCanvas):
         # No intersection means nothing to draw
         if not intersection:
             logging.debug("Skipping draw: no intersection with buffer")
-            return
+            return None
 
         # Cache the current transformation matrix
         ctx.save()
@@ -1053,6 +1211,7 @@ class BitmapCanvas(BufferedCanvas):
         ctx.translate(base_x, base_y)
         # Apply total scale
         ctx.scale(total_scale_x, total_scale_y)
+        extents = _get_device_extents(ctx, im_shape[1], im_shape[0])
 
         if interpolate_data:
             # Since cairo v1.14, FILTER_BEST is different from BILINEAR.
@@ -1098,6 +1257,7 @@ class BitmapCanvas(BufferedCanvas):
 
         # Restore the cached transformation matrix
         ctx.restore()
+        return extents
 
     def _draw_image(self, ctx, im_data, p_im_center, opacity=1.0,
                     im_scale=(1.0, 1.0), rotation=None, shear=None, flip=None,
@@ -1117,12 +1277,15 @@ class BitmapCanvas(BufferedCanvas):
         :param blend_mode: (int) Graphical blending type used for transparency
         :param interpolate_data: (boolean) Apply interpolation if True
 
+        :return: (None or 4 ints) The left, top, right, bottom of the area covered
+            by the image in the context, or None if nothing was drawn
+
         """
 
         # Fully transparent image does not need to be drawn
         if opacity < 1e-8:
             logging.debug("Skipping draw: image fully transparent")
-            return
+            return None
 
         # Determine the rectangle the image would occupy in the buffer
         b_im_rect = self._calc_img_buffer_rect(im_data.shape[:2], im_scale, p_im_center)
@@ -1132,7 +1295,7 @@ class BitmapCanvas(BufferedCanvas):
         if b_im_rect[2] < 1 or b_im_rect[3] < 1:
             # TODO: compute the mean, and display one pixel with it
             logging.debug("Skipping draw: too small")
-            return
+            return None
 
         # Get the intersection with the actual buffer
         buffer_rect = (0, 0) + self._bmp_buffer_size
@@ -1142,7 +1305,7 @@ class BitmapCanvas(BufferedCanvas):
         # No intersection means nothing to draw
         if not intersection:
             logging.debug("Skipping draw: no intersection with buffer")
-            return
+            return None
 
         # logging.debug("Intersection (%s, %s, %s, %s)", *intersection)
         # Cache the current transformation matrix
@@ -1220,9 +1383,11 @@ class BitmapCanvas(BufferedCanvas):
             ctx.paint_with_alpha(opacity)
         else:
             ctx.paint()
+        extents = _get_device_extents(ctx, width, height)
 
         # Restore the cached transformation matrix
         ctx.restore()
+        return extents
 
     def _calc_img_buffer_rect(self, im_shape, im_scale, p_im_center):
         """ Compute the rectangle containing the image in buffer coordinates
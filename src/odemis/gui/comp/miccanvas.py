@@ -107,7 +107,6 @@ class DblMicroscopeCanvas(canvas.DraggableCanvas):
         self._spotmode_ol = None
         self.mirror_ol = None
         self._fps_ol = None
-        self._last_frame_update = None
         self._focus_overlay = None
         self._pixelvalue_ol = None
 
@@ -842,29 +841,20 @@ class DblMicroscopeCanvas(canvas.DraggableCanvas):
         super(DblMicroscopeCanvas, self).on_motion(evt)
 
     def draw(self):
-        """ Redraw the buffer while calculating the number of frames we *could* display
+        """ Redraw the buffer, and update the FPS overlay if it's displayed
 
-        The fps value is an indication of how many times we can draw per second and not the actual
-        number of frames displayed on screen!
+        The fps value is the number of frames actually drawn per second, while
+        the drawing time indicates how many frames we *could* draw.
 
         """
-
         interpolate_data = False if self.view is None else self.view.interpolate_content.value
-        if self._fps_ol:
-            if self._last_frame_update is None:
-                self._last_frame_update = time.time()
-            super(DblMicroscopeCanvas, self).draw(interpolate_data=interpolate_data)
-            now = time.time()
+        super(DblMicroscopeCanvas, self).draw(interpolate_data=interpolate_data)
 
-            try:
-                dur = now - self._last_frame_update
-                fps = 1 / dur
-                self._fps_ol.labels[0].text = u"%s fps" % units.readable_str(fps, sig=3)
-            except ZeroDivisionError:
-                self._fps_ol.labels[0].text = u"∞ fps"
-            self._last_frame_update = now
-        else:
-            super(DblMicroscopeCanvas, self).draw(interpolate_data=interpolate_data)
+        if self._fps_ol:
+            self._fps_ol.labels[0].text = u"%s fps, draw: %s, %d layers rendered" % (
+                units.readable_str(self.fps, sig=3),
+                units.readable_str(self.draw_duration, "s", sig=2),
+                self.layers_rendered)
 
     def _getContentBoundingBox(self):
         """
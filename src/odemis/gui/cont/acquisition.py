@@ -30,7 +30,6 @@ of microscope images.
 from __future__ import division
 
 from builtins import str
-from concurrent import futures
 from concurrent.futures._base import CancelledError
 import logging
 import math
@@ -223,17 +222,30 @@ class SnapshotController(object):
 
                     raw_images.append(d)
 
-            # record everything to a file
-            exporter.export(filepath, raw_images, thumbnail)
-            popup.show_message(self._main_frame,
-                               "Snapshot saved as %s" % (os.path.basename(filepath),),
-                               message="In %s" % (os.path.dirname(filepath),),
-                               timeout=3
-                               )
+            # record everything to a file, in the background, so that another
+            # snapshot can be taken immediately
+            ef = self._main_data_model.export_service.export(filepath, raw_images, thumbnail, exporter)
+            ef.add_done_callback(self._on_snapshot_saved)
+        except Exception:
+            logging.exception("Failed to save snapshot")
 
-            logging.info("Snapshot saved as file '%s'.", filepath)
+    def _on_snapshot_saved(self, future):
+        """
+        Called when the snapshot file is written (or failed to)
+        """
+        try:
+            filepath = future.result()
         except Exception:
             logging.exception("Failed to save snapshot")
+            return
+
+        popup.show_message(self._main_frame,
+                           "Snapshot saved as %s" % (os.path.basename(filepath),),
+                           message="In %s" % (os.path.dirname(filepath),),
+                           timeout=3
+                           )
+
+        logging.info("Snapshot saved as file '%s'.", filepath)
 
     def start_snapshot_animation(self):
         """
@@ -491,9 +503,6 @@ class SparcAcquiController(object):
         self.bmp_acq_status_info = self._tab_panel.bmp_acq_status_info
         self._acq_future_connector = None
 
-        # TODO: share an executor with the whole GUI.
-        self._executor = futures.ThreadPoolExecutor(max_workers=2)
-
         # Link buttons
         self.btn_acquire.Bind(wx.EVT_BUTTON, self.on_acquisition)
         self.btn_change_file.Bind(wx.EVT_BUTTON, self.on_change_file)
@@ -526,9 +535,6 @@ class SparcAcquiController(object):
         # Listen to preparation state
         self._main_data_model.is_preparing.subscribe(self.on_preparation)
 
-    def __del__(self):
-        self._executor.shutdown(wait=False)
-
     # black list of VAs name which are known to not affect the acquisition time
     VAS_NO_ACQUSITION_EFFECT = ("image", "autoBC", "intensityRange", "histogram",
                                 "is_active", "should_update", "status", "name", "tint")
@@ -767,7 +773,10 @@ class SparcAcquiController(object):
 
     def _export_to_file(self, acq_future):
         """
-        return (list of DataArray, filename): data exported and filename
+        Start exporting the data of the acquisition to the file, in the background
+        return (list of DataArray, Exception or None, filename, ProgressiveFuture or None):
+          data exported, acquisition exception, filename, and future of the export
+          (None if there is no data to save)
         """
         streams = list(self._tab_data_model.acquisitionStreams)
         st = stream.StreamTree(streams=streams)
@@ -777,12 +786,12 @@ class SparcAcquiController(object):
         filename = self.filename.value
         if data:
             exporter = dataio.get_converter(self.conf.last_format)
-            exporter.export(filename, data, thumb)
-            logging.info(u"Acquisition saved as file '%s'.", filename)
+            ef = self._main_data_model.export_service.export(filename, data, thumb, exporter)
         else:
             logging.debug("Not saving into file '%s' as there is no data", filename)
+            ef = None
 
-        return data, exp, filename
+        return data, exp, filename, ef
 
     @call_in_wx_main
     def on_acquisition_done(self, future):
@@ -822,33 +831,50 @@ class SparcAcquiController(object):
             if hasattr(v, "removeStream"):
                 v.removeStream(self._tab_data_model.semStream)
 
-        # save result to file
-        self.lbl_acqestimate.SetLabel("Saving file...")
-        # on big acquisitions, it can take ~20s
-        sf = self._executor.submit(self._export_to_file, future)
-        sf.add_done_callback(self.on_file_export_done)
+        # Save result to file. On big acquisitions, it can take ~20s, so it's
+        # done in the background, and the next acquisition can already start.
+        self.gauge_acq.Hide()
+        try:
+            data, exp, filename, ef = self._export_to_file(future)
+        except Exception:
+            logging.exception("Saving acquisition failed")
+            self._reset_acquisition_gui("Saving acquisition file failed (see log panel).",
+                                        level=logging.WARNING)
+            return
+
+        if ef is None:
+            self._reset_acquisition_gui("Acquisition failed (see log panel).",
+                                        level=logging.WARNING,
+                                        keep_filename=True)
+            return
+
+        # The filename is now used, so a new one is picked for the next acquisition
+        self._reset_acquisition_gui(u"Saving file…", level=logging.INFO)
+        ef.add_done_callback(lambda f: self.on_file_export_done(f, data, exp, filename))
 
     @call_in_wx_main
-    def on_file_export_done(self, future):
+    def on_file_export_done(self, future, data, exp, filename):
         """
-        Callback called when the acquisition is finished (either successfully or
-        cancelled)
+        Callback called when the acquisition file is written (or failed to)
         """
-        # hide progress bar
-        self.gauge_acq.Hide()
+        # If a new acquisition has already started, don't disturb it
+        is_acquiring = self._main_data_model.is_acquiring.value
 
         try:
-            data, exp, filename = future.result()
+            future.result()
         except Exception:
             logging.exception("Saving acquisition failed")
-            self._reset_acquisition_gui("Saving acquisition file failed (see log panel).",
-                                        level=logging.WARNING)
+            if not is_acquiring:
+                self.lbl_acqestimate.SetLabel("Saving acquisition file failed (see log panel).")
+                self._show_status_icons(logging.WARNING)
+            return
+
+        logging.info(u"Acquisition saved as file '%s'.", filename)
+        if is_acquiring:
             return
 
         if exp is None:
-            # Needs to be done before changing tabs as it will play again the stream
-            # (and they will be immediately be stopped when changing tab).
-            self._reset_acquisition_gui()
+            self.update_acquisition_time()
 
             # TODO: we should add the file to the list of recently-used files
             # cf http://pyxdg.readthedocs.org/en/latest/recentfiles.html
@@ -856,9 +882,8 @@ class SparcAcquiController(object):
             # display in the analysis tab
             self._show_acquisition(data, open(filename))
         else:
-            self._reset_acquisition_gui("Acquisition failed (see log panel).",
-                                        level=logging.WARNING,
-                                        keep_filename=(not data))
+            self.lbl_acqestimate.SetLabel("Acquisition failed (see log panel).")
+            self._show_status_icons(logging.WARNING)
 
 
 # TODO: merge with AutoCenterController because they share too many GUI elements
@@ -1719,7 +1719,8 @@ class StreamBarController(object):
                 self._main_data_model.ebeam,
                 focuser=self._main_data_model.ebeam_focus,
                 opm=self._main_data_model.opm,
-                blanker=blanker
+                blanker=blanker,
+                partial_frames=True
             )
 
         # If the detector already handles brightness and contrast, don't do it by default
@@ -2597,6 +2598,7 @@ class SparcStreamsController(StreamBarController):
             focuser=self._main_data_model.ebeam_focus,
             emtvas=emtvas,
             detvas=get_local_vas(detector, self._main_data_model.hw_settings_config),
+            partial_frames=True,
         )
 
         # If the detector already handles brightness and contrast, don't do it by default
@@ -325,6 +325,11 @@ class OdemisGUIApp(wx.App):
         if self.dev_powermate:
             self.dev_powermate.terminate()
 
+        # Don't lose the acquisitions still being written
+        if self.main_data.export_service.pending:
+            logging.info("Waiting for %d files to be saved", self.main_data.export_service.pending)
+        self.main_data.export_service.shutdown(wait=True)
+
         try:
             pub.unsubAll()
             # let all the tabs know we are stopping
@@ -40,6 +40,7 @@ from odemis.model import (FloatContinuous, VigilantAttribute, IntEnumerated, Str
                           MD_POS, InstantaneousFuture, hasVA, StringEnumerated)
 from odemis.model import MD_PIXEL_SIZE_COR, MD_POS_COR, MD_ROTATION_COR
 from odemis.gui.log import observe_comp_state
+from odemis.util.dataio import ExportService
 import os
 import threading
 import time
@@ -262,6 +263,10 @@ class MainGUIData(object):
         # Indicates whether a stream is in preparation (i.e., a prepare() future is active)
         self.is_preparing = model.BooleanVA(False)
 
+        # Writes the acquisitions to files in the background, shared by all
+        # the tabs
+        self.export_service = ExportService()
+
         # The microscope object will be probed for common detectors, actuators, emitters etc.
         if microscope:
             self.role = microscope.role
@@ -173,6 +173,66 @@ class TestDblMicroscopeCanvas(test.GuiTestCase):
                       result_im.Height // 2 - 200 + shift[1])
         self.assertEqual(px2, (0, 0, 255))
 
+    # @unittest.skip("simple")
+    def test_layer_cache(self):
+        """
+        Check the images are only rendered again when they change
+        """
+        mpp = 0.00001
+        self.view.mpp.value = mpp
+        self.view.show_crosshair.value = False
+        self.canvas.fit_view_to_next_image = False
+
+        im1 = model.DataArray(numpy.zeros((11, 11, 3), dtype="uint8"))
+        im1[5, 5] = [255, 0, 0]
+        im1.metadata[model.MD_PIXEL_SIZE] = (mpp * 10, mpp * 10)
+        im1.metadata[model.MD_POS] = (0, 0)
+        im1.metadata[model.MD_DIMS] = "YXC"
+        stream1 = RGBStream("s1", im1)
+
+        im2 = model.DataArray(numpy.zeros((201, 201, 3), dtype="uint8"))
+        im2[100, 100] = [0, 0, 255]
+        im2.metadata[model.MD_PIXEL_SIZE] = (mpp, mpp)
+        im2.metadata[model.MD_POS] = (200.5 * mpp, 199.5 * mpp)
+        im2.metadata[model.MD_DIMS] = "YXC"
+        stream2 = RGBStream("s2", im2)
+
+        self.view.addStream(stream1)
+        self.view.addStream(stream2)
+        self.view.mpp.value = mpp
+        self.view.merge_ratio.value = 0.5
+        test.gui_loop(0.5)
+        self.assertEqual(len(self.canvas._layers), 2)
+
+        # Nothing changed => nothing to render, but the result is the same
+        result_im = get_image_from_buffer(self.canvas)
+        px1 = get_rgb(result_im, result_im.Width // 2, result_im.Height // 2)
+        self.assertEqual(px1, (128, 0, 0))
+        self.canvas.update_drawing()
+        self.assertEqual(self.canvas.layers_rendered, 0)
+        result_im = get_image_from_buffer(self.canvas)
+        self.assertEqual(get_rgb(result_im, result_im.Width // 2, result_im.Height // 2), px1)
+
+        # Only the merge ratio changes => the layers are just composed again
+        self.view.merge_ratio.value = 1
+        test.gui_loop(0.5)
+        self.assertEqual(self.canvas.layers_rendered, 0)
+        result_im = get_image_from_buffer(self.canvas)
+        px1 = get_rgb(result_im, result_im.Width // 2, result_im.Height // 2)
+        self.assertEqual(px1, (255, 0, 0))
+
+        # Moving the view => all the layers are rendered again
+        self.canvas.shift_view((10, 10))
+        test.gui_loop(0.5)
+        self.assertEqual(self.canvas.layers_rendered, 2)
+
+        self.assertGreater(self.canvas.fps, 0)
+        self.assertGreater(self.canvas.draw_duration, 0)
+
+        self.view.removeStream(stream1)
+        test.gui_loop(0.5)
+        self.assertEqual(len(self.canvas._layers), 1)
+
     # @unittest.skip("simple")
     def test_basic_move(self):
         mpp = 0.00001
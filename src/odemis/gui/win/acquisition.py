@@ -581,14 +581,32 @@ class AcquisitionDialog(xrcfr_acq):
             logging.warning("Acquisition failed (after %d streams): %s",
                             len(data), exp)
 
-        # save result to file
+        # save result to file, in the background, to not block the GUI
         self.lbl_acqestimate.SetLabel("Saving file...")
         self.lbl_acqestimate.Parent.Layout()
         try:
             thumb = acqmng.computeThumbnail(self._view.stream_tree, future)
             filename = self.filename.value
             exporter = dataio.get_converter(self.conf.last_format)
-            exporter.export(filename, data, thumb)
+            ef = self._main_data_model.export_service.export(filename, data, thumb, exporter)
+        except Exception:
+            logging.exception("Saving acquisition failed")
+            self.btn_secom_acquire.Enable()
+            self.lbl_acqestimate.SetLabel("Saving acquisition file failed.")
+            self.lbl_acqestimate.Parent.Layout()
+            return
+
+        ef.add_done_callback(lambda f: self.on_file_export_done(f, exp))
+
+    @call_in_wx_main
+    def on_file_export_done(self, future, exp):
+        """ Callback called when the acquisition file is written (or failed to) """
+        if not self:
+            # The window has been closed in the meantime, the file is written anyway
+            return
+
+        try:
+            filename = future.result()
             logging.info("Acquisition saved as file '%s'.", filename)
             # Allow to see the acquisition
             self.btn_secom_acquire.SetLabel("VIEW")
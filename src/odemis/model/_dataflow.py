@@ -33,8 +33,10 @@ from odemis.model import _metadata
 from odemis.util import inspect_getmembers
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
+import tempfile
 import threading
 import time
+import weakref
 import zmq
 
 from . import _core
@@ -95,6 +97,131 @@ class DataArray(numpy.ndarray):
     #     out_arr.metadata = self.metadata
     #     return numpy.ndarray.__array_wrap__(self, out_arr, context)
 
+
+# Arrays of at least this size (in bytes) are allocated by allocateDataArray()
+# in a memory-mapped file of the scratch directory, instead of the RAM.
+# None to never use memory-mapped files.
+_memmap_threshold = int(os.environ.get("ODEMIS_MEMMAP_THRESHOLD", 1024 ** 3))
+# Directory where the memory-mapped files are stored
+_scratch_dir = os.environ.get("ODEMIS_SCRATCH_DIR", tempfile.gettempdir())
+
+
+def setScratchDirectory(path):
+    """
+    Changes the directory where the memory-mapped files of the big DataArrays
+    are stored.
+    path (str): directory. Ideally, on a fast local disk with a lot of free space.
+    raises ValueError: if the directory doesn't exist
+    """
+    global _scratch_dir
+    if not os.path.isdir(path):
+        raise ValueError("Scratch directory %s doesn't exist" % (path,))
+    _scratch_dir = path
+
+
+def getScratchDirectory():
+    """
+    return (str): the directory where the memory-mapped files are stored
+    """
+    return _scratch_dir
+
+
+def setMemmapThreshold(size):
+    """
+    Changes the minimum size of the DataArrays stored in memory-mapped files.
+    size (0<=int or None): size in bytes. None to always allocate in RAM.
+    """
+    global _memmap_threshold
+    if size is not None and size < 0:
+        raise ValueError("Memmap threshold must be positive, but got %s" % (size,))
+    _memmap_threshold = size
+
+
+def getMemmapThreshold():
+    """
+    return (0<=int or None): the minimum size (in bytes) of the DataArrays stored
+      in memory-mapped files. None if they are always allocated in RAM.
+    """
+    return _memmap_threshold
+
+
+def getScratchSpace():
+    """
+    return (int): the number of bytes available in the scratch directory
+    """
+    st = os.statvfs(_scratch_dir)
+    return st.f_bavail * st.f_frsize
+
+
+def _remove_file(fn):
+    try:
+        os.remove(fn)
+    except OSError:
+        logging.warning("Failed to delete scratch file %s", fn)
+
+
+def _memmap_zeros(shape, dtype):
+    """
+    Creates an array backed by a (temporary) file of the scratch directory.
+    The file is deleted as soon as the array is not used anymore.
+    shape (tuple of int)
+    dtype (numpy.dtype)
+    return (numpy.memmap): array initialised to 0
+    raises IOError: if not enough space on the scratch directory
+    """
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    free = getScratchSpace()
+    if free < nbytes:
+        raise IOError("Only %d bytes available in %s, while %d needed" %
+                      (free, _scratch_dir, nbytes))
+
+    fd, fn = tempfile.mkstemp(prefix="odemis-", suffix=".dat", dir=_scratch_dir)
+    try:
+        with os.fdopen(fd, "w+b") as f:
+            # The file is extended (sparse), so it's already filled with 0's
+            arr = numpy.memmap(f, dtype=dtype, mode="w+", shape=shape)
+    except Exception:
+        _remove_file(fn)
+        raise
+
+    try:
+        # On Unix, the mapping is still valid after removing the file, and the
+        # disk space is freed as soon as the array is closed.
+        os.remove(fn)
+    except OSError:
+        # The file is in use (eg, on Windows) => delete it once the array is gone
+        weakref.finalize(arr, _remove_file, fn)
+
+    logging.debug("Allocated array of %s %s in scratch file %s", shape, dtype, fn)
+    return arr
+
+
+def allocateDataArray(shape, dtype, metadata=None):
+    """
+    Creates a new DataArray, initialised to 0. If it is big (see
+    setMemmapThreshold()), the data is stored in a memory-mapped file of the
+    scratch directory, so that it can be bigger than the memory available.
+    Apart from being slower to access, it behaves just like a normal DataArray,
+    and the file is automatically deleted when the array is not used anymore.
+    If there is not enough space in the scratch directory, it falls back to the
+    RAM.
+    shape (tuple of 0<=int): the shape of the array
+    dtype (numpy.dtype): the type of the data
+    metadata (dict str-> value): the metadata of the DataArray
+    return (DataArray)
+    """
+    shape = tuple(int(s) for s in shape)
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    if _memmap_threshold is not None and nbytes >= _memmap_threshold and nbytes > 0:
+        try:
+            return DataArray(_memmap_zeros(shape, dtype), metadata)
+        except (IOError, OSError, ValueError) as ex:
+            logging.warning("Failed to allocate %d bytes in %s, will use the RAM: %s",
+                            nbytes, _scratch_dir, ex)
+
+    return DataArray(numpy.zeros(shape, dtype), metadata)
+
 class DataFlowBase(object):
     """
     This is an abstract class that must be extended by each detector which
@@ -186,6 +313,29 @@ class DataFlowBase(object):
                 logging.exception("Exception when notifying a data_flow")
 
 
+def _merge_partial_frame(frame, data):
+    """
+    Copy a block of lines into the whole frame
+    frame (None or DataArray): the frame being assembled so far. Its
+      MD_LINE_OFFSET metadata indicates the number of lines already received.
+    data (DataArray): the block of lines, with MD_LINE_OFFSET and MD_FRAME_SHAPE
+    return (None or DataArray): the frame updated, or None if the block is not
+      the next one of the frame (eg, if the first lines of the frame were missed).
+    """
+    offset = data.metadata[_metadata.MD_LINE_OFFSET]
+    if offset == 0:
+        md = data.metadata.copy()
+        shape = md.pop(_metadata.MD_FRAME_SHAPE)
+        frame = DataArray(numpy.empty(shape, dtype=data.dtype), md)
+    elif frame is None or frame.metadata[_metadata.MD_LINE_OFFSET] != offset:
+        return None  # Some lines are missing => wait for the next frame
+
+    nlines = data.shape[-2]
+    frame[..., offset:offset + nlines, :] = data
+    frame.metadata[_metadata.MD_LINE_OFFSET] = offset + nlines
+    return frame
+
+
 # DataFlow object to create on the server (in a component)
 class DataFlow(DataFlowBase):
     def __init__(self, max_discard=100): # XXX max_discard=100
@@ -312,6 +462,13 @@ class DataFlow(DataFlowBase):
 
         def receive_one_image(df, data, min_time=min_time):
             if data.metadata.get(_metadata.MD_ACQ_DATE, float("inf")) >= min_time:
+                if _metadata.MD_LINE_OFFSET in data.metadata:
+                    # Partial frame => wait until all the lines are received
+                    data = _merge_partial_frame(data_shared[0], data)
+                    data_shared[0] = data
+                    if data is None or data.metadata[_metadata.MD_LINE_OFFSET] < data.shape[-2]:
+                        return
+                    del data.metadata[_metadata.MD_LINE_OFFSET]
                 df.unsubscribe(receive_one_image)
                 data_shared[0] = data
                 is_received.set()
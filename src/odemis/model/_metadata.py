@@ -89,6 +89,11 @@ MD_TIME_LIST = "Time list"  # sec (array) containing the corrections for the tim
 MD_PIXEL_DUR = "Pixel duration"  # Time duration of a 'pixel' along the time dimension
 MD_TIME_OFFSET = "Time offset"  # Time of the first 'pixel' in the time dimension (added to ACQ_DATE), default is 0
 
+# When a DataFlow sends the frames by blocks of lines (partial frames), each
+# block has the metadata of the whole frame, plus the following two.
+MD_LINE_OFFSET = "Line offset"  # (0<=int) index of the first line of the block in the whole frame
+MD_FRAME_SHAPE = "Frame shape"  # (tuple of 0<int) shape of the whole frame
+
 MD_ACQ_TYPE = "Acquisition type"  # the type of acquisition contained in the DataArray
 # The following tags are to be used as the values of MD_ACQ_TYPE
 MD_AT_SPECTRUM = "Spectrum"
@@ -22,9 +22,13 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 from __future__ import division, print_function
 from Pyro4.core import oneway
+import numpy
 from odemis import model
 import logging
+import os
 import pickle
+import shutil
+import tempfile
 import threading
 import time
 import unittest
@@ -295,6 +299,118 @@ class TestDataFlow(unittest.TestCase):
         
         self.assertEqual(self.left, 0)
 
-        
+
+class PartialFrameDataFlow(SimpleDataFlow):
+    # sends frames of 6x4 pixels by blocks of 2 lines
+    def _thread_main(self):
+        i = 0
+        while not self._thread_must_stop.is_set():
+            for offset in range(0, 6, 2):
+                if self._thread_must_stop.wait(0.02):
+                    break
+                data = numpy.full((2, 4), i * 10 + offset, dtype=numpy.uint16)
+                md = {"num": i, model.MD_LINE_OFFSET: offset, model.MD_FRAME_SHAPE: (6, 4)}
+                self.notify(model.DataArray(data, md))
+            i += 1
+        self._thread_must_stop.clear()
+
+
+class TestPartialFrames(unittest.TestCase):
+
+    def test_get(self):
+        """
+        get() returns a whole frame, even if the DataFlow sends blocks of lines
+        """
+        df = PartialFrameDataFlow()
+        self.blocks = []
+        df.subscribe(self.receive_block)
+        try:
+            time.sleep(0.05)  # Start in the middle of a frame
+            im = df.get()
+        finally:
+            df.unsubscribe(self.receive_block)
+
+        self.assertEqual(im.shape, (6, 4))
+        self.assertNotIn(model.MD_LINE_OFFSET, im.metadata)
+        self.assertNotIn(model.MD_FRAME_SHAPE, im.metadata)
+        i = im.metadata["num"]
+        numpy.testing.assert_array_equal(im[:, 0], [i * 10, i * 10, i * 10 + 2, i * 10 + 2,
+                                                    i * 10 + 4, i * 10 + 4])
+
+        # The subscribers received the blocks
+        self.assertGreater(len(self.blocks), 0)
+        for b in self.blocks:
+            self.assertEqual(b.shape, (2, 4))
+            self.assertIn(model.MD_LINE_OFFSET, b.metadata)
+
+    def receive_block(self, df, data):
+        self.blocks.append(data)
+
+
+class TestAllocateDataArray(unittest.TestCase):
+
+    def setUp(self):
+        self._orig_dir = model.getScratchDirectory()
+        self._orig_threshold = model.getMemmapThreshold()
+        self.scratch_dir = tempfile.mkdtemp()
+        model.setScratchDirectory(self.scratch_dir)
+        model.setMemmapThreshold(10000)
+
+    def tearDown(self):
+        model.setScratchDirectory(self._orig_dir)
+        model.setMemmapThreshold(self._orig_threshold)
+        shutil.rmtree(self.scratch_dir)
+
+    def test_small(self):
+        """
+        Small arrays are in RAM
+        """
+        da = model.allocateDataArray((10, 20), numpy.uint16, {"a": 1})
+        self.assertIsInstance(da, model.DataArray)
+        self.assertEqual(da.shape, (10, 20))
+        self.assertEqual(da.dtype, numpy.uint16)
+        self.assertEqual(da.metadata, {"a": 1})
+        self.assertFalse(da.any())
+
+    def test_big(self):
+        """
+        Big arrays are on disk, but behave like normal DataArrays
+        """
+        shape = (5, 100, 200)
+        da = model.allocateDataArray(shape, numpy.uint16, {"a": 1})
+        self.assertIsInstance(da, model.DataArray)
+        self.assertIsInstance(da.base.base, numpy.memmap)
+        self.assertEqual(da.shape, shape)
+        self.assertEqual(da.dtype, numpy.uint16)
+        self.assertEqual(da.metadata, {"a": 1})
+        self.assertFalse(da.any())
+        # The scratch file is already removed
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+        da[2, 10:20, :] = 5
+        self.assertEqual(da.sum(), 5 * 10 * 200)
+        sub = da[2]
+        del da
+        self.assertEqual(sub[15, 15], 5)
+
+        # Can be pickled (as a normal array)
+        da2 = pickle.loads(pickle.dumps(sub))
+        self.assertEqual(da2.metadata, {"a": 1})
+        numpy.testing.assert_array_equal(da2, sub)
+
+    def test_no_memmap(self):
+        """
+        With no threshold, the arrays are always in RAM
+        """
+        model.setMemmapThreshold(None)
+        da = model.allocateDataArray((200, 200), numpy.float64)
+        self.assertEqual(da.shape, (200, 200))
+        self.assertNotIsInstance(da.base.base, numpy.memmap)
+
+    def test_wrong_dir(self):
+        with self.assertRaises(ValueError):
+            model.setScratchDirectory(os.path.join(self.scratch_dir, "notexisting"))
+
+
 if __name__ == "__main__":
     unittest.main()
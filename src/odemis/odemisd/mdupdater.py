@@ -25,6 +25,113 @@ import collections
 import logging
 import numpy
 from odemis import model
+import threading
+import time
+
+
+# Number of latest updates used to compute the latency statistics
+LATENCY_HISTORY = 100
+
+
+class MetadataQueue(object):
+    """
+    Propagates the metadata updates to the components from a separate thread.
+    The updates to the same component are merged: if several updates are
+    queued before they can be applied, only the latest value of each metadata
+    is sent, in a single call to .updateMetadata().
+    This avoids blocking the thread notifying the VA (eg, the stage position),
+    and the updates piling up when they arrive faster than they can be sent.
+    """
+
+    def __init__(self, name="Metadata updater"):
+        self._cv = threading.Condition()
+        # str (component name) -> (Component, dict str->value, float: time of the first update)
+        self._pending = collections.OrderedDict()
+        self._busy = False  # True while an update is being applied
+        self._running = True
+
+        # Time between the (first) request and the actual update, in s
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.requested = 0  # number of updates requested
+        self.applied = 0  # number of calls to .updateMetadata()
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, comp, md):
+        """
+        Queue a metadata update
+        comp (Component): the component to update
+        md (dict str -> value): the metadata to update
+        """
+        with self._cv:
+            self.requested += 1
+            try:
+                pmd = self._pending[comp.name][1]
+                pmd.update(md)  # latest value wins
+            except KeyError:
+                self._pending[comp.name] = (comp, dict(md), time.time())
+                self._cv.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until all the queued updates have been applied
+        timeout (None or float): maximum time to wait, in s
+        return (bool): True if all the updates have been applied
+        """
+        tend = None if timeout is None else time.time() + timeout
+        with self._cv:
+            while self._pending or self._busy:
+                left = None if tend is None else tend - time.time()
+                if left is not None and left <= 0:
+                    return False
+                self._cv.wait(left)
+        return True
+
+    def get_latency(self):
+        """
+        return (float, float): average and maximum latency of the latest
+          updates, in s. (0, 0) if no update has been applied yet.
+        """
+        lats = list(self.latencies)
+        if not lats:
+            return 0, 0
+        return sum(lats) / len(lats), max(lats)
+
+    def _run(self):
+        try:
+            while True:
+                with self._cv:
+                    self._busy = False
+                    self._cv.notify_all()  # for flush()
+                    while self._running and not self._pending:
+                        self._cv.wait()
+                    if not self._pending:  # stopped, and everything sent
+                        return
+                    name, (comp, md, tstart) = self._pending.popitem(last=False)
+                    self._busy = True
+
+                try:
+                    comp.updateMetadata(md)
+                except Exception:
+                    logging.exception("Failed to update metadata of %s", name)
+                latency = time.time() - tstart
+                self.latencies.append(latency)
+                self.applied += 1
+                logging.debug("Updated metadata %s of %s after %g s",
+                              list(md.keys()), name, latency)
+        except Exception:
+            logging.exception("Failure in the metadata update thread")
+
+    def terminate(self):
+        """
+        Stop the thread, after applying all the queued updates
+        """
+        with self._cv:
+            self._running = False
+            self._cv.notify_all()
+        self._thread.join(10)
 
 
 class MetadataUpdater(model.Component):
@@ -57,6 +164,10 @@ class MetadataUpdater(model.Component):
         # str -> set of str: name of affecting component -> names of affected
         self._observed = collections.defaultdict(set)
 
+        # The updates are sent asynchronously, as VAs such as the stage position
+        # can change very often.
+        self._queue = MetadataQueue()
+
         microscope.alive.subscribe(self._onAlive, init=True)
 
     def _getComponent(self, name):
@@ -157,7 +268,7 @@ class MetadataUpdater(model.Component):
             md = {model.MD_POS: (x, y)}
             logging.debug("Updating position for component %s, to %f, %f",
                           comp_affected.name, x, y)
-            comp_affected.updateMetadata(md)
+            self._queue.put(comp_affected, md)
 
         stage.position.subscribe(updateStagePos, init=True)
         self._onTerminate.append((stage.position.unsubscribe, (updateStagePos,)))
@@ -171,7 +282,7 @@ class MetadataUpdater(model.Component):
 
         # update static information
         md = {model.MD_LENS_NAME: lens.hwVersion}
-        comp_affected.updateMetadata(md)
+        self._queue.put(comp_affected, md)
 
         # List of direct VA -> MD mapping
         md_va_list = {"numericalAperture": model.MD_LENS_NA,
@@ -216,7 +327,7 @@ class MetadataUpdater(model.Component):
                 mpp = (captor_mpp[0] * binning[0] / mag, captor_mpp[1] * binning[1] / mag)
                 md = {model.MD_PIXEL_SIZE: mpp,
                       model.MD_LENS_MAG: mag}
-                comp_affected.updateMetadata(md)
+                self._queue.put(comp_affected, md)
 
             lens.magnification.subscribe(updatePixelDensity, init=True)
             self._onTerminate.append((lens.magnification.unsubscribe, (updatePixelDensity,)))
@@ -236,7 +347,7 @@ class MetadataUpdater(model.Component):
                 pole_pos = lens.polePosition.value
                 pp = (pole_pos[0] / binning[0], pole_pos[1] / binning[1])
                 md = {model.MD_AR_POLE: pp}
-                comp_affected.updateMetadata(md)
+                self._queue.put(comp_affected, md)
 
             lens.polePosition.subscribe(updatePolePos, init=True)
             self._onTerminate.append((lens.polePosition.unsubscribe, (updatePolePos,)))
@@ -252,7 +363,7 @@ class MetadataUpdater(model.Component):
 
                 def updateMDFromVA(val, md_key=md_key, comp_affected=comp_affected):
                     md = {md_key: val}
-                    comp_affected.updateMetadata(md)
+                    self._queue.put(comp_affected, md)
 
                 logging.debug("Listening to VA %s.%s -> MD %s", lens.name, va_name, md_key)
                 va = getattr(lens, va_name)
@@ -277,7 +388,7 @@ class MetadataUpdater(model.Component):
                 wl_range = (0, 0)
 
             md = {model.MD_IN_WL: wl_range, model.MD_LIGHT_POWER: sum(power)}
-            comp_affected.updateMetadata(md)
+            self._queue.put(comp_affected, md)
 
         light.power.subscribe(updateLightPower, init=True)
         self._onTerminate.append((light.power.unsubscribe, (updateLightPower,)))
@@ -294,14 +405,14 @@ class MetadataUpdater(model.Component):
             def updateOutWLRange(pos, comp_affected=comp_affected):
                 wl = pos["wavelength"]
                 md = {model.MD_OUT_WL: (wl, wl)}
-                comp_affected.updateMetadata(md)
+                self._queue.put(comp_affected, md)
 
         else:
             def updateOutWLRange(pos, sp=spectrograph, comp_affected=comp_affected):
                 width = pos['slit-monochromator']
                 bandwidth = sp.getOpeningToWavelength(width)
                 md = {model.MD_OUT_WL: bandwidth}
-                comp_affected.updateMetadata(md)
+                self._queue.put(comp_affected, md)
 
         spectrograph.position.subscribe(updateOutWLRange, init=True)
         self._onTerminate.append((spectrograph.position.unsubscribe, (updateOutWLRange,)))
@@ -313,7 +424,7 @@ class MetadataUpdater(model.Component):
         # update any affected component
         def updateOutWLRange(pos, fl=filter, comp_affected=comp_affected):
             wl_out = fl.axes["band"].choices[pos["band"]]
-            comp_affected.updateMetadata({model.MD_OUT_WL: wl_out})
+            self._queue.put(comp_affected, {model.MD_OUT_WL: wl_out})
 
         filter.position.subscribe(updateOutWLRange, init=True)
         self._onTerminate.append((filter.position.unsubscribe, (updateOutWLRange,)))
@@ -325,7 +436,7 @@ class MetadataUpdater(model.Component):
         if model.hasVA(qwp, "position"):
             def updatePosition(pos, comp_affected=comp_affected):
                 md = {model.MD_POL_POS_QWP: pos["rz"]}
-                comp_affected.updateMetadata(md)
+                self._queue.put(comp_affected, md)
 
             qwp.position.subscribe(updatePosition, init=True)
             self._onTerminate.append((qwp.position.unsubscribe, (updatePosition,)))
@@ -337,7 +448,7 @@ class MetadataUpdater(model.Component):
         if model.hasVA(linpol, "position"):
             def updatePosition(pos, comp_affected=comp_affected):
                 md = {model.MD_POL_POS_LINPOL: pos["rz"]}
-                comp_affected.updateMetadata(md)
+                self._queue.put(comp_affected, md)
 
             linpol.position.subscribe(updatePosition, init=True)
             self._onTerminate.append((linpol.position.unsubscribe, (updatePosition,)))
@@ -349,7 +460,7 @@ class MetadataUpdater(model.Component):
         if model.hasVA(analyzer, "position"):
             def updatePosition(pos, comp_affected=comp_affected):
                 md = {model.MD_POL_MODE: pos["pol"]}
-                comp_affected.updateMetadata(md)
+                self._queue.put(comp_affected, md)
 
             analyzer.position.subscribe(updatePosition, init=True)
             self._onTerminate.append((analyzer.position.unsubscribe, (updatePosition,)))
@@ -365,7 +476,7 @@ class MetadataUpdater(model.Component):
 
         def updateMagnification(mag, comp_affected=comp_affected):
             md = {model.MD_LENS_MAG: mag}
-            comp_affected.updateMetadata(md)
+            self._queue.put(comp_affected, md)
 
         streak_lens.magnification.subscribe(updateMagnification, init=True)
         self._onTerminate.append((streak_lens.magnification.unsubscribe, (updateMagnification,)))
@@ -382,4 +493,9 @@ class MetadataUpdater(model.Component):
             except Exception as ex:
                 logging.warning("Failed to unsubscribe metadata properly: %s", ex)
 
+        self._queue.terminate()
+        lat_avg, lat_max = self._queue.get_latency()
+        logging.debug("Metadata updates: %d requested, %d applied, latency avg = %g s, max = %g s",
+                      self._queue.requested, self._queue.applied, lat_avg, lat_max)
+
         model.Component.terminate(self)
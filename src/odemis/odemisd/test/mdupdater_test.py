@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+from __future__ import division
+
+import logging
+from odemis.odemisd.mdupdater import MetadataQueue
+import threading
+import time
+import unittest
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+
+class FakeComponent(object):
+    """
+    Just records the metadata updates, and takes some time to do it, like a
+    remote call.
+    """
+
+    def __init__(self, name, delay=0.01):
+        self.name = name
+        self.delay = delay
+        self.updates = []
+        self.metadata = {}
+        self.lock = threading.Lock()
+
+    def updateMetadata(self, md):
+        time.sleep(self.delay)
+        with self.lock:
+            self.updates.append(md)
+            self.metadata.update(md)
+
+
+class TestMetadataQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = MetadataQueue()
+
+    def tearDown(self):
+        self.queue.terminate()
+
+    def test_simple(self):
+        comp = FakeComponent("ccd")
+        self.queue.put(comp, {"Pos": (1, 2)})
+        self.assertTrue(self.queue.flush(1))
+        self.assertEqual(comp.metadata, {"Pos": (1, 2)})
+        self.assertEqual(self.queue.applied, 1)
+        lat_avg, lat_max = self.queue.get_latency()
+        self.assertGreater(lat_avg, 0)
+        self.assertGreaterEqual(lat_max, lat_avg)
+
+    def test_coalesce(self):
+        """
+        Many updates in a row should be merged, with the latest value winning
+        """
+        ccd = FakeComponent("ccd", delay=0.1)
+        sed = FakeComponent("sed", delay=0.1)
+        n = 100
+        tstart = time.time()
+        for i in range(n):
+            self.queue.put(ccd, {"Pos": (i, 0)})
+            self.queue.put(sed, {"Pos": (i, 0)})
+            if i == n // 2:
+                self.queue.put(ccd, {"Mag": 10})
+        dur = time.time() - tstart
+        # Queuing must not block on the updates
+        self.assertLess(dur, 0.1)
+
+        self.assertTrue(self.queue.flush(5))
+        for c in (ccd, sed):
+            self.assertEqual(c.metadata["Pos"], (n - 1, 0))
+            self.assertLess(len(c.updates), 4)
+        self.assertEqual(ccd.metadata["Mag"], 10)
+        self.assertEqual(self.queue.requested, 2 * n + 1)
+        self.assertLess(self.queue.applied, 2 * n)
+
+    def test_failure(self):
+        """
+        An error while updating a component shouldn't stop the other updates
+        """
+        class BrokenComponent(FakeComponent):
+            def updateMetadata(self, md):
+                raise IOError("Connection lost")
+
+        broken = BrokenComponent("broken")
+        comp = FakeComponent("ccd")
+        self.queue.put(broken, {"Pos": (1, 2)})
+        self.queue.put(comp, {"Pos": (1, 2)})
+        self.assertTrue(self.queue.flush(1))
+        self.assertEqual(comp.metadata, {"Pos": (1, 2)})
+
+    def test_terminate(self):
+        """
+        The updates queued are still applied when terminating
+        """
+        comp = FakeComponent("ccd", delay=0.1)
+        self.queue.put(comp, {"Pos": (1, 2)})
+        self.queue.put(FakeComponent("sed"), {"Pos": (1, 2)})
+        self.queue.put(comp, {"Mag": 3})
+        self.queue.terminate()
+        self.assertEqual(comp.metadata, {"Pos": (1, 2), "Mag": 3})
+
+
+if __name__ == "__main__":
+    unittest.main()
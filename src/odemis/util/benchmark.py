@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 19 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not,
+see http://www.gnu.org/licenses/.
+
+"""
+# Helper functions to measure the throughput of the data path, from the
+# drivers to the DataFlows, the streams, the projections and the export.
+# See scripts/benchmark.py to run the whole benchmark on a (simulated) microscope.
+
+from __future__ import division
+
+import json
+import logging
+import numpy
+from odemis import model
+import os
+import tempfile
+import threading
+import time
+
+
+# Version of the report format
+REPORT_VERSION = 1
+
+# Name of the statistics for which a higher value is better. All the other
+# statistics (durations, latencies, CPU, memory...) are better when lower.
+HIGHER_IS_BETTER = {"fps", "pixels_per_s", "bytes_per_s"}
+
+# Statistics which are not compared between reports (ie, just informative)
+NOT_COMPARED = {"frames", "bytes", "elapsed"}
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _percentiles(values):
+    """
+    values (list of floats)
+    return (dict str -> float): the median, 90th, 99th percentiles and maximum
+      of the values. Empty if no values.
+    """
+    if not values:
+        return {}
+    p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99),
+            "max": float(max(values))}
+
+
+class FrameRecorder(object):
+    """
+    Records the reception of frames (DataArrays), to compute the frame rate and
+    the latency.
+    The latency is the time between the beginning of the acquisition
+    (MD_ACQ_DATE) and the reception of the frame. So it includes the exposure
+    time (or scanning time).
+    It can be directly subscribed to a DataFlow (with .on_data()) or to a
+    VigilantAttribute containing an image (with .on_image()).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._start = time.time()
+            self._times = []  # s, reception time of each frame
+            self._latencies = []  # s
+            self._pixels = 0
+
+    def add(self, data):
+        """
+        Record the reception of a frame
+        data (DataArray): the frame received
+        """
+        now = time.time()
+        with self._lock:
+            self._times.append(now)
+            self._pixels += data.size
+            try:
+                self._latencies.append(now - data.metadata[model.MD_ACQ_DATE])
+            except (AttributeError, KeyError):
+                pass  # No metadata, or no acquisition date => no latency
+
+    def on_data(self, df, data):
+        """ To be subscribed to a DataFlow """
+        self.add(data)
+
+    def on_image(self, image):
+        """ To be subscribed to a VigilantAttribute containing an image """
+        if image is not None:
+            self.add(image)
+
+    def get_stats(self):
+        """
+        return (dict str -> value): the statistics since the last reset
+          frames (int): number of frames received
+          elapsed (float): time since the last reset (s)
+          fps (float): number of frames received per second
+          pixels_per_s (float): number of pixels received per second
+          latency (dict str -> float): percentiles of the latency (s)
+        """
+        with self._lock:
+            dur = time.time() - self._start
+            n = len(self._times)
+            stats = {"frames": n,
+                     "elapsed": dur,
+                     "fps": n / dur if dur > 0 else 0,
+                     "pixels_per_s": self._pixels / dur if dur > 0 else 0,
+                     }
+            lat = _percentiles(self._latencies)
+            if lat:
+                stats["latency"] = lat
+
+        return stats
+
+
+def find_backend_pids():
+    """
+    Find the processes of the back-end (main process and containers)
+    Note: only supported on Linux
+    return (list of int): the PIDs
+    """
+    pids = []
+    for p in os.listdir("/proc"):
+        if not p.isdigit():
+            continue
+        try:
+            with open("/proc/%s/cmdline" % p, "rb") as f:
+                cmdline = f.read().decode("utf-8", "replace")
+        except IOError:  # Process just ended
+            continue
+        if "odemisd" in cmdline or "odemis-start" in cmdline:
+            pids.append(int(p))
+    return pids
+
+
+def _read_proc_usage(pid):
+    """
+    Read the CPU time and memory usage of a process
+    pid (int)
+    return (float, int): CPU time (user + system) in s, and RSS in bytes
+    raises IOError: if the process doesn't exist (anymore)
+    """
+    with open("/proc/%d/stat" % pid) as f:
+        # The process name (2nd field) might contain spaces, so skip it
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime are the 14th and 15th fields (counting from 1)
+    cpu = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    with open("/proc/%d/statm" % pid) as f:
+        rss = int(f.read().split()[1]) * _PAGE_SIZE
+    return cpu, rss
+
+
+class ProcessMonitor(object):
+    """
+    Samples regularly the CPU usage and memory (RSS) of a set of processes, in
+    a separate thread.
+    Note: only supported on Linux
+    """
+
+    def __init__(self, pids=None, period=0.5):
+        """
+        pids (None or list of int): the processes to monitor. If None, the
+          current process and the back-end processes are monitored.
+        period (float): time between two samples (s)
+        """
+        if pids is None:
+            pids = {os.getpid()} | set(find_backend_pids())
+        self.pids = sorted(pids)
+        self.period = period
+        self._stop = threading.Event()
+        self._thread = None
+        self._cpu = []  # %, sum of all the processes
+        self._rss = []  # bytes, sum of all the processes
+
+    def _sample(self):
+        """
+        return (float, int): the total CPU time (s) and memory used (B)
+        """
+        tot_cpu, tot_rss = 0, 0
+        for p in self.pids:
+            try:
+                cpu, rss = _read_proc_usage(p)
+            except (IOError, OSError, IndexError, ValueError):
+                continue  # Process ended
+            tot_cpu += cpu
+            tot_rss += rss
+        return tot_cpu, tot_rss
+
+    def _run(self):
+        try:
+            prev_cpu, rss = self._sample()
+            prev_t = time.time()
+            self._rss.append(rss)
+            while not self._stop.wait(self.period):
+                cpu, rss = self._sample()
+                now = time.time()
+                self._cpu.append(100 * (cpu - prev_cpu) / (now - prev_t))
+                self._rss.append(rss)
+                prev_cpu, prev_t = cpu, now
+        except Exception:
+            logging.exception("Failed to monitor the processes")
+
+    def start(self):
+        self._stop.clear()
+        self._cpu = []
+        self._rss = []
+        self._thread = threading.Thread(target=self._run, name="Process monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(10)
+            self._thread = None
+
+    def get_stats(self):
+        """
+        return (dict str -> dict str -> float):
+          cpu: mean and max CPU usage (in %, 100% = 1 core fully used)
+          rss: mean and max memory used (B)
+        """
+        stats = {}
+        if self._cpu:
+            stats["cpu"] = {"mean": float(numpy.mean(self._cpu)), "max": float(max(self._cpu))}
+        if self._rss:
+            stats["rss"] = {"mean": float(numpy.mean(self._rss)), "max": float(max(self._rss))}
+        return stats
+
+
+def measure_dataflow(df, duration):
+    """
+    Measure the frame rate and latency of a DataFlow
+    df (DataFlow): the DataFlow to subscribe to
+    duration (float): time to acquire (s)
+    return (dict): the statistics (see FrameRecorder.get_stats())
+    """
+    recorder = FrameRecorder()
+    df.subscribe(recorder.on_data)
+    try:
+        time.sleep(duration)
+    finally:
+        df.unsubscribe(recorder.on_data)
+    return recorder.get_stats()
+
+
+def measure_live_stream(stream, duration):
+    """
+    Measure the frame rate and latency of a live stream, both for the raw data
+    received from the detector and the images projected.
+    stream (LiveStream): the stream to play
+    duration (float): time to play the stream (s)
+    return (dict str -> dict): "raw" and "projected" statistics (see
+      FrameRecorder.get_stats())
+    """
+    raw_rec = FrameRecorder()
+    proj_rec = FrameRecorder()
+    # The stream subscribes to the same DataFlow
+    stream._dataflow.subscribe(raw_rec.on_data)
+    stream.image.subscribe(proj_rec.on_image)
+    stream.should_update.value = True
+    stream.is_active.value = True
+    try:
+        time.sleep(duration)
+    finally:
+        stream.is_active.value = False
+        stream.should_update.value = False
+        stream.image.unsubscribe(proj_rec.on_image)
+        stream._dataflow.unsubscribe(raw_rec.on_data)
+
+    return {"raw": raw_rec.get_stats(), "projected": proj_rec.get_stats()}
+
+
+def measure_acquisition(stream, n=1):
+    """
+    Measure the duration of an acquisition, such as of a SEMCCDMDStream
+    stream (Stream): the stream to acquire
+    n (int): number of acquisitions to run
+    return (dict str -> value), list of DataArrays): statistics, and the data of
+      the last acquisition.
+      frames (int): number of acquisitions
+      duration (dict): percentiles of the duration of each acquisition (s)
+      pixels_per_s (float): number of pixels acquired per second
+    """
+    durations = []
+    pixels = 0
+    data = []
+    for i in range(n):
+        start = time.time()
+        f = stream.acquire()
+        ret = f.result()
+        durations.append(time.time() - start)
+        # Some streams also return the exception
+        data = ret[0] if isinstance(ret, tuple) else ret
+        pixels += sum(d.size for d in data)
+
+    stats = {"frames": n,
+             "duration": _percentiles(durations),
+             "pixels_per_s": pixels / sum(durations)}
+    return stats, data
+
+
+def measure_export(data, exporter, n=1):
+    """
+    Measure the speed of exporting data to a file
+    data (list of DataArrays): the data to export
+    exporter (module): the dataio converter to use
+    n (int): number of exports to run
+    return (dict str -> value): statistics
+      bytes (int): size of the file
+      duration (dict): percentiles of the duration of each export (s)
+      bytes_per_s (float): amount of data (in memory) exported per second
+    """
+    durations = []
+    size = 0
+    with tempfile.NamedTemporaryFile(suffix=exporter.EXTENSIONS[0]) as f:
+        fn = f.name
+    try:
+        for i in range(n):
+            start = time.time()
+            exporter.export(fn, data)
+            durations.append(time.time() - start)
+            size = os.path.getsize(fn)
+    finally:
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+    mem_size = sum(d.nbytes for d in data)
+    return {"bytes": size,
+            "duration": _percentiles(durations),
+            "bytes_per_s": mem_size * n / sum(durations)}
+
+
+def make_report(results, process_stats=None, **info):
+    """
+    Creates a benchmark report
+    results (dict str -> dict): the statistics of each benchmark
+    process_stats (None or dict): the statistics of the ProcessMonitor
+    info (str -> value): extra information to store (eg, the configuration)
+    return (dict): the report, which can be serialized to JSON
+    """
+    report = {"version": REPORT_VERSION,
+              "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "results": results,
+              }
+    if process_stats is not None:
+        report["process"] = process_stats
+    report.update(info)
+    return report
+
+
+def write_report(report, filename):
+    """
+    Saves a report as a JSON file
+    """
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def read_report(filename):
+    """
+    Loads a report from a JSON file
+    """
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _flatten(stats, prefix=()):
+    """
+    return (dict tuple of str -> float): the numerical statistics, with their
+      path in the dicts as key
+    """
+    flat = {}
+    for k, v in stats.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + (k,)))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[prefix + (k,)] = v
+    return flat
+
+
+def compare_reports(report, baseline, tolerance=0.2):
+    """
+    Compare the results of a report to the ones of a previous report
+    report (dict): the new report
+    baseline (dict): the reference report
+    tolerance (0 <= float): relative change accepted before considering it a
+      regression
+    return (list of (str, float, float)): for each regression: the name of the
+      statistic, the baseline value, and the new value
+    """
+    new = _flatten({"results": report["results"], "process": report.get("process", {})})
+    ref = _flatten({"results": baseline["results"], "process": baseline.get("process", {})})
+
+    regressions = []
+    for key in sorted(set(new) & set(ref)):
+        # Use the name of the statistic, or of the group for the percentiles
+        names = set(key[-2:])
+        if names & NOT_COMPARED:
+            continue
+        vnew, vref = new[key], ref[key]
+        if names & HIGHER_IS_BETTER:
+            regressed = vnew < vref * (1 - tolerance)
+        else:
+            regressed = vnew > vref * (1 + tolerance)
+        if regressed:
+            regressions.append(("/".join(key), vref, vnew))
+
+    return regressions
@@ -22,13 +22,22 @@ see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from concurrent import futures
 import logging
 import numpy
 from odemis import dataio
 from odemis import model
 from odemis.acq import stream
 from odemis.model import MD_WL_LIST, MD_WL_POLYNOMIAL, MD_TIME_LIST
+from odemis.util import bindFuture
 import os
+import threading
+import time
+
+
+# Initial guess of the speed of exporting data (compression + writing), in
+# bytes/s. It is updated after every export with the actual speed.
+EXPORT_SPEED = 50e6  # B/s
 
 
 def data_to_static_streams(data):
@@ -232,3 +241,109 @@ def splitext(path):
 
     root = path[:len(path) - len(ext)]
     return root, ext
+
+
+class ExportService(object):
+    """
+    Exports data to files in the background, so that the caller (eg, the
+    acquisition controller) doesn't have to wait for the data to be compressed
+    and written, which can take a long time on large acquisitions. Several
+    files are exported simultaneously, each on a separate thread.
+    """
+
+    def __init__(self, max_workers=2):
+        """
+        max_workers (int > 0): maximum number of files exported simultaneously
+        """
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._speed = EXPORT_SPEED  # B/s, updated after every export
+        self._lock = threading.Lock()  # To protect ._pending
+        self._pending = set()  # ProgressiveFutures not yet finished
+
+    @property
+    def pending(self):
+        """
+        (int): the number of exports queued or running
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def estimateExportTime(self, data):
+        """
+        data (list of DataArray or DataArrayShadow): data to export
+        return (0 <= float): the estimated time to export the data, in s
+        """
+        return sum(_get_data_size(d) for d in data) / self._speed
+
+    def export(self, filename, data, thumbnail=None, exporter=None):
+        """
+        Export the data to a file, in the background.
+        filename (str): path of the file to write
+        data (list of DataArray or DataArrayShadow): data to export. The
+          DataArrayShadows are loaded in the background too.
+        thumbnail (None or DataArray): thumbnail to store with the data
+        exporter (module or None): dataio converter to use. If None, it is
+          guessed from the filename.
+        return (ProgressiveFuture): represents the export. The result is the
+          filename, once it is fully written. It can only be cancelled before
+          the writing starts.
+        """
+        if exporter is None:
+            exporter = dataio.find_fittest_converter(filename)
+        data = list(data)
+
+        now = time.time()
+        f = model.ProgressiveFuture(start=now, end=now + self.estimateExportTime(data))
+        with self._lock:
+            self._pending.add(f)
+        f.add_done_callback(self._on_export_done)
+        self._executor.submit(bindFuture, f, self._run_export,
+                              (f, filename, data, thumbnail, exporter))
+        return f
+
+    def _on_export_done(self, f):
+        with self._lock:
+            self._pending.discard(f)
+
+    def _run_export(self, future, filename, data, thumbnail, exporter):
+        size = sum(_get_data_size(d) for d in data)
+        startt = time.time()
+        future.set_progress(start=startt, end=startt + size / self._speed)
+
+        # Loading the whole data can take a while too
+        data = [d.getData() if isinstance(d, model.DataArrayShadow) else d for d in data]
+        exporter.export(filename, data, thumbnail)
+
+        dur = time.time() - startt
+        logging.info(u"Data exported to '%s' in %g s", filename, dur)
+        if size and dur > 0.1:  # Short exports are not representative
+            # Smooth the estimation, as it varies a lot depending on the format
+            # and the data.
+            self._speed = (self._speed + size / dur) / 2
+        return filename
+
+    def wait(self, timeout=None):
+        """
+        Wait until all the exports queued are over
+        timeout (None or float): maximum time to wait, in s
+        return (bool): True if all the exports are over, False if it timed out
+        """
+        with self._lock:
+            fs = list(self._pending)
+        done, not_done = futures.wait(fs, timeout=timeout)
+        return not not_done
+
+    def shutdown(self, wait=True):
+        """
+        Stop the service. No export can be requested afterwards.
+        wait (bool): if True, blocks until all the exports are over
+        """
+        self._executor.shutdown(wait=wait)
+
+
+def _get_data_size(d):
+    """
+    d (DataArray or DataArrayShadow)
+    return (int): the size of the (uncompressed) data, in bytes
+    """
+    return int(numpy.prod(d.shape)) * numpy.dtype(d.dtype).itemsize
@@ -32,6 +32,11 @@ E_CHARGE = 1.602e-19  # J --> eV
 WL_TO_ENERGY = H_PLANK * C_LIGHT / E_CHARGE
 WIDTH_RATIO = 0.01
 
+# For fitting all the spectra of a map
+MAP_FIT_MAX_ITER = 100  # Maximum number of iterations of the Levenberg-Marquardt algorithm
+MAP_FIT_TOLERANCE = 1e-8  # Relative decrease of the residuals to consider the fitting converged
+MAP_FIT_CHUNK_SIZE = 4 * 1024 ** 2  # Max number of values (spectra x points x parameters) fitted at once
+
 # TODO: this code is full of reliance on numpy being quite lax with wrong
 # computation, and easily triggers numpy warnings. To force numpy to be
 # stricter:
@@ -203,6 +208,107 @@ def Detect(y_vector, x_vector=None, lookahead=5, delta=0):
     return maxtab, mintab
 
 
+def _peak_curves(x, params, offset_basis, lorentzian):
+    """
+    Computes the curves of many sets of peak parameters at once, and their
+    Jacobian.
+    x (1d array of floats of length C): position of each point of the curve
+    params (2d array of floats of shape NK): for each curve, the pos, width,
+      amplitude of each peak, followed by the offset
+    offset_basis (1d array of floats of length C): contribution of the offset
+      on each point of the curve
+    lorentzian (bool): if True, the peaks are lorentzian, otherwise gaussian
+    returns:
+      curves (2d array of floats of shape NC)
+      jac (3d array of floats of shape NCK): derivative of each point of the
+        curves for each parameter
+    """
+    n, k = params.shape
+    curves = params[:, -1:] * offset_basis
+    jac = numpy.empty((n, len(x), k))
+    jac[:, :, -1] = offset_basis
+    for i in range(0, k - 1, 3):
+        pos, width, amplitude = params[:, i:i + 1], params[:, i + 1:i + 2], params[:, i + 2:i + 3]
+        d = x - pos
+        if lorentzian:
+            den = d ** 2 + width ** 2
+            shape = width ** 2 / den
+            jac[:, :, i] = amplitude * 2 * d * width ** 2 / den ** 2
+            jac[:, :, i + 1] = amplitude * 2 * width * d ** 2 / den ** 2
+        else:
+            shape = numpy.exp(-d ** 2 / (2 * width ** 2))
+            jac[:, :, i] = amplitude * shape * d / width ** 2
+            jac[:, :, i + 1] = amplitude * shape * d ** 2 / width ** 3
+        jac[:, :, i + 2] = shape
+        curves += amplitude * shape
+    return curves, jac
+
+
+def _FitCurvesLM(x, spectra, params, offset_basis, lorentzian,
+                 max_iter=MAP_FIT_MAX_ITER, tol=MAP_FIT_TOLERANCE):
+    """
+    Least-squares fitting of the peaks on many spectra at once, following the
+    Levenberg-Marquardt algorithm (independently for each spectrum).
+    x (1d array of floats of length C): position of each point of the spectra
+    spectra (2d array of floats of shape NC): the spectra to fit
+    params (2d array of floats of shape NK): initial parameters of each
+      spectrum, as pos, width, amplitude of each peak, followed by the offset.
+      It is updated with the fitted parameters.
+    offset_basis (1d array of floats of length C): contribution of the offset
+      on each point of the spectra
+    lorentzian (bool): if True, the peaks are lorentzian, otherwise gaussian
+    max_iter (int): maximum number of iterations
+    tol (float): relative decrease of the cost under which the fitting is
+      considered converged
+    returns (1d array of floats of length N): the sum of the squared residuals
+      of each spectrum
+    """
+    n, k = params.shape
+    diag_idx = numpy.arange(k)
+    damping = numpy.full(n, 1e-3)
+    curves, jac = _peak_curves(x, params, offset_basis, lorentzian)
+    res = spectra - curves
+    cost = (res ** 2).sum(axis=1)
+    active = numpy.isfinite(cost)
+
+    for i in range(max_iter):
+        idx = numpy.flatnonzero(active)
+        if not idx.size:
+            break
+        j = jac[idx]
+        jtj = numpy.einsum("nck,ncl->nkl", j, j)
+        jtr = numpy.einsum("nck,nc->nk", j, res[idx])
+        # Marquardt damping, scaled by the diagonal (with a tiny bit of
+        # regularisation, to avoid singular matrices)
+        diag = jtj[:, diag_idx, diag_idx]
+        jtj[:, diag_idx, diag_idx] += (damping[idx, None] * diag +
+                                       1e-12 * diag.max(axis=1, keepdims=True))
+        try:
+            delta = numpy.linalg.solve(jtj, jtr[:, :, None])[:, :, 0]
+        except numpy.linalg.LinAlgError:
+            delta = numpy.einsum("nkl,nl->nk", numpy.linalg.pinv(jtj), jtr)
+
+        new_params = params[idx] + delta
+        new_curves, new_jac = _peak_curves(x, new_params, offset_basis, lorentzian)
+        new_res = spectra[idx] - new_curves
+        new_cost = (new_res ** 2).sum(axis=1)
+
+        better = new_cost < cost[idx]  # NaN is never better
+        converged = better & (cost[idx] - new_cost <= tol * cost[idx])
+        ib = idx[better]
+        params[ib] = new_params[better]
+        res[ib] = new_res[better]
+        jac[ib] = new_jac[better]
+        cost[ib] = new_cost[better]
+        damping[ib] /= 10
+        damping[idx[~better]] *= 10
+        # Stop if converged, or if no improvement can be found anymore
+        active[idx[converged]] = False
+        active[damping > 1e10] = False
+
+    return cost
+
+
 class PeakFitter(object):
     def __init__(self):
         # will take care of executing peak fitting asynchronously
@@ -255,96 +361,219 @@ class PeakFitter(object):
                 ValueError if fitting cannot be applied
         """
         try:
-            # values based on experimental datasets
-            if len(wavelength) >= 2000:
-                divider = 20
-            elif len(wavelength) >= 1000:
-                divider = 25
-            else:
-                divider = 30
-            init_window_size = max(3, len(wavelength) // divider)
-            window_size = init_window_size
-            logging.debug("Starting peak detection on data (len = %d) with window = %d",
-                          len(wavelength), window_size)
-            try:
-                wl_rng = wavelength[-1] - wavelength[0]
-                width = wl_rng * WIDTH_RATIO  # initial peak width estimation
-                FitFunction = PEAK_FUNCTIONS[type]
-            except KeyError:
-                raise KeyError("Given type %s not in available fitting types: %s" % (type, list(PEAK_FUNCTIONS.keys())))
-            for step in range(5):
+            peaks_params, offset = self._fitSpectrum(future, spectrum, wavelength, type)
+            return peaks_params, offset, type
+        except CancelledError:
+            logging.debug("Fitting of type %s was cancelled.", type)
+        finally:
+            with future._fit_lock:
                 if future._fit_state == CANCELLED:
                     raise CancelledError()
-                smoothed = Smooth(spectrum, window_len=window_size)
-                # Increase window size until peak detection finds enough peaks to fit
-                # the spectrum curve
-                peaks = Detect(smoothed, wavelength, lookahead=window_size, delta=5)[0]
-                if not peaks:
-                    window_size = int(round(window_size * 1.2))
-                    logging.debug("Retrying to fit peak with window = %d", window_size)
-                    continue
-
-                fit_list = []
-                lower_bounds = []
-                upper_bounds = []
-                for (pos, amplitude) in peaks:
+                future._fit_state = FINISHED
+
+    def _fitSpectrum(self, future, spectrum, wavelength, type):
+        """
+        Fits the peaks of one spectrum. See _DoFit() for the arguments.
+        returns:
+             params (list of 3-tuple): Each peak parameters as (pos, width, amplitude)
+             offset (float): global offset to add
+        raises:
+                CancelledError if the future is cancelled
+                KeyError if given type not available
+                ValueError if fitting cannot be applied
+        """
+        # values based on experimental datasets
+        if len(wavelength) >= 2000:
+            divider = 20
+        elif len(wavelength) >= 1000:
+            divider = 25
+        else:
+            divider = 30
+        init_window_size = max(3, len(wavelength) // divider)
+        window_size = init_window_size
+        logging.debug("Starting peak detection on data (len = %d) with window = %d",
+                      len(wavelength), window_size)
+        try:
+            wl_rng = wavelength[-1] - wavelength[0]
+            width = wl_rng * WIDTH_RATIO  # initial peak width estimation
+            FitFunction = PEAK_FUNCTIONS[type]
+        except KeyError:
+            raise KeyError("Given type %s not in available fitting types: %s" % (type, list(PEAK_FUNCTIONS.keys())))
+        for step in range(5):
+            if future._fit_state == CANCELLED:
+                raise CancelledError()
+            smoothed = Smooth(spectrum, window_len=window_size)
+            # Increase window size until peak detection finds enough peaks to fit
+            # the spectrum curve
+            peaks = Detect(smoothed, wavelength, lookahead=window_size, delta=5)[0]
+            if not peaks:
+                window_size = int(round(window_size * 1.2))
+                logging.debug("Retrying to fit peak with window = %d", window_size)
+                continue
+
+            fit_list = []
+            lower_bounds = []
+            upper_bounds = []
+            for (pos, amplitude) in peaks:
+                if type in {'gaussian_energy', 'lorentzian_energy'}:
+                    energy = apply_jacobian_x(wavelength)
+                    spectra_energy = apply_jacobian_y(wavelength, spectrum)
+                    fit_list.extend(peak_to_energy(pos, width, amplitude))
+                    # lower & upper bounds for center position, width, amplitude in energy domain
+                    en_rng = energy[0] - energy[-1]
+                    lower_bounds.extend([energy[-1] - en_rng / 2, en_rng / 1e4, 0])
+                    upper_bounds.extend([energy[0] + en_rng / 2, en_rng * 10, numpy.inf])
+                else:
+                    # lower & upper bounds for center position, width, amplitude in space domain
+                    fit_list.extend([pos, width, amplitude])
+                    lower_bounds.extend([wavelength[0] - wl_rng / 2, wl_rng / 1e3, 0])
+                    upper_bounds.extend([wavelength[-1] + wl_rng / 2, wl_rng * 10, numpy.inf])
+
+            # Initialize the offset with the minimum possible value
+            offset = 0
+            fit_list.append(offset)
+            # Set the lower & upper bounds for the offset
+            lower_bounds.extend([0])
+            upper_bounds.extend([min(spectrum)])
+            param_bounds = (lower_bounds, upper_bounds)
+
+            if future._fit_state == CANCELLED:
+                raise CancelledError()
+
+            try:
+                with warnings.catch_warnings():
+                    # Hide scipy/optimize/minpack.py:690: OptimizeWarning: Covariance of the parameters could not be estimated
+                    warnings.filterwarnings("ignore", "", OptimizeWarning)
+                    # TODO, from scipy 0.17, curve_fit() supports the 'bounds' parameter.
+                    # It could be used to ensure the peaks params are positives.
+                    # (Once we don't support Ubuntu 12.04)
                     if type in {'gaussian_energy', 'lorentzian_energy'}:
-                        energy = apply_jacobian_x(wavelength)
-                        spectra_energy = apply_jacobian_y(wavelength, spectrum)
-                        fit_list.extend(peak_to_energy(pos, width, amplitude))
-                        # lower & upper bounds for center position, width, amplitude in energy domain
-                        en_rng = energy[0] - energy[-1]
-                        lower_bounds.extend([energy[-1] - en_rng / 2, en_rng / 1e4, 0])
-                        upper_bounds.extend([energy[0] + en_rng / 2, en_rng * 10, numpy.inf])
+                        params, _ = curve_fit(FitFunction, energy, spectra_energy, p0=fit_list, bounds=param_bounds)
                     else:
-                        # lower & upper bounds for center position, width, amplitude in space domain
-                        fit_list.extend([pos, width, amplitude])
-                        lower_bounds.extend([wavelength[0] - wl_rng / 2, wl_rng / 1e3, 0])
-                        upper_bounds.extend([wavelength[-1] + wl_rng / 2, wl_rng * 10, numpy.inf])
-
-                # Initialize the offset with the minimum possible value
-                offset = 0
-                fit_list.append(offset)
-                # Set the lower & upper bounds for the offset
-                lower_bounds.extend([0])
-                upper_bounds.extend([min(spectrum)])
-                param_bounds = (lower_bounds, upper_bounds)
+                        params, _ = curve_fit(FitFunction, wavelength, spectrum, p0=fit_list, bounds=param_bounds)
+                break
+            except Exception as ex:
+                window_size = int(round(window_size * 1.2))
+                logging.debug("Retrying to fit peak with window = %d due to error %s", window_size, ex)
+                continue
+        else:
+            raise ValueError("Could not apply peak fitting of type %s." % type)
+        # reformat parameters to (list of 3 tuples, offset)
+        peaks_params = []
+        for pos, width, amplitude in _Grouped(params[:-1], 3):
+            # Note: to avoid negative peaks, the fit functions only take the
+            # absolute of the amplitude/width. So now amplitude and width
+            # have 50% chances to be negative => Force positive now.
+            if type in {'gaussian_energy', 'lorentzian_energy'}:
+                peaks_params.append(peak_to_wavelength(pos, width, amplitude))
+            else:
+                peaks_params.append((pos, width, amplitude))
 
-                if future._fit_state == CANCELLED:
-                    raise CancelledError()
+        return peaks_params, params[-1]
 
-                try:
-                    with warnings.catch_warnings():
-                        # Hide scipy/optimize/minpack.py:690: OptimizeWarning: Covariance of the parameters could not be estimated
-                        warnings.filterwarnings("ignore", "", OptimizeWarning)
-                        # TODO, from scipy 0.17, curve_fit() supports the 'bounds' parameter.
-                        # It could be used to ensure the peaks params are positives.
-                        # (Once we don't support Ubuntu 12.04)
-                        if type in {'gaussian_energy', 'lorentzian_energy'}:
-                            params, _ = curve_fit(FitFunction, energy, spectra_energy, p0=fit_list, bounds=param_bounds)
-                        else:
-                            params, _ = curve_fit(FitFunction, wavelength, spectrum, p0=fit_list, bounds=param_bounds)
-                    break
-                except Exception as ex:
-                    window_size = int(round(window_size * 1.2))
-                    logging.debug("Retrying to fit peak with window = %d due to error %s", window_size, ex)
-                    continue
-            else:
-                raise ValueError("Could not apply peak fitting of type %s." % type)
-            # reformat parameters to (list of 3 tuples, offset)
-            peaks_params = []
-            for pos, width, amplitude in _Grouped(params[:-1], 3):
-                # Note: to avoid negative peaks, the fit functions only take the
-                # absolute of the amplitude/width. So now amplitude and width
-                # have 50% chances to be negative => Force positive now.
-                if type in {'gaussian_energy', 'lorentzian_energy'}:
-                    peaks_params.append(peak_to_wavelength(pos, width, amplitude))
-                else:
-                    peaks_params.append((pos, width, amplitude))
+    def FitMap(self, data, wavelength, type='gaussian_space'):
+        """
+        Fits the peaks of every spectrum of a spectrum cube. The peaks are
+        detected on the average spectrum, and then the parameters are fitted
+        for all the spectra, many at once.
+        Note: it runs on the same executor as Fit(), so a Fit() requested while
+        a map is being fitted will only start after the map is done.
+        data (ndarray of shape C...): the spectra, along the first dimension
+          (eg, CYX or C11YX)
+        wavelength (1d array of floats): The wavelength values corresponding to
+          the first dimension of the data.
+        type (str): Type of fitting to be applied ('gaussian_space', 'lorentzian_space',
+        'gaussian_energy' or 'lorentzian_energy')
+        returns (model.ProgressiveFuture): Progress of the fitting, whose result() returns:
+             params (ndarray of shape (P, 3) + data.shape[1:]): for each of the
+               P peaks, the images of pos, width, amplitude (in space domain).
+               NaN where the fitting failed.
+             offset (ndarray of shape data.shape[1:]): global offset to add
+             type (str): the type of fitting
+        """
+        est_start = time.time() + 0.1
+        f = model.ProgressiveFuture(start=est_start,
+                                    end=est_start + self.estimateFitMapTime(data))
+        f._fit_state = RUNNING
+        f._fit_lock = threading.Lock()
+        f.task_canceller = self._CancelFit
+
+        return self._executor.submitf(f, self._DoFitMap, f, data, wavelength, type)
 
-            return peaks_params, params[-1], type
+    def _DoFitMap(self, future, data, wavelength, type='gaussian_space'):
+        """
+        Fits the peaks of every spectrum. See FitMap() for the arguments.
+        returns:
+             params (ndarray of shape (P, 3) + data.shape[1:])
+             offset (ndarray of shape data.shape[1:])
+             type (str)
+        raises:
+                KeyError if given type not available
+                ValueError if fitting cannot be applied
+        """
+        try:
+            wavelength = numpy.asarray(wavelength, dtype=float)
+            spectra = numpy.asarray(data).reshape(data.shape[0], -1)  # CN
+            nspec = spectra.shape[1]
+            is_energy = type in {'gaussian_energy', 'lorentzian_energy'}
+            lorentzian = type in {'lorentzian_space', 'lorentzian_energy'}
+
+            # Find the peaks on the average spectrum, to get initial parameters
+            mean_spec = spectra.mean(axis=1)
+            peaks, offset = self._fitSpectrum(future, mean_spec, wavelength, type)
+            logging.debug("Fitting %d peaks on %d spectra", len(peaks), nspec)
+
+            if is_energy:
+                x = apply_jacobian_x(wavelength)
+                offset_basis = WL_TO_ENERGY / x ** 2
+                peaks = [peak_to_energy(*p) for p in peaks]
+                mean_spec = apply_jacobian_y(wavelength, mean_spec)
+            else:
+                x = wavelength
+                offset_basis = numpy.ones_like(x)
+            # Work with a normalised x, for a better conditioning
+            x0, xs = x.mean(), numpy.ptp(x)
+            xn = (x - x0) / xs
+            init = []
+            for pos, width, amplitude in peaks:
+                init.extend([(pos - x0) / xs, width / xs, amplitude])
+            init.append(offset)
+            init = numpy.array(init)
+            mean_rng = numpy.ptp(mean_spec) or 1
+
+            params = numpy.empty((len(init), nspec))
+            chunk = max(1, MAP_FIT_CHUNK_SIZE // (len(x) * len(init)))
+            startt = time.time()
+            for i in range(0, nspec, chunk):
+                if future._fit_state == CANCELLED:
+                    raise CancelledError()
+                sub = spectra[:, i:i + chunk].T.astype(numpy.float64)  # NC
+                if is_energy:
+                    sub = apply_jacobian_y(wavelength, sub)
+                # Scale the initial amplitudes and offset to each spectrum
+                sub_params = numpy.tile(init, (sub.shape[0], 1))
+                ratio = numpy.ptp(sub, axis=1) / mean_rng
+                sub_params[:, 2::3] *= ratio[:, None]
+                sub_params[:, -1] *= ratio
+                cost = _FitCurvesLM(xn, sub, sub_params, offset_basis, lorentzian)
+                sub_params[~numpy.isfinite(cost)] = numpy.nan
+                params[:, i:i + chunk] = sub_params.T
+
+                done = i + sub.shape[0]
+                future.set_progress(end=time.time() + (time.time() - startt) * (nspec - done) / done)
+
+            # Back to the original units
+            pos = params[0:-1:3] * xs + x0
+            width = numpy.abs(params[1:-1:3]) * xs
+            amplitude = params[2:-1:3]
+            if is_energy:
+                pos, width, amplitude = peak_to_wavelength(pos, width, amplitude)
+            peaks_params = numpy.stack([pos, width, amplitude], axis=1)
+            peaks_params.shape = peaks_params.shape[:2] + data.shape[1:]
+            offset = params[-1].reshape(data.shape[1:])
+            return peaks_params, offset, type
         except CancelledError:
-            logging.debug("Fitting of type %s was cancelled.", type)
+            logging.debug("Map fitting of type %s was cancelled.", type)
         finally:
             with future._fit_lock:
                 if future._fit_state == CANCELLED:
@@ -372,6 +601,13 @@ class PeakFitter(object):
         # really rough estimation
         return len(data) * 10e-3  # s
 
+    def estimateFitMapTime(self, data):
+        """
+        Estimates fitting duration of a whole spectrum cube
+        """
+        # really rough estimation: the average spectrum + ~10µs per point
+        return self.estimateFitTime(data) + data.size * 10e-6  # s
+
 
 def peak_to_energy(pos, width, amplitude):
     """
@@ -29,11 +29,19 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import logging
+import numpy
 from numpy.polynomial import polynomial
 from odemis import model
 from builtins import range
 
 
+# Parameters of the spike removal
+SPIKE_MARGIN = 1  # number of pixels left and right of spike that are also corrected
+SPIKE_SPACING = 3  # distance (in px) above which spikes are considered to be two separate spikes
+SPIKE_CHUNK_SIZE = 4 * 1024 ** 2  # Max number of values processed simultaneously
+SPIKE_MAD_SAMPLES = 1024 ** 2  # Max number of values to estimate the global noise level
+
+
 def get_wavelength_per_pixel(da):
     """
     Computes the wavelength for each pixel along the C dimension
@@ -208,3 +216,128 @@ def coefficients_to_dataarray(coef):
     da.metadata[model.MD_WL_LIST] = wl_list
 
     return da
+
+
+def _get_diff_noise(diff, axis=None):
+    """
+    Estimates the standard deviation of the noise, based on the median absolute
+    deviation, which is robust to the spikes.
+    diff (ndarray of float): differences between consecutive pixels
+    axis (None or int): axis along which to compute the noise, None for all
+    returns (float or ndarray): standard deviation (scaled MAD)
+    """
+    med = numpy.median(diff, axis=axis, keepdims=True)
+    mad = numpy.median(numpy.abs(diff - med), axis=axis)
+    noise = 1.4826 * mad  # scale to match the standard deviation for a Gaussian noise
+    # With very low signal, most steps are 0, and so is the MAD. In such case,
+    # fallback to the (non-robust) standard deviation.
+    if numpy.any(noise == 0):
+        noise = numpy.where(noise == 0, numpy.std(diff, axis=axis), noise)
+    return noise
+
+
+def _remove_spikes_chunk(spec, threshold, noise=None):
+    """
+    Detects and corrects the spikes of a set of spectra, in place
+    spec (ndarray of shape CN): N spectra, which will be corrected
+    threshold (float): number of noise std above which a step is a spike
+    noise (None or float): global noise level, if None, it is estimated for
+      each spectrum independently
+    returns:
+       pixels corrected (int)
+       spikes corrected (int)
+    """
+    nc = spec.shape[0]
+    # Steps between consecutive pixels. float32 is enough, as the steps of
+    # 16-bit data are exactly represented.
+    diff = numpy.diff(spec.astype(numpy.float32), axis=0)
+    if noise is None:
+        noise = _get_diff_noise(diff, axis=0)
+    is_step = numpy.abs(diff) > threshold * noise
+
+    # Only one step that deviates is no spike
+    is_spiked = numpy.count_nonzero(is_step, axis=0) > 1
+    is_step &= is_spiked
+    if not is_spiked.any():
+        return 0, 0
+
+    # Group the steps which are close from each other into a single spike:
+    # every position between two steps closer than the spacing is part of it
+    idx = numpy.arange(nc - 1)[:, numpy.newaxis]
+    prev_step = numpy.maximum.accumulate(numpy.where(is_step, idx, -nc), axis=0)
+    next_step = numpy.minimum.accumulate(numpy.where(is_step, idx, 2 * nc)[::-1], axis=0)[::-1]
+    in_spike = (next_step - prev_step) <= SPIKE_SPACING
+    nspikes = int(numpy.count_nonzero(in_spike[0]) +
+                  numpy.count_nonzero(in_spike[1:] & ~in_spike[:-1]))
+
+    # A spike spanning the steps a -> b is replaced by a line from the pixel
+    # a - margin to the pixel b + margin, so the pixels a - margin + 1 -> b + margin - 1
+    # are corrected. The first and last pixels are always kept, as anchors.
+    to_fix = numpy.zeros(spec.shape, dtype=bool)
+    to_fix[:-1] = in_spike
+    for i in range(1, SPIKE_MARGIN):
+        to_fix[:-1 - i] |= in_spike[i:]
+        to_fix[i:-1] |= in_spike[:-i]
+    to_fix[0] = False
+    to_fix[-1] = False
+
+    # Linear interpolation between the closest kept pixels on each side
+    idx = numpy.arange(nc)[:, numpy.newaxis]
+    left = numpy.maximum.accumulate(numpy.where(to_fix, 0, idx), axis=0)
+    right = numpy.minimum.accumulate(numpy.where(to_fix, nc - 1, idx)[::-1], axis=0)[::-1]
+    fixc, fixn = numpy.nonzero(to_fix)
+    l, r = left[fixc, fixn], right[fixc, fixn]
+    vl = spec[l, fixn].astype(numpy.float64)
+    vr = spec[r, fixn].astype(numpy.float64)
+    val = vl + (vr - vl) * (fixc - l) / (r - l)
+    if spec.dtype.kind in "biu":
+        val = numpy.rint(val)
+    spec[fixc, fixn] = val
+
+    return int(numpy.count_nonzero(is_spiked)), nspikes
+
+
+def remove_spikes(data, threshold=8, local=False):
+    """
+    Detects and removes the spikes (typically caused by cosmic rays) in spectra.
+    A spike is detected when the step between two consecutive pixels of a
+    spectrum is larger than the noise level times the threshold. The noise
+    level is estimated from the median absolute deviation of these steps.
+    The spikes are then replaced by a linear interpolation between the pixels
+    on each side of the spike.
+    The data is processed by blocks of spectra, to limit the memory usage.
+    data (DataArray of shape C...): the spectra, along the first dimension
+      (eg, C11YX)
+    threshold (0 < float): sensitivity of the detection (the lower, the more sensitive)
+    local (bool): if True, the noise level is estimated independently for each
+      spectrum, otherwise, a single noise level is estimated for all the spectra.
+    returns:
+       corrected_data (DataArray of same shape and type as data)
+       pixels corrected (int): number of spectra with at least one spike corrected
+       spikes corrected (int): total number of spikes corrected
+    """
+    corrected = data.copy()
+    if data.shape[0] < 3:
+        logging.info("Cannot remove spikes in spectra of only %d pixels", data.shape[0])
+        return corrected, 0, 0
+
+    spec = corrected.reshape(data.shape[0], -1)  # CN, a view of the (contiguous) copy
+    nc, ns = spec.shape
+
+    noise = None
+    if not local:
+        # Estimate the noise on a subset of the spectra, regularly spread
+        step = max(1, (nc * ns) // SPIKE_MAD_SAMPLES)
+        diff = numpy.diff(spec[:, ::step].astype(numpy.float32), axis=0)
+        noise = _get_diff_noise(diff)
+        logging.debug("Estimated noise level of the spectra steps = %g", noise)
+
+    npixels, nspikes = 0, 0
+    chunk = max(1, SPIKE_CHUNK_SIZE // nc)
+    for i in range(0, ns, chunk):
+        p, s = _remove_spikes_chunk(spec[:, i:i + chunk], threshold, noise)
+        npixels += p
+        nspikes += s
+
+    logging.debug("Corrected %d spikes in %d spectra", nspikes, npixels)
+    return corrected, npixels, nspikes
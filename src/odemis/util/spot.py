@@ -28,6 +28,10 @@ from scipy.spatial import cKDTree as KDTree
 from scipy.spatial.distance import cdist
 from scipy.cluster.vq import kmeans
 
+# Methods to localize the center of a spot with sub-pixel accuracy
+LOC_RADIAL_SYMMETRY = "radial symmetry"
+LOC_GAUSSIAN = "gaussian"
+
 
 def _SubtractBackground(data, background=None):
     # We actually want to make really sure that only real signal is > 0.
@@ -213,6 +217,276 @@ def FindCenterCoordinates(image, smoothing=True):
     return xc, yc
 
 
+def _ExtractWindows(image, pos, shape):
+    """
+    Extract sub-images of the same shape from an image, as a single stack.
+    image (2D ndarray): the image
+    pos (ndarray of shape (N, 2) of ints): top-left corner (x, y) of each
+      sub-image. They must all be fully inside the image.
+    shape (int, int): shape (height, width) of the sub-images
+    returns (ndarray of shape (N,) + shape): copy of the sub-images
+    """
+    image = numpy.ascontiguousarray(image)
+    n, m = shape
+    # View of every possible sub-image, so that picking all the sub-images is
+    # a single fancy indexing (without copying the whole image N times).
+    wshape = (image.shape[0] - n + 1, image.shape[1] - m + 1, n, m)
+    windows = numpy.lib.stride_tricks.as_strided(image, wshape, image.strides * 2,
+                                                 writeable=False)
+    pos = numpy.asarray(pos, dtype=numpy.intp).reshape(-1, 2)
+    return windows[pos[:, 1], pos[:, 0]]
+
+
+def FindCentersCoordinates(images, smoothing=True):
+    """
+    Returns the radial symmetry center of each image of a stack, with sub-pixel
+    resolution. It gives the same result as calling FindCenterCoordinates() on
+    every image, but all the images are processed at once, which is much faster
+    when there are many small images.
+
+    Parameters
+    ----------
+    images : array_like of shape (N, n, m), or list of 2D array_like
+        The images of which to determine the radial symmetry center. If it's
+        a list, the images may have different shapes.
+    smoothing : boolean
+        Apply a smoothing kernel to the intensity gradient.
+
+    Returns
+    -------
+    pos : ndarray of shape (N, 2)
+        Position (x, y) of the radial symmetry center in px from the center
+        of each image.
+
+    """
+    if not isinstance(images, numpy.ndarray):
+        # Process together all the images with the same shape
+        images = [numpy.asarray(i) for i in images]
+        pos = numpy.empty((len(images), 2))
+        shapes = {}
+        for idx, im in enumerate(images):
+            shapes.setdefault(im.shape, []).append(idx)
+        for idxs in shapes.values():
+            pos[idxs] = FindCentersCoordinates(numpy.array([images[i] for i in idxs]), smoothing)
+        return pos
+
+    images = numpy.asarray(images, dtype=numpy.float64)
+    if images.ndim != 3:
+        raise ValueError("Expected a stack of images of shape (N, n, m), got %s" % (images.shape,))
+
+    # Compute lattice midpoints (ik, jk).
+    _, n, m = images.shape
+    jk, ik = numpy.meshgrid(numpy.arange(m - 1) + 0.5, numpy.arange(n - 1) + 0.5)
+
+    # Calculate the intensity gradient, as in FindCenterCoordinates(), but
+    # with slices, to process all the images at once.
+    tl = images[:, :-1, :-1]
+    tr = images[:, :-1, 1:]
+    bl = images[:, 1:, :-1]
+    br = images[:, 1:, 1:]
+    dIdi = (bl + br) - (tl + tr)
+    dIdj = (tr + br) - (tl + bl)
+    if smoothing:
+        dIdi = _MeanFilter3x3(dIdi)
+        dIdj = _MeanFilter3x3(dIdj)
+    dI2 = numpy.square(dIdi) + numpy.square(dIdj)
+
+    # Entries where the intensity gradient magnitude is zero are discarded, by
+    # giving them a null weight (instead of removing them, which would lead to
+    # a different number of entries per image).
+    valid = dI2 != 0
+    dI = numpy.sqrt(dI2)
+    dI[~valid] = 1
+    a = -dIdj / dI
+    b = dIdi / dI
+    c = a * ik + b * jk
+
+    # Weighting: weight by the square of the gradient magnitude and inverse
+    # distance to the centroid of the square of the gradient intensity
+    # magnitude.
+    sdI2 = dI2.sum(axis=(1, 2))
+    sdI2[sdI2 == 0] = 1  # Uniform image => no solution anyway
+    i0 = (dI2 * ik).sum(axis=(1, 2)) / sdI2
+    j0 = (dI2 * jk).sum(axis=(1, 2)) / sdI2
+    with numpy.errstate(divide='ignore'):
+        w2 = dI2 / numpy.hypot(ik - i0[:, None, None], jk - j0[:, None, None])
+    w2[~valid] = 0
+
+    # Solve the weighted linear least-squares problems, via the 2x2 normal
+    # equations of each image.
+    saa = (w2 * a * a).sum(axis=(1, 2))
+    sab = (w2 * a * b).sum(axis=(1, 2))
+    sbb = (w2 * b * b).sum(axis=(1, 2))
+    sac = (w2 * a * c).sum(axis=(1, 2))
+    sbc = (w2 * b * c).sum(axis=(1, 2))
+    det = saa * sbb - sab * sab
+    # Same criterion as the rcond of lstsq() in FindCenterCoordinates(), but
+    # on the normal matrix, so the tolerance is squared.
+    tol = (numpy.finfo(numpy.float64).eps * max(m, n)) ** 2 * numpy.maximum(saa, sbb) ** 2
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        ic = (sbb * sac - sab * sbc) / det
+        jc = (saa * sbc - sab * sac) / det
+    # The (rare) ill-conditioned ones are passed to lstsq(), which handles
+    # them in its own way.
+    for idx in numpy.flatnonzero(~(det > tol)):
+        xc, yc = FindCenterCoordinates(images[idx], smoothing)
+        ic[idx] = yc + 0.5 * float(n) - 0.5
+        jc[idx] = xc + 0.5 * float(m) - 0.5
+
+    # Convert from index (top-left) to (center) position information.
+    xc = jc - 0.5 * float(m) + 0.5
+    yc = ic - 0.5 * float(n) + 0.5
+
+    return numpy.column_stack((xc, yc))
+
+
+def _MeanFilter3x3(images):
+    """
+    Apply a 3x3 mean filter on each image of a stack, with symmetric boundary
+    conditions. Equivalent to convolve2d(image, ones((3, 3)) / 9,
+    boundary='symm', mode='same') on each image.
+    images (ndarray of shape (N, n, m))
+    returns (ndarray of shape (N, n, m))
+    """
+    padded = numpy.pad(images, ((0, 0), (1, 1), (1, 1)), mode='symmetric')
+    # Separable filter: first along the rows, then along the columns
+    rows = padded[:, :-2] + padded[:, 1:-1] + padded[:, 2:]
+    out = rows[:, :, :-2] + rows[:, :, 1:-1] + rows[:, :, 2:]
+    out /= 9
+    return out
+
+
+def FindGaussianCenters(images):
+    """
+    Returns the center of a Gaussian spot in each image of a stack, with
+    sub-pixel resolution. The center is estimated by fitting a Gaussian, along
+    each dimension, on the brightest pixel and its two neighbours. It is less
+    precise than the radial symmetry method, but faster, and works fine for
+    small spots.
+
+    Parameters
+    ----------
+    images : array_like of shape (N, n, m)
+        The images of which to determine the spot center. The images should
+        be at least 3x3 px, and the spot should not be on the border.
+
+    Returns
+    -------
+    pos : ndarray of shape (N, 2)
+        Position (x, y) of the spot center in px from the center of each image.
+
+    """
+    images = numpy.asarray(images, dtype=numpy.float64)
+    if images.ndim != 3:
+        raise ValueError("Expected a stack of images of shape (N, n, m), got %s" % (images.shape,))
+    N, n, m = images.shape
+
+    # Position of the brightest pixel, excluding the border so that it always
+    # has two neighbours.
+    inner = images[:, 1:-1, 1:-1].reshape(N, -1)
+    i, j = numpy.unravel_index(inner.argmax(axis=1), (n - 2, m - 2))
+    i += 1
+    j += 1
+
+    # The logarithm of a Gaussian is a parabola => fit it on 3 points.
+    # Clip to stay on positive values, as the background might be negative
+    # after filtering.
+    k = numpy.arange(N)
+    lim = numpy.finfo(numpy.float64).tiny
+    lc = numpy.log(numpy.maximum(images[k, i, j], lim))
+    lu = numpy.log(numpy.maximum(images[k, i - 1, j], lim))
+    ld = numpy.log(numpy.maximum(images[k, i + 1, j], lim))
+    ll = numpy.log(numpy.maximum(images[k, i, j - 1], lim))
+    lr = numpy.log(numpy.maximum(images[k, i, j + 1], lim))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        di = (lu - ld) / (2 * (lu - 2 * lc + ld))
+        dj = (ll - lr) / (2 * (ll - 2 * lc + lr))
+    # If the curvature is null (eg, flat image), stay on the brightest pixel
+    di = numpy.where(numpy.isfinite(di), di, 0)
+    dj = numpy.where(numpy.isfinite(dj), dj, 0)
+
+    xc = j + dj - 0.5 * (m - 1)
+    yc = i + di - 0.5 * (n - 1)
+    return numpy.column_stack((xc, yc))
+
+
+def RefineSpotPositions(image, pos, size, method=LOC_RADIAL_SYMMETRY):
+    """
+    Improve the estimation of the center of many spots in an image.
+    A sub-image of (size x size) px is taken around the spot and all the spots
+    are localized at once. If a spot is too close to the border of the image,
+    the sub-image is cropped so that the spot is still at its center.
+
+    Parameters
+    ----------
+    image : 2D array like
+        The image containing the spots.
+    pos : array like of shape (N, 2) of ints
+        The estimated (x, y) position of each spot, in px.
+    size : int
+        The size of the sub-image around each spot.
+    method : LOC_*
+        The localization method. LOC_RADIAL_SYMMETRY is the most precise.
+        LOC_GAUSSIAN is faster, but less precise.
+
+    Returns
+    -------
+    refined_position : array like
+        A 2D array of shape (N, 2) containing the refined (x, y) positions.
+
+    """
+    if method == LOC_RADIAL_SYMMETRY:
+        localize = FindCentersCoordinates
+    elif method == LOC_GAUSSIAN:
+        localize = FindGaussianCenters
+    else:
+        raise ValueError("Unknown localization method %s" % (method,))
+
+    pos = numpy.asarray(pos, dtype=numpy.intp).reshape(-1, 2)
+    refined_center = numpy.zeros(pos.shape, dtype=numpy.float64)
+    hw = size // 2
+    start = pos - hw
+    end = start + size
+    shape = numpy.array(image.shape[::-1])
+    inside = numpy.all((start >= 0) & (end <= shape), axis=1)
+
+    # All the sub-images fully inside the image have the same shape, so they
+    # can be processed at once.
+    if numpy.any(inside):
+        windows = _ExtractWindows(image, start[inside], (size, size))
+        refined_center[inside] = localize(windows)
+
+    # The ones on the border are cropped, and so each have a different shape.
+    for idx in numpy.flatnonzero(~inside):
+        (x_start, y_start), (x_end, y_end) = start[idx], end[idx]
+        x_max, y_max = shape
+        # Subtract the value of x/y_start from x/y_end to keep the spot in the
+        # center when x/y_start is set to 0. Add the difference between
+        # x/y_end and x/y_max to x/y_start to keep the spot in the center when
+        # x/y_end is set to x/y_max.
+        if x_start < 0:
+            x_end += x_start
+            x_start = 0
+        elif x_end > x_max:
+            x_start += x_end - x_max
+            x_end = x_max
+        if y_start < 0:
+            y_end += y_start
+            y_start = 0
+        elif y_end > y_max:
+            y_start += y_end - y_max
+            y_end = y_max
+        spot = image[y_start:y_end, x_start:x_end]
+        if min(spot.shape) >= 3:
+            refined_center[idx] = localize(spot[numpy.newaxis])[0]
+        elif method == LOC_RADIAL_SYMMETRY:
+            # Too small to process as a stack, keep the old behaviour
+            refined_center[idx] = FindCenterCoordinates(spot)
+        # else: too small to fit a Gaussian => keep the rough position
+
+    return pos + refined_center
+
+
 def _CreateSEDisk(r=3):
     """
     Create a flat disk-shaped structuring element with the specified radius r. The structuring element can be used
@@ -233,7 +507,7 @@ def _CreateSEDisk(r=3):
     return numpy.array(neighborhood).astype(numpy.uint8)
 
 
-def MaximaFind(image, qty, len_object=18):
+def MaximaFind(image, qty, len_object=18, method=LOC_RADIAL_SYMMETRY):
     """
     Find the center coordinates of maximum spots in an image.
 
@@ -245,6 +519,8 @@ def MaximaFind(image, qty, len_object=18):
         The amount of maxima you want to find.
     len_object : int
         A length in pixels somewhat larger than a typical spot.
+    method : LOC_*
+        The method to localize each spot with sub-pixel accuracy.
 
     Returns
     -------
@@ -279,32 +555,11 @@ def MaximaFind(image, qty, len_object=18):
     if numpy.any(numpy.isnan(pos)):
         pos = pos[numpy.any(~numpy.isnan(pos), axis=1)]
         logging.debug("Only %d maxima found, while expected %d", len(pos), qty)
-    # Improve center estimate using radial symmetry method.
+    # Improve center estimate using radial symmetry method, on all the spots
+    # at once.
     w = len_object // 2
-    refined_center = numpy.zeros_like(pos)
     pos = numpy.rint(pos).astype(numpy.int16)
-    y_max, x_max = image.shape
-    for idx, xy in enumerate(pos):
-        x_start, y_start = xy - w + 1
-        x_end, y_end = xy + w
-        # If the spot is near the edge of the image, crop so it is still in the center of the sub-image. Subtract the
-        # value of x/y_start from x/y_end to keep the spot in the center when x/y_start is set to 0. Add the difference
-        # between x/y_end and x/y_max to x/y_start to keep the spot in the center when x/y_end is set to x/y_max.
-        if x_start < 0:
-            x_end += x_start
-            x_start = 0
-        elif x_end > x_max:
-            x_start += x_end - x_max
-            x_end = x_max
-        if y_start < 0:
-            y_end += y_start
-            y_start = 0
-        elif y_end > y_max:
-            y_start += y_end - y_max
-            y_end = y_max
-        spot = filtered[y_start:y_end, x_start:x_end]
-        refined_center[idx] = numpy.array(FindCenterCoordinates(spot))
-    refined_position = pos + refined_center
+    refined_position = RefineSpotPositions(filtered, pos, 2 * w - 1, method)
     return refined_position
 
 
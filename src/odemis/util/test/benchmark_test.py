@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 19 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not,
+see http://www.gnu.org/licenses/.
+
+"""
+from __future__ import division
+
+import logging
+import numpy
+from odemis import model
+from odemis.util import benchmark
+import os
+import tempfile
+import time
+import unittest
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+
+class TestFrameRecorder(unittest.TestCase):
+
+    def test_stats(self):
+        rec = benchmark.FrameRecorder()
+        for i in range(10):
+            md = {model.MD_ACQ_DATE: time.time() - 0.1}
+            rec.add(model.DataArray(numpy.zeros((20, 10), dtype=numpy.uint16), md))
+        # No acquisition date => no latency, but still counted
+        rec.add(numpy.zeros((20, 10), dtype=numpy.uint16))
+        time.sleep(0.1)
+
+        stats = rec.get_stats()
+        self.assertEqual(stats["frames"], 11)
+        self.assertGreater(stats["fps"], 0)
+        self.assertAlmostEqual(stats["pixels_per_s"], stats["fps"] * 200)
+        lat = stats["latency"]
+        self.assertGreaterEqual(lat["p50"], 0.1)
+        self.assertLess(lat["max"], 1)
+        self.assertLessEqual(lat["p50"], lat["p90"])
+
+        rec.reset()
+        stats = rec.get_stats()
+        self.assertEqual(stats["frames"], 0)
+        self.assertNotIn("latency", stats)
+
+
+class TestProcessMonitor(unittest.TestCase):
+
+    def test_current_process(self):
+        if not os.path.exists("/proc/self/stat"):
+            self.skipTest("Process monitoring not supported on this OS")
+        monitor = benchmark.ProcessMonitor(pids=[os.getpid()], period=0.05)
+        monitor.start()
+        # Keep the CPU busy
+        end = time.time() + 0.5
+        while time.time() < end:
+            numpy.random.random((100, 100)).sum()
+        monitor.stop()
+
+        stats = monitor.get_stats()
+        self.assertGreater(stats["cpu"]["max"], 0)
+        self.assertGreater(stats["rss"]["mean"], 0)
+
+
+class TestReport(unittest.TestCase):
+
+    def _make_report(self, fps, latency, cpu):
+        results = {"df-ccd": {"frames": 10, "elapsed": 1, "fps": fps,
+                              "latency": {"p50": latency, "max": latency}}}
+        process = {"cpu": {"mean": cpu, "max": cpu}}
+        return benchmark.make_report(results, process, config="test.odm.yaml")
+
+    def test_compare(self):
+        ref = self._make_report(10, 0.1, 50)
+
+        # Same values => no regression
+        self.assertEqual(benchmark.compare_reports(ref, ref), [])
+
+        # Small changes => within the tolerance
+        new = self._make_report(9, 0.11, 55)
+        self.assertEqual(benchmark.compare_reports(new, ref, 0.2), [])
+
+        # Improvements => not a regression
+        new = self._make_report(20, 0.01, 10)
+        self.assertEqual(benchmark.compare_reports(new, ref, 0.2), [])
+
+        # Lower fps, higher latency and CPU => regressions
+        new = self._make_report(5, 0.2, 100)
+        regs = benchmark.compare_reports(new, ref, 0.2)
+        names = {r[0] for r in regs}
+        self.assertEqual(names, {"results/df-ccd/fps",
+                                 "results/df-ccd/latency/p50",
+                                 "results/df-ccd/latency/max",
+                                 "process/cpu/mean",
+                                 "process/cpu/max"})
+        self.assertIn(("results/df-ccd/fps", 10, 5), regs)
+
+    def test_read_write(self):
+        report = self._make_report(10, 0.1, 50)
+        fd, fn = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            benchmark.write_report(report, fn)
+            rreport = benchmark.read_report(fn)
+        finally:
+            os.remove(fn)
+        self.assertEqual(rreport, report)
+
+
+if __name__ == "__main__":
+    unittest.main()
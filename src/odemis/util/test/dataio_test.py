@@ -17,12 +17,15 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 from __future__ import division
 
+from concurrent.futures import CancelledError
 import numpy
 from odemis import model
 from odemis.acq import stream
-from odemis.dataio import tiff
+from odemis.dataio import tiff, hdf5
 from odemis.util.dataio import data_to_static_streams, open_acquisition, \
-    splitext
+    splitext, ExportService
+import os
+import threading
 import time
 import unittest
 
@@ -223,6 +226,94 @@ class TestDataIO(unittest.TestCase):
             self.assertEqual(ao, eo, "Unexpected output for '%s': %s" % (inp, ao))
 
 
+class SlowExporter(object):
+    """
+    Exporter which doesn't write anything, but blocks until it's released
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.exported = []
+
+    def export(self, filename, data, thumbnail=None):
+        self.release.wait(10)
+        self.exported.append(filename)
+
+
+class TestExportService(unittest.TestCase):
+
+    def setUp(self):
+        self.service = ExportService(max_workers=2)
+        self.filenames = []
+
+    def tearDown(self):
+        self.service.shutdown(wait=True)
+        for fn in self.filenames:
+            try:
+                os.remove(fn)
+            except Exception:
+                pass
+
+    def test_export(self):
+        """
+        Export several files simultaneously, and read them back
+        """
+        fs = []
+        exporters = (tiff, hdf5, tiff)
+        for i, exporter in enumerate(exporters):
+            fn = u"test-export-%d%s" % (i, exporter.EXTENSIONS[0])
+            self.filenames.append(fn)
+            data = [model.DataArray(numpy.full((512, 256), i, dtype=numpy.uint16),
+                                    {model.MD_DESCRIPTION: "test %d" % i})]
+            f = self.service.export(fn, data, exporter=exporter)
+            start, end = f.get_progress()
+            self.assertGreater(end, start)
+            fs.append(f)
+
+        self.assertTrue(self.service.wait(30))
+        self.assertEqual(self.service.pending, 0)
+        for i, (f, fn, exporter) in enumerate(zip(fs, self.filenames, exporters)):
+            self.assertEqual(f.result(), fn)
+            rdata = exporter.read_data(fn)
+            self.assertEqual(len(rdata), 1)
+            self.assertTrue(numpy.all(rdata[0] == i))
+
+    def test_cancel(self):
+        """
+        An export can be cancelled while it's queued, but not while it's running
+        """
+        exporter = SlowExporter()
+        data = [model.DataArray(numpy.zeros((10, 10), dtype=numpy.uint8))]
+        fs = [self.service.export("fake%d.h5" % i, data, exporter=exporter)
+              for i in range(3)]
+        time.sleep(0.1)  # Let the first ones start
+        self.assertEqual(self.service.pending, 3)
+        self.assertFalse(self.service.wait(0.1))
+
+        self.assertFalse(fs[0].cancel())
+        self.assertTrue(fs[2].cancel())
+        exporter.release.set()
+
+        self.assertEqual(fs[0].result(10), "fake0.h5")
+        self.assertEqual(fs[1].result(10), "fake1.h5")
+        with self.assertRaises(CancelledError):
+            fs[2].result()
+        self.assertEqual(sorted(exporter.exported), ["fake0.h5", "fake1.h5"])
+        self.assertTrue(self.service.wait(1))
+        self.assertEqual(self.service.pending, 0)
+
+    def test_error(self):
+        """
+        An exception during the export is passed to the future
+        """
+        fn = "/non-existing-dir/test.h5"
+        data = [model.DataArray(numpy.zeros((10, 10), dtype=numpy.uint8))]
+        f = self.service.export(fn, data, exporter=hdf5)
+        with self.assertRaises(Exception):
+            f.result(10)
+        self.assertTrue(self.service.wait(1))
+
+
 if __name__ == "__main__":
     unittest.main()
 
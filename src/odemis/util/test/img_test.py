@@ -22,6 +22,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division, print_function
 
 import logging
+import math
 import numpy
 from odemis import model
 from odemis.util import img, get_best_dtype_for_acc
@@ -312,6 +313,129 @@ class TestHistogram(unittest.TestCase):
         numpy.testing.assert_array_equal(hist, nchist)
 
 
+class TestHistogramAccumulator(unittest.TestCase):
+
+    def test_full(self):
+        """
+        Without sub-sampling, the result is the same as histogram()
+        """
+        depth = 4096
+        grey_img = numpy.random.randint(0, depth, size=(1024, 965)).astype(numpy.uint16)
+        acc = img.HistogramAccumulator((0, depth - 1))
+        hist, edges = acc.compute(grey_img)
+        hist_exp, edges_exp = img.histogram(grey_img, (0, depth - 1))
+        numpy.testing.assert_array_equal(hist, hist_exp)
+        self.assertEqual(edges, edges_exp)
+
+        # The buffer is reused
+        hist2, edges = acc.compute(grey_img[:512])
+        self.assertIs(hist2, hist)
+        self.assertEqual(hist2.sum(), 512 * 965)
+
+    def test_lines(self):
+        """
+        Updating line by line is the same as computing on the whole image
+        """
+        for dtype, irange in ((numpy.uint16, (0, 4095)), (numpy.float32, (0, 4095))):
+            shape = (1000, 801)
+            old_img = (numpy.random.random(shape) * 4000).astype(dtype)
+            new_img = (numpy.random.random(shape) * 4000).astype(dtype)
+
+            for max_pixels in (None, 10000):
+                acc = img.HistogramAccumulator(irange, max_pixels=max_pixels)
+                acc.compute(old_img)
+                # Replace the old image by the new one, by blocks of lines
+                for i in range(0, shape[0], 7):
+                    acc.update(new_img[i:i + 7], i, old=old_img[i:i + 7])
+
+                acc_exp = img.HistogramAccumulator(irange, max_pixels=max_pixels)
+                hist_exp, edges_exp = acc_exp.compute(new_img)
+                numpy.testing.assert_array_equal(acc.hist, hist_exp)
+                self.assertEqual(acc.edges, edges_exp)
+
+        # New frame, starting from an empty histogram
+        acc = img.HistogramAccumulator((0, 4095), shape=shape)
+        for i in range(0, shape[0], 100):
+            acc.update(new_img[i:i + 100].astype(numpy.uint16), i)
+        hist_exp, _ = img.histogram(new_img.astype(numpy.uint16), (0, 4095))
+        numpy.testing.assert_array_equal(acc.hist, hist_exp)
+
+    def test_out_of_range(self):
+        """
+        Values above the range are counted in the last bin, even in the first frame
+        """
+        irange = (0, 255)
+        shape = (100, 80)
+        first_img = numpy.random.randint(0, 256, size=shape).astype(numpy.uint16)
+        first_img[10, 20] = 300
+        second_img = numpy.random.randint(0, 256, size=shape).astype(numpy.uint16)
+
+        acc = img.HistogramAccumulator(irange)
+        hist, edges = acc.compute(first_img)
+        self.assertEqual(hist.size, 256)
+        self.assertEqual(edges, irange)
+        self.assertEqual(hist.sum(), first_img.size)
+        self.assertGreaterEqual(hist[-1], 1)
+
+        # Next frame, in range, fits in the same buffer
+        hist, edges = acc.compute(second_img)
+        hist_exp, edges_exp = img.histogram(second_img, irange)
+        numpy.testing.assert_array_equal(hist, hist_exp)
+        self.assertEqual(edges, edges_exp)
+
+        # Same thing, by blocks of lines
+        acc = img.HistogramAccumulator(irange)
+        acc.compute(first_img)
+        for i in range(0, shape[0], 7):
+            acc.update(second_img[i:i + 7], i, old=first_img[i:i + 7])
+        numpy.testing.assert_array_equal(acc.hist, hist_exp)
+
+    def test_subsample_accuracy(self):
+        """
+        Check the sub-sampled histogram stays within the documented bounds
+        """
+        depth = 2 ** 16
+        grey_img = numpy.random.normal(20000, 3000, size=(4096, 4096)).clip(0, depth - 1).astype(numpy.uint16)
+        hist_full, edges = img.histogram(grey_img, (0, depth - 1))
+
+        max_pixels = 2 ** 16
+        acc = img.HistogramAccumulator((0, depth - 1), max_pixels=max_pixels)
+        hist, edges_sub = acc.compute(grey_img)
+        self.assertEqual(edges_sub, edges)
+        n = hist.sum()
+        self.assertLessEqual(n, max_pixels)
+        self.assertGreater(n, max_pixels / 4)
+
+        # Dvoretzky–Kiefer–Wolfowitz bound, with a = 1e-6
+        bound = math.sqrt(math.log(2 / 1e-6) / (2 * n))
+        cdf_full = numpy.cumsum(hist_full) / hist_full.sum()
+        cdf = numpy.cumsum(hist) / n
+        self.assertLess(numpy.abs(cdf - cdf_full).max(), bound)
+
+        # The range for auto BC is approximately the same
+        irange_full = img.findOptimalRange(hist_full, edges, 1 / 256)
+        irange = img.findOptimalRange(hist, edges, 1 / 256)
+        numpy.testing.assert_allclose(irange, irange_full, rtol=0.02)
+
+    def test_speed(self):
+        depth = 2 ** 16
+        grey_img = numpy.random.randint(0, depth, size=(4096, 4096)).astype(numpy.uint16)
+        acc = img.HistogramAccumulator((0, depth - 1), max_pixels=2 ** 20)
+
+        tstart = time.time()
+        for i in range(5):
+            img.histogram(grey_img, (0, depth - 1))
+        dur_full = (time.time() - tstart) / 5
+
+        tstart = time.time()
+        for i in range(5):
+            acc.compute(grey_img)
+        dur_sub = (time.time() - tstart) / 5
+
+        logging.info("Sub-sampled histogram took %g s, while full took %g s", dur_sub, dur_full)
+        self.assertLess(dur_sub, dur_full)
+
+
 class TestDataArray2RGB(unittest.TestCase):
     @staticmethod
     def CountValues(array):
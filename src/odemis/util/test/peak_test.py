@@ -21,6 +21,7 @@ import numpy
 from odemis.dataio import hdf5
 from odemis.util import peak
 import os
+import time
 import unittest
 import matplotlib.pyplot as plt
 
@@ -132,6 +133,52 @@ class TestPeak(unittest.TestCase):
         # Assert wrong fitting type
         self.assertRaises(KeyError, peak.Curve, wl, params, offset, type='wrongType')
 
+    def test_peakfitting_map_synthetic(self):
+        """
+        Fit a map of spectra with one peak, moving across the map
+        """
+        wl = numpy.linspace(400e-9, 700e-9, 300)
+        shape = (20, 30)
+        pos = 550e-9 + 20e-9 * numpy.sin(numpy.arange(shape[1]) / 10) * numpy.ones(shape)
+        amp = 1000 + 500 * numpy.arange(shape[0])[:, None] / shape[0] * numpy.ones(shape)
+        for ptype, func in (("gaussian_space", peak.GaussianFit),
+                            ("lorentzian_space", peak.LorentzianFit)):
+            data = numpy.empty((len(wl),) + shape)
+            for y in range(shape[0]):
+                for x in range(shape[1]):
+                    data[:, y, x] = func(wl, pos[y, x], 15e-9, amp[y, x], 100)
+            data += numpy.random.normal(0, 10, data.shape)
+            data = data.astype(numpy.uint16)
+
+            f = self._peak_fitter.FitMap(data, wl, type=ptype)
+            params, offset, curve_type = f.result()
+            self.assertEqual(curve_type, ptype)
+            self.assertEqual(params.shape, (1, 3) + shape)
+            self.assertEqual(offset.shape, shape)
+            numpy.testing.assert_allclose(params[0, 0], pos, atol=1e-9)
+            numpy.testing.assert_allclose(params[0, 1], 15e-9, rtol=0.05)
+            numpy.testing.assert_allclose(params[0, 2], amp, rtol=0.05)
+
+    def test_peakfitting_map(self):
+        data = self.data[:, 15:25, 15:30]
+        wl = self.wl_in_meters
+        for ptype in ("gaussian_energy", "lorentzian_space"):
+            f = self._peak_fitter.FitMap(data, wl, type=ptype)
+            params, offset, curve_type = f.result()
+            self.assertTrue(1 <= params.shape[0] < 20)
+            self.assertEqual(params.shape[1:], (3,) + data.shape[1:])
+            self.assertEqual(offset.shape, data.shape[1:])
+            # Most of the spectra should have been fitted
+            self.assertGreater(numpy.isfinite(params[0, 0]).mean(), 0.9)
+
+    def test_peakfitting_map_cancel(self):
+        data = numpy.random.randint(0, 100, (167, 500, 500)).astype(numpy.uint16)
+        data[80] += 1000
+        f = self._peak_fitter.FitMap(data, self.wl_in_meters, type='gaussian_space')
+        time.sleep(0.1)
+        self.assertTrue(f.cancel())
+        self.assertTrue(f.cancelled())
+
 
 if __name__ == "__main__":
     unittest.main()
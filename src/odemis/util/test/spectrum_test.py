@@ -87,5 +87,68 @@ class TestCoefToDA(unittest.TestCase):
         numpy.testing.assert_equal(da[:, 0, 0, 0, 0], dcalib)
         numpy.testing.assert_equal(da.metadata[model.MD_WL_LIST], wl_calib * 1e-9)
 
+
+class TestRemoveSpikes(unittest.TestCase):
+
+    def setUp(self):
+        # A spectrum cube with a smooth spectrum + noise, and a few spikes
+        numpy.random.seed(0)
+        shape = (256, 1, 1, 30, 40)
+        wl = numpy.arange(shape[0])
+        spec = 1000 + 500 * numpy.exp(-(wl - 100) ** 2 / (2 * 30 ** 2))
+        self.clean = spec[:, None, None, None, None] + numpy.random.normal(0, 10, shape)
+        self.spikes = [(50, 3, 4, 1), (51, 7, 12, 2), (200, 20, 30, 1), (1, 2, 2, 1), (253, 5, 5, 2)]
+        data = self.clean.copy()
+        for c, y, x, w in self.spikes:
+            data[c:c + w, 0, 0, y, x] += 3000
+        self.data = model.DataArray(data.astype(numpy.uint16), {model.MD_DESCRIPTION: "test"})
+
+    def test_global(self):
+        res, npixels, nspikes = spectrum.remove_spikes(self.data, 8)
+        self.assertEqual(res.shape, self.data.shape)
+        self.assertEqual(res.dtype, self.data.dtype)
+        self.assertEqual(res.metadata, self.data.metadata)
+        self.assertEqual(npixels, len(self.spikes))
+        self.assertEqual(nspikes, len(self.spikes))
+        # Original data is not modified
+        self.assertGreater(self.data.max(), 3000)
+        self.assertLess(res.max(), 2000)
+
+        # Spectra without spike are untouched
+        for c, y, x, w in self.spikes:
+            self.data[:, 0, 0, y, x] = res[:, 0, 0, y, x]
+        numpy.testing.assert_array_equal(res, self.data)
+
+    def test_local(self):
+        res, npixels, nspikes = spectrum.remove_spikes(self.data, 8, local=True)
+        self.assertEqual(npixels, len(self.spikes))
+        self.assertEqual(nspikes, len(self.spikes))
+        self.assertLess(res.max(), 2000)
+
+    def test_chunks(self):
+        """
+        The result shouldn't depend on the size of the blocks processed
+        """
+        exp_res, exp_npixels, exp_nspikes = spectrum.remove_spikes(self.data, 8)
+        orig_chunk = spectrum.SPIKE_CHUNK_SIZE
+        try:
+            spectrum.SPIKE_CHUNK_SIZE = self.data.shape[0] * 7
+            res, npixels, nspikes = spectrum.remove_spikes(self.data, 8)
+        finally:
+            spectrum.SPIKE_CHUNK_SIZE = orig_chunk
+        numpy.testing.assert_array_equal(res, exp_res)
+        self.assertEqual((npixels, nspikes), (exp_npixels, exp_nspikes))
+
+    def test_speed(self):
+        data = numpy.random.randint(1000, 1100, (1024, 1, 1, 128, 128)).astype(numpy.uint16)
+        data[500, 0, 0, 64, 64] = 10000
+        startt = time.time()
+        res, npixels, nspikes = spectrum.remove_spikes(data, 8)
+        dur = time.time() - startt
+        logging.info("Spike removal on %s took %g s", data.shape, dur)
+        self.assertEqual(npixels, 1)
+        self.assertLess(dur, 10)
+
+
 if __name__ == "__main__":
     unittest.main()
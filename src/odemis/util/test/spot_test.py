@@ -16,6 +16,7 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 from __future__ import division
 
+import logging
 import math
 import numpy
 from odemis import model
@@ -23,6 +24,7 @@ from odemis.dataio import tiff, hdf5
 from odemis.util import spot
 import os
 import scipy.stats
+import time
 import unittest
 
 
@@ -218,5 +220,141 @@ class TestFindCenterCoordinates(unittest.TestCase):
                         self.assertAlmostEqual(i, yc + 0.5 * (n - 1))
 
 
+def _gridImage(n, pitch=20, sigma=2, seed=0):
+    """
+    Generate an image with a grid of n x n Gaussian spots, each slightly
+    shifted by a random sub-pixel offset.
+    returns (ndarray, ndarray of shape (n * n, 2)): image, and (x, y) spot positions
+    """
+    rng = numpy.random.RandomState(seed)
+    size = n * pitch
+    img = numpy.zeros((size, size))
+    yy, xx = numpy.mgrid[:pitch, :pitch]
+    pos = []
+    for i in range(n):
+        for j in range(n):
+            dx, dy = rng.uniform(-1, 1, 2)
+            cx, cy = (pitch - 1) / 2 + dx, (pitch - 1) / 2 + dy
+            img[i * pitch:(i + 1) * pitch, j * pitch:(j + 1) * pitch] = \
+                100 * numpy.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (2 * sigma ** 2))
+            pos.append((j * pitch + cx, i * pitch + cy))
+    img += rng.normal(0, 1, img.shape)
+    return img, numpy.array(pos)
+
+
+class TestFindCentersCoordinates(unittest.TestCase):
+    """
+    Test the batch localization of spots: FindCentersCoordinates,
+    FindGaussianCenters and RefineSpotPositions.
+    """
+
+    def test_same_as_single(self):
+        """
+        FindCentersCoordinates should give the same result as
+        FindCenterCoordinates on every image.
+        """
+        imgdata = tiff.read_data(os.path.join(TEST_IMAGE_PATH, 'spotdata.tif'))
+        images = numpy.array(imgdata)
+        expected = numpy.array([spot.FindCenterCoordinates(i) for i in images])
+        coords = spot.FindCentersCoordinates(images)
+        numpy.testing.assert_almost_equal(coords, expected)
+
+        # Without smoothing, and with images of different shapes
+        images = [numpy.random.random((s, s)) for s in (5, 9, 5, 7, 9)]
+        expected = numpy.array([spot.FindCenterCoordinates(i, smoothing=False) for i in images])
+        coords = spot.FindCentersCoordinates(images, smoothing=False)
+        numpy.testing.assert_almost_equal(coords, expected)
+
+    def test_sanity(self):
+        """
+        A single pixel with value one should be found at its position, by both
+        methods.
+        """
+        images = numpy.zeros((9, 7, 9))
+        expected = []
+        for k, (i, j) in enumerate((i, j) for i in range(2, 5) for j in range(2, 7, 2)):
+            images[k, i, j] = 1
+            expected.append((j - 4, i - 3))
+        numpy.testing.assert_almost_equal(spot.FindCentersCoordinates(images), expected)
+        numpy.testing.assert_almost_equal(spot.FindGaussianCenters(images), expected)
+
+    def test_refine(self):
+        """
+        RefineSpotPositions should give the same result as localizing every
+        spot separately, including on the border of the image.
+        """
+        img, pos = _gridImage(8)
+        pos -= 8  # Spots on the top and left border
+        img = img[8:, 8:]
+        filtered = spot.BandPassFilter(img, 1, 18)
+        rough = numpy.rint(pos).astype(int)
+        refined = spot.RefineSpotPositions(filtered, rough, 17)
+
+        for p, r in zip(rough, refined):
+            x_start, y_start = numpy.maximum(p - 8, 0)
+            x_end, y_end = p + 9
+            # Crop symmetrically on the border, as RefineSpotPositions does
+            x_end -= numpy.maximum(8 - p[0], 0)
+            y_end -= numpy.maximum(8 - p[1], 0)
+            x_end = min(x_end, img.shape[1])
+            y_end = min(y_end, img.shape[0])
+            if p[0] + 9 > img.shape[1]:
+                x_start = 2 * p[0] + 1 - img.shape[1]
+            if p[1] + 9 > img.shape[0]:
+                y_start = 2 * p[1] + 1 - img.shape[0]
+            exp = p + spot.FindCenterCoordinates(filtered[y_start:y_end, x_start:x_end])
+            numpy.testing.assert_almost_equal(r, exp)
+
+        # Spots fully in the image should be found precisely
+        inside = numpy.all(rough >= 8, axis=1)
+        for method in (spot.LOC_RADIAL_SYMMETRY, spot.LOC_GAUSSIAN):
+            refined = spot.RefineSpotPositions(filtered, rough, 17, method)
+            numpy.testing.assert_allclose(refined[inside], pos[inside], atol=0.2)
+
+        with self.assertRaises(ValueError):
+            spot.RefineSpotPositions(filtered, rough, 17, "foo")
+
+    def test_maxima_find(self):
+        """
+        MaximaFind should find all the spots of a grid, precisely.
+        """
+        img, pos = _gridImage(8)
+        for method in (spot.LOC_RADIAL_SYMMETRY, spot.LOC_GAUSSIAN):
+            found = spot.MaximaFind(img, len(pos), method=method)
+            self.assertEqual(len(found), len(pos))
+            # Match each spot found to the closest expected spot
+            dist = numpy.hypot(*(found[:, numpy.newaxis] - pos[numpy.newaxis]).T)
+            self.assertLess(dist.min(axis=1).max(), 0.2)
+
+    def test_speed(self):
+        """
+        Compare the speed of the batch localization with the localization of
+        every spot separately.
+        """
+        for n in (8, 64):  # 64 and 4096 spots
+            img, pos = _gridImage(n)
+            filtered = spot.BandPassFilter(img, 1, 18)
+            rough = numpy.rint(pos).astype(int)
+
+            startt = time.time()
+            for p in rough:
+                x, y = p
+                spot.FindCenterCoordinates(filtered[y - 8:y + 9, x - 8:x + 9])
+            dur_single = time.time() - startt
+
+            startt = time.time()
+            spot.RefineSpotPositions(filtered, rough, 17)
+            dur_batch = time.time() - startt
+
+            startt = time.time()
+            spot.RefineSpotPositions(filtered, rough, 17, spot.LOC_GAUSSIAN)
+            dur_gauss = time.time() - startt
+
+            logging.info("Localizing %d spots took %g s one by one, %g s in batch, %g s with Gaussian",
+                         len(rough), dur_single, dur_batch, dur_gauss)
+            if n >= 64:
+                self.assertLess(dur_batch, dur_single)
+
+
 if __name__ == "__main__":
     unittest.main()